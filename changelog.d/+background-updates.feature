@@ -0,0 +1 @@
+Run data migrations as resumable background updates rather than at startup.
@@ -0,0 +1 @@
+Periodically delete global associations that have been superseded by newer ones.
@@ -0,0 +1 @@
+Serve lookups from a table of the current mapping for each 3PID, populated by a background update after upgrading.
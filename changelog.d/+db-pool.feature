@@ -0,0 +1 @@
+Run slow read-only queries on a database thread pool rather than the main thread, sized by the new `db.pool.size` option.
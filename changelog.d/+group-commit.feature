@@ -0,0 +1 @@
+Add the `db.group_commit` option, which commits writes made in the same reactor turn together.
@@ -0,0 +1 @@
+Add the `db.lookup_bloom_filter` option to answer lookups of 3PIDs which aren't bound without querying the database.
@@ -0,0 +1 @@
+Add the `db.lookup_cache.size` option to cache lookup results in memory.
@@ -0,0 +1 @@
+Add the `db.lookup_hash_index` option to answer hashed lookups from memory.
@@ -0,0 +1 @@
+Add a `lookup_only` mode, in which Sydent serves lookups from the associations pushed to it by its peers and refuses every endpoint that would write to its database.
@@ -0,0 +1 @@
+Add the `clientapi.http.lookup_response_cache.size` option to cache signed v1 lookup responses in memory.
@@ -0,0 +1 @@
+Add the `db.lookup_snapshot.path` and `db.lookup_snapshot.interval` options to serve hashed lookups from a memory-mapped snapshot file.
@@ -0,0 +1 @@
+Pick up changes to the replication peers without a restart, within 10 seconds or straight away on `SIGHUP`.
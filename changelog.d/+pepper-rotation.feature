@@ -0,0 +1 @@
+Add an internal API to rotate the lookup pepper online, rehashing stored associations in the background.
@@ -0,0 +1 @@
+Pipeline pushes to replication peers with the new `replication.https.push_window` and `replication.https.max_push_size` options, adapt the size of pushes to how quickly peers acknowledge them, and honour `Retry-After` from peers.
@@ -0,0 +1 @@
+Add support for storing data in PostgreSQL, selected with `db.engine = postgres` and the `db.postgres.*` options, and a `scripts.port_db` script to copy an existing SQLite database to it.
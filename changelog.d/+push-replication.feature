@@ -0,0 +1 @@
+Push new associations to replication peers as they are made, until each peer has caught up.
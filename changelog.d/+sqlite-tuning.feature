@@ -0,0 +1 @@
+Add the `db.journal_mode`, `db.synchronous`, `db.cache_size` and `db.mmap_size` options to tune SQLite, and serve lookups from a separate pool of read-only connections, sized by the new `db.lookup_pool.size` option.
@@ -0,0 +1 @@
+Stream large bulk lookup responses rather than building them in memory.
@@ -0,0 +1 @@
+Add the `clientapi.http.workers` option to serve the client API from several worker processes.
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+"""Compare the ways bulk lookups can match a batch of addresses or hashes against the
+database, for batches of various sizes:
+
+* temp_table: inserting the batch into a temporary table and joining on it (the
+  approach used before bulk lookups stopped running DDL);
+* in_list: `IN (?, ?, ...)` lists of up to IN_LIST_CHUNK_SIZE values;
+* array: a single query taking the whole batch as one JSON array parameter.
+
+Uses (and if needed fills) the same kind of SQLite database as benchmark_lookups.py.
+"""
+
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+from benchmark_lookups import FakeSydent, fill_database, make_lookup_hash
+
+from sydent.config import SydentConfig
+from sydent.db.engines import Sqlite3Engine
+from sydent.db.threepid_associations import GlobalAssociationStore
+from sydent.db.transaction import Cursor, TransactionalConnection
+from sydent.util import time_msec
+
+logger = logging.getLogger("benchmark_bulk_lookups")
+
+BATCH_SIZES = (1, 100, 10000, 100000)
+
+
+def retrieve_mxids_for_hashes_temp_table(
+    cur: Cursor, hashes: List[str]
+) -> Dict[str, str]:
+    """Hash lookups as they were done with a temporary table."""
+    cur.execute("CREATE TEMPORARY TABLE tmp_hashes (lookup_hash VARCHAR)")
+    cur.execute("CREATE INDEX tmp_hashes_lookup_hash ON tmp_hashes(lookup_hash)")
+    try:
+        for i in range(0, len(hashes), 500):
+            cur.executemany(
+                "INSERT INTO tmp_hashes(lookup_hash) VALUES (?)",
+                [(h,) for h in hashes[i : i + 500]],
+            )
+        res = cur.execute(
+            "SELECT gta.lookup_hash, gta.mxid FROM global_threepid_associations gta "
+            "JOIN tmp_hashes ON gta.lookup_hash = tmp_hashes.lookup_hash "
+            "WHERE gta.notBefore < ? AND gta.notAfter > ? "
+            "ORDER BY gta.lookup_hash, gta.mxid, gta.ts",
+            (time_msec(), time_msec()),
+        )
+        return dict(res.fetchall())
+    finally:
+        cur.execute("DROP TABLE tmp_hashes")
+
+
+def time_approach(
+    db: TransactionalConnection,
+    func: Callable[[Cursor, List[str]], Dict[str, str]],
+    batch: List[str],
+    repeats: int,
+) -> Tuple[float, int]:
+    """Look up the given batch of hashes several times.
+
+    :return: The fastest time taken, in seconds, and the number of matches found.
+    """
+    best = float("inf")
+    matches = 0
+    for _ in range(repeats):
+        cur = db.cursor()
+        start = time.perf_counter()
+        matches = len(func(cur, batch))
+        best = min(best, time.perf_counter() - start)
+        cur.close()
+        db.commit()
+    return best, matches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark bulk lookup strategies")
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=2000000,
+        help="number of associations in the database (default: 2000000)",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=5,
+        help="number of times to run each lookup, keeping the fastest (default: 5)",
+    )
+    parser.add_argument(
+        "--database",
+        help="path to the SQLite database to use, which is created and filled in if "
+        "it doesn't exist (default: a temporary file)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.database or os.path.join(tmpdir, "sydent.db")
+        exists = os.path.exists(path)
+
+        config = SydentConfig()
+        config.parse_config_dict({"db": {"db.file": path}})
+        engine = Sqlite3Engine(config.database)
+        db = engine.connect()
+        engine.prepare_database(db)
+
+        if not exists:
+            logger.info("Inserting %d associations", args.rows)
+            fill_database(db, args.rows)
+
+        store = GlobalAssociationStore(FakeSydent(engine))  # type: ignore[arg-type]
+
+        def in_list(cur: Cursor, hashes: List[str]) -> Dict[str, str]:
+            engine.IN_LIST_MAX_SIZE = len(hashes)
+            return store._retrieveMxidsForHashesTxn(cur, hashes)
+
+        def array(cur: Cursor, hashes: List[str]) -> Dict[str, str]:
+            engine.IN_LIST_MAX_SIZE = 0
+            return store._retrieveMxidsForHashesTxn(cur, hashes)
+
+        approaches = [
+            ("temp_table", retrieve_mxids_for_hashes_temp_table),
+            ("in_list", in_list),
+            ("array", array),
+        ]
+
+        rng = random.Random(0)
+        print("%10s" % ("batch",) + "".join("%14s" % (a,) for a, _ in approaches))
+        for batch_size in BATCH_SIZES:
+            # Half of the hashes are bound.
+            batch = [
+                make_lookup_hash(rng.randrange(2 * args.rows))
+                for _ in range(batch_size)
+            ]
+            timings = [
+                time_approach(db, func, batch, args.repeats) for _, func in approaches
+            ]
+            if len({matches for _, matches in timings}) != 1:
+                raise RuntimeError("The approaches returned different results")
+            print(
+                "%10d" % (batch_size,)
+                + "".join("%11.2f ms" % (duration * 1000,) for duration, _ in timings)
+            )
+
+        db.close()
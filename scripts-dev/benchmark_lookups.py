@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+"""Compare the speed of bulk lookups as they're currently done with that of previous
+versions of the query:
+
+* lower(address): joining the history of associations on lower(address), through a
+  temporary table;
+* history: matching the stored normalised_address column of the history of
+  associations, and picking the newest valid association for each 3PID;
+* current: GlobalAssociationStore's current implementation.
+
+Fills a SQLite database with the given number of associations, then times bulk
+lookups of random addresses (half of which are bound) with each query.
+"""
+
+import argparse
+import functools
+import logging
+import os
+import random
+import tempfile
+import time
+from typing import Callable, List, Tuple
+
+from sydent.config import SydentConfig
+from sydent.db.engines import BaseDatabaseEngine, Sqlite3Engine
+from sydent.db.threepid_associations import GlobalAssociationStore
+from sydent.db.transaction import Cursor, TransactionalConnection
+from sydent.db.updates import populate_current_mappings
+from sydent.util import time_msec
+from sydent.util.hash import sha256_and_url_safe_base64
+from sydent.util.stringutils import normalise_address_for_lookup
+
+logger = logging.getLogger("benchmark_lookups")
+
+FAR_FUTURE = 2**62
+
+
+def make_address(i: int) -> str:
+    return "User.%d@Example%d.com" % (i, i % 1000)
+
+
+def make_lookup_hash(i: int) -> str:
+    return sha256_and_url_safe_base64("%s email pepper" % (make_address(i).lower(),))
+
+
+def fill_database(db: TransactionalConnection, rows: int, versions: int = 1) -> None:
+    """Insert the given number of associations into the database, with the given
+    number of successive associations for each 3PID, so 3PID i is bound to
+    @user<i>:example.com by its newest association.
+    """
+    cur = db.cursor()
+    batch_size = 10000
+    for start in range(0, rows, batch_size):
+        batch = []
+        for j in range(start, min(start + batch_size, rows)):
+            i = j // versions
+            address = make_address(i)
+            newest = j % versions == versions - 1
+            batch.append(
+                (
+                    "email",
+                    address,
+                    normalise_address_for_lookup(address),
+                    make_lookup_hash(i),
+                    "@user%d:example.com" % (i,) if newest else "@old:example.com",
+                    j,
+                    0,
+                    FAR_FUTURE,
+                    "example.com",
+                    j,
+                    "{}",
+                )
+            )
+        cur.executemany(
+            "INSERT INTO global_threepid_associations (medium, address, "
+            "normalised_address, lookup_hash, mxid, ts, notBefore, notAfter, "
+            "originServer, originId, sgAssoc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            batch,
+        )
+    populate_current_mappings(db)
+    db.commit()
+
+    # The index used by the previous queries, which new databases keep until their
+    # background updates have run.
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS global_threepid_medium_lower_address "
+        "ON global_threepid_associations (medium, lower(address))"
+    )
+    db.execute("ANALYZE")
+    db.commit()
+
+
+def get_mxids_lower(
+    cur: Cursor, threepid_tuples: List[Tuple[str, str]]
+) -> List[Tuple[str, str, str]]:
+    """The bulk lookup query as it was before the normalised_address column."""
+    cur.execute(
+        "CREATE TEMPORARY TABLE tmp_getmxids (medium VARCHAR(16), address VARCHAR(256))"
+    )
+    cur.execute(
+        "CREATE INDEX tmp_getmxids_medium_lower_address "
+        "ON tmp_getmxids (medium, lower(address))"
+    )
+    try:
+        cur.executemany(
+            "INSERT INTO tmp_getmxids (medium, address) VALUES (?, ?)",
+            threepid_tuples,
+        )
+        res = cur.execute(
+            "SELECT gte.medium, gte.address, gte.ts, gte.mxid "
+            "FROM global_threepid_associations gte "
+            "JOIN tmp_getmxids ON gte.medium = tmp_getmxids.medium "
+            "AND lower(gte.address) = lower(tmp_getmxids.address) "
+            "WHERE gte.notBefore < ? AND gte.notAfter > ? "
+            "ORDER BY gte.medium, gte.address, gte.ts DESC",
+            (time_msec(), time_msec()),
+        )
+        results = []
+        current = None
+        for row in res.fetchall():
+            # only use the most recent entry for each threepid
+            if (row[0], row[1]) == current:
+                continue
+            current = (row[0], row[1])
+            results.append((row[0], row[1], row[3]))
+        return results
+    finally:
+        cur.execute("DROP TABLE tmp_getmxids")
+
+
+class FakeSydent:
+    """Just enough of a Sydent for GlobalAssociationStore's transaction functions."""
+
+    def __init__(self, engine: BaseDatabaseEngine) -> None:
+        self.db_engine = engine
+
+
+def get_mxids_history(
+    engine: BaseDatabaseEngine, cur: Cursor, threepid_tuples: List[Tuple[str, str]]
+) -> List[Tuple[str, str, str]]:
+    """The bulk lookup query as it was before the current mappings table."""
+    addresses = sorted({normalise_address_for_lookup(a) for _, a in threepid_tuples})
+    rows = []
+    for clause, args in engine.in_clauses("normalised_address", addresses):
+        cur.execute(
+            "SELECT medium, address, ts, mxid FROM global_threepid_associations "
+            "WHERE medium = 'email' AND %s AND notBefore < ? AND notAfter > ?"
+            % (clause,),
+            [*args, time_msec(), time_msec()],
+        )
+        rows.extend(cur.fetchall())
+    rows.sort(key=lambda row: (row[0], row[1], -row[2]))
+    results = []
+    current = None
+    for row in rows:
+        if (row[0], row[1]) == current:
+            continue
+        current = (row[0], row[1])
+        results.append((row[0], row[1], row[3]))
+    return results
+
+
+def time_lookups(
+    db: TransactionalConnection,
+    func: Callable[[Cursor, List[Tuple[str, str]]], List[Tuple[str, str, str]]],
+    batches: List[List[Tuple[str, str]]],
+) -> Tuple[float, int]:
+    """Run the given lookup function on each batch of 3PIDs.
+
+    :return: The average time taken per batch, in seconds, and the total number of
+        matches found.
+    """
+    matches = 0
+    start = time.perf_counter()
+    for batch in batches:
+        cur = db.cursor()
+        matches += len(func(cur, batch))
+        cur.close()
+    return (time.perf_counter() - start) / len(batches), matches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark bulk lookups")
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=2000000,
+        help="number of associations in the database (default: 2000000)",
+    )
+    parser.add_argument(
+        "--versions",
+        type=int,
+        default=1,
+        help="number of successive associations for each 3PID, e.g. because it was "
+        "rebound (default: 1)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="number of 3PIDs looked up per request (default: 1000)",
+    )
+    parser.add_argument(
+        "--batches",
+        type=int,
+        default=20,
+        help="number of lookup requests to time (default: 20)",
+    )
+    parser.add_argument(
+        "--database",
+        help="path to the SQLite database to use, which is created and filled in if "
+        "it doesn't exist (default: a temporary file)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.database or os.path.join(tmpdir, "sydent.db")
+        exists = os.path.exists(path)
+
+        config = SydentConfig()
+        config.parse_config_dict({"db": {"db.file": path}})
+        engine = Sqlite3Engine(config.database)
+        db = engine.connect()
+        engine.prepare_database(db)
+
+        if not exists:
+            logger.info("Inserting %d associations", args.rows)
+            fill_database(db, args.rows, args.versions)
+
+        rng = random.Random(0)
+        batches = [
+            [
+                # Look up the address in a different case to how it was stored.
+                (
+                    "email",
+                    make_address(rng.randrange(2 * args.rows // args.versions)).lower(),
+                )
+                for _ in range(args.batch_size)
+            ]
+            for _ in range(args.batches)
+        ]
+
+        store = GlobalAssociationStore(FakeSydent(engine))  # type: ignore[arg-type]
+        results = [
+            (
+                "lower(address)",
+                time_lookups(db, get_mxids_lower, batches),
+            ),
+            (
+                "history",
+                time_lookups(db, functools.partial(get_mxids_history, engine), batches),
+            ),
+            (
+                "current",
+                time_lookups(db, store._getMxidsTxn, batches),
+            ),
+        ]
+
+        for name, (duration, matches) in results:
+            print(
+                "%-20s %8.1f ms per lookup of %d 3PIDs (%d matches)"
+                % (name, duration * 1000, args.batch_size, matches)
+            )
+
+        db.close()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+"""Time the ingestion of replication pushes.
+
+Signs the given number of associations as a fake peer, splits them into full-sized
+pushes (replication.https.max_push_size associations each), then times
+ReplicationPushServlet handling each of them against a SQLite database.
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from io import BytesIO
+from types import SimpleNamespace
+from typing import List
+
+import signedjson.key
+import signedjson.sign
+import signedjson.types
+from twisted.internet.defer import ensureDeferred
+from twisted.test.proto_helpers import MemoryReactorClock
+from twisted.web.test.requesthelper import DummyRequest
+
+from sydent.config import SydentConfig
+from sydent.http.servlets.replication import ReplicationPushServlet
+from sydent.sydent import Sydent
+
+logger = logging.getLogger("benchmark_replication")
+
+PEER_NAME = "fake.server"
+
+
+class FakeTransport:
+    """Just enough of a TLS transport for the push servlet to identify the peer."""
+
+    def getPeerCertificate(self) -> SimpleNamespace:
+        return SimpleNamespace(
+            get_subject=lambda: SimpleNamespace(commonName=PEER_NAME)
+        )
+
+
+def make_sydent(path: str) -> Sydent:
+    """Create a Sydent using the SQLite database at the given path."""
+    config = SydentConfig()
+    config.parse_config_dict(
+        {
+            "general": {
+                "server.name": "benchmark.server",
+                "templates.path": os.path.join(
+                    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "res"
+                ),
+            },
+            # The reactor doesn't run, so do all the database work on the main
+            # connection.
+            "db": {"db.file": path, "db.pool.size": "0", "db.lookup_pool.size": "0"},
+        }
+    )
+    sydent = Sydent(sydent_config=config, reactor=MemoryReactorClock())
+    ensureDeferred(sydent.background_updater.run_updates(sleep=False))
+    return sydent
+
+
+def make_bodies(
+    signing_key: signedjson.types.SigningKey, count: int, batch_size: int
+) -> List[bytes]:
+    """Sign the given number of associations as the fake peer, and encode them in
+    pushes of the given size.
+    """
+    bodies = []
+    for start in range(0, count, batch_size):
+        sg_assocs = {}
+        for i in range(start, min(start + batch_size, count)):
+            assoc = {
+                "medium": "email",
+                "address": "bob%d@example.com" % (i,),
+                "mxid": "@bob%d:example.com" % (i,),
+                "ts": i,
+                "not_before": 0,
+                "not_after": 99999999999,
+            }
+            sg_assocs[str(i)] = signedjson.sign.sign_json(assoc, PEER_NAME, signing_key)
+        bodies.append(json.dumps({"sgAssocs": sg_assocs}).encode("utf8"))
+    return bodies
+
+
+def push(servlet: ReplicationPushServlet, body: bytes) -> None:
+    """Handle a push from the fake peer."""
+    request = DummyRequest([])
+    request.method = b"POST"
+    request.transport = FakeTransport()
+    request.content = BytesIO(body)
+    request.requestHeaders.addRawHeader(b"Content-Type", b"application/json")
+    response = json.loads(servlet.render_POST(request))
+    if response != {"success": True}:
+        raise Exception("Push failed: %r" % (response,))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark replication pushes")
+    parser.add_argument(
+        "--associations",
+        type=int,
+        default=50000,
+        help="number of associations to push (default: 50000)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(message)s")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sydent = make_sydent(os.path.join(tmpdir, "sydent.db"))
+
+        signing_key = signedjson.key.generate_signing_key("0")
+        cur = sydent.db.cursor()
+        cur.execute(
+            "INSERT INTO peers (name, port, lastSentVersion, active) "
+            "VALUES (?, ?, ?, ?)",
+            (PEER_NAME, 1234, 0, 1),
+        )
+        cur.execute(
+            "INSERT INTO peer_pubkeys (peername, alg, key) VALUES (?, ?, ?)",
+            (
+                PEER_NAME,
+                "ed25519",
+                signedjson.key.encode_verify_key_base64(signing_key.verify_key),
+            ),
+        )
+        sydent.db.commit()
+
+        batch_size = sydent.config.http.replication_max_push_size
+        bodies = make_bodies(signing_key, args.associations, batch_size)
+        servlet = ReplicationPushServlet(sydent)
+
+        start = time.perf_counter()
+        for body in bodies:
+            push(servlet, body)
+        elapsed = time.perf_counter() - start
+
+        print(
+            "Ingested %d associations in %d pushes in %.2fs (%.0f associations/s)"
+            % (args.associations, len(bodies), elapsed, args.associations / elapsed)
+        )
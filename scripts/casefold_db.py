@@ -12,7 +12,6 @@ import argparse
 import json
 import logging
 import os
-import sqlite3
 import sys
 import time
 from typing import Any, Dict, List, Optional, Tuple
@@ -21,6 +20,8 @@ import attr
 import signedjson.sign
 
 from sydent.config import SydentConfig
+from sydent.db.transaction import TransactionalConnection
+from sydent.db.updates import populate_current_mappings
 from sydent.sydent import Sydent
 from sydent.util import json_decoder
 from sydent.util.emailutils import EmailSendException, sendEmail
@@ -69,7 +70,7 @@ class CantSendEmailException(Exception):
 
 
 def calculate_lookup_hash(sydent: Sydent, address: str) -> str:
-    pepper = sydent.threepidBinder.hashing_store.get_lookup_pepper()
+    pepper = sydent.hashing_store.get_lookup_pepper()
     if pepper is None:
         raise RuntimeError(
             "No lookup pepper found; Sydent should have generated one on startup."
@@ -128,7 +129,7 @@ def sendEmailWithBackoff(
 
 def update_local_associations(
     sydent: Sydent,
-    db: sqlite3.Connection,
+    db: TransactionalConnection,
     send_email: bool,
     dry_run: bool,
     test: bool = False,
@@ -249,7 +250,7 @@ def update_local_associations(
                 )
                 cur = db.cursor()
                 cur.execute(
-                    "UPDATE local_threepid_associations SET address = ?, lookup_hash = ? WHERE medium = 'email' AND address = ? AND mxid = ?",
+                    "UPDATE local_threepid_associations SET address = ?, lookup_hash = ?, sgAssoc = NULL WHERE medium = 'email' AND address = ? AND mxid = ?",
                     (
                         casefolded_address,
                         delta.to_update.lookup_hash,
@@ -272,7 +273,7 @@ def update_local_associations(
 
 def update_global_associations(
     sydent: Sydent,
-    db: sqlite3.Connection,
+    db: TransactionalConnection,
     dry_run: bool,
 ) -> None:
     """Update the DB table global_threepid_associations so that all stored
@@ -328,7 +329,7 @@ def update_global_associations(
             associations[casefold_address] = [(address, mxid, lookup_hash, sg_assoc)]
 
     # list of arguments to update db with
-    db_update_args: List[Tuple[Any, str, str, str, str]] = []
+    db_update_args: List[Tuple[Any, Optional[str], Optional[str], str, str, str]] = []
 
     # list of mxids to delete
     to_delete: List[Tuple[str]] = []
@@ -339,10 +340,15 @@ def update_global_associations(
         if len(assoc_tuples) == 1 and assoc_tuples[0][0] == casefold_address:
             continue
 
+        # Also rehash the email with the pepper being rotated to or from, if any.
+        lookup_hash, alt_lookup_hash = sydent.hashing_store.get_lookup_hash_values(
+            medium, casefold_address, assoc_tuples[0][2]
+        )
         db_update_args.append(
             (
                 casefold_address,
-                assoc_tuples[0][2],
+                lookup_hash,
+                alt_lookup_hash,
                 assoc_tuples[0][3],
                 assoc_tuples[0][0],
                 assoc_tuples[0][1],
@@ -373,7 +379,7 @@ def update_global_associations(
 
         if len(db_update_args) > 0:
             cur.executemany(
-                "UPDATE global_threepid_associations SET address = ?, lookup_hash = ?, sgAssoc = ? WHERE medium = 'email' AND address = ? AND mxid = ?",
+                "UPDATE global_threepid_associations SET address = ?, lookup_hash = ?, alt_lookup_hash = ?, sgAssoc = ? WHERE medium = 'email' AND address = ? AND mxid = ?",
                 db_update_args,
             )
 
@@ -381,6 +387,8 @@ def update_global_associations(
                 f"{len(db_update_args)} rows updated in global_threepid_associations"
             )
 
+        populate_current_mappings(db)
+
         db.commit()
 
 
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+"""Copy the contents of a SQLite database to the PostgreSQL database configured in a
+Sydent configuration file.
+
+Sydent must be stopped while the database is being ported, and the PostgreSQL
+database must be empty, or only contain what Sydent created when starting on it.
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from sydent.config import SydentConfig
+from sydent.db import SCHEMA_VERSION
+from sydent.db.engines import PostgresEngine
+from sydent.db.transaction import TransactionalConnection
+
+logger = logging.getLogger("port_db")
+
+# Number of rows to copy at once.
+BATCH_SIZE = 1000
+
+# The tables to copy, along with their columns.
+TABLES: List[Tuple[str, Sequence[str]]] = [
+    (
+        "local_threepid_associations",
+        (
+            "id",
+            "medium",
+            "address",
+            "mxid",
+            "ts",
+            "notBefore",
+            "notAfter",
+            "lookup_hash",
+            "sgAssoc",
+        ),
+    ),
+    (
+        "global_threepid_associations",
+        (
+            "id",
+            "medium",
+            "address",
+            "mxid",
+            "ts",
+            "notBefore",
+            "notAfter",
+            "originServer",
+            "originId",
+            "sgAssoc",
+            "lookup_hash",
+            "normalised_address",
+            "alt_lookup_hash",
+        ),
+    ),
+    (
+        "global_threepid_current_mappings",
+        (
+            "medium",
+            "normalised_address",
+            "address",
+            "mxid",
+            "lookup_hash",
+            "ts",
+            "notBefore",
+            "notAfter",
+            "association_id",
+            "alt_lookup_hash",
+        ),
+    ),
+    (
+        "threepid_validation_sessions",
+        ("id", "medium", "address", "clientSecret", "validated", "mtime"),
+    ),
+    ("threepid_token_auths", ("id", "validationSession", "token", "sendAttemptNumber")),
+    (
+        "invite_tokens",
+        (
+            "id",
+            "medium",
+            "address",
+            "room_id",
+            "sender",
+            "token",
+            "received_ts",
+            "sent_ts",
+        ),
+    ),
+    (
+        "ephemeral_public_keys",
+        ("id", "public_key", "verify_count", "persistence_ts"),
+    ),
+    (
+        "peers",
+        ("id", "name", "port", "lastSentVersion", "lastPokeSucceededAt", "active"),
+    ),
+    ("peer_pubkeys", ("id", "peername", "alg", "key")),
+    (
+        "hashing_metadata",
+        (
+            "id",
+            "lookup_pepper",
+            "lookup_hash_column",
+            "previous_lookup_pepper",
+            "next_lookup_pepper",
+        ),
+    ),
+    ("accounts", ("user_id", "created_ts", "consent_version")),
+    ("tokens", ("token", "user_id")),
+    ("accepted_terms_urls", ("user_id", "url")),
+    ("background_updates", ("update_name", "ordering", "progress_json")),
+]
+# global_threepid_mapping_changes isn't copied: it only tells lookup processes what
+# has changed since the last lookup snapshot was written, and Sydent writes a new
+# snapshot from the current mappings when it starts.
+
+# Tables which Sydent fills in when it starts, and whose contents are replaced rather
+# than being required to be empty. The lookup pepper must be the one the copied
+# lookup hashes were computed with.
+REPLACED_TABLES = ("hashing_metadata",)
+
+# Conversions to apply to the values of columns whose type differs between SQLite and
+# PostgreSQL, keyed by table and column name.
+CONVERSIONS: Dict[Tuple[str, str], Callable[[Any], Any]] = {
+    # SQLite stores booleans as integers.
+    ("threepid_validation_sessions", "validated"): lambda v: None
+    if v is None
+    else bool(v),
+}
+
+
+def check_source(source: sqlite3.Connection) -> None:
+    """Check that the SQLite database is at the schema version this version of Sydent
+    uses, so that the tables to copy match the PostgreSQL schema, and that it doesn't
+    have any background update left to run.
+    """
+    version = source.execute("PRAGMA user_version").fetchone()[0]
+    if version != SCHEMA_VERSION:
+        raise RuntimeError(
+            "The SQLite database is at schema version %d but this version of Sydent "
+            "uses version %d: start Sydent on it once to upgrade it before porting it"
+            % (version, SCHEMA_VERSION)
+        )
+
+    # Lookups don't work efficiently on PostgreSQL until the updates have finished,
+    # since the indexes they rely on in the meantime aren't in its schema.
+    pending = source.execute("SELECT update_name FROM background_updates").fetchall()
+    if pending:
+        raise RuntimeError(
+            "The SQLite database still has background updates to run (%s): leave "
+            "Sydent running on it until they have finished before porting it"
+            % (", ".join(row[0] for row in pending),)
+        )
+
+
+def check_target(target: TransactionalConnection) -> None:
+    """Check that none of the tables to copy contain any rows in the PostgreSQL
+    database, so that we don't mix two databases together.
+    """
+    for table, _ in TABLES:
+        if table in REPLACED_TABLES:
+            continue
+        row = target.execute("SELECT 1 FROM %s LIMIT 1" % (table,)).fetchone()
+        if row is not None:
+            raise RuntimeError(
+                "Table %s in the PostgreSQL database isn't empty: refusing to port "
+                "the database into it" % (table,)
+            )
+
+
+def copy_table(
+    source: sqlite3.Connection,
+    target: TransactionalConnection,
+    table: str,
+    columns: Sequence[str],
+) -> int:
+    """Copy every row of a table from the SQLite database to the PostgreSQL one.
+
+    :return: The number of rows copied.
+    """
+    conversions = [CONVERSIONS.get((table, column)) for column in columns]
+
+    select = "SELECT %s FROM %s" % (", ".join(columns), table)
+    insert = "INSERT INTO %s (%s) VALUES (%s)" % (
+        table,
+        ", ".join(columns),
+        ", ".join("?" for _ in columns),
+    )
+
+    src_cur = source.execute(select)
+    count = 0
+    while True:
+        rows = src_cur.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+
+        batch = [
+            tuple(
+                convert(value) if convert is not None else value
+                for convert, value in zip(conversions, row)
+            )
+            for row in rows
+        ]
+        target.cursor().executemany(insert, batch)
+        count += len(batch)
+
+    if "id" in columns:
+        # The IDs were copied explicitly, so move the table's sequence past them. If
+        # the table doesn't have a sequence, pg_get_serial_sequence returns NULL and
+        # this does nothing.
+        target.execute(
+            "SELECT setval(pg_get_serial_sequence(?, 'id'), COALESCE(MAX(id), 0) + 1,"
+            " false) FROM %s" % (table,),
+            (table,),
+        )
+
+    return count
+
+
+def port_db(source: sqlite3.Connection, target: TransactionalConnection) -> None:
+    """Copy the contents of the SQLite database to the PostgreSQL one, in a single
+    transaction.
+    """
+    check_source(source)
+    check_target(target)
+
+    with target.unit_of_work():
+        for table in REPLACED_TABLES:
+            target.execute("DELETE FROM %s" % (table,))
+        for table, columns in TABLES:
+            count = copy_table(source, target, table, columns)
+            logger.info("Copied %d rows from %s", count, table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Port a Sydent SQLite database to PostgreSQL"
+    )
+    parser.add_argument("sqlite_path", help="path to the SQLite database to port")
+    parser.add_argument(
+        "config_path",
+        help="path to the sydent configuration file, configured to use PostgreSQL",
+    )
+
+    args = parser.parse_args()
+
+    # Set up logging.
+    log_format = "%(asctime)s - %(name)s - %(lineno)d - %(levelname)s" " - %(message)s"
+    formatter = logging.Formatter(log_format)
+    handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    for path in (args.sqlite_path, args.config_path):
+        if not os.path.exists(path):
+            logger.error(f"The file '{path}' does not exist.")
+            sys.exit(1)
+
+    sydent_config = SydentConfig()
+    sydent_config.parse_config_file(args.config_path)
+
+    if sydent_config.database.engine != "postgres":
+        logger.error("The configuration file must set db.engine to 'postgres'.")
+        sys.exit(1)
+
+    source = sqlite3.connect("file:%s?mode=ro" % (args.sqlite_path,), uri=True)
+
+    engine = PostgresEngine(sydent_config.database)
+    target = engine.connect()
+    engine.prepare_database(target)
+
+    try:
+        port_db(source, target)
+    except RuntimeError as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+    logger.info("Done! Sydent can now be started on the PostgreSQL database.")
@@ -4,6 +4,7 @@ from typing import Optional, Type, TypeVar, Union, overload
 _E = TypeVar("_E")
 
 class Failure(BaseException):
+    value: BaseException
     def __init__(
         self,
         exc_value: Optional[BaseException] = ...,
@@ -22,3 +23,4 @@ class Failure(BaseException):
         elideFrameworkCode: int = ...,
         detail: str = ...,
     ) -> str: ...
+    def getErrorMessage(self) -> str: ...
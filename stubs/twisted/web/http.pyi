@@ -3,7 +3,7 @@ from typing import AnyStr, Dict, List, Optional
 
 from twisted.internet import protocol
 from twisted.internet.defer import Deferred
-from twisted.internet.interfaces import IAddress, ITCPTransport
+from twisted.internet.interfaces import IAddress, IProducer, ITCPTransport
 from twisted.logger import Logger
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IRequest
@@ -32,6 +32,7 @@ class Request:
     # Other instance attributes set in __init__
     channel: HTTPChannel
     client: IAddress
+    clientproto: bytes
     # This was hard to derive.
     # - `transport` is `self.channel.transport`
     # - `self.channel` is set in the constructor, and looks like it's always
@@ -53,7 +54,10 @@ class Request:
     def setHeader(self, k: AnyStr, v: AnyStr) -> None: ...
     def write(self, data: bytes) -> None: ...
     def finish(self) -> None: ...
+    def registerProducer(self, producer: IProducer, streaming: bool) -> None: ...
+    def unregisterProducer(self) -> None: ...
     def getClientAddress(self) -> IAddress: ...
+    def getAllHeaders(self) -> Dict[bytes, bytes]: ...
 
 class PotentialDataLoss(Exception): ...
 
@@ -16,6 +16,7 @@ from typing import Dict
 from sydent.config.crypto import CryptoConfig
 from sydent.config.database import DatabaseConfig
 from sydent.config.email import EmailConfig
+from sydent.config.exceptions import ConfigError
 from sydent.config.general import GeneralConfig
 from sydent.config.http import HTTPConfig
 from sydent.config.sms import SMSConfig
@@ -74,19 +75,102 @@ CONFIG_DEFAULTS = {
         "homeserver_allow_list": "",
         # If set to 'false', entirely disable access via the V1 api.
         "enable_v1_access": "true",
+        # If set to 'true', only serve lookups (and public keys) from the associations
+        # replicated to this server by its peers, and refuse every request which
+        # would write to the database, such as binds and validation sessions. Such
+        # servers don't send emails or text messages, or push associations to peers.
+        "lookup_only": "false",
     },
     "db": {
+        # The database engine to use: either 'sqlite' or 'postgres'. Using PostgreSQL
+        # requires installing Sydent with the 'postgres' extra. An existing SQLite
+        # database can be copied to PostgreSQL with scripts/port_db.py.
+        "db.engine": "sqlite",
+        # The SQLite database file.
         "db.file": os.environ.get("SYDENT_DB_PATH", "sydent.db"),
+        # How to connect to the PostgreSQL database. An empty value leaves libpq's
+        # default in place (e.g. connecting through a local Unix socket if no host is
+        # given).
+        "db.postgres.host": "",
+        "db.postgres.port": "",
+        "db.postgres.user": "",
+        "db.postgres.password": "",
+        "db.postgres.database": "sydent",
+        # The maximum number of threads (each with their own database connection) to
+        # use for running slow read-only queries, such as loading the lookup hash
+        # index, away from the main thread. Set to 0 to run every query on the main
+        # thread.
+        "db.pool.size": "4",
+        # The maximum number of read-only connections used to serve lookups (v1 lookup
+        # and bulk_lookup, v2 lookup and store-invite's existing-binding check). Set to
+        # 0 to serve lookups from the main connection.
+        "db.lookup_pool.size": "4",
+        # Whether to commit writes at most once per reactor tick, so that concurrent
+        # requests share a single commit (and fsync). This trades some durability for
+        # write throughput: see sydent/db/transaction.py for details.
+        "db.group_commit": "false",
+        # Whether to keep the lookup hashes of every 3PID in memory, so that hashed v2
+        # lookups are served without querying the database. This takes a few hundred
+        # bytes of memory per 3PID; the amount used is reported by the
+        # sydent_lookup_hash_index_size_bytes metric.
+        "db.lookup_hash_index": "false",
+        # Whether to keep a Bloom filter of the bound 3PIDs and lookup hashes in
+        # memory, so that lookups for 3PIDs which aren't bound (which are most of them)
+        # don't query the database. This takes about 5 bytes of memory per 3PID.
+        "db.lookup_bloom_filter": "false",
+        # The maximum number of lookup results (by 3PID and by lookup hash) to keep in
+        # memory, so that the 3PIDs which are looked up most often are served without
+        # querying the database. Each of the three caches (3PID to MXID, 3PID to signed
+        # association, and lookup hash to MXID) holds up to this many entries. The
+        # sydent_lru_cache_* metrics report their hits, misses and evictions. Set to 0
+        # to disable the caches.
+        "db.lookup_cache.size": "0",
+        # The path of a file to write a snapshot of the lookup hashes of every 3PID to,
+        # so that hashed v2 lookups are served from it rather than by querying the
+        # database. The file is memory-mapped, so that processes on the same machine
+        # share one copy of it. Empty to not write a snapshot.
+        "db.lookup_snapshot.path": "",
+        # How often to write a new lookup snapshot, in seconds.
+        "db.lookup_snapshot.interval": "600",
+        # SQLite tuning. Each of these is applied to every connection Sydent opens, and
+        # an empty value leaves SQLite's default in place.
+        #
+        # Setting the journal mode to 'wal' lets lookups carry on reading while
+        # associations are being written, and is recommended for busy servers. See
+        # https://www.sqlite.org/pragma.html for the meaning of each option.
+        "db.journal_mode": "",
+        # One of 'off', 'normal', 'full' or 'extra'. 'normal' is safe in WAL mode, in
+        # that it can't corrupt the database, but the most recent commits may be rolled
+        # back after a power loss.
+        "db.synchronous": "",
+        # A positive value is a number of pages, a negative one an amount of KiB.
+        "db.cache_size": "",
+        # The maximum number of bytes of the database file to memory-map.
+        "db.mmap_size": "",
     },
     "http": {
         "clientapi.http.bind_address": "::",
         "clientapi.http.port": "8090",
+        # The number of worker processes to serve the client API's lookups from, on
+        # top of the main process which handles everything else. 0 to serve the whole
+        # client API from the main process.
+        "clientapi.http.workers": "0",
+        # The number of signed associations to keep the v1 lookup responses of in
+        # memory, so that associations replicated from peers aren't signed and encoded
+        # again every time they are looked up. 0 to not cache them.
+        "clientapi.http.lookup_response_cache.size": "10000",
         "internalapi.http.bind_address": "::1",
         "internalapi.http.port": "",
         "replication.https.certfile": "",
         "replication.https.cacert": "",  # This should only be used for testing
         "replication.https.bind_address": "::",
         "replication.https.port": "4434",
+        # The number of batches of associations to send to each peer at once, without
+        # waiting for the previous ones to be acknowledged.
+        "replication.https.push_window": "4",
+        # The maximum number of associations to accept from a peer in one push. Peers
+        # sending more are told to send smaller batches.
+        "replication.https.max_push_size": "1000",
         "obey_x_forwarded_for": "False",
         "federation.verifycerts": "True",
         # verify_response_template is deprecated, but still used if defined. Define
@@ -193,6 +277,16 @@ class SydentConfig:
             if section.parse_config(cfg):
                 needs_saving = True
 
+        if (
+            self.http.client_workers > 0
+            and self.database.engine == "sqlite"
+            and self.database.database_path == ":memory:"
+        ):
+            raise ConfigError(
+                "clientapi.http.workers can't be used with an in-memory database, "
+                "which the workers can't share"
+            )
+
         return needs_saving
 
     def parse_from_config_parser(self, cfg: ConfigParser) -> bool:
@@ -8,8 +8,14 @@
 # <http://www.apache.org/licenses/LICENSE-2.0>.
 
 from configparser import ConfigParser
+from typing import Dict, Optional, Tuple
 
 from sydent.config._base import BaseConfig
+from sydent.config.exceptions import ConfigError
+
+ENGINES = ("sqlite", "postgres")
+JOURNAL_MODES = ("delete", "truncate", "persist", "wal")
+SYNCHRONOUS_MODES = ("off", "normal", "full", "extra")
 
 
 class DatabaseConfig(BaseConfig):
@@ -19,6 +25,92 @@ class DatabaseConfig(BaseConfig):
 
         :param cfg: the configuration to be parsed
         """
+        self.engine = cfg.get("db", "db.engine").strip().lower()
+        if self.engine not in ENGINES:
+            raise ConfigError(
+                "db.engine must be one of %s, not '%s'"
+                % (", ".join(ENGINES), self.engine)
+            )
+
         self.database_path = cfg.get("db", "db.file")
 
+        # The keyword arguments to give psycopg2.connect.
+        self.postgres_args: Dict[str, str] = {}
+        for option in ("host", "port", "user", "password", "database"):
+            value = cfg.get("db", "db.postgres." + option).strip()
+            if value:
+                self.postgres_args[option] = value
+
+        self.pool_size = cfg.getint("db", "db.pool.size")
+        if self.pool_size < 0:
+            raise ConfigError("db.pool.size must not be negative")
+
+        self.lookup_pool_size = cfg.getint("db", "db.lookup_pool.size")
+        if self.lookup_pool_size < 0:
+            raise ConfigError("db.lookup_pool.size must not be negative")
+
+        self.group_commit = cfg.getboolean("db", "db.group_commit")
+
+        self.lookup_hash_index = cfg.getboolean("db", "db.lookup_hash_index")
+        self.lookup_bloom_filter = cfg.getboolean("db", "db.lookup_bloom_filter")
+        self.lookup_cache_size = cfg.getint("db", "db.lookup_cache.size")
+        if self.lookup_cache_size < 0:
+            raise ConfigError("db.lookup_cache.size must not be negative")
+
+        self.lookup_snapshot_path: Optional[str] = (
+            cfg.get("db", "db.lookup_snapshot.path").strip() or None
+        )
+        self.lookup_snapshot_interval = cfg.getint("db", "db.lookup_snapshot.interval")
+        if self.lookup_snapshot_interval <= 0:
+            raise ConfigError("db.lookup_snapshot.interval must be positive")
+
+        self.journal_mode = _parse_choice(cfg, "db.journal_mode", JOURNAL_MODES)
+        self.synchronous = _parse_choice(cfg, "db.synchronous", SYNCHRONOUS_MODES)
+        self.cache_size = _parse_optional_int(cfg, "db.cache_size")
+        self.mmap_size = _parse_optional_int(cfg, "db.mmap_size")
+        if self.mmap_size is not None and self.mmap_size < 0:
+            raise ConfigError("db.mmap_size must not be negative")
+
         return False
+
+
+def _parse_choice(
+    cfg: ConfigParser, option: str, choices: Tuple[str, ...]
+) -> Optional[str]:
+    """
+    Parse an option of the db section which must be one of the given values, or empty
+    to leave SQLite's default in place.
+
+    :param cfg: the configuration to be parsed
+    :param option: the name of the option
+    :param choices: the allowed values for the option
+
+    :return: the lowercased value of the option, or None if it is empty
+    """
+    value = cfg.get("db", option).strip().lower()
+    if value == "":
+        return None
+    if value not in choices:
+        raise ConfigError(
+            "%s must be one of %s, not '%s'" % (option, ", ".join(choices), value)
+        )
+    return value
+
+
+def _parse_optional_int(cfg: ConfigParser, option: str) -> Optional[int]:
+    """
+    Parse an integer option of the db section which may be empty to leave SQLite's
+    default in place.
+
+    :param cfg: the configuration to be parsed
+    :param option: the name of the option
+
+    :return: the value of the option, or None if it is empty
+    """
+    value = cfg.get("db", option).strip()
+    if value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ConfigError("%s must be an integer, not '%s'" % (option, value))
@@ -110,6 +110,8 @@ class GeneralConfig(BaseConfig):
                 cfg.get("general", "enable_v1_associations")
             )
 
+        self.lookup_only = parse_cfg_bool(cfg.get("general", "lookup_only"))
+
         return False
 
 
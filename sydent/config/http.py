@@ -11,6 +11,7 @@ from configparser import ConfigParser
 from typing import Optional
 
 from sydent.config._base import BaseConfig
+from sydent.config.exceptions import ConfigError
 
 
 class HTTPConfig(BaseConfig):
@@ -27,6 +28,16 @@ class HTTPConfig(BaseConfig):
 
         self.client_bind_address = cfg.get("http", "clientapi.http.bind_address")
         self.client_port = cfg.getint("http", "clientapi.http.port")
+        self.client_workers = cfg.getint("http", "clientapi.http.workers")
+        if self.client_workers < 0:
+            raise ConfigError("clientapi.http.workers must not be negative")
+        self.lookup_response_cache_size = cfg.getint(
+            "http", "clientapi.http.lookup_response_cache.size"
+        )
+        if self.lookup_response_cache_size < 0:
+            raise ConfigError(
+                "clientapi.http.lookup_response_cache.size must not be negative"
+            )
 
         # internal port is allowed to be set to an empty string in the config
         internal_api_port = cfg.get("http", "internalapi.http.port")
@@ -44,6 +55,16 @@ class HTTPConfig(BaseConfig):
             "http", "replication.https.bind_address"
         )
         self.replication_port = cfg.getint("http", "replication.https.port")
+        self.replication_push_window = cfg.getint(
+            "http", "replication.https.push_window"
+        )
+        if self.replication_push_window < 1:
+            raise ConfigError("replication.https.push_window must be positive")
+        self.replication_max_push_size = cfg.getint(
+            "http", "replication.https.max_push_size"
+        )
+        if self.replication_max_push_size < 1:
+            raise ConfigError("replication.https.max_push_size must be positive")
 
         self.obey_x_forwarded_for = cfg.getboolean("http", "obey_x_forwarded_for")
 
@@ -0,0 +1,8 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+# The current version of the database schema. Every engine must upgrade databases to
+# this version in its prepare_database.
+SCHEMA_VERSION = 12
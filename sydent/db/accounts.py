@@ -53,8 +53,9 @@ class AccountStore:
         """
         cur = self.sydent.db.cursor()
         cur.execute(
-            "insert or ignore into accounts (user_id, created_ts, consent_version) "
-            "values (?, ?, ?)",
+            self.sydent.db_engine.insert_or_ignore(
+                "accounts", ("user_id", "created_ts", "consent_version")
+            ),
             (user_id, creation_ts, consent_version),
         )
         self.sydent.db.commit()
@@ -0,0 +1,274 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+"""Background updates are data migrations which are too slow to run while upgrading
+the schema at startup, e.g. because they need to rewrite every row of a large table.
+
+Schema upgrades only make the schema changes, and schedule the data migration as a
+background update by adding a row to the background_updates table. Once Sydent is
+running, the updates are run in small batches on the main database connection, like
+every other write, one update at a time in ascending order. Each batch stores the
+update's progress in the same transaction as the changes it makes, so that an
+interrupted update resumes where it left off, and the update's row is deleted once
+it has finished.
+
+Code which depends on the result of an update must check whether it has completed
+(with BackgroundUpdater.has_completed_update) and keep working until it has.
+"""
+
+import json
+import logging
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+from twisted.internet import defer, task
+
+from sydent.db.transaction import Cursor
+from sydent.types import JsonDict
+from sydent.util import json_decoder
+
+if TYPE_CHECKING:
+    from sydent.sydent import Sydent
+
+logger = logging.getLogger(__name__)
+
+# Runs one batch of a background update. It's called with a cursor, the progress
+# returned by the previous batch (or an empty dict for the first batch), and the
+# number of items to process, and returns the number of items it processed along with
+# its new progress, or None if the update has finished.
+BackgroundUpdateHandler = Callable[
+    [Cursor, JsonDict, int], Tuple[int, Optional[JsonDict]]
+]
+
+background_update_items = Counter(
+    "sydent_background_update_items",
+    "Number of items processed by background updates",
+    labelnames=("update",),
+)
+pending_background_updates = Gauge(
+    "sydent_background_updates_pending",
+    "Number of background updates which haven't finished yet",
+)
+
+
+def schedule_background_update(cur: Cursor, update_name: str, ordering: int) -> None:
+    """Schedule a background update, to be run once Sydent has started. This is meant
+    to be called by schema upgrades, in the same transaction as the schema changes
+    the update relies on.
+
+    :param cur: The cursor to use.
+    :param update_name: The name of the update, which must be a key of the handlers
+        given to the BackgroundUpdater.
+    :param ordering: Pending updates are run in ascending order of this value, so an
+        update can rely on the ones with a lower ordering having finished.
+    """
+    cur.execute(
+        "INSERT INTO background_updates (update_name, ordering, progress_json) "
+        "VALUES (?, ?, ?)",
+        (update_name, ordering, "{}"),
+    )
+
+
+class BackgroundUpdater:
+    """Runs the pending background updates, see the module docstring."""
+
+    # The time each batch should take, in milliseconds. The size of the batches is
+    # adjusted after each batch to get close to it.
+    BATCH_DURATION_MS = 100
+    # The number of items to process in the first batch of an update, and the
+    # smallest batch size to use.
+    MINIMUM_BATCH_SIZE = 100
+    # The time to wait between batches, in milliseconds, so that the updates don't
+    # hog the database.
+    SLEEP_DURATION_MS = 100
+
+    def __init__(
+        self, sydent: "Sydent", handlers: Dict[str, BackgroundUpdateHandler]
+    ) -> None:
+        """
+        :param sydent: The Sydent instance to run the updates for.
+        :param handlers: The function running a batch of each update, keyed by the
+            update's name.
+        """
+        self.sydent = sydent
+        self._handlers = handlers
+        self._batch_sizes: Dict[str, int] = {}
+        self._completion_callbacks: Dict[str, List[Callable[[], None]]] = {}
+        self._running = False
+        self._started = False
+
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "SELECT update_name FROM background_updates ORDER BY ordering, update_name"
+        )
+        self._pending: List[str] = [row[0] for row in cur.fetchall()]
+        cur.close()
+
+        for update_name in self._pending:
+            if update_name not in self._handlers:
+                raise Exception("Unknown background update %s" % (update_name,))
+        pending_background_updates.set(len(self._pending))
+
+    def has_completed_update(self, update_name: str) -> bool:
+        """Check whether an update has finished, i.e. isn't pending.
+
+        :param update_name: The name of the update to check.
+
+        :return: Whether the update has finished.
+        """
+        return update_name not in self._pending
+
+    def has_completed_all_updates(self) -> bool:
+        """
+        :return: Whether every background update has finished.
+        """
+        return not self._pending
+
+    def add_completion_callback(
+        self, update_name: str, callback: Callable[[], None]
+    ) -> None:
+        """Register a function to call whenever the given update finishes.
+
+        :param update_name: The name of the update.
+        :param callback: The function to call.
+        """
+        self._completion_callbacks.setdefault(update_name, []).append(callback)
+
+    def add_update(self, update_name: str) -> None:
+        """Pick up an update scheduled while Sydent is running, and start running it
+        if the pending updates have been started.
+
+        :param update_name: The name of the update, which must have been scheduled
+            with schedule_background_update in a transaction which has committed.
+        """
+        if update_name not in self._handlers:
+            raise Exception("Unknown background update %s" % (update_name,))
+        if update_name not in self._pending:
+            self._pending.append(update_name)
+            pending_background_updates.set(len(self._pending))
+        if self._started:
+            self.start()
+
+    def refresh(self) -> None:
+        """Pick up the updates which another process has finished running, and call
+        their completion callbacks. For processes which don't run the updates
+        themselves.
+        """
+        cur = self.sydent.db.cursor()
+        cur.execute("SELECT update_name FROM background_updates")
+        pending = {row[0] for row in cur.fetchall()}
+        cur.close()
+
+        for update_name in list(self._pending):
+            if update_name in pending:
+                continue
+            logger.info("Background update %s has finished", update_name)
+            self._pending.remove(update_name)
+            pending_background_updates.set(len(self._pending))
+            for callback in self._completion_callbacks.get(update_name, []):
+                callback()
+
+    def start(self) -> None:
+        """Start running the pending updates in the background, if there are any."""
+        self._started = True
+        if self._running or not self._pending:
+            return
+
+        logger.info("Starting background updates: %s", ", ".join(self._pending))
+        self._running = True
+
+        defer.ensureDeferred(self._run_updates_in_background())
+
+    async def _run_updates_in_background(self) -> None:
+        try:
+            await self.run_updates()
+        except Exception:
+            logger.exception(
+                "Background update failed, not running any more updates until "
+                "Sydent restarts"
+            )
+        finally:
+            self._running = False
+
+    async def run_updates(self, sleep: bool = True) -> None:
+        """Run batches of the pending updates until they have all finished.
+
+        :param sleep: Whether to wait between batches to let other work through.
+        """
+        while self._pending:
+            await self.do_next_batch()
+            if sleep and self._pending:
+                await task.deferLater(
+                    self.sydent.reactor, self.SLEEP_DURATION_MS / 1000
+                )
+
+        logger.info("All background updates have finished")
+
+    async def do_next_batch(self) -> None:
+        """Run one batch of the first pending update, adjusting the size of its next
+        batch according to the time this one took.
+        """
+        update_name = self._pending[0]
+        batch_size = self._batch_sizes.get(update_name, self.MINIMUM_BATCH_SIZE)
+
+        start = time.perf_counter()
+        with self.sydent.db.unit_of_work():
+            cur = self.sydent.db.cursor()
+            items, progress = self._doBatchTxn(cur, update_name, batch_size)
+            cur.close()
+        duration_ms = (time.perf_counter() - start) * 1000
+
+        background_update_items.labels(update_name).inc(items)
+
+        if progress is None:
+            logger.info("Background update %s has finished", update_name)
+            self._pending.remove(update_name)
+            self._batch_sizes.pop(update_name, None)
+            pending_background_updates.set(len(self._pending))
+            for callback in self._completion_callbacks.get(update_name, []):
+                callback()
+            return
+
+        logger.info(
+            "Background update %s processed %d items in %.1f ms, progress: %s",
+            update_name,
+            items,
+            duration_ms,
+            json.dumps(progress),
+        )
+
+        # Scale the batch size towards the target duration, but don't let it grow too
+        # quickly in case the batch was unusually fast.
+        new_batch_size = batch_size
+        if items > 0 and duration_ms > 0:
+            new_batch_size = int(items * self.BATCH_DURATION_MS / duration_ms)
+        self._batch_sizes[update_name] = max(
+            self.MINIMUM_BATCH_SIZE, min(new_batch_size, 2 * batch_size)
+        )
+
+    def _doBatchTxn(
+        self, cur: Cursor, update_name: str, batch_size: int
+    ) -> Tuple[int, Optional[JsonDict]]:
+        cur.execute(
+            "SELECT progress_json FROM background_updates WHERE update_name = ?",
+            (update_name,),
+        )
+        row: Tuple[str] = cur.fetchone()
+        progress: JsonDict = json_decoder.decode(row[0])
+
+        items, new_progress = self._handlers[update_name](cur, progress, batch_size)
+
+        if new_progress is None:
+            cur.execute(
+                "DELETE FROM background_updates WHERE update_name = ?", (update_name,)
+            )
+        else:
+            cur.execute(
+                "UPDATE background_updates SET progress_json = ? WHERE update_name = ?",
+                (json.dumps(new_progress), update_name),
+            )
+
+        return items, new_progress
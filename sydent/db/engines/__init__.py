@@ -0,0 +1,27 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+from typing import TYPE_CHECKING
+
+from sydent.db.engines._base import BaseDatabaseEngine
+from sydent.db.engines.postgres import PostgresEngine
+from sydent.db.engines.sqlite import Sqlite3Engine
+
+if TYPE_CHECKING:
+    from sydent.config.database import DatabaseConfig
+
+__all__ = ["BaseDatabaseEngine", "PostgresEngine", "Sqlite3Engine", "create_engine"]
+
+
+def create_engine(config: "DatabaseConfig") -> BaseDatabaseEngine:
+    """Create the database engine selected by the config.
+
+    :param config: The database config.
+
+    :return: The engine.
+    """
+    if config.engine == "postgres":
+        return PostgresEngine(config)
+    return Sqlite3Engine(config)
@@ -0,0 +1,161 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+import abc
+from types import ModuleType
+from typing import TYPE_CHECKING, Any, List, Optional, Sequence, Tuple
+
+from sydent.db.transaction import TransactionalConnection
+from sydent.db.types import DBAPI2Connection
+
+if TYPE_CHECKING:
+    from sydent.config.database import DatabaseConfig
+
+
+class BaseDatabaseEngine(abc.ABC):
+    """Encapsulates the differences between the database engines Sydent can use: how
+    to connect to the database and manage its schema, and the few bits of SQL which
+    can't be written in a way that works on all of them.
+
+    SQL which is the same for every engine is written in the stores directly, using
+    `?` placeholders.
+    """
+
+    # Batches of up to this many values are matched with `IN (?, ?, ...)` lists, and
+    # larger ones with a single array parameter, if the engine supports it. See
+    # scripts-dev/benchmark_bulk_lookups.py.
+    IN_LIST_MAX_SIZE = 50
+
+    # The maximum number of values in a single `IN (?, ?, ...)` list. This is kept
+    # well below SQLite's limit on the number of parameters (999 before 3.32.0).
+    IN_LIST_CHUNK_SIZE = 500
+
+    def __init__(self, module: ModuleType, config: "DatabaseConfig") -> None:
+        """
+        :param module: The DB-API module used to talk to the database.
+        :param config: The database config.
+        """
+        self.module = module
+        self.config = config
+
+    @property
+    @abc.abstractmethod
+    def reads_open_transactions(self) -> bool:
+        """Whether the driver implicitly opens a transaction before any statement run
+        outside of one, rather than only before statements which modify data.
+        """
+
+    @property
+    @abc.abstractmethod
+    def single_connection(self) -> bool:
+        """Whether the database can only be accessed through a single connection
+        (e.g. because it only lives in memory), in which case Sydent must not open
+        additional connections to it.
+        """
+
+    def connect(self, read_only: bool = False) -> TransactionalConnection:
+        """Open a new connection to the database.
+
+        :param read_only: Whether the connection will only be used to read from the
+            database, in which case the engine may open it in a read-only mode.
+
+        :return: The new connection.
+        """
+        return TransactionalConnection(self, self._connect(read_only))
+
+    @abc.abstractmethod
+    def _connect(self, read_only: bool) -> DBAPI2Connection:
+        """Open a new connection to the database, and set it up."""
+
+    @abc.abstractmethod
+    def prepare_database(self, db: TransactionalConnection) -> None:
+        """Create the database schema if the database is empty, and upgrade it to the
+        current version otherwise.
+
+        :param db: A connection to the database.
+        """
+
+    @abc.abstractmethod
+    def get_schema_version(self, db: TransactionalConnection) -> int:
+        """Get the version of the schema of the database.
+
+        :param db: A connection to the database.
+
+        :return: The version of the schema, or 0 if no schema has been created.
+        """
+
+    @abc.abstractmethod
+    def convert_param_style(self, sql: str) -> str:
+        """Convert a query written with `?` placeholders to the engine's own
+        placeholder style.
+        """
+
+    @abc.abstractmethod
+    def in_transaction(self, conn: DBAPI2Connection) -> bool:
+        """Whether a transaction is currently open on the given connection."""
+
+    @abc.abstractmethod
+    def in_failed_transaction(self, conn: DBAPI2Connection) -> bool:
+        """Whether a statement failed on the given connection in a way which aborted
+        the current transaction, so it must be rolled back before it can be used
+        again.
+        """
+
+    @abc.abstractmethod
+    def begin_transaction(self, conn: DBAPI2Connection) -> None:
+        """Start a transaction on the given connection."""
+
+    def in_clauses(
+        self, column: str, values: Sequence[Any]
+    ) -> List[Tuple[str, List[Any]]]:
+        """Build clauses which, between them, match the given column against every one
+        of the given values, without creating any temporary tables. Callers must run
+        one query per clause and combine the results.
+
+        Small batches are matched with `IN` lists, in chunks of up to
+        IN_LIST_CHUNK_SIZE values. Batches larger than IN_LIST_MAX_SIZE are matched with
+        a single clause taking every value as one parameter, if the engine supports
+        it.
+
+        :param column: The column to match against.
+        :param values: The values to match.
+
+        :return: A list of (clause, args) tuples, the clause using `?` placeholders.
+        """
+        if len(values) > self.IN_LIST_MAX_SIZE:
+            clause = self._array_clause(column, values)
+            if clause is not None:
+                return [clause]
+
+        clauses = []
+        for i in range(0, len(values), self.IN_LIST_CHUNK_SIZE):
+            chunk = list(values[i : i + self.IN_LIST_CHUNK_SIZE])
+            clauses.append(
+                ("%s IN (%s)" % (column, ", ".join("?" for _ in chunk)), chunk)
+            )
+        return clauses
+
+    @abc.abstractmethod
+    def _array_clause(
+        self, column: str, values: Sequence[Any]
+    ) -> Optional[Tuple[str, List[Any]]]:
+        """Build a clause matching the given column against every one of the given
+        values, which are passed as a single parameter.
+
+        :return: The clause and its args, or None if the engine can't do this.
+        """
+
+    @abc.abstractmethod
+    def insert_or_ignore(self, table: str, columns: Sequence[str]) -> str:
+        """Build a statement inserting a row into the given table, unless doing so
+        would violate one of its unique constraints, in which case the row is
+        silently dropped.
+
+        :param table: The table to insert into.
+        :param columns: The columns to insert values into. The statement takes one
+            parameter per column, in the same order.
+
+        :return: The statement, with `?` placeholders.
+        """
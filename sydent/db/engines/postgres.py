@@ -0,0 +1,108 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+from typing import TYPE_CHECKING, Any, List, Optional, Sequence, Tuple, cast
+
+from sydent.config.exceptions import ConfigError
+from sydent.db.engines._base import BaseDatabaseEngine
+from sydent.db.postgresdb import PostgresDatabase
+from sydent.db.transaction import TransactionalConnection
+from sydent.db.types import DBAPI2Connection
+
+if TYPE_CHECKING:
+    import psycopg2.extensions
+
+    from sydent.config.database import DatabaseConfig
+
+
+class PostgresEngine(BaseDatabaseEngine):
+    def __init__(self, config: "DatabaseConfig") -> None:
+        try:
+            import psycopg2
+            import psycopg2.extensions
+        except ImportError:
+            raise ConfigError(
+                "db.engine is set to postgres, but psycopg2 is not installed. Install "
+                "Sydent with the 'postgres' extra to use PostgreSQL."
+            )
+
+        super().__init__(psycopg2, config)
+        self._extensions = psycopg2.extensions
+
+    @property
+    def reads_open_transactions(self) -> bool:
+        return True
+
+    @property
+    def single_connection(self) -> bool:
+        return False
+
+    def _connect(self, read_only: bool) -> DBAPI2Connection:
+        conn = self.module.connect(**self.config.postgres_args)
+        if read_only:
+            conn.set_session(readonly=True)
+        return cast(DBAPI2Connection, conn)
+
+    def prepare_database(self, db: TransactionalConnection) -> None:
+        row: Tuple[str] = db.execute("SHOW server_encoding").fetchone()
+        if row[0].upper() not in ("UTF8", "UTF-8"):
+            raise ConfigError(
+                "The PostgreSQL database must use the UTF8 encoding, but it uses %s. "
+                "Create it with: CREATE DATABASE <name> ENCODING 'UTF8' "
+                "TEMPLATE template0" % (row[0],)
+            )
+
+        PostgresDatabase(db)
+
+    def get_schema_version(self, db: TransactionalConnection) -> int:
+        cur = db.cursor()
+        cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+        exists: Tuple[bool] = cur.fetchone()
+
+        version = 0
+        if exists[0]:
+            cur.execute("SELECT version FROM schema_version")
+            row: Optional[Tuple[int]] = cur.fetchone()
+            if row is not None:
+                version = row[0]
+
+        cur.close()
+        return version
+
+    def convert_param_style(self, sql: str) -> str:
+        # psycopg2 uses the "format" style, so literal % signs need escaping. This
+        # means that queries mustn't contain a literal ? outside of a placeholder.
+        return sql.replace("%", "%%").replace("?", "%s")
+
+    def in_transaction(self, conn: DBAPI2Connection) -> bool:
+        pg_conn = cast("psycopg2.extensions.connection", conn)
+        return bool(
+            pg_conn.info.transaction_status != self._extensions.TRANSACTION_STATUS_IDLE
+        )
+
+    def in_failed_transaction(self, conn: DBAPI2Connection) -> bool:
+        pg_conn = cast("psycopg2.extensions.connection", conn)
+        return bool(
+            pg_conn.info.transaction_status
+            == self._extensions.TRANSACTION_STATUS_INERROR
+        )
+
+    def begin_transaction(self, conn: DBAPI2Connection) -> None:
+        # psycopg2 implicitly opens a transaction before the first statement run
+        # outside of one, so there's nothing to do.
+        pass
+
+    def _array_clause(
+        self, column: str, values: Sequence[Any]
+    ) -> Optional[Tuple[str, List[Any]]]:
+        # psycopg2 passes lists as arrays.
+        return "%s = ANY(?)" % (column,), [list(values)]
+
+    def insert_or_ignore(self, table: str, columns: Sequence[str]) -> str:
+        return "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT DO NOTHING" % (
+            table,
+            ", ".join(columns),
+            ", ".join("?" for _ in columns),
+        )
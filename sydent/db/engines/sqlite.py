@@ -0,0 +1,107 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+import json
+import sqlite3
+import urllib.parse
+from typing import TYPE_CHECKING, Any, List, Optional, Sequence, Tuple, cast
+
+from sydent.db.engines._base import BaseDatabaseEngine
+from sydent.db.sqlitedb import SqliteDatabase
+from sydent.db.transaction import TransactionalConnection
+from sydent.db.types import DBAPI2Connection
+
+if TYPE_CHECKING:
+    from sydent.config.database import DatabaseConfig
+
+
+class Sqlite3Engine(BaseDatabaseEngine):
+    def __init__(self, config: "DatabaseConfig") -> None:
+        super().__init__(sqlite3, config)
+
+        # Whether SQLite was built with the JSON functions, which are used to pass
+        # large batches of values as a single parameter. Checked on connecting.
+        self._supports_json = False
+
+    @property
+    def reads_open_transactions(self) -> bool:
+        return False
+
+    @property
+    def single_connection(self) -> bool:
+        return self.config.database_path == ":memory:"
+
+    def _connect(self, read_only: bool) -> DBAPI2Connection:
+        # check_same_thread is disabled so that connections used by database pools can
+        # be closed from the reactor thread when the pool stops; they are otherwise only
+        # ever used from the thread that opened them.
+        if read_only and not self.single_connection:
+            conn = sqlite3.connect(
+                "file:%s?mode=ro" % (urllib.parse.quote(self.config.database_path),),
+                uri=True,
+                check_same_thread=False,
+            )
+        else:
+            conn = sqlite3.connect(self.config.database_path, check_same_thread=False)
+
+        # NB. pragma doesn't support variable substitution. The values come from the
+        # config, and have been checked to be either one of a list of allowed values or
+        # integers, so we can safely use string formatting.
+        if self.config.synchronous is not None:
+            conn.execute("PRAGMA synchronous = %s" % (self.config.synchronous,))
+        if self.config.cache_size is not None:
+            conn.execute("PRAGMA cache_size = %d" % (self.config.cache_size,))
+        if self.config.mmap_size is not None:
+            conn.execute("PRAGMA mmap_size = %d" % (self.config.mmap_size,))
+
+        try:
+            conn.execute("SELECT json_valid('[]')")
+            self._supports_json = True
+        except sqlite3.OperationalError:
+            self._supports_json = False
+
+        return conn
+
+    def prepare_database(self, db: TransactionalConnection) -> None:
+        SqliteDatabase(db, self.config)
+
+    def get_schema_version(self, db: TransactionalConnection) -> int:
+        cur = db.cursor()
+        cur.execute("PRAGMA user_version")
+        row: Tuple[int] = cur.fetchone()
+        cur.close()
+        return row[0]
+
+    def convert_param_style(self, sql: str) -> str:
+        return sql
+
+    def in_transaction(self, conn: DBAPI2Connection) -> bool:
+        return bool(cast(sqlite3.Connection, conn).in_transaction)
+
+    def in_failed_transaction(self, conn: DBAPI2Connection) -> bool:
+        # A failed statement doesn't affect the rest of the transaction in SQLite.
+        return False
+
+    def begin_transaction(self, conn: DBAPI2Connection) -> None:
+        # sqlite3 only opens transactions implicitly before data-modifying statements,
+        # so we need to do it ourselves.
+        conn.cursor().execute("BEGIN")
+
+    def _array_clause(
+        self, column: str, values: Sequence[Any]
+    ) -> Optional[Tuple[str, List[Any]]]:
+        if not self._supports_json:
+            return None
+        return (
+            "%s IN (SELECT value FROM json_each(?))" % (column,),
+            [json.dumps(list(values))],
+        )
+
+    def insert_or_ignore(self, table: str, columns: Sequence[str]) -> str:
+        return "INSERT OR IGNORE INTO %s (%s) VALUES (%s)" % (
+            table,
+            ", ".join(columns),
+            ", ".join("?" for _ in columns),
+        )
@@ -9,19 +9,82 @@
 
 # Actions on the hashing_metadata table which is defined in the migration process in
 # sqlitedb.py
-from sqlite3 import Cursor
+#
+# Global associations have two lookup hash columns, lookup_hash and alt_lookup_hash,
+# so that the lookup pepper can be rotated without downtime. The lookup_hash_column
+# of hashing_metadata says which of them holds the hashes computed with the current
+# pepper. The other column holds either the hashes computed with the pepper being
+# rotated to (next_lookup_pepper), which a background update fills in, or once the
+# rotation has finished, the hashes computed with the previous pepper
+# (previous_lookup_pepper), so that clients which haven't fetched the new pepper yet
+# can still look up 3PIDs until the next rotation. Finishing a rotation only swaps
+# the roles of the columns, so it doesn't have to rewrite every row.
+import logging
 from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
 
+import attr
 from typing_extensions import Literal
 
+from sydent.db.background_updates import schedule_background_update
+from sydent.db.transaction import Cursor
+from sydent.types import JsonDict
+from sydent.util.hash import sha256_and_url_safe_base64
+from sydent.util.stringutils import normalise_address
+
 if TYPE_CHECKING:
     from sydent.sydent import Sydent
 
+logger = logging.getLogger(__name__)
+
+LOOKUP_HASH_COLUMNS = ("lookup_hash", "alt_lookup_hash")
+
+# The name of the background update rehashing 3PIDs with a new pepper.
+REHASH_LOOKUP_HASHES = "rehash_lookup_hashes"
+
+
+def _other_lookup_hash_column(column: str) -> str:
+    return LOOKUP_HASH_COLUMNS[1 - LOOKUP_HASH_COLUMNS.index(column)]
+
+
+def hash_threepid(medium: str, address: str, pepper: str) -> str:
+    """Compute the lookup hash of a 3PID.
+
+    :param medium: The medium of the 3PID.
+    :param address: The address of the 3PID, normalised with normalise_address.
+    :param pepper: The pepper to hash the 3PID with.
+
+    :return: The lookup hash.
+    """
+    # Combine the medium, address and pepper together in the following form:
+    # "address medium pepper"
+    # According to MSC2134: https://github.com/matrix-org/matrix-doc/pull/2134
+    return sha256_and_url_safe_base64("%s %s %s" % (address, medium, pepper))
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class LookupPeppers:
+    """The contents of the hashing_metadata table."""
+
+    # The pepper clients are told to use.
+    current: str
+    # The column holding the hashes computed with the current pepper.
+    hash_column: str
+    # The pepper used before the last rotation, if lookups can still use it.
+    previous: Optional[str]
+    # The pepper being rotated to, if a rotation is in progress.
+    next: Optional[str]
+
+
+class PepperRotationError(Exception):
+    """Raised when a rotation of the lookup pepper can't be started."""
+
+    pass
+
 
 class HashingMetadataStore:
     def __init__(self, sydent: "Sydent") -> None:
         self.sydent = sydent
-        self._cached_lookup_pepper: Optional[str] = None
+        self._cached_peppers: Optional[LookupPeppers] = None
 
     def get_lookup_pepper(self) -> Optional[str]:
         """Return the value of the current lookup pepper from the db
@@ -29,37 +92,115 @@ class HashingMetadataStore:
         :return: A pepper if it exists in the database, or None if one does
                  not exist
         """
+        peppers = self.get_lookup_peppers()
+        if peppers is None:
+            return None
+        return peppers.current
+
+    def get_lookup_peppers(self) -> Optional[LookupPeppers]:
+        """Return the current lookup pepper along with the previous and next ones, if
+        any, and the column holding the hashes computed with the current one.
 
-        if self._cached_lookup_pepper is not None:
-            return self._cached_lookup_pepper
+        :return: The peppers, or None if there isn't a pepper in the database yet.
+        """
+        if self._cached_peppers is not None:
+            return self._cached_peppers
 
         cur = self.sydent.db.cursor()
-        res = cur.execute("select lookup_pepper from hashing_metadata")
+        res = cur.execute(
+            "SELECT lookup_pepper, lookup_hash_column, previous_lookup_pepper, "
+            "next_lookup_pepper FROM hashing_metadata"
+        )
         # Annotation safety: lookup_pepper is marked as varchar(256) in the
         # schema, so could be null. I.e. `row` should strictly be
-        # Optional[Tuple[Optional[str]].
+        # Optional[Tuple[Optional[str], ...]].
         # But I think the application code is such that either
         #  - hashing_metadata contains no rows
         #  - or it contains exactly one row with a nonnull lookup_pepper.
-        row: Optional[Tuple[str]] = res.fetchone()
+        row: Optional[Tuple[str, str, Optional[str], Optional[str]]] = res.fetchone()
 
         if not row:
             return None
 
-        pepper = row[0]
+        pepper, hash_column, previous, next_pepper = row
 
         # Ensure we're dealing with unicode.
         if isinstance(pepper, bytes):
             pepper = pepper.decode("UTF-8")
 
-        self._cached_lookup_pepper = pepper
+        self._cached_peppers = LookupPeppers(pepper, hash_column, previous, next_pepper)
+
+        return self._cached_peppers
+
+    def reload(self) -> None:
+        """Forget the cached peppers, so that they're read from the database again.
+        Must be called whenever the database is changed by something else than this
+        store.
+        """
+        self._cached_peppers = None
+        # The lookup hashes may have been changed too, e.g. by a pepper rotation.
+        if self.sydent.lookup_cache is not None:
+            self.sydent.lookup_cache.clear_hashes()
+
+    def get_lookup_hash_column(self, pepper: str) -> Optional[str]:
+        """Return the column holding the lookup hashes computed with the given
+        pepper, if lookups can use it.
+
+        :param pepper: The pepper a client hashed 3PIDs with.
+
+        :return: The column to look up hashes in, or None if the pepper is neither
+            the current nor the previous one.
+        """
+        peppers = self.get_lookup_peppers()
+        if peppers is None:
+            return None
+        if pepper == peppers.current:
+            return peppers.hash_column
+        if pepper == peppers.previous:
+            return _other_lookup_hash_column(peppers.hash_column)
+        return None
+
+    def get_lookup_hash_values(
+        self, medium: str, address: str, lookup_hash: Optional[str]
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """Compute the values to store in the lookup_hash and alt_lookup_hash columns
+        of a new global association.
 
-        return pepper
+        :param medium: The medium of the association's 3PID.
+        :param address: The address of the association's 3PID.
+        :param lookup_hash: The hash of the 3PID computed with the current pepper, or
+            None to compute it here.
+
+        :return: The values of the lookup_hash and alt_lookup_hash columns.
+        """
+        peppers = self.get_lookup_peppers()
+        if peppers is None:
+            return lookup_hash, None
+
+        # Lookups only match associations through their hash, so always store one.
+        if lookup_hash is None:
+            lookup_hash = hash_threepid(
+                medium, normalise_address(address, medium), peppers.current
+            )
+
+        other_hash = None
+        other_pepper = peppers.next or peppers.previous
+        if other_pepper is not None:
+            other_hash = hash_threepid(
+                medium, normalise_address(address, medium), other_pepper
+            )
+
+        if peppers.hash_column == LOOKUP_HASH_COLUMNS[0]:
+            return lookup_hash, other_hash
+        return other_hash, lookup_hash
 
     def store_lookup_pepper(
         self, hashing_function: Callable[[str], str], pepper: str
     ) -> None:
-        """Stores a new lookup pepper in the hashing_metadata db table and rehashes all 3PIDs
+        """Stores a new lookup pepper in the hashing_metadata db table and rehashes all
+        3PIDs in a single transaction. This is only meant to be used when there
+        isn't a pepper yet, see start_pepper_rotation for changing the pepper of a
+        live server.
 
         :param hashing_function: A function with single input and output strings
 
@@ -68,10 +209,8 @@ class HashingMetadataStore:
         cur = self.sydent.db.cursor()
 
         # Create or update lookup_pepper
-        sql = (
-            "INSERT OR REPLACE INTO hashing_metadata (id, lookup_pepper) "
-            "VALUES (0, ?)"
-        )
+        cur.execute("DELETE FROM hashing_metadata WHERE id = 0")
+        sql = "INSERT INTO hashing_metadata (id, lookup_pepper) VALUES (0, ?)"
         cur.execute(sql, (pepper,))
 
         # Hand the cursor to each rehashing function
@@ -82,12 +221,18 @@ class HashingMetadataStore:
         self._rehash_threepids(
             cur, hashing_function, pepper, "global_threepid_associations"
         )
+        # Copy the new hashes over to the current mappings.
+        cur.execute(
+            "UPDATE global_threepid_current_mappings SET lookup_hash = ("
+            "SELECT lookup_hash FROM global_threepid_associations "
+            "WHERE id = association_id)"
+        )
 
         # Commit the queued db transactions so that adding a new pepper and hashing is atomic
         self.sydent.db.commit()
 
         # Update the cached pepper (only once the transaction has committed successfully!)
-        self._cached_lookup_pepper = pepper
+        self.reload()
 
     def _rehash_threepids(
         self,
@@ -107,46 +252,151 @@ class HashingMetadataStore:
         :param pepper: A pepper to append to the end of the 3PID (after a space) before hashing
         :param table: The database table to perform the rehashing on
         """
+        # Iterate through the table in order of ID, hash each medium, normalised
+        # address combo and store the hashes in the db
+        batch_size = 500
+        last_id = -1
+        while True:
+            sql = (
+                "SELECT id, medium, address FROM %s WHERE id > ? ORDER BY id LIMIT ?"
+                % (table,)
+            )
+            res = cur.execute(sql, (last_id, batch_size))
+            rows: List[Tuple[int, str, str]] = res.fetchall()
+            if not rows:
+                break
 
-        # Get count of all 3PID records
-        # Medium/address combos are marked as UNIQUE in the database
-        sql = "SELECT COUNT(*) FROM %s" % table
-        res = cur.execute(sql)
-        row: Tuple[int] = res.fetchone()
-        row_count = row[0]
+            cur.executemany(
+                "UPDATE %s SET lookup_hash = ? WHERE id = ?" % (table,),
+                [
+                    (
+                        hashing_function(
+                            "%s %s %s"
+                            % (normalise_address(address, medium), medium, pepper)
+                        ),
+                        id,
+                    )
+                    for id, medium, address in rows
+                    # Skip broken db entry
+                    if medium and address
+                ],
+            )
+            last_id = rows[-1][0]
 
-        # Iterate through each medium, address combo, hash it,
-        # and store in the db
-        batch_size = 500
-        count = 0
-        while count < row_count:
-            sql = "SELECT medium, address FROM %s ORDER BY id LIMIT %s OFFSET %s" % (
-                table,
-                batch_size,
-                count,
+    def start_pepper_rotation(self, pepper: str) -> None:
+        """Start rotating the lookup pepper: the 3PIDs are rehashed with the new
+        pepper by a background update, and clients are told to use the new pepper
+        once it has finished. New associations are hashed with both peppers in the
+        meantime.
+
+        :param pepper: The new pepper.
+
+        :raise PepperRotationError: if the pepper can't be rotated at the moment.
+        """
+        peppers = self.get_lookup_peppers()
+        if peppers is None:
+            raise PepperRotationError("There isn't a lookup pepper to rotate")
+        if peppers.next is not None:
+            raise PepperRotationError("The lookup pepper is already being rotated")
+        if pepper in (peppers.current, peppers.previous):
+            raise PepperRotationError("The new pepper must not have been used before")
+        if not self.sydent.background_updater.has_completed_all_updates():
+            raise PepperRotationError(
+                "The lookup pepper can't be rotated until the background updates "
+                "have finished"
             )
-            res = cur.execute(sql)
-            rows: List[Tuple[str, str]] = res.fetchall()
-
-            for medium, address in rows:
-                # Skip broken db entry
-                if not medium or not address:
-                    continue
-
-                # Combine the medium, address and pepper together in the
-                # following form: "address medium pepper"
-                # According to MSC2134: https://github.com/matrix-org/matrix-doc/pull/2134
-                combo = "%s %s %s" % (address, medium, pepper)
-
-                # Hash the resulting string
-                result = hashing_function(combo)
-
-                # Save the result to the DB
-                sql = (
-                    "UPDATE %s SET lookup_hash = ? "
-                    "WHERE medium = ? AND address = ?" % table
+
+        cur = self.sydent.db.cursor()
+        # The other hash column is about to be overwritten, so stop accepting the
+        # previous pepper.
+        cur.execute(
+            "UPDATE hashing_metadata SET previous_lookup_pepper = NULL, "
+            "next_lookup_pepper = ? WHERE id = 0",
+            (pepper,),
+        )
+        schedule_background_update(cur, REHASH_LOOKUP_HASHES, 1000)
+        self.sydent.db.commit()
+        self.reload()
+
+        logger.info("Started rotating the lookup pepper")
+        self.sydent.background_updater.add_update(REHASH_LOOKUP_HASHES)
+
+
+def rehash_lookup_hashes(
+    cur: Cursor, progress: JsonDict, batch_size: int
+) -> Tuple[int, Optional[JsonDict]]:
+    """The background update filling in the lookup hash column which isn't in use
+    with hashes computed with the next pepper, then making it the one in use.
+
+    It goes through global_threepid_associations in order of ID, then
+    global_threepid_current_mappings in order of 3PID. Associations added in the
+    meantime are hashed with both peppers when they're added. Finally, it rehashes
+    local_threepid_associations, whose hashes lookups don't use, in place.
+    """
+    cur.execute("SELECT lookup_hash_column, next_lookup_pepper FROM hashing_metadata")
+    row: Tuple[str, str] = cur.fetchone()
+    column = _other_lookup_hash_column(row[0])
+    pepper = row[1]
+
+    table = progress.get("table", "global_threepid_associations")
+
+    if table == "global_threepid_current_mappings":
+        # The current mappings are keyed on the 3PID rather than an ID.
+        medium, address = progress.get("last_threepid", ("", ""))
+        cur.execute(
+            "SELECT medium, normalised_address, address "
+            "FROM global_threepid_current_mappings "
+            "WHERE medium > ? OR (medium = ? AND normalised_address > ?) "
+            "ORDER BY medium, normalised_address LIMIT ?",
+            (medium, medium, address, batch_size),
+        )
+        mapping_rows: List[Tuple[str, str, str]] = cur.fetchall()
+        cur.executemany(
+            "UPDATE global_threepid_current_mappings SET %s = ? "
+            "WHERE medium = ? AND normalised_address = ?" % (column,),
+            [
+                (
+                    hash_threepid(medium, normalise_address(address, medium), pepper),
+                    medium,
+                    normalised,
                 )
-                # Lines up the query to be executed on commit
-                cur.execute(sql, (result, medium, address))
+                for medium, normalised, address in mapping_rows
+            ],
+        )
+        if len(mapping_rows) == batch_size:
+            last_threepid = list(mapping_rows[-1][:2])
+            return len(mapping_rows), {"table": table, "last_threepid": last_threepid}
+        return len(mapping_rows), {"table": "local_threepid_associations"}
+
+    # The local associations only have the one column.
+    if table == "local_threepid_associations":
+        column = "lookup_hash"
+
+    cur.execute(
+        "SELECT id, medium, address FROM %s WHERE id > ? ORDER BY id LIMIT ?"
+        % (table,),
+        (progress.get("last_id", -1), batch_size),
+    )
+    rows: List[Tuple[int, str, str]] = cur.fetchall()
+    cur.executemany(
+        "UPDATE %s SET %s = ? WHERE id = ?" % (table, column),
+        [
+            (hash_threepid(medium, normalise_address(address, medium), pepper), id)
+            for id, medium, address in rows
+            if medium and address
+        ],
+    )
+    if len(rows) == batch_size:
+        return len(rows), {"table": table, "last_id": rows[-1][0]}
+    if table == "global_threepid_associations":
+        return len(rows), {"table": "global_threepid_current_mappings"}
 
-            count += len(rows)
+    # Everything has been rehashed: switch over to the new pepper.
+    cur.execute(
+        "UPDATE hashing_metadata SET previous_lookup_pepper = lookup_pepper, "
+        "lookup_pepper = next_lookup_pepper, next_lookup_pepper = NULL, "
+        "lookup_hash_column = ? WHERE id = 0",
+        (_other_lookup_hash_column(row[0]),),
+    )
+    logger.info("Rehashed every 3PID with the new lookup pepper")
+    return len(rows), None
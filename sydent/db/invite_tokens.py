@@ -35,7 +35,7 @@ class JoinTokenStore:
 
         cur.execute(
             "INSERT INTO invite_tokens"
-            " ('medium', 'address', 'room_id', 'sender', 'token', 'received_ts')"
+            " (medium, address, room_id, sender, token, received_ts)"
             " VALUES (?, ?, ?, ?, ?, ?)",
             (medium, normalised_address, roomId, sender, token, int(time.time())),
         )
@@ -0,0 +1,246 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+"""A Bloom filter of the 3PIDs and lookup hashes of
+global_threepid_current_mappings, which answers lookups for 3PIDs which aren't bound
+without going to the database.
+
+Most lookups are misses, as clients send the whole address book of their user to
+find the few contacts which are on Matrix. The filter holds the (medium, normalised
+address) and the lookup hashes of every current mapping which hasn't expired, and
+lookups only query the database for the 3PIDs and hashes the filter may contain.
+
+Bound 3PIDs are added to the filter once the transaction binding them has committed,
+but a Bloom filter can't forget anything, so unbound 3PIDs stay in it until it is
+rebuilt. It is rebuilt in the background every few hours, once it holds more items
+than it was sized for, and whenever the lookup hashes have changed.
+"""
+
+import logging
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+from twisted.internet import defer
+
+from sydent.db.lookup_hash_index import CurrentMapping
+from sydent.db.transaction import Cursor
+from sydent.util import time_msec
+from sydent.util.bloomfilter import BloomFilter
+from sydent.util.stringutils import normalise_address_for_lookup
+
+if TYPE_CHECKING:
+    from sydent.sydent import Sydent
+
+logger = logging.getLogger(__name__)
+
+lookup_bloom_filter_results = Counter(
+    "sydent_lookup_bloom_filter_results",
+    "Number of 3PIDs and hashes looked up, by whether the Bloom filter answered that "
+    "they're not bound (negative, saving a database probe), or let them through to "
+    "the database which found them bound (hit) or not (false_positive)",
+    labelnames=("kind", "result"),
+)
+lookup_bloom_filter_size = Gauge(
+    "sydent_lookup_bloom_filter_size_bytes",
+    "Size of the lookup Bloom filter's bit array",
+)
+
+
+def _threepid_item(medium: str, normalised_address: str) -> str:
+    return "3pid\0%s\0%s" % (medium, normalised_address)
+
+
+def _hash_item(lookup_hash: str) -> str:
+    return "hash\0" + lookup_hash
+
+
+class LookupBloomFilter:
+    """See the module docstring."""
+
+    # The false positive rate to size the filter for.
+    FALSE_POSITIVE_RATE = 0.01
+    # How much larger than the current number of items to make the filter, so that
+    # it doesn't have to be rebuilt too often as 3PIDs are bound.
+    HEADROOM = 1.25
+    # The number of rows to read from the database at once when building the filter.
+    LOAD_BATCH_SIZE = 10000
+
+    def __init__(self, sydent: "Sydent") -> None:
+        self.sydent = sydent
+        self._filter: Optional[BloomFilter] = None
+        # The 3PIDs and hashes bound while the filter is being rebuilt, if it is.
+        self._pending_items: Optional[List[str]] = None
+        self._load_generation = 0
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the filter has been built, and can answer lookups."""
+        return self._filter is not None
+
+    def start_loading(self) -> None:
+        """(Re)build the filter in the background."""
+        defer.ensureDeferred(self._load_in_background())
+
+    async def _load_in_background(self) -> None:
+        try:
+            await self.load()
+        except Exception:
+            logger.exception("Failed to build the lookup Bloom filter")
+
+    async def load(self) -> None:
+        """(Re)build the filter from the database. The previous filter, if any, keeps
+        answering lookups in the meantime.
+        """
+        self._pending_items = []
+        # If the filter gets rebuilt again in the meantime, let the newest build win.
+        self._load_generation += 1
+        generation = self._load_generation
+
+        try:
+            bloom_filter = await self.sydent.db_pool.runInteraction(
+                "load_lookup_bloom_filter", self._loadTxn
+            )
+        except Exception:
+            if generation == self._load_generation:
+                self._pending_items = None
+            raise
+        if generation != self._load_generation:
+            return
+
+        # Add the items which may have been bound after the rows were read.
+        for item in self._pending_items:
+            bloom_filter.add(item)
+        self._pending_items = None
+
+        self._filter = bloom_filter
+        lookup_bloom_filter_size.set(bloom_filter.size)
+        logger.info(
+            "Built the lookup Bloom filter: %d items in %d bytes",
+            len(bloom_filter),
+            bloom_filter.size,
+        )
+
+    def _loadTxn(self, cur: Cursor) -> BloomFilter:
+        now = time_msec()
+        cur.execute(
+            "SELECT COUNT(*) FROM global_threepid_current_mappings WHERE notAfter > ?",
+            (now,),
+        )
+        row: Tuple[int] = cur.fetchone()
+        # Each mapping has up to three items: its 3PID, and its hash in each of the
+        # lookup hash columns.
+        bloom_filter = BloomFilter(
+            int(row[0] * 3 * self.HEADROOM), self.FALSE_POSITIVE_RATE
+        )
+
+        last_threepid = ("", "")
+        while True:
+            cur.execute(
+                "SELECT medium, normalised_address, lookup_hash, alt_lookup_hash "
+                "FROM global_threepid_current_mappings "
+                "WHERE (medium > ? OR (medium = ? AND normalised_address > ?)) "
+                "AND notAfter > ? "
+                "ORDER BY medium, normalised_address LIMIT ?",
+                (
+                    last_threepid[0],
+                    last_threepid[0],
+                    last_threepid[1],
+                    now,
+                    self.LOAD_BATCH_SIZE,
+                ),
+            )
+            rows: List[Tuple[str, str, Optional[str], Optional[str]]] = cur.fetchall()
+            for medium, normalised_address, lookup_hash, alt_lookup_hash in rows:
+                bloom_filter.add(_threepid_item(medium, normalised_address))
+                for h in (lookup_hash, alt_lookup_hash):
+                    if h is not None:
+                        bloom_filter.add(_hash_item(h))
+            if len(rows) < self.LOAD_BATCH_SIZE:
+                return bloom_filter
+            last_threepid = (rows[-1][0], rows[-1][1])
+
+    def add(
+        self, threepids: Iterable[Tuple[str, str]], mappings: Iterable[CurrentMapping]
+    ) -> None:
+        """Add newly bound 3PIDs to the filter. Must be called once the change has
+        been committed.
+
+        :param threepids: The (medium, normalised address) of the 3PIDs.
+        :param mappings: The current mappings of the 3PIDs, for their lookup hashes.
+        """
+        items = [_threepid_item(medium, address) for medium, address in threepids]
+        for mapping in mappings:
+            items.extend(_hash_item(h) for h in mapping[:2] if h is not None)
+
+        if self._pending_items is not None:
+            self._pending_items.extend(items)
+        if self._filter is None:
+            return
+        for item in items:
+            self._filter.add(item)
+
+        if len(self._filter) > self._filter.capacity and self._pending_items is None:
+            logger.info("The lookup Bloom filter is full, rebuilding it")
+            self.start_loading()
+
+    def filter_threepids(
+        self, threepids: Iterable[Tuple[str, str]]
+    ) -> List[Tuple[str, str]]:
+        """Drop the 3PIDs which definitely aren't bound.
+
+        :param threepids: The (medium, address) of the 3PIDs to look up.
+
+        :return: The 3PIDs which may be bound, or all of them if the filter hasn't
+            been built yet.
+        """
+        if self._filter is None:
+            return list(threepids)
+
+        results = []
+        negatives = 0
+        for medium, address in threepids:
+            item = _threepid_item(medium, normalise_address_for_lookup(address))
+            if item in self._filter:
+                results.append((medium, address))
+            else:
+                negatives += 1
+        lookup_bloom_filter_results.labels("3pid", "negative").inc(negatives)
+        return results
+
+    def filter_hashes(self, lookup_hashes: Iterable[str]) -> List[str]:
+        """Drop the lookup hashes which definitely aren't bound.
+
+        :param lookup_hashes: The hashes to look up.
+
+        :return: The hashes which may be bound, or all of them if the filter hasn't
+            been built yet.
+        """
+        if self._filter is None:
+            return list(lookup_hashes)
+
+        results = []
+        negatives = 0
+        for lookup_hash in lookup_hashes:
+            if _hash_item(lookup_hash) in self._filter:
+                results.append(lookup_hash)
+            else:
+                negatives += 1
+        lookup_bloom_filter_results.labels("hash", "negative").inc(negatives)
+        return results
+
+    def record_results(self, kind: str, candidates: int, hits: int) -> None:
+        """Record how many of the 3PIDs or hashes let through by the filter were
+        found bound in the database.
+
+        :param kind: "3pid" or "hash".
+        :param candidates: The number of distinct 3PIDs or hashes let through.
+        :param hits: The number of them found bound.
+        """
+        if self._filter is None:
+            return
+        lookup_bloom_filter_results.labels(kind, "hit").inc(hits)
+        lookup_bloom_filter_results.labels(kind, "false_positive").inc(
+            max(candidates - hits, 0)
+        )
@@ -0,0 +1,85 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+"""LRU caches of the results of lookups, by 3PID and by lookup hash, so that the
+3PIDs which are looked up over and over (support addresses, bots...) don't need a
+database query each time.
+
+The caches hold the current mappings the lookups read, along with their notBefore
+and notAfter, so that whether they are valid is checked whenever they are read. They
+also remember the 3PIDs and hashes which aren't bound. GlobalAssociationStore
+invalidates the entries of the 3PIDs and hashes whose current mappings change once
+the change has been committed, and the results of the lookups which were in progress
+at the time aren't cached, see LruCache.set_many.
+
+Like the lookup hash index, the caches only see the changes made by the process
+holding them, so workers don't use them.
+"""
+
+from typing import Iterable, Optional, Tuple
+
+from sydent.db.hashing_metadata import LOOKUP_HASH_COLUMNS
+from sydent.db.lookup_hash_index import CurrentMapping
+from sydent.util.lrucache import LruCache
+
+# A 3PID's medium and normalised address.
+ThreepidKey = Tuple[str, str]
+# A lookup hash column, and a hash in it.
+HashKey = Tuple[str, str]
+
+# The medium, address, MXID, notBefore and notAfter of a 3PID's current mapping.
+MxidEntry = Tuple[str, str, str, int, int]
+# The ID and signed association of a 3PID's current mapping, with its notBefore and
+# notAfter.
+SignedAssociationEntry = Tuple[int, str, int, int]
+# The MXID of the current mapping a lookup hash belongs to, with its notBefore and
+# notAfter.
+HashEntry = Tuple[str, int, int]
+
+
+class LookupCache:
+    """See the module docstring."""
+
+    def __init__(self, max_size: int) -> None:
+        """
+        :param max_size: The maximum number of entries to hold in each cache.
+        """
+        # None for the 3PIDs and hashes which aren't bound.
+        self.mxids: LruCache[ThreepidKey, Optional[MxidEntry]] = LruCache(
+            "lookup_mxid", max_size
+        )
+        self.signed_associations: LruCache[
+            ThreepidKey, Optional[SignedAssociationEntry]
+        ] = LruCache("lookup_signed_association", max_size)
+        self.hashes: LruCache[HashKey, Optional[HashEntry]] = LruCache(
+            "lookup_hash", max_size
+        )
+
+    def invalidate(
+        self, threepids: Iterable[ThreepidKey], mappings: Iterable[CurrentMapping]
+    ) -> None:
+        """Forget the lookups of 3PIDs whose current mappings have changed. Must be
+        called once the change has been committed.
+
+        :param threepids: The (medium, normalised address) of the 3PIDs.
+        :param mappings: The current mappings of the 3PIDs before and after the
+            change, for their lookup hashes.
+        """
+        threepids = list(threepids)
+        self.mxids.invalidate(threepids)
+        self.signed_associations.invalidate(threepids)
+        self.hashes.invalidate(
+            (column, lookup_hash)
+            for mapping in mappings
+            for lookup_hash in mapping[:2]
+            if lookup_hash is not None
+            for column in LOOKUP_HASH_COLUMNS
+        )
+
+    def clear_hashes(self) -> None:
+        """Forget every lookup by hash, e.g. because the lookup hashes have been
+        changed.
+        """
+        self.hashes.clear()
@@ -0,0 +1,332 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+"""An in-memory copy of the lookup hashes of global_threepid_current_mappings, which
+serves hashed v2 lookups without going to the database.
+
+The index is loaded on the database pool once the current mappings have been built,
+and reloaded after each rotation of the lookup pepper. GlobalAssociationStore keeps
+it in step with the database by passing it the current mappings of the 3PIDs each
+transaction changes, once the transaction has committed. Lookups are served from the
+database until the index has been loaded.
+"""
+
+import base64
+import logging
+import sys
+from array import array
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+from prometheus_client import Gauge
+from twisted.internet import defer
+
+from sydent.db.hashing_metadata import LOOKUP_HASH_COLUMNS
+from sydent.db.transaction import Cursor
+
+if TYPE_CHECKING:
+    from sydent.sydent import Sydent
+
+logger = logging.getLogger(__name__)
+
+# A row of global_threepid_current_mappings: its lookup_hash, alt_lookup_hash, mxid,
+# notBefore and notAfter.
+CurrentMapping = Tuple[Optional[str], Optional[str], str, int, int]
+
+lookup_hash_index_entries = Gauge(
+    "sydent_lookup_hash_index_entries",
+    "Number of 3PIDs in the in-memory lookup hash index",
+)
+lookup_hash_index_size = Gauge(
+    "sydent_lookup_hash_index_size_bytes",
+    "Approximate memory used by the in-memory lookup hash index",
+)
+
+# The size of a key holding a SHA-256 digest.
+_KEY_SIZE = sys.getsizeof(bytes(32))
+# The size of a slot number, most of which are too large to be shared by Python.
+_SLOT_SIZE = sys.getsizeof(2**20)
+
+
+def lookup_hash_digest(lookup_hash: str) -> Optional[bytes]:
+    """
+    :param lookup_hash: A lookup hash.
+
+    :return: The 32 bytes of SHA-256 digest the hash is the URL-safe unpadded base64
+        encoding of, or None if it isn't one (e.g. if it's been stored by an older
+        version or is garbage sent by a client).
+    """
+    if len(lookup_hash) == 43:
+        try:
+            digest = base64.urlsafe_b64decode(lookup_hash + "=")
+            if base64.urlsafe_b64encode(digest)[:43] == lookup_hash.encode("ascii"):
+                return digest
+        except ValueError:
+            pass
+    return None
+
+
+def _key(lookup_hash: str) -> bytes:
+    """Turn a lookup hash into the key it's stored under: its digest, or if it isn't
+    one, something which can't be mistaken for a digest.
+    """
+    digest = lookup_hash_digest(lookup_hash)
+    if digest is not None:
+        return digest
+    return b"\0" + lookup_hash.encode("utf-8", "surrogatepass")
+
+
+class _Entries:
+    """The contents of the index. Each 3PID occupies a slot, which holds its MXID
+    and validity period, and is found through the keys of its lookup hashes.
+
+    This is laid out to keep the per-3PID overhead low: the keys are raw digests
+    rather than base64 strings, the validity periods are stored as machine integers,
+    the MXIDs are interned, and there is no per-3PID object.
+    """
+
+    def __init__(self) -> None:
+        # The slot of each key, for each lookup hash column.
+        self.slots: Tuple[Dict[bytes, int], Dict[bytes, int]] = ({}, {})
+        # The keys of each slot, for each lookup hash column, so that the slot can
+        # be removed.
+        self.keys: Tuple[List[Optional[bytes]], List[Optional[bytes]]] = ([], [])
+        self.mxids: List[Optional[str]] = []
+        self.not_before = array("q")
+        self.not_after = array("q")
+        # The slots which have been removed, and can be reused.
+        self.free_slots: List[int] = []
+        # The total size of the MXIDs, without taking interning into account.
+        self.mxids_size = 0
+
+    def add(self, mapping: CurrentMapping) -> None:
+        lookup_hash, alt_lookup_hash, mxid, not_before, not_after = mapping
+        keys = [
+            _key(h) if h is not None else None for h in (lookup_hash, alt_lookup_hash)
+        ]
+
+        # Replace whichever 3PID these hashes were pointing to.
+        for column, key in enumerate(keys):
+            if key is not None and key in self.slots[column]:
+                self._remove_slot(self.slots[column][key])
+
+        mxid = sys.intern(mxid)
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.mxids[slot] = mxid
+            self.not_before[slot] = not_before
+            self.not_after[slot] = not_after
+            for column, key in enumerate(keys):
+                self.keys[column][slot] = key
+        else:
+            slot = len(self.mxids)
+            self.mxids.append(mxid)
+            self.not_before.append(not_before)
+            self.not_after.append(not_after)
+            for column, key in enumerate(keys):
+                self.keys[column].append(key)
+
+        for column, key in enumerate(keys):
+            if key is not None:
+                self.slots[column][key] = slot
+        self.mxids_size += sys.getsizeof(mxid)
+
+    def remove(self, mapping: CurrentMapping) -> None:
+        for column, lookup_hash in enumerate(mapping[:2]):
+            if lookup_hash is None:
+                continue
+            slot = self.slots[column].get(_key(lookup_hash))
+            if slot is not None:
+                self._remove_slot(slot)
+
+    def _remove_slot(self, slot: int) -> None:
+        for column in range(len(LOOKUP_HASH_COLUMNS)):
+            key = self.keys[column][slot]
+            if key is not None and self.slots[column].get(key) == slot:
+                del self.slots[column][key]
+            self.keys[column][slot] = None
+
+        mxid = self.mxids[slot]
+        assert mxid is not None
+        self.mxids_size -= sys.getsizeof(mxid)
+        self.mxids[slot] = None
+        self.free_slots.append(slot)
+
+    def __len__(self) -> int:
+        return len(self.mxids) - len(self.free_slots)
+
+    def memory_usage(self) -> int:
+        """
+        :return: An estimate of the number of bytes used by the entries.
+        """
+        return (
+            sum(sys.getsizeof(slots) for slots in self.slots)
+            + sum(len(slots) for slots in self.slots) * _KEY_SIZE
+            + len(self) * _SLOT_SIZE
+            + sum(sys.getsizeof(keys) for keys in self.keys)
+            + sys.getsizeof(self.mxids)
+            + sys.getsizeof(self.not_before)
+            + sys.getsizeof(self.not_after)
+            + sys.getsizeof(self.free_slots)
+            + self.mxids_size
+        )
+
+
+class LookupHashIndex:
+    """Maps the lookup hashes of the current mappings to their MXIDs, see the module
+    docstring.
+    """
+
+    # The number of rows to read from the database at once when loading the index.
+    LOAD_BATCH_SIZE = 10000
+
+    def __init__(self, sydent: "Sydent") -> None:
+        self.sydent = sydent
+        self._entries = _Entries()
+        self._loaded = False
+        # The changes made while the index is being loaded, if it is.
+        self._pending_changes: Optional[
+            List[Tuple[List[CurrentMapping], List[CurrentMapping]]]
+        ] = None
+        self._load_generation = 0
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the index is up to date, and can serve lookups."""
+        return self._loaded
+
+    def start_loading(self) -> None:
+        """(Re)load the index in the background."""
+        defer.ensureDeferred(self._load_in_background())
+
+    async def _load_in_background(self) -> None:
+        try:
+            await self.load()
+        except Exception:
+            logger.exception(
+                "Failed to load the lookup hash index, serving lookups from the "
+                "database instead"
+            )
+
+    async def load(self) -> None:
+        """(Re)load the index from the database. Lookups aren't served from the index
+        until this has completed.
+        """
+        self._loaded = False
+        self._pending_changes = []
+        # If the index gets reloaded again in the meantime, let the newest load win.
+        self._load_generation += 1
+        generation = self._load_generation
+
+        try:
+            entries = await self.sydent.db_pool.runInteraction(
+                "load_lookup_hash_index", self._loadTxn
+            )
+        except Exception:
+            if generation == self._load_generation:
+                self._pending_changes = None
+            raise
+        if generation != self._load_generation:
+            return
+
+        # Apply the changes which may have been committed after the rows were read.
+        # Applying those which were committed before is harmless.
+        for old_mappings, new_mappings in self._pending_changes:
+            self._apply(entries, old_mappings, new_mappings)
+        self._pending_changes = None
+
+        self._entries = entries
+        self._loaded = True
+        self._update_metrics()
+        logger.info("Loaded %d 3PIDs into the lookup hash index", len(entries))
+
+    def _loadTxn(self, cur: Cursor) -> _Entries:
+        entries = _Entries()
+
+        # Go through the table in batches, so that the driver doesn't hold every row
+        # in memory at once.
+        last_threepid = ("", "")
+        while True:
+            cur.execute(
+                "SELECT medium, normalised_address, lookup_hash, alt_lookup_hash, "
+                "mxid, notBefore, notAfter FROM global_threepid_current_mappings "
+                "WHERE medium > ? OR (medium = ? AND normalised_address > ?) "
+                "ORDER BY medium, normalised_address LIMIT ?",
+                (
+                    last_threepid[0],
+                    last_threepid[0],
+                    last_threepid[1],
+                    self.LOAD_BATCH_SIZE,
+                ),
+            )
+            rows: List[Tuple[str, str, Optional[str], Optional[str], str, int, int]]
+            rows = cur.fetchall()
+            for row in rows:
+                entries.add(row[2:])
+            if len(rows) < self.LOAD_BATCH_SIZE:
+                return entries
+            last_threepid = (rows[-1][0], rows[-1][1])
+
+    def update(
+        self,
+        old_mappings: Iterable[CurrentMapping],
+        new_mappings: Iterable[CurrentMapping],
+    ) -> None:
+        """Replace the current mappings of some 3PIDs. Must be called once the change
+        has been committed.
+
+        :param old_mappings: The current mappings of the 3PIDs before the change.
+        :param new_mappings: The current mappings of the 3PIDs after the change.
+        """
+        old_mappings = list(old_mappings)
+        new_mappings = list(new_mappings)
+
+        if self._pending_changes is not None:
+            self._pending_changes.append((old_mappings, new_mappings))
+        self._apply(self._entries, old_mappings, new_mappings)
+        self._update_metrics()
+
+    @staticmethod
+    def _apply(
+        entries: _Entries,
+        old_mappings: List[CurrentMapping],
+        new_mappings: List[CurrentMapping],
+    ) -> None:
+        for mapping in old_mappings:
+            entries.remove(mapping)
+        for mapping in new_mappings:
+            entries.add(mapping)
+
+    def get_mxids(
+        self, lookup_hashes: Iterable[str], lookup_hash_column: str, now: int
+    ) -> Dict[str, str]:
+        """Look up the MXIDs of the given hashes.
+
+        :param lookup_hashes: The lookup hashes to look up.
+        :param lookup_hash_column: The column the hashes would be stored in, see
+            HashingMetadataStore.get_lookup_hash_column.
+        :param now: The current time, in milliseconds since the epoch.
+
+        :return: The MXID of each hash which is bound to one, and whose binding is
+            currently valid.
+        """
+        entries = self._entries
+        slots = entries.slots[LOOKUP_HASH_COLUMNS.index(lookup_hash_column)]
+
+        results = {}
+        for lookup_hash in lookup_hashes:
+            slot = slots.get(_key(lookup_hash))
+            if slot is None:
+                continue
+            # 'notBefore' is the time the association starts being valid, 'notAfter'
+            # the time at which it ceases to be valid.
+            if entries.not_before[slot] < now < entries.not_after[slot]:
+                mxid = entries.mxids[slot]
+                assert mxid is not None
+                results[lookup_hash] = mxid
+        return results
+
+    def _update_metrics(self) -> None:
+        lookup_hash_index_entries.set(len(self._entries))
+        lookup_hash_index_size.set(self._entries.memory_usage())
@@ -0,0 +1,626 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+"""A snapshot of the lookup hashes of global_threepid_current_mappings written to a
+file, which serves hashed v2 lookups without going to the database and without each
+process holding its own copy of the hashes in memory.
+
+The snapshot is written every few minutes, and whenever the lookup hashes have
+changed. It holds the SHA-256 digests of the lookup hashes computed with the current
+pepper, sorted and of a fixed width, each with the offset of its MXID in a blob of
+MXIDs at the end of the file, so that it can be memory-mapped and binary searched in
+place. Every process mapping the file shares the same copy of it in the page cache.
+
+The 3PIDs bound or unbound since the snapshot was written are found in
+global_threepid_mapping_changes, which update_current_mappings logs them to, and
+which each process polls into an overlay of the snapshot holding the current
+mappings of the hashes which have changed. The writer prunes the log once every
+process has had time to switch to a newer snapshot. Changes made by this process
+are applied to its overlay as soon as they have been committed.
+
+The stream IDs of the log are assumed to be committed in order, which holds as long
+as the associations are only written through a single connection, as Sydent does.
+"""
+
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+from typing import IO, TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+from prometheus_client import Gauge
+from twisted.internet import defer
+
+from sydent.db.hashing_metadata import LOOKUP_HASH_COLUMNS
+from sydent.db.lookup_hash_index import CurrentMapping, lookup_hash_digest
+from sydent.db.transaction import Cursor
+from sydent.db.updates import POPULATE_CURRENT_MAPPINGS
+from sydent.util import time_msec
+
+if TYPE_CHECKING:
+    from sydent.sydent import Sydent
+
+logger = logging.getLogger(__name__)
+
+lookup_snapshot_entries = Gauge(
+    "sydent_lookup_snapshot_entries",
+    "Number of lookup hashes in the lookup snapshot in use",
+)
+lookup_snapshot_overlay_entries = Gauge(
+    "sydent_lookup_snapshot_overlay_entries",
+    "Number of lookup hashes which have changed since the lookup snapshot in use was "
+    "written",
+)
+
+_MAGIC = b"SYDLKUP1"
+# The magic number, the stream ID of the last change included in the snapshot, the
+# number of records, and the offsets of the bucket table, the records and the MXIDs.
+_HEADER = struct.Struct("<8sqQQQQ")
+# The length of the pepper and of the name of the hash column, which follow the
+# header.
+_STRING_LENGTH = struct.Struct("<H")
+# The records are split into buckets by the first two bytes of their digest. The
+# bucket table holds the index of the first record of each bucket, followed by the
+# number of records.
+_NUM_BUCKETS = 1 << 16
+_BUCKET_START = struct.Struct("<Q")
+# A digest, the offset and length of its MXID in the MXID blob, and the notBefore
+# and notAfter of its mapping.
+_RECORD = struct.Struct("<32sQIqq")
+
+# The MXID and the notBefore and notAfter of a mapping.
+_Mapping = Tuple[str, int, int]
+# The stream ID and lookup hashes of a change, followed by the lookup hashes, MXID,
+# notBefore and notAfter of the current mapping of its 3PID, if it has one.
+_ChangeRow = Tuple[
+    int,
+    Optional[str],
+    Optional[str],
+    Optional[str],
+    Optional[str],
+    Optional[str],
+    Optional[int],
+    Optional[int],
+]
+
+
+def _bucket(digest: bytes) -> int:
+    return (digest[0] << 8) | digest[1]
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+class _SnapshotFile:
+    """A memory-mapped snapshot file."""
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            (
+                magic,
+                self.stream_id,
+                self.count,
+                self._buckets_offset,
+                self._records_offset,
+                self._blob_offset,
+            ) = _HEADER.unpack_from(self._mmap)
+            if magic != _MAGIC:
+                raise ValueError("%s isn't a lookup snapshot" % (path,))
+            if self._blob_offset != self._records_offset + self.count * _RECORD.size:
+                raise ValueError("%s is truncated" % (path,))
+
+            offset = _HEADER.size
+            self.pepper, offset = self._read_string(offset)
+            self.lookup_hash_column, offset = self._read_string(offset)
+        except (struct.error, UnicodeDecodeError):
+            self.close()
+            raise ValueError("%s isn't a valid lookup snapshot" % (path,))
+        except Exception:
+            self.close()
+            raise
+
+    def _read_string(self, offset: int) -> Tuple[str, int]:
+        (length,) = _STRING_LENGTH.unpack_from(self._mmap, offset)
+        offset += _STRING_LENGTH.size
+        value = self._mmap[offset : offset + length].decode("utf-8")
+        return value, offset + length
+
+    def get(self, digest: bytes) -> Optional[_Mapping]:
+        """Look up the mapping of a digest.
+
+        :param digest: The SHA-256 digest of a lookup hash.
+
+        :return: The mapping of the digest, if it's in the snapshot.
+        """
+        mm = self._mmap
+        bucket_offset = self._buckets_offset + _bucket(digest) * _BUCKET_START.size
+        (lo,) = _BUCKET_START.unpack_from(mm, bucket_offset)
+        (hi,) = _BUCKET_START.unpack_from(mm, bucket_offset + _BUCKET_START.size)
+
+        records_offset = self._records_offset
+        record_size = _RECORD.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = records_offset + mid * record_size
+            key = mm[offset : offset + 32]
+            if key < digest:
+                lo = mid + 1
+            elif key > digest:
+                hi = mid
+            else:
+                (
+                    _,
+                    mxid_offset,
+                    mxid_length,
+                    not_before,
+                    not_after,
+                ) = _RECORD.unpack_from(mm, offset)
+                mxid_offset += self._blob_offset
+                mxid = mm[mxid_offset : mxid_offset + mxid_length].decode("utf-8")
+                return mxid, not_before, not_after
+        return None
+
+    def close(self) -> None:
+        self._mmap.close()
+
+
+class _Overlay:
+    """The mappings of the lookup hashes which have changed since a snapshot was
+    written, with None for the hashes which no longer map to anything.
+
+    Each mapping is tagged with the stream ID of the change it comes from, so that
+    changes can be applied in any order: a mapping never replaces one from a later
+    change.
+    """
+
+    def __init__(self, stream_id: int, lookup_hash_column: str) -> None:
+        # The stream ID of the last change read from the database.
+        self.stream_id = stream_id
+        self._column = LOOKUP_HASH_COLUMNS.index(lookup_hash_column)
+        self.mappings: Dict[str, Tuple[int, Optional[_Mapping]]] = {}
+
+    def _set(
+        self, lookup_hash: str, stream_id: int, mapping: Optional[_Mapping]
+    ) -> None:
+        existing = self.mappings.get(lookup_hash)
+        if existing is None or existing[0] <= stream_id:
+            self.mappings[lookup_hash] = (stream_id, mapping)
+
+    def apply_changes(self, rows: Iterable[_ChangeRow]) -> None:
+        """Apply rows read by LookupSnapshot._pollTxn."""
+        for row in rows:
+            stream_id = row[0]
+            old_hash = row[1:3][self._column]
+            if old_hash is not None:
+                self._set(old_hash, stream_id, None)
+            new_hash = row[3:5][self._column]
+            mxid, not_before, not_after = row[5:]
+            if new_hash is not None and mxid is not None:
+                assert not_before is not None and not_after is not None
+                self._set(new_hash, stream_id, (mxid, not_before, not_after))
+            self.stream_id = max(self.stream_id, stream_id)
+
+    def apply_mappings(
+        self,
+        stream_id: int,
+        old_mappings: Iterable[CurrentMapping],
+        new_mappings: Iterable[CurrentMapping],
+    ) -> None:
+        """Apply a change made by this process."""
+        for mapping in old_mappings:
+            old_hash = mapping[:2][self._column]
+            if old_hash is not None:
+                self._set(old_hash, stream_id, None)
+        for mapping in new_mappings:
+            new_hash = mapping[:2][self._column]
+            if new_hash is not None:
+                self._set(new_hash, stream_id, mapping[2:])
+
+
+class LookupSnapshot:
+    """Maps lookup hashes to MXIDs through a snapshot file, see the module
+    docstring.
+    """
+
+    # How often to read the changes made since the snapshot was written, in seconds.
+    POLL_INTERVAL = 1.0
+    # The number of rows to read from the database at once.
+    BATCH_SIZE = 10000
+
+    def __init__(self, sydent: "Sydent") -> None:
+        self.sydent = sydent
+        path = sydent.config.database.lookup_snapshot_path
+        assert path is not None
+        self.path = path
+
+        self._snapshot: Optional[_SnapshotFile] = None
+        self._overlay: Optional[_Overlay] = None
+        # The overlay of a snapshot which is being opened, if one is.
+        self._new_overlay: Optional[_Overlay] = None
+        # The stream ID of the last snapshot this process wrote.
+        self._written_stream_id: Optional[int] = None
+        self._writing = False
+        self._refreshing = False
+
+    @property
+    def loaded(self) -> bool:
+        """Whether a snapshot has been opened, and can serve lookups."""
+        return self._snapshot is not None
+
+    def start_writing(self) -> None:
+        """Write a new snapshot in the background."""
+        defer.ensureDeferred(self._write_in_background())
+
+    async def _write_in_background(self) -> None:
+        try:
+            await self.write()
+        except Exception:
+            logger.exception("Failed to write the lookup snapshot")
+
+    async def write(self) -> None:
+        """Write a new snapshot of the current mappings and start using it. Does
+        nothing until the current mappings have been built.
+        """
+        if not self.sydent.background_updater.has_completed_update(
+            POPULATE_CURRENT_MAPPINGS
+        ):
+            return
+        if self._writing:
+            return
+
+        self._writing = True
+        try:
+            stream_id, count = await self.sydent.db_pool.runInteraction(
+                "write_lookup_snapshot", self._writeTxn
+            )
+            logger.info(
+                "Wrote %d lookup hashes to the lookup snapshot %s", count, self.path
+            )
+            await self.refresh()
+
+            # Every process has had an interval's worth of time to switch to the
+            # previous snapshot, so the changes it includes aren't needed any more.
+            if self._written_stream_id is not None:
+                await self.sydent.db_pool.runInteraction(
+                    "prune_lookup_snapshot_changes",
+                    self._pruneTxn,
+                    self._written_stream_id,
+                )
+            self._written_stream_id = stream_id
+        finally:
+            self._writing = False
+
+    def _writeTxn(self, cur: Cursor) -> Tuple[int, int]:
+        # Read the stream ID first, so that changes made while the mappings are
+        # being read are in the overlay.
+        cur.execute(
+            "SELECT COALESCE(MAX(stream_id), 0) FROM global_threepid_mapping_changes"
+        )
+        stream_id: int = cur.fetchone()[0]
+        cur.execute("SELECT lookup_pepper, lookup_hash_column FROM hashing_metadata")
+        pepper: str
+        lookup_hash_column: str
+        pepper, lookup_hash_column = cur.fetchone()
+        # Type safety: the column comes from the database, and must be checked
+        # before being used in a query.
+        if lookup_hash_column not in LOOKUP_HASH_COLUMNS:
+            raise ValueError("Unknown lookup hash column %s" % (lookup_hash_column,))
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.TemporaryFile(dir=directory) as records, tempfile.TemporaryFile(
+            dir=directory
+        ) as blob:
+            # Write the records as they come, then sort them bucket by bucket, so
+            # that only one bucket needs to be held in memory at once.
+            bucket_sizes = array("Q", bytes(_BUCKET_START.size * _NUM_BUCKETS))
+            count = self._write_unsorted_records(
+                cur, lookup_hash_column, records, blob, bucket_sizes
+            )
+
+            fd, temp_path = tempfile.mkstemp(
+                dir=directory, prefix=os.path.basename(self.path) + "."
+            )
+            try:
+                with os.fdopen(fd, "w+b") as out:
+                    self._write_file(
+                        out,
+                        stream_id,
+                        pepper,
+                        lookup_hash_column,
+                        count,
+                        records,
+                        blob,
+                        bucket_sizes,
+                    )
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+        return stream_id, count
+
+    def _write_unsorted_records(
+        self,
+        cur: Cursor,
+        lookup_hash_column: str,
+        records: IO[bytes],
+        blob: IO[bytes],
+        bucket_sizes: "array[int]",
+    ) -> int:
+        now = time_msec()
+        count = 0
+        blob_size = 0
+        last_threepid = ("", "")
+        while True:
+            cur.execute(
+                "SELECT medium, normalised_address, %s, mxid, notBefore, notAfter "
+                "FROM global_threepid_current_mappings "
+                "WHERE (medium > ? OR (medium = ? AND normalised_address > ?)) "
+                "AND notAfter > ? "
+                "ORDER BY medium, normalised_address LIMIT ?" % (lookup_hash_column,),
+                (
+                    last_threepid[0],
+                    last_threepid[0],
+                    last_threepid[1],
+                    now,
+                    self.BATCH_SIZE,
+                ),
+            )
+            rows: List[Tuple[str, str, Optional[str], str, int, int]]
+            rows = cur.fetchall()
+            for _, _, lookup_hash, mxid, not_before, not_after in rows:
+                # Hashes which aren't SHA-256 digests are looked up in the database.
+                digest = lookup_hash_digest(lookup_hash) if lookup_hash else None
+                if digest is None:
+                    continue
+                mxid_bytes = mxid.encode("utf-8")
+                records.write(
+                    _RECORD.pack(
+                        digest, blob_size, len(mxid_bytes), not_before, not_after
+                    )
+                )
+                blob.write(mxid_bytes)
+                blob_size += len(mxid_bytes)
+                bucket_sizes[_bucket(digest)] += 1
+                count += 1
+            if len(rows) < self.BATCH_SIZE:
+                return count
+            last_threepid = (rows[-1][0], rows[-1][1])
+
+    @staticmethod
+    def _write_file(
+        out: IO[bytes],
+        stream_id: int,
+        pepper: str,
+        lookup_hash_column: str,
+        count: int,
+        records: IO[bytes],
+        blob: IO[bytes],
+        bucket_sizes: "array[int]",
+    ) -> None:
+        strings = b""
+        for value in (pepper, lookup_hash_column):
+            encoded = value.encode("utf-8")
+            strings += _STRING_LENGTH.pack(len(encoded)) + encoded
+        buckets_offset = _align(_HEADER.size + len(strings))
+        records_offset = buckets_offset + (_NUM_BUCKETS + 1) * _BUCKET_START.size
+        blob_offset = records_offset + count * _RECORD.size
+
+        bucket_starts = array("Q", [0])
+        for size in bucket_sizes:
+            bucket_starts.append(bucket_starts[-1] + size)
+
+        out.write(
+            _HEADER.pack(
+                _MAGIC, stream_id, count, buckets_offset, records_offset, blob_offset
+            )
+        )
+        out.write(strings)
+        out.seek(buckets_offset)
+        out.write(b"".join(_BUCKET_START.pack(start) for start in bucket_starts))
+        out.truncate(blob_offset)
+
+        if count:
+            with mmap.mmap(out.fileno(), blob_offset) as mm:
+                # Scatter the records into their buckets.
+                positions = array("Q", bucket_starts)
+                records.seek(0)
+                record_size = _RECORD.size
+                while True:
+                    chunk = records.read(record_size * 4096)
+                    if not chunk:
+                        break
+                    for i in range(0, len(chunk), record_size):
+                        record = chunk[i : i + record_size]
+                        bucket = _bucket(record)
+                        offset = records_offset + positions[bucket] * record_size
+                        mm[offset : offset + record_size] = record
+                        positions[bucket] += 1
+
+                # Then sort each bucket.
+                for bucket in range(_NUM_BUCKETS):
+                    if bucket_sizes[bucket] < 2:
+                        continue
+                    start = records_offset + bucket_starts[bucket] * record_size
+                    end = records_offset + bucket_starts[bucket + 1] * record_size
+                    data = mm[start:end]
+                    mm[start:end] = b"".join(
+                        sorted(
+                            data[i : i + record_size]
+                            for i in range(0, len(data), record_size)
+                        )
+                    )
+                mm.flush()
+
+        out.seek(blob_offset)
+        blob.seek(0)
+        shutil.copyfileobj(blob, out)
+        out.flush()
+        os.fsync(out.fileno())
+
+    def _pruneTxn(self, cur: Cursor, stream_id: int) -> None:
+        cur.execute(
+            "DELETE FROM global_threepid_mapping_changes WHERE stream_id <= ?",
+            (stream_id,),
+        )
+
+    def start_refreshing(self) -> None:
+        """Catch up with the changes made by other processes in the background."""
+        defer.ensureDeferred(self._refresh_in_background())
+
+    async def _refresh_in_background(self) -> None:
+        try:
+            await self.refresh()
+        except Exception:
+            logger.exception("Failed to refresh the lookup snapshot")
+
+    async def refresh(self) -> None:
+        """Switch to the snapshot file if it has been replaced, and read the changes
+        made since the snapshot was written into the overlay.
+        """
+        if self._refreshing:
+            return
+        self._refreshing = True
+        try:
+            snapshot = self._snapshot
+            overlay = self._overlay
+            replaced = snapshot is None or self._file_replaced(snapshot)
+            if replaced:
+                try:
+                    snapshot = _SnapshotFile(self.path)
+                except FileNotFoundError:
+                    # The writer hasn't written a snapshot yet.
+                    return
+                overlay = _Overlay(snapshot.stream_id, snapshot.lookup_hash_column)
+                self._new_overlay = overlay
+            assert snapshot is not None and overlay is not None
+
+            try:
+                while True:
+                    rows = await self.sydent.db_pool.runInteraction(
+                        "refresh_lookup_snapshot", self._pollTxn, overlay.stream_id
+                    )
+                    overlay.apply_changes(rows)
+                    if len(rows) < self.BATCH_SIZE:
+                        break
+            except Exception:
+                if replaced:
+                    snapshot.close()
+                raise
+            finally:
+                self._new_overlay = None
+
+            if replaced:
+                old_snapshot = self._snapshot
+                self._snapshot = snapshot
+                self._overlay = overlay
+                if old_snapshot is not None:
+                    old_snapshot.close()
+                logger.info(
+                    "Opened the lookup snapshot %s with %d lookup hashes",
+                    self.path,
+                    snapshot.count,
+                )
+            lookup_snapshot_entries.set(snapshot.count)
+            lookup_snapshot_overlay_entries.set(len(overlay.mappings))
+        finally:
+            self._refreshing = False
+
+    def _file_replaced(self, snapshot: _SnapshotFile) -> bool:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size) != snapshot.identity
+
+    def _pollTxn(self, cur: Cursor, stream_id: int) -> List[_ChangeRow]:
+        # Read the current mapping of each changed 3PID, rather than what it was
+        # at the time of the change, so that applying the changes of a 3PID in any
+        # order ends up with its current mapping.
+        cur.execute(
+            "SELECT c.stream_id, c.lookup_hash, c.alt_lookup_hash, m.lookup_hash, "
+            "m.alt_lookup_hash, m.mxid, m.notBefore, m.notAfter "
+            "FROM global_threepid_mapping_changes c "
+            "LEFT JOIN global_threepid_current_mappings m "
+            "ON m.medium = c.medium AND m.normalised_address = c.normalised_address "
+            "WHERE c.stream_id > ? ORDER BY c.stream_id LIMIT ?",
+            (stream_id, self.BATCH_SIZE),
+        )
+        return cur.fetchall()
+
+    def update(
+        self,
+        stream_id: int,
+        old_mappings: Iterable[CurrentMapping],
+        new_mappings: Iterable[CurrentMapping],
+    ) -> None:
+        """Apply a change to the current mappings made by this process. Must be
+        called once the change has been committed.
+
+        :param stream_id: The stream ID of the last row the change logged to
+            global_threepid_mapping_changes.
+        :param old_mappings: The current mappings of the 3PIDs before the change.
+        :param new_mappings: The current mappings of the 3PIDs after the change.
+        """
+        old_mappings = list(old_mappings)
+        new_mappings = list(new_mappings)
+        for overlay in (self._overlay, self._new_overlay):
+            if overlay is not None:
+                overlay.apply_mappings(stream_id, old_mappings, new_mappings)
+
+    def get_mxids(
+        self, lookup_hashes: Iterable[str], lookup_hash_column: str, now: int
+    ) -> Optional[Tuple[Dict[str, str], List[str]]]:
+        """Look up the MXIDs of the given hashes.
+
+        :param lookup_hashes: The lookup hashes to look up.
+        :param lookup_hash_column: The column the hashes would be stored in, see
+            HashingMetadataStore.get_lookup_hash_column.
+        :param now: The current time, in milliseconds since the epoch.
+
+        :return: None if the snapshot can't answer lookups for hashes computed with
+            the pepper the column is for. Otherwise, the MXID of each hash which is
+            bound to one and whose binding is currently valid, and the hashes which
+            must be looked up in the database instead because they aren't digests.
+        """
+        snapshot = self._snapshot
+        overlay = self._overlay
+        if snapshot is None or overlay is None:
+            return None
+        if (
+            self.sydent.hashing_store.get_lookup_hash_column(snapshot.pepper)
+            != lookup_hash_column
+        ):
+            return None
+
+        results = {}
+        unanswered = []
+        for lookup_hash in lookup_hashes:
+            change = overlay.mappings.get(lookup_hash)
+            if change is not None:
+                mapping = change[1]
+            else:
+                digest = lookup_hash_digest(lookup_hash)
+                if digest is None:
+                    unanswered.append(lookup_hash)
+                    continue
+                mapping = snapshot.get(digest)
+            if mapping is None:
+                continue
+            mxid, not_before, not_after = mapping
+            # 'notBefore' is the time the association starts being valid, 'notAfter'
+            # the time at which it ceases to be valid.
+            if not_before < now < not_after:
+                results[lookup_hash] = mxid
+        return results, unanswered
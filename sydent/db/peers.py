@@ -7,7 +7,7 @@
 # Originally licensed under the Apache License, Version 2.0:
 # <http://www.apache.org/licenses/LICENSE-2.0>.
 
-from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
 
 from sydent.replication.peer import RemotePeer
 
@@ -57,11 +57,16 @@ class PeerStore:
 
         return p
 
-    def getAllPeers(self) -> List[RemotePeer]:
+    def getPeerConfigs(
+        self,
+    ) -> Dict[str, Tuple[Optional[int], Dict[str, str], Optional[int]]]:
         """
-        Retrieve all of the remote peers from the database.
+        Retrieve the configuration of all of the active remote peers from the database,
+        without building RemotePeer objects for them.
 
-        :return: A list of the remote peers this server knows about.
+        :return: A dict mapping the server name of each peer to its port, its public
+            keys (in a dict[key_id, key_b64]) and the ID of the last association sent
+            to it.
         """
         cur = self.sydent.db.cursor()
         res = cur.execute(
@@ -69,41 +74,26 @@ class PeerStore:
             "where pk.peername = p.name and p.active = 1"
         )
 
-        peers = []
-
-        # Safety: we need to convince ourselves that `peername` will be not None
-        # when passed to `RemotePeer`.
-        #
-        # If `res` is empty, then `pubkeys` will start empty and never be written to.
-        # So we will never create a `RemotePeer`. That's fine.
-        #
-        # Otherwise we process at least one row. The first row we process will
-        # satisfy `row[0] is not None` because `name` is nonnull in the schema.
-        # `pubkeys` will be empty, so we skip the innermost `if` and assign peername
-        # to be a string. There are no further assignments of `None` to `peername`;
-        # it will be a string whenever we use it.
-        peername: str = None  # type: ignore[assignment]
-        port = None
-        lastSentVer = None
-        pubkeys: Dict[str, str] = {}
+        configs: Dict[str, Tuple[Optional[int], Dict[str, str], Optional[int]]] = {}
 
         row: Tuple[str, Optional[int], Optional[int], str, str]
         for row in res.fetchall():
-            if row[0] != peername:
-                if len(pubkeys) > 0:
-                    p = RemotePeer(self.sydent, peername, port, pubkeys, lastSentVer)
-                    peers.append(p)
-                    pubkeys = {}
-                peername = row[0]
-                port = row[1]
-                lastSentVer = row[2]
-            pubkeys[row[3]] = row[4]
+            config = configs.setdefault(row[0], (row[1], {}, row[2]))
+            config[1][row[3]] = row[4]
 
-        if len(pubkeys) > 0:
-            p = RemotePeer(self.sydent, peername, port, pubkeys, lastSentVer)
-            peers.append(p)
+        return configs
 
-        return peers
+    def getPeersVersion(self) -> int:
+        """
+        Retrieve the number of changes made to the configuration of the remote peers,
+        which is bumped by triggers on the peers and peer_pubkeys tables.
+
+        :return: The number of changes.
+        """
+        cur = self.sydent.db.cursor()
+        res = cur.execute("SELECT version FROM peers_version")
+        row: Tuple[int] = res.fetchone()
+        return row[0]
 
     def setLastSentVersionAndPokeSucceeded(
         self,
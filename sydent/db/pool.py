@@ -0,0 +1,169 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, List, Optional, TypeVar
+
+from prometheus_client import Histogram
+from twisted.internet import defer, threads
+from twisted.internet.defer import Deferred
+from twisted.python.threadpool import ThreadPool
+
+from sydent.db.transaction import TransactionalConnection
+
+if TYPE_CHECKING:
+    from sydent.sydent import Sydent
+
+logger = logging.getLogger(__name__)
+
+R = TypeVar("R")
+
+interaction_duration = Histogram(
+    "sydent_db_interaction_duration_seconds",
+    "Time spent running database interactions, including time spent waiting for a "
+    "connection from the pool",
+    labelnames=("pool", "desc"),
+)
+
+
+class DatabasePool:
+    """Runs database interactions on a pool of threads, each of which holds its own
+    connection to the database, so that slow queries don't stall the reactor.
+
+    Until the pool is started (and if the database can't be shared between
+    connections, e.g. an in-memory SQLite one), interactions are run synchronously on
+    the reactor thread, using the main connection.
+    """
+
+    def __init__(
+        self, sydent: "Sydent", name: str, size: int, read_only: bool = False
+    ) -> None:
+        """
+        :param sydent: The Sydent instance to run interactions for.
+        :param name: The name of the pool, used for metrics and to name its threads.
+        :param size: The maximum number of threads (and therefore connections) in
+            the pool. 0 means interactions are always run on the main connection.
+        :param read_only: Whether to open the pool's connections in read-only mode.
+        """
+        self.sydent = sydent
+        self.name = name
+        self._read_only = read_only
+
+        self._threadpool: Optional[ThreadPool] = None
+        if size > 0 and not sydent.db_engine.single_connection:
+            # Type safety: twisted.python.threadpool isn't annotated.
+            self._threadpool = ThreadPool(  # type: ignore[no-untyped-call]
+                minthreads=1, maxthreads=size, name="sydent-%s" % (name,)
+            )
+
+        self._local = threading.local()
+        self._connections: List[TransactionalConnection] = []
+        self._connections_lock = threading.Lock()
+
+    def start(self) -> None:
+        """Start the thread pool, if there is one. This must only be called once the
+        reactor is about to run, since the pool relies on it to deliver results.
+        """
+        if self._threadpool is None or self._threadpool.started:
+            return
+
+        logger.info(
+            "Starting database pool %s with up to %d connections",
+            self.name,
+            self._threadpool.max,
+        )
+        self._threadpool.start()  # type: ignore[no-untyped-call]
+        self.sydent.reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+
+    def stop(self) -> None:
+        """Stop the thread pool and close every connection it opened."""
+        if self._threadpool is None or not self._threadpool.started:
+            return
+
+        self._threadpool.stop()  # type: ignore[no-untyped-call]
+
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+
+    def runInteraction(
+        self, desc: str, func: Callable[..., R], *args: Any, **kwargs: Any
+    ) -> "Deferred[R]":
+        """Run the given function in a database transaction, and commit the
+        transaction once the function returns (or roll it back if it raises).
+
+        The function is called with a cursor as its first argument, followed by the
+        other arguments given. It must only use that cursor to access the database,
+        as it may be run on a thread other than the reactor's.
+
+        :param desc: A short description of the interaction, used for metrics and
+            logging.
+        :param func: The function to run.
+
+        :return: A deferred resolving to the function's result.
+        """
+        start = time.perf_counter()
+
+        d: "Deferred[R]"
+        if self._threadpool is None or not self._threadpool.started:
+            d = defer.maybeDeferred(self._runInline, func, *args, **kwargs)
+        else:
+            d = threads.deferToThreadPool(  # type: ignore[no-untyped-call]
+                self.sydent.reactor,
+                self._threadpool,
+                self._runOnThread,
+                func,
+                *args,
+                **kwargs,
+            )
+
+        def _record_duration(res: R) -> R:
+            interaction_duration.labels(self.name, desc).observe(
+                time.perf_counter() - start
+            )
+            return res
+
+        d.addBoth(_record_duration)
+        return d
+
+    def _runInline(self, func: Callable[..., R], *args: Any, **kwargs: Any) -> R:
+        """Run an interaction on the main connection, as a unit of work so that
+        rolling it back doesn't affect any other pending changes.
+        """
+        with self.sydent.db.unit_of_work():
+            cur = self.sydent.db.cursor()
+            try:
+                return func(cur, *args, **kwargs)
+            finally:
+                cur.close()
+
+    def _runOnThread(self, func: Callable[..., R], *args: Any, **kwargs: Any) -> R:
+        """Run an interaction on the current thread's connection, opening it first if
+        this thread doesn't have one yet.
+        """
+        conn: Optional[TransactionalConnection] = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.sydent.db_engine.connect(read_only=self._read_only)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+
+        cur = conn.cursor()
+        try:
+            res = func(cur, *args, **kwargs)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+        # Always end the transaction, even for read-only interactions: otherwise the
+        # connection could hold on to its read lock and prevent writers from
+        # committing.
+        conn.commit()
+        return res
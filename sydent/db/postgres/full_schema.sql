@@ -0,0 +1,186 @@
+/*
+Copyright 2025 New Vector Ltd.
+
+SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+Please see LICENSE files in the repository root for full details.
+*/
+
+-- The full schema for PostgreSQL databases, at the version given by SCHEMA_VERSION in
+-- sydent/db/__init__.py. Changes to the schema must be made here, and, once a version
+-- of Sydent supporting PostgreSQL has been released, as upgrade steps in
+-- sydent/db/postgresdb.py too.
+--
+-- SQLite doesn't enforce the lengths of VARCHAR columns, nor foreign keys (unless
+-- asked to), so to behave the same way this schema uses TEXT columns and doesn't
+-- declare foreign keys.
+
+CREATE TABLE local_threepid_associations (
+    id BIGSERIAL PRIMARY KEY,
+    medium TEXT NOT NULL,
+    address TEXT NOT NULL,
+    mxid TEXT,
+    ts BIGINT,
+    notBefore BIGINT,
+    notAfter BIGINT,
+    lookup_hash TEXT,
+    sgAssoc TEXT
+);
+CREATE UNIQUE INDEX local_threepid_medium_address ON local_threepid_associations (medium, address);
+
+CREATE TABLE global_threepid_associations (
+    id BIGSERIAL PRIMARY KEY,
+    medium TEXT NOT NULL,
+    address TEXT NOT NULL,
+    mxid TEXT NOT NULL,
+    ts BIGINT NOT NULL,
+    notBefore BIGINT NOT NULL,
+    notAfter BIGINT NOT NULL,
+    originServer TEXT NOT NULL,
+    originId BIGINT NOT NULL,
+    sgAssoc TEXT NOT NULL,
+    lookup_hash TEXT,
+    normalised_address TEXT,
+    alt_lookup_hash TEXT
+);
+CREATE INDEX global_threepid_medium_address ON global_threepid_associations (medium, address);
+CREATE INDEX global_threepid_medium_normalised_address ON global_threepid_associations (medium, normalised_address);
+CREATE UNIQUE INDEX global_threepid_originServer_originId ON global_threepid_associations (originServer, originId);
+CREATE INDEX global_threepid_lookup_hash ON global_threepid_associations (lookup_hash);
+
+-- The newest association for each 3PID in global_threepid_associations, which is
+-- what lookups return.
+CREATE TABLE global_threepid_current_mappings (
+    medium TEXT NOT NULL,
+    normalised_address TEXT NOT NULL,
+    address TEXT NOT NULL,
+    mxid TEXT NOT NULL,
+    lookup_hash TEXT,
+    ts BIGINT NOT NULL,
+    notBefore BIGINT NOT NULL,
+    notAfter BIGINT NOT NULL,
+    association_id BIGINT NOT NULL,
+    alt_lookup_hash TEXT
+);
+CREATE UNIQUE INDEX global_threepid_current_mappings_medium_address ON global_threepid_current_mappings (medium, normalised_address);
+CREATE INDEX global_threepid_current_mappings_lookup_hash ON global_threepid_current_mappings (lookup_hash);
+CREATE INDEX global_threepid_current_mappings_alt_lookup_hash ON global_threepid_current_mappings (alt_lookup_hash);
+
+CREATE TABLE global_threepid_mapping_changes (
+    stream_id BIGSERIAL PRIMARY KEY,
+    medium TEXT NOT NULL,
+    normalised_address TEXT NOT NULL,
+    lookup_hash TEXT,
+    alt_lookup_hash TEXT
+);
+
+CREATE TABLE threepid_validation_sessions (
+    id BIGINT PRIMARY KEY,
+    medium TEXT NOT NULL,
+    address TEXT NOT NULL,
+    clientSecret TEXT NOT NULL,
+    validated BOOLEAN DEFAULT FALSE,
+    mtime BIGINT NOT NULL
+);
+CREATE INDEX threepid_validation_sessions_mtime ON threepid_validation_sessions (mtime);
+
+CREATE TABLE threepid_token_auths (
+    id BIGSERIAL PRIMARY KEY,
+    validationSession BIGINT NOT NULL,
+    token TEXT NOT NULL,
+    sendAttemptNumber BIGINT NOT NULL
+);
+
+CREATE TABLE invite_tokens (
+    id BIGSERIAL PRIMARY KEY,
+    medium TEXT NOT NULL,
+    address TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    token TEXT NOT NULL,
+    received_ts BIGINT, -- When the invite was received by us from the homeserver
+    sent_ts BIGINT -- When the token was sent by us to the user
+);
+CREATE INDEX invite_token_medium_address ON invite_tokens (medium, address);
+CREATE INDEX invite_token_token ON invite_tokens (token);
+
+CREATE TABLE ephemeral_public_keys (
+    id BIGSERIAL PRIMARY KEY,
+    public_key TEXT NOT NULL,
+    verify_count BIGINT DEFAULT 0,
+    persistence_ts BIGINT
+);
+CREATE UNIQUE INDEX ephemeral_public_keys_index ON ephemeral_public_keys (public_key);
+
+CREATE TABLE peers (
+    id BIGSERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    port INTEGER DEFAULT NULL,
+    lastSentVersion BIGINT,
+    lastPokeSucceededAt BIGINT,
+    active INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX peers_name ON peers (name);
+
+CREATE TABLE peer_pubkeys (
+    id BIGSERIAL PRIMARY KEY,
+    peername TEXT NOT NULL,
+    alg TEXT NOT NULL,
+    key TEXT NOT NULL
+);
+CREATE UNIQUE INDEX peername_alg ON peer_pubkeys (peername, alg);
+
+-- Counts the changes made to the peers' configuration, which is edited by hand, see
+-- sydent.replication.registry.
+CREATE TABLE peers_version (
+    version BIGINT NOT NULL
+);
+INSERT INTO peers_version (version) VALUES (0);
+
+CREATE FUNCTION bump_peers_version() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE peers_version SET version = version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER peers_version AFTER INSERT OR DELETE OR UPDATE OF name, port, active
+    ON peers FOR EACH STATEMENT EXECUTE PROCEDURE bump_peers_version();
+CREATE TRIGGER peer_pubkeys_version AFTER INSERT OR DELETE OR UPDATE ON peer_pubkeys
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_peers_version();
+
+-- The peppers lookup hashes are computed with, see sydent.db.hashing_metadata.
+CREATE TABLE hashing_metadata (
+    id INTEGER PRIMARY KEY,
+    lookup_pepper TEXT,
+    lookup_hash_column TEXT NOT NULL DEFAULT 'lookup_hash',
+    previous_lookup_pepper TEXT,
+    next_lookup_pepper TEXT
+);
+
+CREATE TABLE accounts (
+    user_id TEXT NOT NULL PRIMARY KEY,
+    created_ts BIGINT NOT NULL,
+    consent_version TEXT
+);
+
+CREATE TABLE tokens (
+    token TEXT NOT NULL PRIMARY KEY,
+    user_id TEXT NOT NULL
+);
+
+CREATE TABLE accepted_terms_urls (
+    user_id TEXT NOT NULL,
+    url TEXT NOT NULL
+);
+CREATE UNIQUE INDEX accepted_terms_urls_idx ON accepted_terms_urls (user_id, url);
+
+-- Data migrations left to run in the background, see sydent.db.background_updates.
+CREATE TABLE background_updates (
+    update_name TEXT NOT NULL PRIMARY KEY,
+    ordering INTEGER NOT NULL,
+    progress_json TEXT NOT NULL
+);
+
+CREATE TABLE schema_version (
+    version INTEGER NOT NULL
+);
@@ -0,0 +1,52 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+import logging
+import os
+
+from sydent.db import SCHEMA_VERSION
+from sydent.db.transaction import TransactionalConnection
+
+logger = logging.getLogger(__name__)
+
+
+class PostgresDatabase:
+    """Creates the schema of a PostgreSQL database.
+
+    Unlike SQLite databases, which are created with the v0 schema and then upgraded
+    step by step, new PostgreSQL databases are created with the current schema
+    straight away. No released version of Sydent has supported PostgreSQL at an
+    earlier schema version, so there are no upgrades to run yet: any future change
+    to the schema must be added both to full_schema.sql and as an upgrade step here.
+    """
+
+    def __init__(self, db: TransactionalConnection) -> None:
+        self.db = db
+
+        curVer = self.db.engine.get_schema_version(self.db)
+        if curVer == 0:
+            self._createSchema()
+        elif curVer != SCHEMA_VERSION:
+            raise Exception(
+                "Database schema is at version %d, but this version of Sydent only "
+                "supports version %d on PostgreSQL" % (curVer, SCHEMA_VERSION)
+            )
+
+    def _createSchema(self) -> None:
+        schemaPath = os.path.join(
+            os.path.dirname(__file__), "postgres", "full_schema.sql"
+        )
+        logger.info("Creating database schema from %s", schemaPath)
+
+        with open(schemaPath) as fp:
+            schema = fp.read()
+
+        with self.db.unit_of_work():
+            cur = self.db.cursor()
+            cur.execute(schema)
+            cur.execute(
+                "INSERT INTO schema_version (version) VALUES (?)", (SCHEMA_VERSION,)
+            )
+            cur.close()
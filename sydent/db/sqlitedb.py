@@ -10,22 +10,34 @@
 import logging
 import os
 import sqlite3
-from typing import TYPE_CHECKING, Tuple
+from typing import TYPE_CHECKING, Tuple, cast
+
+from sydent.db.background_updates import schedule_background_update
+from sydent.db.transaction import TransactionalConnection
+from sydent.db.updates import (
+    DROP_LOWER_ADDRESS_INDEX,
+    POPULATE_CURRENT_MAPPINGS,
+    POPULATE_LOOKUP_HASHES,
+    POPULATE_NORMALISED_ADDRESSES,
+)
 
 if TYPE_CHECKING:
-    from sydent.sydent import Sydent
+    from sydent.config.database import DatabaseConfig
 
 logger = logging.getLogger(__name__)
 
 
 class SqliteDatabase:
-    def __init__(self, syd: "Sydent") -> None:
-        self.sydent = syd
+    """Creates and upgrades the schema of a SQLite database."""
+
+    def __init__(self, db: TransactionalConnection, config: "DatabaseConfig") -> None:
+        self.db = db
+        self.config = config
 
-        dbFilePath = self.sydent.config.database.database_path
-        logger.info("Using DB file %s", dbFilePath)
+        logger.info("Using DB file %s", config.database_path)
+
+        self._setJournalMode()
 
-        self.db = sqlite3.connect(dbFilePath)
         curVer = self._getSchemaVersion()
 
         # We always run the schema files if the version is zero: either the db is
@@ -36,11 +48,36 @@ class SqliteDatabase:
             self._createSchema()
         self._upgradeSchema()
 
+    def _setJournalMode(self) -> None:
+        """Switch the database to the configured journal mode, if any. Unlike the
+        other settings, this is persisted in the database file, so it only needs
+        setting on the main connection.
+        """
+        journal_mode = self.config.journal_mode
+        if journal_mode is None:
+            return
+
+        cur = self.db.cursor()
+        # NB. pragma doesn't support variable substitution, but the value has been
+        # checked against a list of allowed values when parsing the config.
+        cur.execute("PRAGMA journal_mode = %s" % (journal_mode,))
+        row: Tuple[str] = cur.fetchone()
+        # SQLite refuses to use some journal modes in some situations (e.g. WAL for
+        # in-memory databases), in which case it tells us which mode it's using.
+        if row[0] != journal_mode:
+            logger.warning(
+                "Could not set the database journal mode to %s, using %s instead",
+                journal_mode,
+                row[0],
+            )
+        cur.close()
+
     def _createSchema(self) -> None:
         logger.info("Running schema files...")
         schemaDir = os.path.dirname(__file__)
 
-        c = self.db.cursor()
+        # executescript is specific to sqlite3, so use the underlying connection.
+        c = cast(sqlite3.Connection, self.db.conn).cursor()
 
         for f in os.listdir(schemaDir):
             if not f.endswith(".sql"):
@@ -206,11 +243,160 @@ class SqliteDatabase:
             logger.info("v4 -> v5 schema migration complete")
             self._setSchemaVersion(5)
 
+        if curVer < 6:
+            # Store the normalised address of global associations, so that lookups
+            # can match on it directly rather than calling lower() on every row. The
+            # addresses of existing associations are filled in by a background
+            # update, and the index on lower(address) is kept until lookups no longer
+            # need it.
+            cur = self.db.cursor()
+            cur.execute(
+                "CREATE TABLE background_updates ("
+                "update_name varchar(256) not null primary key, "
+                "ordering integer not null, "
+                "progress_json text not null)"
+            )
+            cur.execute(
+                "ALTER TABLE global_threepid_associations "
+                "ADD COLUMN normalised_address VARCHAR(256)"
+            )
+            cur.execute(
+                "CREATE INDEX global_threepid_medium_normalised_address "
+                "ON global_threepid_associations (medium, normalised_address)"
+            )
+            schedule_background_update(cur, POPULATE_NORMALISED_ADDRESSES, 6)
+            self.db.commit()
+            logger.info("v5 -> v6 schema migration complete")
+            self._setSchemaVersion(6)
+
+        if curVer < 7:
+            # Keep the newest association for each 3PID in its own table, so that
+            # lookups don't have to pick it out of the whole history.
+            cur = self.db.cursor()
+            cur.execute(
+                "CREATE TABLE global_threepid_current_mappings ("
+                "medium varchar(16) not null, "
+                "normalised_address varchar(256) not null, "
+                "address varchar(256) not null, "
+                "mxid varchar(256) not null, "
+                "lookup_hash varchar(256), "
+                "ts bigint not null, "
+                "notBefore bigint not null, "
+                "notAfter bigint not null, "
+                "association_id integer not null)"
+            )
+            cur.execute(
+                "CREATE UNIQUE INDEX global_threepid_current_mappings_medium_address "
+                "ON global_threepid_current_mappings (medium, normalised_address)"
+            )
+            cur.execute(
+                "CREATE INDEX global_threepid_current_mappings_lookup_hash "
+                "ON global_threepid_current_mappings (lookup_hash)"
+            )
+            # Existing associations are copied over by a background update, after
+            # which lookups stop using the index on lower(address).
+            schedule_background_update(cur, POPULATE_CURRENT_MAPPINGS, 7)
+            schedule_background_update(cur, DROP_LOWER_ADDRESS_INDEX, 8)
+            self.db.commit()
+            logger.info("v6 -> v7 schema migration complete")
+            self._setSchemaVersion(7)
+
+        if curVer < 8:
+            # Add a second column for lookup hashes, so that the lookup pepper can
+            # be rotated without downtime.
+            cur = self.db.cursor()
+            cur.execute(
+                "ALTER TABLE global_threepid_associations "
+                "ADD COLUMN alt_lookup_hash VARCHAR(256)"
+            )
+            cur.execute(
+                "ALTER TABLE global_threepid_current_mappings "
+                "ADD COLUMN alt_lookup_hash VARCHAR(256)"
+            )
+            cur.execute(
+                "CREATE INDEX global_threepid_current_mappings_alt_lookup_hash "
+                "ON global_threepid_current_mappings (alt_lookup_hash)"
+            )
+            cur.execute(
+                "ALTER TABLE hashing_metadata ADD COLUMN lookup_hash_column "
+                "varchar(256) not null default 'lookup_hash'"
+            )
+            cur.execute(
+                "ALTER TABLE hashing_metadata ADD COLUMN previous_lookup_pepper "
+                "varchar(256)"
+            )
+            cur.execute(
+                "ALTER TABLE hashing_metadata ADD COLUMN next_lookup_pepper "
+                "varchar(256)"
+            )
+            self.db.commit()
+            logger.info("v7 -> v8 schema migration complete")
+            self._setSchemaVersion(8)
+
+        if curVer < 9:
+            # Log the changes to the current mappings, for the lookup snapshot's
+            # overlay.
+            cur = self.db.cursor()
+            cur.execute(
+                "CREATE TABLE IF NOT EXISTS global_threepid_mapping_changes ("
+                "stream_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "medium VARCHAR(16) NOT NULL, "
+                "normalised_address VARCHAR(256) NOT NULL, "
+                "lookup_hash VARCHAR(256), "
+                "alt_lookup_hash VARCHAR(256))"
+            )
+            self.db.commit()
+            logger.info("v8 -> v9 schema migration complete")
+            self._setSchemaVersion(9)
+
+        if curVer < 10:
+            # Store the signed JSON of local associations, so that they're signed
+            # once rather than on every push. Existing associations are signed when
+            # they're next read.
+            cur = self.db.cursor()
+            cur.execute(
+                "ALTER TABLE local_threepid_associations ADD COLUMN sgAssoc TEXT"
+            )
+            self.db.commit()
+            logger.info("v9 -> v10 schema migration complete")
+            self._setSchemaVersion(10)
+
+        if curVer < 11:
+            # Fill in the lookup hashes which are missing, or weren't computed from
+            # the normalised address, so that plaintext lookups can be served through
+            # them.
+            cur = self.db.cursor()
+            schedule_background_update(cur, POPULATE_LOOKUP_HASHES, 9)
+            self.db.commit()
+            logger.info("v10 -> v11 schema migration complete")
+            self._setSchemaVersion(11)
+
+        if curVer < 12:
+            # Count the changes made to the peers' configuration (which is edited by
+            # hand), so that the peer registry can tell when to reload it without
+            # reading all of it.
+            cur = self.db.cursor()
+            cur.execute("CREATE TABLE peers_version (version integer not null)")
+            cur.execute("INSERT INTO peers_version (version) VALUES (0)")
+            for name, event, table in (
+                ("peers_insert", "INSERT", "peers"),
+                ("peers_update", "UPDATE OF name, port, active", "peers"),
+                ("peers_delete", "DELETE", "peers"),
+                ("peer_pubkeys_insert", "INSERT", "peer_pubkeys"),
+                ("peer_pubkeys_update", "UPDATE", "peer_pubkeys"),
+                ("peer_pubkeys_delete", "DELETE", "peer_pubkeys"),
+            ):
+                cur.execute(
+                    "CREATE TRIGGER %s_version AFTER %s ON %s BEGIN "
+                    "UPDATE peers_version SET version = version + 1; END"
+                    % (name, event, table)
+                )
+            self.db.commit()
+            logger.info("v11 -> v12 schema migration complete")
+            self._setSchemaVersion(12)
+
     def _getSchemaVersion(self) -> int:
-        cur = self.db.cursor()
-        cur.execute("PRAGMA user_version")
-        row: Tuple[int] = cur.fetchone()
-        return row[0]
+        return self.db.engine.get_schema_version(self.db)
 
     def _setSchemaVersion(self, ver: int) -> None:
         cur = self.db.cursor()
@@ -50,7 +50,9 @@ class TermsStore:
         """
         cur = self.sydent.db.cursor()
         cur.executemany(
-            "insert or ignore into accepted_terms_urls (user_id, url) values (?, ?)",
+            self.sydent.db_engine.insert_or_ignore(
+                "accepted_terms_urls", ("user_id", "url")
+            ),
             ((user_id, u) for u in urls),
         )
         self.sydent.db.commit()
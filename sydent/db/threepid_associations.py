@@ -7,12 +7,43 @@
 # Originally licensed under the Apache License, Version 2.0:
 # <http://www.apache.org/licenses/LICENSE-2.0>.
 
+import itertools
+import json
 import logging
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
-
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from prometheus_client import Counter
+from twisted.internet import task
+
+from sydent.db.hashing_metadata import LOOKUP_HASH_COLUMNS, hash_threepid
+from sydent.db.lookup_cache import HashEntry, MxidEntry, SignedAssociationEntry
+from sydent.db.lookup_hash_index import CurrentMapping
+from sydent.db.transaction import Cursor
+from sydent.db.updates import (
+    POPULATE_CURRENT_MAPPINGS,
+    POPULATE_LOOKUP_HASHES,
+    update_current_mappings,
+)
 from sydent.threepid import ThreepidAssociation
 from sydent.threepid.signer import Signer
-from sydent.util import time_msec
+from sydent.util import json_decoder, time_msec
+from sydent.util.lrucache import LruCache
+from sydent.util.singleflight import SingleFlight
+from sydent.util.stringutils import normalise_address, normalise_address_for_lookup
+from sydent.util.ttlcache import Sentinel
 
 if TYPE_CHECKING:
     from sydent.sydent import Sydent
@@ -22,9 +53,21 @@ if TYPE_CHECKING:
 # version of sydent.db.TheepidAssociation.
 SignedAssociations = Dict[int, Dict[str, Any]]
 
+K = TypeVar("K")
+V = TypeVar("V")
+
 
 logger = logging.getLogger(__name__)
 
+compacted_associations = Counter(
+    "sydent_compacted_associations",
+    "Number of superseded global associations removed by compaction",
+)
+compacted_association_bytes = Counter(
+    "sydent_compacted_association_bytes",
+    "Approximate size of the superseded global associations removed by compaction",
+)
+
 
 class LocalAssociationStore:
     def __init__(self, sydent: "Sydent") -> None:
@@ -38,13 +81,23 @@ class LocalAssociationStore:
 
         :param assoc: The association to create or update.
         """
+        # Sign the association now, so that it isn't signed again every time it's
+        # pushed to a peer.
+        sgAssoc = json.dumps(Signer(self.sydent).signedThreePidAssociation(assoc))
+
         cur = self.sydent.db.cursor()
 
-        # sqlite's support for upserts is atrocious
+        # Delete any existing association for this 3PID and insert a new one, rather
+        # than updating it, so that the new row gets a new ID and is picked up by
+        # replication.
+        cur.execute(
+            "DELETE FROM local_threepid_associations WHERE medium = ? AND address = ?",
+            (assoc.medium, assoc.address),
+        )
         cur.execute(
-            "insert or replace into local_threepid_associations "
-            "('medium', 'address', 'lookup_hash', 'mxid', 'ts', 'notBefore', 'notAfter')"
-            " values (?, ?, ?, ?, ?, ?, ?)",
+            "INSERT INTO local_threepid_associations "
+            "(medium, address, lookup_hash, mxid, ts, notBefore, notAfter, sgAssoc)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
             (
                 assoc.medium,
                 assoc.address,
@@ -53,6 +106,7 @@ class LocalAssociationStore:
                 assoc.ts,
                 assoc.not_before,
                 assoc.not_after,
+                sgAssoc,
             ),
         )
         self.sydent.db.commit()
@@ -112,7 +166,9 @@ class LocalAssociationStore:
     def getSignedAssociationsAfterId(
         self, afterId: Optional[int], limit: Optional[int] = None
     ) -> Tuple[SignedAssociations, Optional[int]]:
-        """Get associations after a given ID, and sign them before returning
+        """Get the signed associations after a given ID. Associations are signed when
+        they're stored, apart from the ones stored before schema version 10, which
+        are signed here.
 
         :param afterId: The ID to return results after (not inclusive)
 
@@ -123,15 +179,46 @@ class LocalAssociationStore:
             (id: assoc dict) and an int representing the maximum ID (which is None if
             there was no association to retrieve).
         """
-        assocs = {}
+        cur = self.sydent.db.cursor()
 
-        (localAssocs, maxId) = self.getAssociationsAfterId(afterId, limit)
+        if afterId is None:
+            afterId = -1
 
-        signer = Signer(self.sydent)
+        q = (
+            "select id, sgAssoc, medium, address, lookup_hash, mxid, ts, notBefore, "
+            "notAfter from local_threepid_associations "
+            "where id > ? order by id asc"
+        )
+        if limit is not None:
+            q += " limit ?"
+            res = cur.execute(q, (afterId, limit))
+        else:
+            res = cur.execute(q, (afterId,))
+
+        maxId = None
 
-        for localId in localAssocs:
-            sgAssoc = signer.signedThreePidAssociation(localAssocs[localId])
-            assocs[localId] = sgAssoc
+        assocs = {}
+        signer = Signer(self.sydent)
+        row: Tuple[
+            int,
+            Optional[str],
+            str,
+            str,
+            Optional[str],
+            Optional[str],
+            Optional[int],
+            Optional[int],
+            Optional[int],
+        ]
+        for row in res.fetchall():
+            if row[1] is not None:
+                assocs[row[0]] = json_decoder.decode(row[1])
+            else:
+                assoc = ThreepidAssociation(
+                    row[2], row[3], row[4], row[5], row[6], row[7], row[8]
+                )
+                assocs[row[0]] = signer.signedThreePidAssociation(assoc)
+            maxId = row[0]
 
         return assocs, maxId
 
@@ -148,8 +235,8 @@ class LocalAssociationStore:
         cur = self.sydent.db.cursor()
 
         # check to see if we have any matching associations first.
-        # We use a REPLACE INTO because we need the resulting row to have
-        # a new ID (such that we know it's a new change that needs to be
+        # We replace the row (rather than updating it) because we need the resulting
+        # row to have a new ID (such that we know it's a new change that needs to be
         # replicated) so there's no need to insert a deletion row if there's
         # nothing to delete.
         cur.execute(
@@ -160,11 +247,22 @@ class LocalAssociationStore:
         row: Tuple[int] = cur.fetchone()
         if row[0] > 0:
             ts = time_msec()
+            deletion = ThreepidAssociation(
+                threepid["medium"], threepid["address"], None, None, ts, None, None
+            )
+            sgAssoc = json.dumps(
+                Signer(self.sydent).signedThreePidAssociation(deletion)
+            )
+            cur.execute(
+                "DELETE FROM local_threepid_associations "
+                "WHERE medium = ? AND address = ?",
+                (threepid["medium"], threepid["address"]),
+            )
             cur.execute(
-                "REPLACE INTO local_threepid_associations "
-                "('medium', 'address', 'mxid', 'ts', 'notBefore', 'notAfter') "
-                " values (?, ?, NULL, ?, null, null)",
-                (threepid["medium"], threepid["address"], ts),
+                "INSERT INTO local_threepid_associations "
+                "(medium, address, mxid, ts, notBefore, notAfter, sgAssoc) "
+                " values (?, ?, NULL, ?, null, null, ?)",
+                (threepid["medium"], threepid["address"], ts, sgAssoc),
             )
             logger.info(
                 "Deleting local assoc for %s/%s/%s replaced %d rows",
@@ -186,10 +284,37 @@ class LocalAssociationStore:
 
 
 class GlobalAssociationStore:
+    """Stores the associations received from local binds and from peers.
+
+    Every association received is kept in global_threepid_associations, for
+    replication and auditing. Lookups instead read global_threepid_current_mappings,
+    which only holds the newest association for each 3PID, and is updated in the same
+    transaction as the history whenever an association is added or removed.
+
+    Associations which have been superseded by a newer one for the same 3PID are
+    periodically removed from the history by compactAssociations, apart from the
+    association with the highest origin ID from each server, which replication uses
+    to know where to resume from (see lastIdFromServer).
+
+    Lookups only return a 3PID's newest association if it's currently valid (i.e.
+    now is between its notBefore and notAfter), rather than falling back to an older
+    association which would be.
+
+    Until the background update building the current mappings of existing databases
+    has finished, lookups instead read the history, matching addresses on the index on
+    lower(address), and return each 3PID's newest association which is valid.
+    """
+
+    # The number of IDs compactAssociations goes through in each transaction.
+    COMPACTION_CHUNK_SIZE = 2000
+    # The time compactAssociations waits between transactions, in milliseconds, so
+    # that requests writing to the database aren't held up.
+    COMPACTION_SLEEP_DURATION_MS = 100
+
     def __init__(self, sydent: "Sydent") -> None:
         self.sydent = sydent
 
-    def signedAssociationStringForThreepid(
+    async def signedAssociationStringForThreepid(
         self, medium: str, address: str
     ) -> Optional[str]:
         """
@@ -202,29 +327,105 @@ class GlobalAssociationStore:
         :return: The signed association, or None if no association was found for this
             3PID.
         """
+        res = await self.signedAssociationForThreepid(medium, address)
+        return res[1] if res is not None else None
 
-        cur = self.sydent.db.cursor()
-        # We treat address as case-insensitive because that's true for all the
-        # threepids we have currently (we treat the local part of email addresses as
-        # case insensitive which is technically incorrect). If we someday get a
-        # case-sensitive threepid, this can change.
+    async def signedAssociationForThreepid(
+        self, medium: str, address: str
+    ) -> Optional[Tuple[int, str]]:
+        """
+        Retrieve the signed association matching the provided 3PID, if one exists,
+        along with its ID. Associations are never changed once stored, so anything
+        derived from one can be cached against its ID.
+
+        :param medium: The medium of the 3PID.
+        :param address: The address of the 3PID.
+
+        :return: The ID of the association and its signed JSON, or None if no
+            association was found for this 3PID.
+        """
+        if not self._hasCurrentMappings():
+            return await self.sydent.lookup_db_pool.runInteraction(
+                "signedAssociationForThreepid",
+                self._signedAssociationForThreepidFromHistoryTxn,
+                medium,
+                address,
+            )
+
+        bloom_filter = self.sydent.lookup_bloom_filter
+        if bloom_filter is not None and not bloom_filter.filter_threepids(
+            [(medium, address)]
+        ):
+            return None
+
+        async def fetch(
+            threepids: List[Tuple[str, str]]
+        ) -> Dict[Tuple[str, str], SignedAssociationEntry]:
+            # Only ever called with the one 3PID.
+            entry = await self.sydent.lookup_db_pool.runInteraction(
+                "signedAssociationForThreepid",
+                self._signedAssociationForThreepidTxn,
+                medium,
+                address,
+            )
+            return {threepids[0]: entry} if entry is not None else {}
+
+        key = (medium, normalise_address_for_lookup(address))
+        cache = self.sydent.lookup_cache
+        results = await self._getCachedOrFetch(
+            cache.signed_associations if cache is not None else None,
+            self.sydent.signed_association_lookups,
+            [key],
+            fetch,
+        )
+        entry = results.get(key)
+        sgAssoc = None
+        now = time_msec()
+        if entry is not None and entry[2] < now < entry[3]:
+            sgAssoc = (entry[0], entry[1])
+        if bloom_filter is not None:
+            bloom_filter.record_results("3pid", 1, int(sgAssoc is not None))
+        return sgAssoc
+
+    def _signedAssociationForThreepidTxn(
+        self, cur: Cursor, medium: str, address: str
+    ) -> Optional[SignedAssociationEntry]:
+        # Addresses are matched case-insensitively, see normalise_address_for_lookup.
+        # The mapping is returned if it hasn't expired, even if it isn't valid yet, so
+        # that it can be cached until it is.
+        res = cur.execute(
+            "select g.id, g.sgAssoc, c.notBefore, c.notAfter "
+            "from global_threepid_current_mappings c "
+            "join global_threepid_associations g on g.id = c.association_id "
+            "where c.medium = ? and c.normalised_address = ? and c.notAfter > ?",
+            (medium, normalise_address_for_lookup(address), time_msec()),
+        )
+
+        row: Optional[SignedAssociationEntry] = res.fetchone()
+
+        if not row:
+            return None
+
+        return (row[0], row[1], row[2], row[3])
+
+    def _signedAssociationForThreepidFromHistoryTxn(
+        self, cur: Cursor, medium: str, address: str
+    ) -> Optional[Tuple[int, str]]:
         res = cur.execute(
-            "select sgAssoc from global_threepid_associations where "
+            "select id, sgAssoc from global_threepid_associations where "
             "medium = ? and lower(address) = lower(?) and notBefore < ? and notAfter > ? "
             "order by ts desc limit 1",
             (medium, address, time_msec(), time_msec()),
         )
 
-        row: Optional[Tuple[str]] = res.fetchone()
+        row: Optional[Tuple[int, str]] = res.fetchone()
 
         if not row:
             return None
 
-        sgAssocStr = row[0]
+        return (row[0], row[1])
 
-        return sgAssocStr
-
-    def getMxid(self, medium: str, normalised_address: str) -> Optional[str]:
+    async def getMxid(self, medium: str, normalised_address: str) -> Optional[str]:
         """
         Retrieves the MXID associated with a 3PID. Please note that
         emails need to be casefolded before calling this function.
@@ -234,8 +435,26 @@ class GlobalAssociationStore:
 
         :return: The associated MXID, or None if no MXID is associated with this 3PID.
         """
+        if not self._hasCurrentMappings():
+            return await self.sydent.lookup_db_pool.runInteraction(
+                "getMxid", self._getMxidFromHistoryTxn, medium, normalised_address
+            )
 
-        cur = self.sydent.db.cursor()
+        bloom_filter = self.sydent.lookup_bloom_filter
+        if bloom_filter is not None and not bloom_filter.filter_threepids(
+            [(medium, normalised_address)]
+        ):
+            return None
+
+        results = await self._getCurrentMxids([(medium, normalised_address)])
+        mxid = results[0][2] if results else None
+        if bloom_filter is not None:
+            bloom_filter.record_results("3pid", 1, int(mxid is not None))
+        return mxid
+
+    def _getMxidFromHistoryTxn(
+        self, cur: Cursor, medium: str, normalised_address: str
+    ) -> Optional[str]:
         res = cur.execute(
             "select mxid from global_threepid_associations where "
             "medium = ? and lower(address) = lower(?) and notBefore < ? and notAfter > ? "
@@ -250,7 +469,7 @@ class GlobalAssociationStore:
 
         return row[0]
 
-    def getMxids(
+    async def getMxids(
         self, threepid_tuples: List[Tuple[str, str]]
     ) -> List[Tuple[str, str, str]]:
         """Given a list of threepid_tuples, return the same list but with
@@ -261,47 +480,180 @@ class GlobalAssociationStore:
 
         :return: a list of (medium, address, mxid) tuples
         """
-        cur = self.sydent.db.cursor()
+        if not self._hasCurrentMappings():
+            return await self.sydent.lookup_db_pool.runInteraction(
+                "getMxids", self._getMxidsFromHistoryTxn, threepid_tuples
+            )
 
-        cur.execute(
-            "CREATE TEMPORARY TABLE tmp_getmxids (medium VARCHAR(16), address VARCHAR(256))"
-        )
-        cur.execute(
-            "CREATE INDEX tmp_getmxids_medium_lower_address ON tmp_getmxids (medium, lower(address))"
+        bloom_filter = self.sydent.lookup_bloom_filter
+        if bloom_filter is not None:
+            threepid_tuples = bloom_filter.filter_threepids(threepid_tuples)
+            if not threepid_tuples:
+                return []
+
+        results = await self._getCurrentMxids(threepid_tuples)
+        if bloom_filter is not None:
+            candidates = {
+                (medium, normalise_address_for_lookup(address))
+                for medium, address in threepid_tuples
+            }
+            bloom_filter.record_results("3pid", len(candidates), len(results))
+        return results
+
+    async def getMxidsByHash(
+        self, threepid_tuples: List[Tuple[str, str]]
+    ) -> List[Tuple[str, str, str]]:
+        """Like getMxids, but hashes the 3PIDs with the current lookup pepper and looks
+        up their hashes, so that plaintext and hashed lookups are served by the same
+        index and caches.
+
+        The hashes are computed from the 3PIDs' addresses normalised the way they are
+        when associations are stored (see normalise_address), which is also the
+        address returned. Until the background update filling in the hashes of
+        existing associations has finished, the 3PIDs not found through their hashes
+        are looked up with getMxids too.
+
+        :param threepid_tuples: List containing (medium, address) tuples
+
+        :return: a list of (medium, normalised address, mxid) tuples, ordered by
+            medium and address.
+        """
+        peppers = self.sydent.hashing_store.get_lookup_peppers()
+        if peppers is None:
+            return await self.getMxids(threepid_tuples)
+
+        threepids_by_hash: Dict[str, Set[Tuple[str, str]]] = {}
+        for medium, address in threepid_tuples:
+            address = normalise_address(address, medium)
+            lookup_hash = hash_threepid(medium, address, peppers.current)
+            threepids_by_hash.setdefault(lookup_hash, set()).add((medium, address))
+
+        mxids = await self.retrieveMxidsForHashes(
+            list(threepids_by_hash), peppers.hash_column
         )
+        results = [
+            (medium, address, mxid)
+            for lookup_hash, mxid in mxids.items()
+            for medium, address in threepids_by_hash[lookup_hash]
+        ]
 
-        try:
-            inserted_cap = 0
-            while inserted_cap < len(threepid_tuples):
-                cur.executemany(
-                    "INSERT INTO tmp_getmxids (medium, address) VALUES (?, ?)",
-                    threepid_tuples[inserted_cap : inserted_cap + 500],
+        if not self.sydent.background_updater.has_completed_update(
+            POPULATE_LOOKUP_HASHES
+        ):
+            misses = [
+                threepid
+                for lookup_hash, threepids in threepids_by_hash.items()
+                if lookup_hash not in mxids
+                for threepid in threepids
+            ]
+            if misses:
+                results.extend(
+                    (medium, normalise_address(address, medium), mxid)
+                    for medium, address, mxid in await self.getMxids(misses)
                 )
-                inserted_cap += 500
 
-            res = cur.execute(
-                # 'notBefore' is the time the association starts being valid, 'notAfter' the the time at which
-                # it ceases to be valid, so the ts must be greater than 'notBefore' and less than 'notAfter'.
-                "SELECT gte.medium, gte.address, gte.ts, gte.mxid FROM global_threepid_associations gte "
-                "JOIN tmp_getmxids ON gte.medium = tmp_getmxids.medium AND lower(gte.address) = lower(tmp_getmxids.address) "
-                "WHERE gte.notBefore < ? AND gte.notAfter > ? "
-                "ORDER BY gte.medium, gte.address, gte.ts DESC",
-                (time_msec(), time_msec()),
+        return sorted(results)
+
+    async def _getCurrentMxids(
+        self, threepid_tuples: List[Tuple[str, str]]
+    ) -> List[Tuple[str, str, str]]:
+        """Look up the current mappings of the given 3PIDs, sharing the queries of
+        concurrent lookups for the same 3PIDs.
+
+        :param threepid_tuples: The (medium, address) of the 3PIDs.
+
+        :return: The (medium, address, mxid) of the 3PIDs which are bound, ordered by
+            medium and address.
+        """
+
+        async def fetch(
+            threepids: List[Tuple[str, str]]
+        ) -> Dict[Tuple[str, str], MxidEntry]:
+            rows = await self.sydent.lookup_db_pool.runInteraction(
+                "getMxids", self._getMxidsTxn, threepids
             )
+            return {(row[0], normalise_address_for_lookup(row[1])): row for row in rows}
 
-            results = []
-            current = None
-            row: Tuple[str, str, int, str]
-            for row in res.fetchall():
-                # only use the most recent entry for each
-                # threepid (they're sorted by ts)
-                if (row[0], row[1]) == current:
-                    continue
-                current = (row[0], row[1])
-                results.append((row[0], row[1], row[3]))
+        cache = self.sydent.lookup_cache
+        results = await self._getCachedOrFetch(
+            cache.mxids if cache is not None else None,
+            self.sydent.mxid_lookups,
+            (
+                (medium, normalise_address_for_lookup(address))
+                for medium, address in threepid_tuples
+            ),
+            fetch,
+        )
+        now = time_msec()
+        return sorted(
+            (medium, address, mxid)
+            for medium, address, mxid, not_before, not_after in results.values()
+            if not_before < now < not_after
+        )
+
+    def _getMxidsTxn(
+        self, cur: Cursor, threepid_tuples: List[Tuple[str, str]]
+    ) -> List[MxidEntry]:
+        # Group the addresses to look up by medium, so that each can be matched on
+        # the (medium, normalised_address) index.
+        addresses_by_medium: Dict[str, Set[str]] = {}
+        for medium, address in threepid_tuples:
+            addresses_by_medium.setdefault(medium, set()).add(
+                normalise_address_for_lookup(address)
+            )
 
-        finally:
-            cur.execute("DROP TABLE tmp_getmxids")
+        results: List[MxidEntry] = []
+        now = time_msec()
+        for medium, addresses in addresses_by_medium.items():
+            for clause, args in self.sydent.db_engine.in_clauses(
+                "normalised_address", sorted(addresses)
+            ):
+                cur.execute(
+                    # 'notBefore' is the time the association starts being valid, 'notAfter' the the time at which
+                    # it ceases to be valid. The mappings which aren't valid yet are
+                    # returned too, so that they can be cached until they are.
+                    "SELECT medium, address, mxid, notBefore, notAfter "
+                    "FROM global_threepid_current_mappings "
+                    "WHERE medium = ? AND %s AND notAfter > ?" % (clause,),
+                    [medium, *args, now],
+                )
+                results.extend(cur.fetchall())
+
+        return results
+
+    def _getMxidsFromHistoryTxn(
+        self, cur: Cursor, threepid_tuples: List[Tuple[str, str]]
+    ) -> List[Tuple[str, str, str]]:
+        # NB. the addresses are lowercased in Python to be matched against the
+        # lower(address) index, which only differs from SQLite's lower() for
+        # non-ASCII characters in addresses which weren't casefolded when stored.
+        addresses_by_medium: Dict[str, Set[str]] = {}
+        for medium, address in threepid_tuples:
+            addresses_by_medium.setdefault(medium, set()).add(address.lower())
+
+        rows: List[Tuple[str, str, int, str]] = []
+        now = time_msec()
+        for medium, addresses in addresses_by_medium.items():
+            for clause, args in self.sydent.db_engine.in_clauses(
+                "lower(address)", sorted(addresses)
+            ):
+                cur.execute(
+                    "SELECT medium, address, ts, mxid FROM global_threepid_associations "
+                    "WHERE medium = ? AND %s AND notBefore < ? AND notAfter > ?"
+                    % (clause,),
+                    [medium, *args, now, now],
+                )
+                rows.extend(cur.fetchall())
+
+        # Only use the most recent association for each 3PID.
+        rows.sort(key=lambda row: (row[0], row[1], -row[2]))
+        results = []
+        current = None
+        for row in rows:
+            if (row[0], row[1]) == current:
+                continue
+            current = (row[0], row[1])
+            results.append((row[0], row[1], row[3]))
 
         return results
 
@@ -327,15 +679,36 @@ class GlobalAssociationStore:
             association.
         """
 
+        # While the lookup pepper is being rotated, or just after, the association
+        # also needs hashing with the other pepper.
+        lookup_hash, alt_lookup_hash = self.sydent.hashing_store.get_lookup_hash_values(
+            assoc.medium, assoc.address, assoc.lookup_hash
+        )
+
         cur = self.sydent.db.cursor()
         cur.execute(
-            "insert or ignore into global_threepid_associations "
-            "(medium, address, lookup_hash, mxid, ts, notBefore, notAfter, originServer, originId, sgAssoc) values "
-            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            self.sydent.db_engine.insert_or_ignore(
+                "global_threepid_associations",
+                (
+                    "medium",
+                    "address",
+                    "lookup_hash",
+                    "alt_lookup_hash",
+                    "mxid",
+                    "ts",
+                    "notBefore",
+                    "notAfter",
+                    "originServer",
+                    "originId",
+                    "sgAssoc",
+                    "normalised_address",
+                ),
+            ),
             (
                 assoc.medium,
                 assoc.address,
-                assoc.lookup_hash,
+                lookup_hash,
+                alt_lookup_hash,
                 assoc.mxid,
                 assoc.ts,
                 assoc.not_before,
@@ -343,11 +716,181 @@ class GlobalAssociationStore:
                 originServer,
                 originId,
                 rawSgAssoc,
+                normalise_address_for_lookup(assoc.address),
             ),
         )
+        # The row is ignored if we already have this association.
+        if cur.rowcount > 0:
+            self._updateCurrentMappings(
+                cur, [(assoc.medium, normalise_address_for_lookup(assoc.address))]
+            )
         if commit:
             self.sydent.db.commit()
 
+    def addAssociations(
+        self, assocs: Sequence[Tuple[ThreepidAssociation, str, int]], originServer: str
+    ) -> None:
+        """
+        Saves a batch of associations received through a replication push, in the
+        order they're given. Associations without an MXID are deletions, which remove
+        every association stored for their 3PID. Consecutive additions and
+        consecutive deletions are written with a single statement each. Must be
+        called in a unit of work, so that the batch is stored in a single
+        transaction. Please note that emails in the associations need to be
+        casefolded before calling this function.
+
+        :param assocs: The associations to save, along with the JSON of their
+            signed association and their ID on the server they were created on.
+        :param originServer: The name of the server the associations were created on.
+        """
+        insert_sql = self.sydent.db_engine.insert_or_ignore(
+            "global_threepid_associations",
+            (
+                "medium",
+                "address",
+                "lookup_hash",
+                "alt_lookup_hash",
+                "mxid",
+                "ts",
+                "notBefore",
+                "notAfter",
+                "originServer",
+                "originId",
+                "sgAssoc",
+                "normalised_address",
+            ),
+        )
+
+        cur = self.sydent.db.cursor()
+        changed = False
+        threepids: Dict[Tuple[str, str], None] = {}
+        for is_deletion, run in itertools.groupby(
+            assocs, key=lambda a: a[0].mxid is None
+        ):
+            if is_deletion:
+                rows = [(assoc.medium, assoc.address) for assoc, _, _ in run]
+                cur.executemany(
+                    "DELETE FROM global_threepid_associations WHERE "
+                    "medium = ? AND address = ?",
+                    rows,
+                )
+                logger.info(
+                    "Deleted %d rows from global associations for %d 3PIDs from %s",
+                    cur.rowcount,
+                    len(rows),
+                    originServer,
+                )
+                for medium, address in rows:
+                    threepids[(medium, normalise_address_for_lookup(address))] = None
+                changed = True
+            else:
+                inserts = []
+                for assoc, rawSgAssoc, originId in run:
+                    # While the lookup pepper is being rotated, or just after, the
+                    # association also needs hashing with the other pepper.
+                    (
+                        lookup_hash,
+                        alt_lookup_hash,
+                    ) = self.sydent.hashing_store.get_lookup_hash_values(
+                        assoc.medium, assoc.address, assoc.lookup_hash
+                    )
+                    normalised_address = normalise_address_for_lookup(assoc.address)
+                    inserts.append(
+                        (
+                            assoc.medium,
+                            assoc.address,
+                            lookup_hash,
+                            alt_lookup_hash,
+                            assoc.mxid,
+                            assoc.ts,
+                            assoc.not_before,
+                            assoc.not_after,
+                            originServer,
+                            originId,
+                            rawSgAssoc,
+                            normalised_address,
+                        )
+                    )
+                    threepids[(assoc.medium, normalised_address)] = None
+                cur.executemany(insert_sql, inserts)
+                # The rows are ignored if we already have these associations.
+                if cur.rowcount != 0:
+                    changed = True
+
+        if changed:
+            self._updateCurrentMappings(cur, list(threepids))
+
+    def _updateCurrentMappings(
+        self, cur: Cursor, threepids: List[Tuple[str, str]]
+    ) -> None:
+        """Update the current mappings of the given 3PIDs after their associations
+        have changed, and the lookup hash index, Bloom filter and snapshot once the
+        change has been committed.
+
+        :param cur: The cursor to use.
+        :param threepids: The (medium, normalised address) of the 3PIDs to update.
+        """
+        index = self.sydent.lookup_hash_index
+        bloom_filter = self.sydent.lookup_bloom_filter
+        snapshot = self.sydent.lookup_snapshot
+        cache = self.sydent.lookup_cache
+
+        # Don't let lookups which start once the change has been committed share the
+        # results of the ones which started before. Which hashes have changed isn't
+        # known here, so forget every lookup by hash.
+        def forget_lookups() -> None:
+            self.sydent.mxid_lookups.forget(threepids)
+            self.sydent.signed_association_lookups.forget(threepids)
+            self.sydent.lookup_hash_lookups.forget_all()
+
+        self.sydent.db.call_after_commit(forget_lookups)
+
+        old_mappings = []
+        if index is not None or snapshot is not None or cache is not None:
+            old_mappings = self._getCurrentMappingsTxn(cur, threepids)
+        update_current_mappings(cur, threepids, log_changes=snapshot is not None)
+        if (
+            index is None
+            and bloom_filter is None
+            and snapshot is None
+            and cache is None
+        ):
+            return
+        new_mappings = self._getCurrentMappingsTxn(cur, threepids)
+
+        stream_id = 0
+        if snapshot is not None:
+            # The associations are only written through this connection, so the
+            # last change logged is this one.
+            cur.execute("SELECT MAX(stream_id) FROM global_threepid_mapping_changes")
+            stream_id = cur.fetchone()[0] or 0
+
+        def after_commit() -> None:
+            if index is not None:
+                index.update(old_mappings, new_mappings)
+            if bloom_filter is not None and new_mappings:
+                bloom_filter.add(threepids, new_mappings)
+            if snapshot is not None:
+                snapshot.update(stream_id, old_mappings, new_mappings)
+            if cache is not None:
+                cache.invalidate(threepids, old_mappings + new_mappings)
+
+        self.sydent.db.call_after_commit(after_commit)
+
+    def _getCurrentMappingsTxn(
+        self, cur: Cursor, threepids: List[Tuple[str, str]]
+    ) -> List[CurrentMapping]:
+        mappings: List[CurrentMapping] = []
+        for medium, normalised_address in threepids:
+            cur.execute(
+                "SELECT lookup_hash, alt_lookup_hash, mxid, notBefore, notAfter "
+                "FROM global_threepid_current_mappings "
+                "WHERE medium = ? AND normalised_address = ?",
+                (medium, normalised_address),
+            )
+            mappings.extend(cur.fetchall())
+        return mappings
+
     def lastIdFromServer(self, server: str) -> Optional[int]:
         """
         Retrieves the ID of the last association received from the given peer.
@@ -392,67 +935,282 @@ class GlobalAssociationStore:
             medium,
             normalised_address,
         )
+        self._updateCurrentMappings(
+            cur, [(medium, normalise_address_for_lookup(normalised_address))]
+        )
         self.sydent.db.commit()
 
-    def retrieveMxidsForHashes(self, addresses: List[str]) -> Dict[str, str]:
-        """Returns a mapping from hash: mxid from a list of given lookup_hash values
+    async def compactAssociationsInBackground(self) -> None:
+        """Run compactAssociations, logging any failure rather than raising it so
+        that the next scheduled compaction still happens.
+        """
+        try:
+            await self.compactAssociations()
+        except Exception:
+            logger.exception("Failed to compact associations")
 
-        :param addresses: An array of lookup_hash values to check against the db
+    async def compactAssociations(self) -> None:
+        """Remove the associations which have been superseded by a newer association
+        for the same 3PID, going through the history in chunks of
+        COMPACTION_CHUNK_SIZE IDs so that each transaction stays short.
 
-        :returns a dictionary of lookup_hash values to mxids of all discovered matches
+        This writes to the database, so it runs on the main connection rather than on
+        the database pool, waiting between chunks to let requests through.
         """
+        if not self._hasCurrentMappings():
+            logger.info("Not compacting associations until current mappings are built")
+            return
+
         cur = self.sydent.db.cursor()
+        cur.execute("SELECT MAX(id) FROM global_threepid_associations")
+        row: Tuple[Optional[int]] = cur.fetchone()
+        cur.close()
+        max_id = row[0]
+        if max_id is None:
+            return
+
+        total_count = 0
+        total_bytes = 0
+        for from_id in range(0, max_id, self.COMPACTION_CHUNK_SIZE):
+            if from_id > 0:
+                await task.deferLater(
+                    self.sydent.reactor, self.COMPACTION_SLEEP_DURATION_MS / 1000
+                )
+            with self.sydent.db.unit_of_work():
+                cur = self.sydent.db.cursor()
+                count, size = self._compactAssociationsTxn(
+                    cur, from_id, from_id + self.COMPACTION_CHUNK_SIZE
+                )
+                cur.close()
+            total_count += count
+            total_bytes += size
 
-        cur.execute(
-            "CREATE TEMPORARY TABLE tmp_retrieve_mxids_for_hashes "
-            "(lookup_hash VARCHAR)"
+        logger.info(
+            "Compacted %d superseded associations, reclaiming about %d bytes",
+            total_count,
+            total_bytes,
         )
+
+    def _compactAssociationsTxn(
+        self, cur: Cursor, from_id: int, to_id: int
+    ) -> Tuple[int, int]:
+        # The size is the size of the values in the row, not including the space used
+        # by the row's entries in indexes.
         cur.execute(
-            "CREATE INDEX tmp_retrieve_mxids_for_hashes_lookup_hash ON "
-            "tmp_retrieve_mxids_for_hashes(lookup_hash)"
+            "SELECT g.id, g.medium, g.normalised_address, "
+            "LENGTH(g.sgAssoc) + LENGTH(g.address) + LENGTH(g.normalised_address) "
+            "+ LENGTH(g.mxid) + COALESCE(LENGTH(g.lookup_hash), 0) "
+            "+ COALESCE(LENGTH(g.alt_lookup_hash), 0) "
+            "+ LENGTH(g.originServer) "
+            "FROM global_threepid_associations g "
+            "JOIN global_threepid_current_mappings c ON c.medium = g.medium "
+            "AND c.normalised_address = g.normalised_address "
+            "WHERE g.id > ? AND g.id <= ? AND g.id != c.association_id "
+            "AND g.originId < ("
+            "    SELECT MAX(originId) FROM global_threepid_associations g2"
+            "    WHERE g2.originServer = g.originServer"
+            ")",
+            (from_id, to_id),
+        )
+        rows: List[Tuple[int, str, str, int]] = cur.fetchall()
+
+        # Check again that the association isn't its 3PID's newest when deleting it,
+        # in case the newer association was removed in the meantime.
+        cur.executemany(
+            "DELETE FROM global_threepid_associations WHERE id = ? AND id != ("
+            "    SELECT association_id FROM global_threepid_current_mappings"
+            "    WHERE medium = ? AND normalised_address = ?"
+            ")",
+            [(id, medium, address) for id, medium, address, _ in rows],
         )
 
-        results = {}
-        try:
-            # Convert list of addresses to list of tuples of addresses
-            tuplized_addresses = [(x,) for x in addresses]
+        count = len(rows)
+        size = sum(row_size for _, _, _, row_size in rows)
+        compacted_associations.inc(count)
+        compacted_association_bytes.inc(size)
+        return count, size
 
-            inserted_cap = 0
-            while inserted_cap < len(tuplized_addresses):
-                cur.executemany(
-                    "INSERT INTO tmp_retrieve_mxids_for_hashes(lookup_hash) "
-                    "VALUES (?)",
-                    tuplized_addresses[inserted_cap : inserted_cap + 500],
-                )
-                inserted_cap += 500
+    async def retrieveMxidsForHashes(
+        self, addresses: List[str], lookup_hash_column: str = "lookup_hash"
+    ) -> Dict[str, str]:
+        """Returns a mapping from hash: mxid from a list of given lookup_hash values
 
-            res = cur.execute(
-                # 'notBefore' is the time the association starts being valid, 'notAfter' the the time at which
-                # it ceases to be valid, so the ts must be greater than 'notBefore' and less than 'notAfter'.
-                "SELECT gta.lookup_hash, gta.mxid FROM global_threepid_associations gta "
-                "JOIN tmp_retrieve_mxids_for_hashes "
-                "ON gta.lookup_hash = tmp_retrieve_mxids_for_hashes.lookup_hash "
-                "WHERE gta.notBefore < ? AND gta.notAfter > ? "
-                "ORDER BY gta.lookup_hash, gta.mxid, gta.ts",
-                (time_msec(), time_msec()),
+        :param addresses: An array of lookup_hash values to check against the db
+        :param lookup_hash_column: The column holding the hashes computed with the
+            pepper the addresses were hashed with, see
+            HashingMetadataStore.get_lookup_hash_column.
+
+        :returns a dictionary of lookup_hash values to mxids of all discovered matches
+        """
+        if lookup_hash_column not in LOOKUP_HASH_COLUMNS:
+            raise ValueError("Unknown lookup hash column %s" % (lookup_hash_column,))
+
+        index = self.sydent.lookup_hash_index
+        if index is not None and index.loaded:
+            return index.get_mxids(addresses, lookup_hash_column, time_msec())
+
+        snapshot_results: Dict[str, str] = {}
+        snapshot = self.sydent.lookup_snapshot
+        if snapshot is not None:
+            answer = snapshot.get_mxids(addresses, lookup_hash_column, time_msec())
+            if answer is not None:
+                snapshot_results, addresses = answer
+                if not addresses:
+                    return snapshot_results
+
+        if not self._hasCurrentMappings():
+            return await self.sydent.lookup_db_pool.runInteraction(
+                "retrieveMxidsForHashes",
+                self._retrieveMxidsForHashesFromHistoryTxn,
+                addresses,
+                lookup_hash_column,
             )
 
-            # Place the results from the query into a dictionary
-            # Results are sorted from oldest to newest, so if there are multiple mxid's for
-            # the same lookup hash, only the newest mapping will be returned
+        bloom_filter = self.sydent.lookup_bloom_filter
+        if bloom_filter is not None:
+            addresses = bloom_filter.filter_hashes(addresses)
+            if not addresses:
+                return snapshot_results
+
+        async def fetch(
+            keys: List[Tuple[str, str]]
+        ) -> Dict[Tuple[str, str], HashEntry]:
+            entries = await self.sydent.lookup_db_pool.runInteraction(
+                "retrieveMxidsForHashes",
+                self._retrieveMxidsForHashesTxn,
+                [lookup_hash for _, lookup_hash in keys],
+                lookup_hash_column,
+            )
+            return {
+                (lookup_hash_column, lookup_hash): entry
+                for lookup_hash, entry in entries.items()
+            }
+
+        cache = self.sydent.lookup_cache
+        shared = await self._getCachedOrFetch(
+            cache.hashes if cache is not None else None,
+            self.sydent.lookup_hash_lookups,
+            ((lookup_hash_column, lookup_hash) for lookup_hash in addresses),
+            fetch,
+        )
+        now = time_msec()
+        results = {
+            lookup_hash: mxid
+            for (_, lookup_hash), (mxid, not_before, not_after) in shared.items()
+            if not_before < now < not_after
+        }
+        if bloom_filter is not None:
+            bloom_filter.record_results("hash", len(set(addresses)), len(results))
+        results.update(snapshot_results)
+        return results
+
+    def _retrieveMxidsForHashesTxn(
+        self, cur: Cursor, addresses: List[str], lookup_hash_column: str
+    ) -> Dict[str, HashEntry]:
+        results = {}
+        now = time_msec()
+        for clause, args in self.sydent.db_engine.in_clauses(
+            lookup_hash_column, sorted(set(addresses))
+        ):
+            cur.execute(
+                # 'notBefore' is the time the association starts being valid, 'notAfter' the the time at which
+                # it ceases to be valid. The mappings which aren't valid yet are
+                # returned too, so that they can be cached until they are.
+                "SELECT %s, mxid, notBefore, notAfter "
+                "FROM global_threepid_current_mappings "
+                "WHERE %s AND notAfter > ?" % (lookup_hash_column, clause),
+                [*args, now],
+            )
 
             # Type safety: lookup_hash is a nullable string in
-            # global_threepid_associations. But it must be equal to a lookup_hash
-            # in the temporary table thanks to the join condition.
-            # The temporary table gets hashes from the `addresses` argument,
-            # which is a list of (non-None) strings.
-            # So lookup_hash really is a str.
+            # global_threepid_current_mappings. But it must be equal to one of the
+            # hashes in the `addresses` argument, which is a list of (non-None)
+            # strings, thanks to the IN clause. So lookup_hash really is a str.
+            lookup_hash: str
+            mxid: str
+            not_before: int
+            not_after: int
+            for lookup_hash, mxid, not_before, not_after in cur.fetchall():
+                results[lookup_hash] = (mxid, not_before, not_after)
+
+        return results
+
+    def _retrieveMxidsForHashesFromHistoryTxn(
+        self, cur: Cursor, addresses: List[str], lookup_hash_column: str
+    ) -> Dict[str, str]:
+        results = {}
+        now = time_msec()
+        for clause, args in self.sydent.db_engine.in_clauses(
+            lookup_hash_column, sorted(set(addresses))
+        ):
+            # Order by ts so that the newest association for each hash wins.
+            cur.execute(
+                "SELECT %s, mxid FROM global_threepid_associations "
+                "WHERE %s AND notBefore < ? AND notAfter > ? ORDER BY ts"
+                % (lookup_hash_column, clause),
+                [*args, now, now],
+            )
+
             lookup_hash: str
             mxid: str
-            for lookup_hash, mxid in res.fetchall():
+            for lookup_hash, mxid in cur.fetchall():
                 results[lookup_hash] = mxid
 
-        finally:
-            cur.execute("DROP TABLE tmp_retrieve_mxids_for_hashes")
+        return results
 
+    async def _getCachedOrFetch(
+        self,
+        cache: Optional[LruCache[K, Optional[V]]],
+        lookups: SingleFlight[K, V],
+        keys: Iterable[K],
+        fetch: Callable[[List[K]], Awaitable[Dict[K, V]]],
+    ) -> Dict[K, V]:
+        """Look up the given keys in the lookup cache if it's enabled, and fetch the
+        ones which aren't in it, sharing the fetches of concurrent lookups.
+
+        :param cache: The lookup cache to use, if it's enabled.
+        :param lookups: The fetches in flight.
+        :param keys: The keys to look up.
+        :param fetch: The function to fetch the keys with. Keys missing from the dict
+            it returns have no value.
+
+        :return: The values of the keys which have one.
+        """
+        if cache is None:
+            return await lookups.get_many(keys, fetch)
+
+        results: Dict[K, V] = {}
+        missing: List[K] = []
+        for key in keys:
+            value = cache.get(key)
+            if value is Sentinel.token:
+                missing.append(key)
+            elif value is not None:
+                results[key] = value
+        if not missing:
+            return results
+
+        async def fetch_and_cache(fetch_keys: List[K]) -> Dict[K, V]:
+            assert cache is not None
+            # The cache is invalidated once changes are committed, which, in group
+            # commit mode, can be before they've reached the database. Don't cache
+            # what's fetched while there are changes waiting to be committed, as it
+            # may not include them.
+            version = cache.version
+            cacheable = not self.sydent.db.in_transaction
+            fetched = await fetch(fetch_keys)
+            if cacheable:
+                cache.set_many(((key, fetched.get(key)) for key in fetch_keys), version)
+            return fetched
+
+        results.update(await lookups.get_many(missing, fetch_and_cache))
         return results
+
+    def _hasCurrentMappings(self) -> bool:
+        """
+        :return: Whether the current mappings have been built, so that lookups can
+            read them rather than the history.
+        """
+        return self.sydent.background_updater.has_completed_update(
+            POPULATE_CURRENT_MAPPINGS
+        )
@@ -0,0 +1,325 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+import logging
+import re
+from contextlib import contextmanager
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+)
+
+from prometheus_client import Counter
+from twisted.internet.interfaces import IDelayedCall, IReactorTime
+
+from sydent.db.types import DBAPI2Connection, DBAPI2Cursor
+
+if TYPE_CHECKING:
+    from sydent.db.engines import BaseDatabaseEngine
+
+logger = logging.getLogger(__name__)
+
+group_commits = Counter(
+    "sydent_db_group_commits",
+    "Number of transactions committed by the group commit mode",
+)
+coalesced_commits = Counter(
+    "sydent_db_coalesced_commits",
+    "Number of commits requested while in group commit mode, which were folded into "
+    "a group commit",
+)
+
+# The name of the savepoint wrapping the outermost unit of work.
+_SAVEPOINT = "sydent_unit_of_work"
+
+# Matches statements whose transaction must be left open after they run: those
+# which modify data (before which sqlite3 implicitly opens a transaction), and
+# savepoints.
+_TRANSACTIONAL_STATEMENT_RE = re.compile(
+    r"\s*(INSERT|UPDATE|DELETE|REPLACE|SAVEPOINT)\b", re.I
+)
+
+
+class Cursor:
+    """A cursor on a TransactionalConnection.
+
+    Queries always use `?` placeholders, whichever database engine is in use, and
+    `execute()` returns the cursor itself (as sqlite3's does) so that results can be
+    fetched straight from its return value.
+    """
+
+    def __init__(self, conn: "TransactionalConnection", txn: DBAPI2Cursor) -> None:
+        self._conn = conn
+        self._txn = txn
+
+    @property
+    def rowcount(self) -> int:
+        return self._txn.rowcount
+
+    @property
+    def description(self) -> Optional[Sequence[Any]]:
+        return self._txn.description
+
+    def execute(self, sql: str, args: Sequence[Any] = ()) -> "Cursor":
+        was_in_transaction = self._conn.in_transaction
+        try:
+            self._txn.execute(self._conn.engine.convert_param_style(sql), args)
+        except Exception:
+            self._conn._on_statement_failure()
+            raise
+        self._conn._on_statement_success(sql, was_in_transaction)
+        return self
+
+    def executemany(self, sql: str, args: Iterable[Sequence[Any]]) -> "Cursor":
+        was_in_transaction = self._conn.in_transaction
+        try:
+            self._txn.executemany(self._conn.engine.convert_param_style(sql), args)
+        except Exception:
+            self._conn._on_statement_failure()
+            raise
+        self._conn._on_statement_success(sql, was_in_transaction)
+        return self
+
+    def fetchone(self) -> Any:
+        return self._txn.fetchone()
+
+    def fetchall(self) -> List[Any]:
+        return self._txn.fetchall()
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._txn.fetchall())
+
+    def close(self) -> None:
+        self._txn.close()
+
+
+class TransactionalConnection:
+    """A connection to the database, whichever engine it uses, which lets callers
+    group several writes into a single transaction, either explicitly by opening a
+    unit of work, or implicitly by enabling group commit.
+
+    Units of work
+    -------------
+
+    Writes made inside a `unit_of_work()` block are committed together when the
+    outermost block exits, or rolled back together if it raises. Inside a unit of
+    work, `commit()` is a no-op and `rollback()` only rolls back the changes made
+    since the start of the unit, so stores can keep committing after each write and
+    still be used as part of a larger transaction.
+
+    A unit of work must not span an `await` (or otherwise yield to the reactor), as
+    another request could then make changes inside it. Nested units are folded into
+    the outermost one.
+
+    Group commit
+    ------------
+
+    In group commit mode, `commit()` (and the end of an outermost unit of work)
+    doesn't commit straight away. Instead, the transaction is left open and committed
+    at the end of the current reactor tick, so that all of the requests handled in
+    the same tick share a single commit, and therefore a single fsync.
+
+    This weakens durability: a response may be sent to a client before the changes
+    it reports are on disk, and those changes will be lost if Sydent crashes, or if
+    the commit fails, before the end of the tick. Changes also become visible to
+    other connections (including the lookup pool) only once they are committed.
+    Atomicity is unaffected: units of work are still either entirely committed or
+    entirely rolled back. However, calling `rollback()` outside of a unit of work
+    rolls back every change made since the last group commit, including other
+    requests', so code that needs to roll back must use a unit of work.
+
+    On PostgreSQL, a statement failing outside of a unit of work aborts the whole
+    transaction, which is then rolled back so that the connection remains usable.
+
+    In-memory state derived from the database (such as the lookup hash index) can be
+    kept in step with it by updating it from a `call_after_commit()` callback, which
+    only runs once the changes have actually been committed.
+    """
+
+    def __init__(self, engine: "BaseDatabaseEngine", conn: DBAPI2Connection) -> None:
+        """
+        :param engine: The engine the connection was opened with.
+        :param conn: The underlying DB-API connection.
+        """
+        self.engine = engine
+        self.conn = conn
+        self._unit_of_work_depth = 0
+        self._group_commit_clock: Optional[IReactorTime] = None
+        self._pending_flush: Optional[IDelayedCall] = None
+        # The callbacks to call once the current unit of work has exited.
+        self._after_commit_callbacks: List[Callable[[], None]] = []
+        # The callbacks to call once the current transaction has been committed.
+        self._pending_after_commit_callbacks: List[Callable[[], None]] = []
+
+    def cursor(self) -> Cursor:
+        return Cursor(self, self.conn.cursor())
+
+    def execute(self, sql: str, args: Sequence[Any] = ()) -> Cursor:
+        """Run a single statement on a new cursor, and return that cursor."""
+        return self.cursor().execute(sql, args)
+
+    @property
+    def in_transaction(self) -> bool:
+        return self.engine.in_transaction(self.conn)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def enable_group_commit(self, clock: IReactorTime) -> None:
+        """Switch the connection to group commit mode.
+
+        :param clock: The clock to use to schedule group commits.
+        """
+        self._group_commit_clock = clock
+
+    def call_after_commit(self, callback: Callable[[], None]) -> None:
+        """Call a function once the changes made so far have been committed: straight
+        away if there are no uncommitted changes, or once the transaction holding them
+        has been committed otherwise (in group commit mode, at the end of the reactor
+        tick). The function isn't called if the changes are rolled back, or if
+        committing them fails.
+
+        :param callback: The function to call.
+        """
+        if self._unit_of_work_depth > 0:
+            self._after_commit_callbacks.append(callback)
+        elif self.in_transaction:
+            self._pending_after_commit_callbacks.append(callback)
+        else:
+            callback()
+
+    def _commit_and_run_callbacks(self) -> None:
+        """Commit the current transaction, then call the functions waiting for it to
+        be committed. These are dropped if the commit fails.
+        """
+        callbacks = self._pending_after_commit_callbacks
+        self._pending_after_commit_callbacks = []
+        self.conn.commit()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Failed to run a callback after a commit")
+
+    @contextmanager
+    def unit_of_work(self) -> Iterator[None]:
+        """Run a block of code as a single transaction.
+
+        Commits the transaction when the outermost block exits, or rolls it back if
+        the block raises an exception.
+        """
+        if self._unit_of_work_depth > 0:
+            self._unit_of_work_depth += 1
+            try:
+                yield
+            finally:
+                self._unit_of_work_depth -= 1
+            return
+
+        # Explicitly begin a transaction if one isn't already in progress (e.g. from
+        # writes waiting for a group commit). Otherwise the savepoint could start a
+        # transaction itself, and releasing it would commit straight away.
+        if not self.in_transaction:
+            self.engine.begin_transaction(self.conn)
+        self.execute("SAVEPOINT %s" % (_SAVEPOINT,))
+
+        self._after_commit_callbacks = []
+        self._unit_of_work_depth = 1
+        try:
+            yield
+        except BaseException:
+            self._unit_of_work_depth = 0
+            self._after_commit_callbacks = []
+            self.execute("ROLLBACK TO SAVEPOINT %s" % (_SAVEPOINT,))
+            self.execute("RELEASE SAVEPOINT %s" % (_SAVEPOINT,))
+            # Don't leave an empty transaction open if there's nothing else in it.
+            self.commit()
+            raise
+
+        self._unit_of_work_depth = 0
+        self.execute("RELEASE SAVEPOINT %s" % (_SAVEPOINT,))
+        self._pending_after_commit_callbacks.extend(self._after_commit_callbacks)
+        self._after_commit_callbacks = []
+        self.commit()
+
+    def commit(self) -> None:
+        """Commit the current transaction, unless inside a unit of work (in which case
+        this is a no-op) or in group commit mode (in which case the commit happens at
+        the end of the reactor tick), then call the functions waiting for it.
+        """
+        if self._unit_of_work_depth > 0:
+            return
+
+        if self._group_commit_clock is not None:
+            if not self.in_transaction:
+                # There is nothing left to commit, but there may be callbacks waiting.
+                self._commit_and_run_callbacks()
+                return
+            coalesced_commits.inc()
+            if self._pending_flush is None:
+                self._pending_flush = self._group_commit_clock.callLater(0, self.flush)
+            return
+
+        self._commit_and_run_callbacks()
+
+    def rollback(self) -> None:
+        """Roll back the current unit of work if there is one, otherwise the whole
+        transaction.
+        """
+        if self._unit_of_work_depth > 0:
+            self._after_commit_callbacks = []
+            self.execute("ROLLBACK TO SAVEPOINT %s" % (_SAVEPOINT,))
+            return
+
+        self._pending_after_commit_callbacks = []
+        self.conn.rollback()
+
+    def flush(self) -> None:
+        """Commit any changes waiting for a group commit."""
+        if self._pending_flush is not None:
+            if self._pending_flush.active():
+                self._pending_flush.cancel()
+            self._pending_flush = None
+
+        if not self.in_transaction:
+            self._commit_and_run_callbacks()
+            return
+
+        try:
+            self._commit_and_run_callbacks()
+            group_commits.inc()
+        except Exception:
+            logger.exception("Failed to commit pending changes to the database")
+            self.conn.rollback()
+
+    def _on_statement_success(self, sql: str, was_in_transaction: bool) -> None:
+        """Called when a statement succeeds. If the driver opened a transaction just to
+        run a statement which doesn't modify any data, end it now, as sqlite3 would
+        not have opened one. Otherwise the connection would sit idle in a transaction
+        until the next write is committed.
+        """
+        if (
+            not was_in_transaction
+            and self.engine.reads_open_transactions
+            and not _TRANSACTIONAL_STATEMENT_RE.match(sql)
+        ):
+            self.conn.commit()
+
+    def _on_statement_failure(self) -> None:
+        """Called when a statement fails. If that aborted the transaction and we're
+        not in a unit of work (which will be rolled back as the error propagates), roll
+        the transaction back now so that later statements don't fail too.
+        """
+        if self._unit_of_work_depth == 0 and self.engine.in_failed_transaction(
+            self.conn
+        ):
+            self._pending_after_commit_callbacks = []
+            self.conn.rollback()
@@ -0,0 +1,49 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+# The parts of the DB-API 2.0 (PEP 249) interface that Sydent relies on, implemented
+# by both sqlite3 and psycopg2.
+from typing import Any, Iterable, List, Optional, Sequence
+
+from typing_extensions import Protocol
+
+
+class DBAPI2Cursor(Protocol):
+    @property
+    def rowcount(self) -> int:
+        ...
+
+    @property
+    def description(self) -> Optional[Sequence[Any]]:
+        ...
+
+    def execute(self, sql: str, parameters: Sequence[Any] = ...) -> Any:
+        ...
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Sequence[Any]]) -> Any:
+        ...
+
+    def fetchone(self) -> Any:
+        ...
+
+    def fetchall(self) -> List[Any]:
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+class DBAPI2Connection(Protocol):
+    def cursor(self) -> DBAPI2Cursor:
+        ...
+
+    def commit(self) -> None:
+        ...
+
+    def rollback(self) -> None:
+        ...
+
+    def close(self) -> None:
+        ...
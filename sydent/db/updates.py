@@ -0,0 +1,230 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+"""Data migrations which are the same for every database engine, along with the
+background updates schema upgrades schedule to run them (see
+sydent.db.background_updates).
+"""
+
+import logging
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sydent.db.background_updates import BackgroundUpdateHandler
+from sydent.db.hashing_metadata import (
+    REHASH_LOOKUP_HASHES,
+    hash_threepid,
+    rehash_lookup_hashes,
+)
+from sydent.db.transaction import Cursor, TransactionalConnection
+from sydent.types import JsonDict
+from sydent.util.stringutils import normalise_address, normalise_address_for_lookup
+
+logger = logging.getLogger(__name__)
+
+# The names of the background updates.
+POPULATE_NORMALISED_ADDRESSES = "populate_normalised_addresses"
+POPULATE_CURRENT_MAPPINGS = "populate_current_mappings"
+DROP_LOWER_ADDRESS_INDEX = "drop_global_threepid_medium_lower_address"
+POPULATE_LOOKUP_HASHES = "populate_lookup_hashes"
+
+
+def update_current_mappings(
+    cur: Cursor, threepids: Iterable[Tuple[str, str]], log_changes: bool = False
+) -> None:
+    """Replace the current mapping for each of the given 3PIDs with its newest
+    association, or remove it if the 3PID doesn't have any association left. Must be
+    called in the same transaction as any change to the 3PIDs' associations.
+
+    :param cur: The cursor to use.
+    :param threepids: The (medium, normalised address) of the 3PIDs to update, with
+        the address normalised with normalise_address_for_lookup.
+    :param log_changes: Whether to record the lookup hashes of the 3PIDs before and
+        after the change in global_threepid_mapping_changes, for the lookup
+        snapshot (see sydent.db.lookup_snapshot).
+    """
+    threepids = list(threepids)
+    if log_changes:
+        _log_current_mappings(cur, threepids)
+    cur.executemany(
+        "DELETE FROM global_threepid_current_mappings "
+        "WHERE medium = ? AND normalised_address = ?",
+        threepids,
+    )
+    cur.executemany(
+        "INSERT INTO global_threepid_current_mappings (medium, normalised_address, "
+        "address, mxid, lookup_hash, alt_lookup_hash, ts, notBefore, notAfter, "
+        "association_id) "
+        "SELECT medium, normalised_address, address, mxid, lookup_hash, "
+        "alt_lookup_hash, ts, notBefore, notAfter, id FROM global_threepid_associations "
+        "WHERE medium = ? AND normalised_address = ? "
+        "ORDER BY ts DESC, id DESC LIMIT 1",
+        threepids,
+    )
+    if log_changes:
+        _log_current_mappings(cur, threepids)
+
+
+def _log_current_mappings(cur: Cursor, threepids: List[Tuple[str, str]]) -> None:
+    """Record the lookup hashes of the current mappings of the given 3PIDs in
+    global_threepid_mapping_changes. This is done both before and after the mappings
+    change, so that readers learn about the hashes which no longer map to anything as
+    well as those which now do.
+    """
+    cur.executemany(
+        "INSERT INTO global_threepid_mapping_changes (medium, normalised_address, "
+        "lookup_hash, alt_lookup_hash) "
+        "SELECT medium, normalised_address, lookup_hash, alt_lookup_hash "
+        "FROM global_threepid_current_mappings "
+        "WHERE medium = ? AND normalised_address = ?",
+        threepids,
+    )
+
+
+def populate_current_mappings(db: TransactionalConnection) -> None:
+    """Rebuild global_threepid_current_mappings from global_threepid_associations in
+    one go, keeping the newest association for each 3PID.
+
+    :param db: A connection to the database. The caller is responsible for
+        committing the changes.
+    """
+    cur = db.cursor()
+    cur.execute("DELETE FROM global_threepid_current_mappings")
+    cur.execute(
+        "INSERT INTO global_threepid_current_mappings (medium, normalised_address, "
+        "address, mxid, lookup_hash, alt_lookup_hash, ts, notBefore, notAfter, "
+        "association_id) "
+        "SELECT medium, normalised_address, address, mxid, lookup_hash, "
+        "alt_lookup_hash, ts, notBefore, notAfter, id FROM global_threepid_associations g "
+        "WHERE id = ("
+        "    SELECT id FROM global_threepid_associations g2"
+        "    WHERE g2.medium = g.medium"
+        "    AND g2.normalised_address = g.normalised_address"
+        "    ORDER BY ts DESC, id DESC LIMIT 1"
+        ")"
+    )
+    logger.info("Built %d current mappings", cur.rowcount)
+    cur.close()
+
+
+def _populate_normalised_addresses(
+    cur: Cursor, progress: JsonDict, batch_size: int
+) -> Tuple[int, Optional[JsonDict]]:
+    """Fill in the normalised_address column of global_threepid_associations, in
+    order of ID. The normalisation is done in Python rather than with SQL's lower(),
+    which doesn't handle non-ASCII characters in SQLite.
+
+    Associations added while the update is running already have their normalised
+    address, so rows past the ones which existed when it started are harmlessly
+    normalised again.
+    """
+    cur.execute(
+        "SELECT id, address FROM global_threepid_associations "
+        "WHERE id > ? ORDER BY id LIMIT ?",
+        (progress.get("last_id", -1), batch_size),
+    )
+    rows: List[Tuple[int, str]] = cur.fetchall()
+
+    cur.executemany(
+        "UPDATE global_threepid_associations SET normalised_address = ? WHERE id = ?",
+        [(normalise_address_for_lookup(address), id) for id, address in rows],
+    )
+
+    if len(rows) < batch_size:
+        return len(rows), None
+    return len(rows), {"last_id": rows[-1][0]}
+
+
+def _populate_current_mappings(
+    cur: Cursor, progress: JsonDict, batch_size: int
+) -> Tuple[int, Optional[JsonDict]]:
+    """Build global_threepid_current_mappings by going through
+    global_threepid_associations in order of ID, and updating the current mapping of
+    every 3PID found. This relies on the normalised addresses having been filled in.
+
+    Associations added or removed while the update is running update their 3PID's
+    current mapping themselves, and recomputing a current mapping again is harmless.
+    """
+    cur.execute(
+        "SELECT id, medium, normalised_address FROM global_threepid_associations "
+        "WHERE id > ? ORDER BY id LIMIT ?",
+        (progress.get("last_id", -1), batch_size),
+    )
+    rows: List[Tuple[int, str, str]] = cur.fetchall()
+
+    threepids: Set[Tuple[str, str]] = {(medium, address) for _, medium, address in rows}
+    update_current_mappings(cur, sorted(threepids))
+
+    if len(rows) < batch_size:
+        return len(rows), None
+    return len(rows), {"last_id": rows[-1][0]}
+
+
+def _drop_lower_address_index(
+    cur: Cursor, progress: JsonDict, batch_size: int
+) -> Tuple[int, Optional[JsonDict]]:
+    """Drop the index on lower(address), which lookups use until the current
+    mappings have been built.
+    """
+    cur.execute("DROP INDEX IF EXISTS global_threepid_medium_lower_address")
+    return 0, None
+
+
+def _populate_lookup_hashes(
+    cur: Cursor, progress: JsonDict, batch_size: int
+) -> Tuple[int, Optional[JsonDict]]:
+    """Fill in the lookup hashes of the global associations which don't have one, or
+    whose hash wasn't computed from their normalised address, in order of ID, so that
+    plaintext lookups can be served through the hashes (see
+    GlobalAssociationStore.getMxidsByHash). The current mappings of the 3PIDs whose
+    hashes changed are updated too.
+
+    Only the column in use is filled in. This relies on the current mappings having
+    been built.
+    """
+    cur.execute("SELECT lookup_pepper, lookup_hash_column FROM hashing_metadata")
+    pepper_row: Optional[Tuple[str, str]] = cur.fetchone()
+    if pepper_row is None:
+        # There are no hashes to fill in until there is a pepper, at which point
+        # every association is hashed.
+        return 0, None
+    pepper, column = pepper_row
+
+    cur.execute(
+        "SELECT id, medium, address, normalised_address, %s "
+        "FROM global_threepid_associations WHERE id > ? ORDER BY id LIMIT ?"
+        % (column,),
+        (progress.get("last_id", -1), batch_size),
+    )
+    rows: List[Tuple[int, str, str, str, Optional[str]]] = cur.fetchall()
+
+    updates = []
+    threepids: Set[Tuple[str, str]] = set()
+    for id, medium, address, normalised_address, lookup_hash in rows:
+        # Skip broken db entries
+        if not medium or not address:
+            continue
+        new_hash = hash_threepid(medium, normalise_address(address, medium), pepper)
+        if new_hash != lookup_hash:
+            updates.append((new_hash, id))
+            threepids.add((medium, normalised_address))
+
+    cur.executemany(
+        "UPDATE global_threepid_associations SET %s = ? WHERE id = ?" % (column,),
+        updates,
+    )
+    update_current_mappings(cur, sorted(threepids))
+
+    if len(rows) < batch_size:
+        return len(rows), None
+    return len(rows), {"last_id": rows[-1][0]}
+
+
+BACKGROUND_UPDATE_HANDLERS: Dict[str, BackgroundUpdateHandler] = {
+    POPULATE_NORMALISED_ADDRESSES: _populate_normalised_addresses,
+    POPULATE_CURRENT_MAPPINGS: _populate_current_mappings,
+    DROP_LOWER_ADDRESS_INDEX: _drop_lower_address_index,
+    POPULATE_LOOKUP_HASHES: _populate_lookup_hashes,
+    REHASH_LOOKUP_HASHES: rehash_lookup_hashes,
+}
@@ -115,7 +115,7 @@ class ThreePidValSessionStore:
         sid = self.random.randint(0, 2 ** 31)
 
         cur.execute(
-            "insert into threepid_validation_sessions ('id', 'medium', 'address', 'clientSecret', 'mtime')"
+            "insert into threepid_validation_sessions (id, medium, address, clientSecret, mtime)"
             + " values (?, ?, ?, ?, ?)",
             (sid, medium, address, clientSecret, mtime),
         )
@@ -254,7 +254,11 @@ class ThreePidValSessionStore:
         return s
 
     def deleteOldSessions(self) -> None:
-        """Delete old threepid validation sessions that are long expired."""
+        """Delete old threepid validation sessions that are long expired.
+
+        This writes to the database, so it runs on the main connection rather than on
+        the database pool, like every other write.
+        """
 
         cur = self.sydent.db.cursor()
 
@@ -10,13 +10,16 @@
 # <http://www.apache.org/licenses/LICENSE-2.0>.
 
 import logging
-from typing import TYPE_CHECKING
+import os
+import socket
+from typing import TYPE_CHECKING, Collection, Optional
 
 import twisted.internet.ssl
 from twisted.web.resource import Resource
 from twisted.web.server import Site
 
 from sydent.http.httpcommon import SizeLimitingRequest
+from sydent.http.lookup_only import LookupOnlyResource
 from sydent.http.servlets.accountservlet import AccountServlet
 from sydent.http.servlets.authenticated_bind_threepid_servlet import (
     AuthenticatedBindThreePidServlet,
@@ -47,11 +50,14 @@ from sydent.http.servlets.pubkeyservlets import (
 )
 from sydent.http.servlets.registerservlet import RegisterServlet
 from sydent.http.servlets.replication import ReplicationPushServlet
+from sydent.http.servlets.rotate_lookup_pepper_servlet import RotateLookupPepperServlet
 from sydent.http.servlets.store_invite_servlet import StoreInviteServlet
 from sydent.http.servlets.termsservlet import TermsServlet
 from sydent.http.servlets.threepidbindservlet import ThreePidBindServlet
 from sydent.http.servlets.threepidunbindservlet import ThreePidUnbindServlet
 from sydent.http.servlets.versions import VersionsServlet
+from sydent.http.writer_proxy import WriterProxyResource
+from sydent.workers import WorkerSupervisor, bind_client_socket
 
 if TYPE_CHECKING:
     from sydent.sydent import Sydent
@@ -60,13 +66,9 @@ logger = logging.getLogger(__name__)
 
 
 class ClientApiHttpServer:
-    def __init__(self, sydent: "Sydent", lookup_pepper: str) -> None:
-        """
-        Args:
-            lookup_pepper: The pepper used when hashing identifiers.
-
-        """
+    def __init__(self, sydent: "Sydent") -> None:
         self.sydent = sydent
+        self.worker_supervisor: Optional[WorkerSupervisor] = None
 
         root = Resource()
         matrix = Resource()
@@ -105,7 +107,7 @@ class ClientApiHttpServer:
             api.putChild(b"v1", v1)
             validate.putChild(b"email", email)
             validate.putChild(b"msisdn", msisdn)
-            v1.putChild(b"validate", validate)
+            v1.putChild(b"validate", self._on_writer(validate))
 
             v1.putChild(b"lookup", LookupServlet(sydent))
             v1.putChild(b"bulk_lookup", BulkLookupServlet(sydent))
@@ -114,7 +116,7 @@ class ClientApiHttpServer:
 
             threepid_v1.putChild(b"getValidated3pid", GetValidated3pidServlet(sydent))
             threepid_v1.putChild(b"unbind", unbind)
-            v1.putChild(b"3pid", threepid_v1)
+            v1.putChild(b"3pid", self._on_writer(threepid_v1))
 
             email.putChild(b"requestToken", EmailRequestCodeServlet(sydent))
             email.putChild(b"submitToken", EmailValidateCodeServlet(sydent))
@@ -122,9 +124,11 @@ class ClientApiHttpServer:
             msisdn.putChild(b"requestToken", MsisdnRequestCodeServlet(sydent))
             msisdn.putChild(b"submitToken", MsisdnValidateCodeServlet(sydent))
 
-            v1.putChild(b"store-invite", StoreInviteServlet(sydent))
+            v1.putChild(b"store-invite", self._on_writer(StoreInviteServlet(sydent)))
 
-            v1.putChild(b"sign-ed25519", BlindlySignStuffServlet(sydent))
+            v1.putChild(
+                b"sign-ed25519", self._on_writer(BlindlySignStuffServlet(sydent))
+            )
 
         if self.sydent.config.general.enable_v1_associations:
             threepid_v1.putChild(b"bind", ThreePidBindServlet(sydent))
@@ -157,28 +161,83 @@ class ClientApiHttpServer:
         )
 
         # v2 exclusive APIs
-        v2.putChild(b"terms", TermsServlet(sydent))
+        v2.putChild(
+            b"terms",
+            self._on_writer(TermsServlet(sydent), read_methods=(b"GET", b"OPTIONS")),
+        )
         account = AccountServlet(sydent)
-        v2.putChild(b"account", account)
+        v2.putChild(b"account", self._on_writer(account))
         account.putChild(b"register", RegisterServlet(sydent))
         account.putChild(b"logout", LogoutServlet(sydent))
 
         # v2 versions of existing APIs
-        v2.putChild(b"validate", validate_v2)
+        v2.putChild(b"validate", self._on_writer(validate_v2))
         v2.putChild(b"pubkey", pubkey)
-        v2.putChild(b"3pid", threepid_v2)
-        v2.putChild(b"store-invite", StoreInviteServlet(sydent, require_auth=True))
-        v2.putChild(b"sign-ed25519", BlindlySignStuffServlet(sydent, require_auth=True))
-        v2.putChild(b"lookup", LookupV2Servlet(sydent, lookup_pepper))
-        v2.putChild(b"hash_details", HashDetailsServlet(sydent, lookup_pepper))
+        v2.putChild(b"3pid", self._on_writer(threepid_v2))
+        v2.putChild(
+            b"store-invite",
+            self._on_writer(StoreInviteServlet(sydent, require_auth=True)),
+        )
+        v2.putChild(
+            b"sign-ed25519",
+            self._on_writer(BlindlySignStuffServlet(sydent, require_auth=True)),
+        )
+        v2.putChild(b"lookup", LookupV2Servlet(sydent))
+        v2.putChild(b"hash_details", HashDetailsServlet(sydent))
 
+        self.root: Resource = root
         self.factory = Site(root, SizeLimitingRequest)
         self.factory.displayTracebacks = False
 
+    def _on_writer(
+        self, resource: Resource, read_methods: Collection[bytes] = ()
+    ) -> Resource:
+        """Serve the given part of the API, which writes to the database, from the
+        writer process if this is a worker process (see sydent.workers), or refuse it
+        if this is a lookup-only server.
+
+        :param resource: The resource serving the part of the API.
+        :param read_methods: The HTTP methods of the requests which the resource can
+            serve from a worker or lookup-only server.
+
+        :return: The resource to serve the part of the API with.
+        """
+        if self.sydent.config.general.lookup_only:
+            return LookupOnlyResource(resource, read_methods)
+        if self.sydent.worker is None:
+            return resource
+        return WriterProxyResource(self.sydent, resource, read_methods)
+
     def setup(self) -> None:
         httpPort = self.sydent.config.http.client_port
         interface = self.sydent.config.http.client_bind_address
 
+        worker = self.sydent.worker
+        if worker is not None:
+            logger.info("Serving the Client API from worker %d", worker.index)
+            self.sydent.reactor.adoptStreamPort(
+                worker.listen_fd,
+                socket.AddressFamily(worker.listen_family),
+                self.factory,
+            )
+            # The reactor has made its own copy of the socket.
+            os.close(worker.listen_fd)
+            return
+
+        num_workers = self.sydent.config.http.client_workers
+        if num_workers > 0:
+            logger.info(
+                "Starting %d Client API workers on %s:%d",
+                num_workers,
+                interface,
+                httpPort,
+            )
+            self.worker_supervisor = WorkerSupervisor(
+                self.sydent, bind_client_socket(interface, httpPort)
+            )
+            self.worker_supervisor.start(num_workers)
+            return
+
         logger.info("Starting Client API HTTP server on %s:%d", interface, httpPort)
         self.sydent.reactor.listenTCP(
             httpPort,
@@ -205,17 +264,25 @@ class InternalApiHttpServer:
         internal = Resource()
         identity.putChild(b"internal", internal)
 
-        authenticated_bind = AuthenticatedBindThreePidServlet(self.sydent)
-        internal.putChild(b"bind", authenticated_bind)
+        if self.sydent.config.general.lookup_only:
+            internal.putChild(b"bind", LookupOnlyResource())
+            internal.putChild(b"unbind", LookupOnlyResource())
+            internal.putChild(b"rotate_lookup_pepper", LookupOnlyResource())
+        else:
+            authenticated_bind = AuthenticatedBindThreePidServlet(self.sydent)
+            internal.putChild(b"bind", authenticated_bind)
+
+            authenticated_unbind = AuthenticatedUnbindThreePidServlet(self.sydent)
+            internal.putChild(b"unbind", authenticated_unbind)
 
-        authenticated_unbind = AuthenticatedUnbindThreePidServlet(self.sydent)
-        internal.putChild(b"unbind", authenticated_unbind)
+            rotate_lookup_pepper = RotateLookupPepperServlet(self.sydent)
+            internal.putChild(b"rotate_lookup_pepper", rotate_lookup_pepper)
 
-        factory = Site(root)
-        factory.displayTracebacks = False
+        self.factory = Site(root)
+        self.factory.displayTracebacks = False
         self.sydent.reactor.listenTCP(
             port,
-            factory,
+            self.factory,
             backlog=50,  # taken from PosixReactorBase.listenTCP
             interface=interface,
         )
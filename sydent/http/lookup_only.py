@@ -0,0 +1,44 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+from typing import Collection, Optional
+
+from twisted.web.resource import Resource
+from twisted.web.server import Request
+
+from sydent.http.servlets import MatrixRestError, jsonwrap, send_cors
+from sydent.types import JsonDict
+
+
+class LookupOnlyResource(Resource):
+    """Refuses the requests for a part of the API which writes to the database, on
+    servers configured with general.lookup_only.
+    """
+
+    isLeaf = True
+
+    def __init__(
+        self,
+        resource: Optional[Resource] = None,
+        read_methods: Collection[bytes] = (),
+    ) -> None:
+        """
+        :param resource: The resource to serve the read requests with, if any.
+        :param read_methods: The HTTP methods of the requests to serve with
+            `resource` rather than refuse.
+        """
+        super().__init__()
+        self._resource = resource
+        self._read_methods = read_methods
+
+    def render(self, request: Request) -> object:
+        if self._resource is not None and request.method in self._read_methods:
+            return self._resource.render(request)
+        return self._refuse(request)
+
+    @jsonwrap
+    def _refuse(self, request: Request) -> JsonDict:
+        send_cors(request)
+        raise MatrixRestError(403, "M_FORBIDDEN", "This server only serves lookups")
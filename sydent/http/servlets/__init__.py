@@ -11,13 +11,25 @@ import copy
 import functools
 import json
 import logging
-from typing import Any, Awaitable, Callable, Dict, Iterable, TypeVar
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    TypeVar,
+    Union,
+)
 
 from prometheus_client import Counter
 from twisted.internet import defer
+from twisted.internet.interfaces import IPullProducer
 from twisted.web import server
 from twisted.web.resource import Resource
 from twisted.web.server import Request
+from zope.interface import implementer
 
 from sydent.types import JsonDict
 from sydent.util import json_decoder
@@ -189,7 +201,95 @@ def jsonwrap(f: Callable[[Res, Request], JsonDict]) -> Callable[[Res, Request],
     return inner
 
 
-AsyncRenderer = Callable[[Res, Request], Awaitable[JsonDict]]
+class StreamingJsonResponse:
+    """A JSON object with a single field holding a (possibly large) list or object,
+    e.g. the results of a bulk lookup.
+
+    Large responses are written to the client a chunk at a time as they are encoded,
+    rather than encoded all at once, so that they aren't held in memory in full a
+    second time once encoded. Small ones are encoded in one go, which is faster.
+    """
+
+    # The number of items above which the response is streamed.
+    STREAMING_THRESHOLD = 10000
+
+    def __init__(self, key: str, items: Union[List[Any], Dict[str, Any]]) -> None:
+        """
+        :param key: The name of the field.
+        :param items: The list or object in the field.
+        """
+        self.key = key
+        self.items = items
+
+    def should_stream(self) -> bool:
+        return len(self.items) > self.STREAMING_THRESHOLD
+
+    def to_json_bytes(self) -> bytes:
+        return dict_to_json_bytes({self.key: self.items})
+
+    def iterencode(self) -> Iterator[str]:
+        """Encode the response an item at a time, producing the same JSON as
+        to_json_bytes.
+        """
+        if isinstance(self.items, dict):
+            yield "{%s: {" % (json.dumps(self.key),)
+            separator = ""
+            for key, value in self.items.items():
+                yield separator + json.dumps(key) + ": " + json.dumps(value)
+                separator = ", "
+            yield "}}"
+        else:
+            yield "{%s: [" % (json.dumps(self.key),)
+            separator = ""
+            for item in self.items:
+                yield separator + json.dumps(item)
+                separator = ", "
+            yield "]}"
+
+
+@implementer(IPullProducer)
+class _JsonProducer:
+    """Writes a JSON response to a request, a chunk at a time whenever the connection
+    is ready for more, then finishes the request.
+    """
+
+    # The number of bytes to write at a time, at least.
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, request: Request, response: StreamingJsonResponse) -> None:
+        self._request = request
+        self._chunks: Iterator[str] = response.iterencode()
+
+    def start(self) -> None:
+        self._request.registerProducer(self, False)
+
+    def resumeProducing(self) -> None:
+        # Each item is encoded separately, so group them.
+        chunk = []
+        size = 0
+        for s in self._chunks:
+            chunk.append(s)
+            size += len(s)
+            if size >= self.CHUNK_SIZE:
+                break
+
+        if chunk:
+            self._request.write("".join(chunk).encode("UTF-8"))
+        if size < self.CHUNK_SIZE:
+            # The whole object has been written.
+            self._request.unregisterProducer()
+            self._request.finish()
+
+    def stopProducing(self) -> None:
+        # The connection has been lost.
+        self._chunks = iter(())
+
+
+# Async renderers can also return the JSON they respond with already encoded, e.g.
+# because they cached it, or to be streamed.
+AsyncRenderer = Callable[
+    [Res, Request], Awaitable[Union[JsonDict, bytes, StreamingJsonResponse]]
+]
 
 
 def asyncjsonwrap(f: AsyncRenderer[Res]) -> Callable[[Res, Request], object]:
@@ -197,7 +297,16 @@ def asyncjsonwrap(f: AsyncRenderer[Res]) -> Callable[[Res, Request], object]:
         request.setHeader("Content-Type", "application/json")
         try:
             result = await f(self, request)
-            request.write(dict_to_json_bytes(result))
+            if isinstance(result, StreamingJsonResponse):
+                if result.should_stream():
+                    # The producer finishes the request once it has written
+                    # everything.
+                    _JsonProducer(request, result).start()
+                    return
+                result = result.to_json_bytes()
+            if not isinstance(result, bytes):
+                result = dict_to_json_bytes(result)
+            request.write(result)
         except MatrixRestError as e:
             request.setResponseCode(e.httpStatus)
             request.write(dict_to_json_bytes({"errcode": e.errcode, "error": e.error}))
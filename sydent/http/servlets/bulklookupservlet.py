@@ -8,16 +8,17 @@
 # <http://www.apache.org/licenses/LICENSE-2.0>.
 
 import logging
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Union
 
 from twisted.web.server import Request
 
 from sydent.db.threepid_associations import GlobalAssociationStore
 from sydent.http.servlets import (
     MatrixRestError,
+    StreamingJsonResponse,
     SydentResource,
+    asyncjsonwrap,
     get_args,
-    jsonwrap,
     send_cors,
 )
 from sydent.types import JsonDict
@@ -35,14 +36,16 @@ class BulkLookupServlet(SydentResource):
         super().__init__()
         self.sydent = syd
 
-    @jsonwrap
-    def render_POST(self, request: Request) -> JsonDict:
+    @asyncjsonwrap
+    async def render_POST(
+        self, request: Request
+    ) -> Union[JsonDict, StreamingJsonResponse]:
         """
         Bulk-lookup for threepids.
         Params: 'threepids': list of threepids, each of which is a list of medium, address
         Returns: Object with key 'threepids', which is a list of results where each result
                  is a 3 item list of medium, address, mxid
-                 Note that results are not streamed to the client.
+                 Large responses are written to the client as they are encoded.
         Threepids for which no mapping is found are omitted.
         """
         send_cors(request)
@@ -56,9 +59,9 @@ class BulkLookupServlet(SydentResource):
         logger.info("Bulk lookup of %d threepids", len(threepids))
 
         globalAssocStore = GlobalAssociationStore(self.sydent)
-        results = globalAssocStore.getMxids(threepids)
+        results = await globalAssocStore.getMxidsByHash(threepids)
 
-        return {"threepids": results}
+        return StreamingJsonResponse("threepids", results)
 
     def render_OPTIONS(self, request: Request) -> bytes:
         send_cors(request)
@@ -93,6 +93,7 @@ class EmailRequestCodeServlet(SydentResource):
         if "next_link" in args and not args["next_link"].startswith("file:///"):
             nextLink = args["next_link"]
 
+        assert self.sydent.validators is not None
         try:
             sid = self.sydent.validators.email.requestToken(
                 email,
@@ -192,6 +193,7 @@ class EmailValidateCodeServlet(SydentResource):
                 "error": "Invalid client_secret provided",
             }
 
+        assert self.sydent.validators is not None
         try:
             return self.sydent.validators.email.validateSessionWithToken(
                 sid, clientSecret, tokenString
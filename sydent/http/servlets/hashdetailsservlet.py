@@ -26,10 +26,9 @@ class HashDetailsServlet(SydentResource):
     isLeaf = True
     known_algorithms = ["sha256", "none"]
 
-    def __init__(self, syd: "Sydent", lookup_pepper: str) -> None:
+    def __init__(self, syd: "Sydent") -> None:
         super().__init__()
         self.sydent = syd
-        self.lookup_pepper = lookup_pepper
 
     @jsonwrap
     def render_GET(self, request: Request) -> JsonDict:
@@ -49,7 +48,7 @@ class HashDetailsServlet(SydentResource):
 
         return {
             "algorithms": self.known_algorithms,
-            "lookup_pepper": self.lookup_pepper,
+            "lookup_pepper": self.sydent.hashing_store.get_lookup_pepper(),
         }
 
     def render_OPTIONS(self, request: Request) -> bytes:
@@ -9,15 +9,23 @@
 # <http://www.apache.org/licenses/LICENSE-2.0>.
 
 import logging
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Optional, Tuple, Union
 
 import signedjson.sign
 from twisted.web.server import Request
 
 from sydent.db.threepid_associations import GlobalAssociationStore
-from sydent.http.servlets import SydentResource, get_args, jsonwrap, send_cors
+from sydent.http.servlets import (
+    SydentResource,
+    asyncjsonwrap,
+    dict_to_json_bytes,
+    get_args,
+    send_cors,
+)
 from sydent.types import JsonDict
 from sydent.util import json_decoder
+from sydent.util.lrucache import LruCache
+from sydent.util.ttlcache import Sentinel
 
 if TYPE_CHECKING:
     from sydent.sydent import Sydent
@@ -31,9 +39,16 @@ class LookupServlet(SydentResource):
     def __init__(self, syd: "Sydent") -> None:
         super().__init__()
         self.sydent = syd
-
-    @jsonwrap
-    def render_GET(self, request: Request) -> JsonDict:
+        # The responses to lookups, keyed by the ID of the association they return,
+        # along with its signed JSON. The JSON is checked on every hit, as IDs may be
+        # reused once associations have been deleted.
+        self._responses: Optional[LruCache[int, Tuple[str, bytes]]] = None
+        cache_size = self.sydent.config.http.lookup_response_cache_size
+        if cache_size > 0:
+            self._responses = LruCache("lookup_response", cache_size)
+
+    @asyncjsonwrap
+    async def render_GET(self, request: Request) -> Union[JsonDict, bytes]:
         """
         Look up an individual threepid.
 
@@ -52,13 +67,32 @@ class LookupServlet(SydentResource):
 
         globalAssocStore = GlobalAssociationStore(self.sydent)
 
-        sgassoc_raw = globalAssocStore.signedAssociationStringForThreepid(
-            medium, address
-        )
+        res = await globalAssocStore.signedAssociationForThreepid(medium, address)
 
-        if not sgassoc_raw:
+        if not res:
             return {}
 
+        assoc_id, sgassoc_raw = res
+        if self._responses is not None:
+            cached = self._responses.get(assoc_id)
+            if cached is not Sentinel.token and cached[0] == sgassoc_raw:
+                return cached[1]
+
+        response = dict_to_json_bytes(self._sign(sgassoc_raw))
+        if self._responses is not None:
+            # The response only depends on the association, so it can't be stale.
+            self._responses.set_many(
+                [(assoc_id, (sgassoc_raw, response))], self._responses.version
+            )
+        return response
+
+    def _sign(self, sgassoc_raw: str) -> JsonDict:
+        """Add our signature to a signed association, if it isn't there already.
+
+        :param sgassoc_raw: The JSON of the signed association.
+
+        :return: The signed association.
+        """
         # TODO validate this really is a dict
         sgassoc: JsonDict = json_decoder.decode(sgassoc_raw)
         if self.sydent.config.general.server_name not in sgassoc["signatures"]:
@@ -8,13 +8,19 @@
 # <http://www.apache.org/licenses/LICENSE-2.0>.
 
 import logging
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Union
 
 from twisted.web.server import Request
 
 from sydent.db.threepid_associations import GlobalAssociationStore
 from sydent.http.auth import authV2
-from sydent.http.servlets import SydentResource, get_args, jsonwrap, send_cors
+from sydent.http.servlets import (
+    StreamingJsonResponse,
+    SydentResource,
+    asyncjsonwrap,
+    get_args,
+    send_cors,
+)
 from sydent.http.servlets.hashdetailsservlet import HashDetailsServlet
 from sydent.types import JsonDict
 
@@ -27,14 +33,15 @@ logger = logging.getLogger(__name__)
 class LookupV2Servlet(SydentResource):
     isLeaf = True
 
-    def __init__(self, syd: "Sydent", lookup_pepper: str) -> None:
+    def __init__(self, syd: "Sydent") -> None:
         super().__init__()
         self.sydent = syd
         self.globalAssociationStore = GlobalAssociationStore(self.sydent)
-        self.lookup_pepper = lookup_pepper
 
-    @jsonwrap
-    def render_POST(self, request: Request) -> JsonDict:
+    @asyncjsonwrap
+    async def render_POST(
+        self, request: Request
+    ) -> Union[JsonDict, StreamingJsonResponse]:
         """
         Perform lookups with potentially hashed 3PID details.
 
@@ -56,7 +63,8 @@ class LookupV2Servlet(SydentResource):
                  where each result is a key/value pair of what the client sent, and
                  the matching Matrix User ID that claims to own that 3PID.
 
-                 User IDs for which no mapping is found are omitted.
+                 User IDs for which no mapping is found are omitted. Large
+                 responses are written to the client as they are encoded.
         """
         send_cors(request)
 
@@ -83,14 +91,18 @@ class LookupV2Servlet(SydentResource):
                 "error": "More than the maximum amount of " "addresses provided",
             }
 
+        # Lookups with the previous pepper keep working after a rotation, so that
+        # clients which fetched the pepper beforehand don't all fail at once.
         pepper = str(args["pepper"])
-        if pepper != self.lookup_pepper:
+        lookup_hash_column = self.sydent.hashing_store.get_lookup_hash_column(pepper)
+        if lookup_hash_column is None:
+            lookup_pepper = self.sydent.hashing_store.get_lookup_pepper()
             request.setResponseCode(400)
             return {
                 "errcode": "M_INVALID_PEPPER",
-                "error": "pepper does not match '%s'" % (self.lookup_pepper,),
+                "error": "pepper does not match '%s'" % (lookup_pepper,),
                 "algorithm": algorithm,
-                "lookup_pepper": self.lookup_pepper,
+                "lookup_pepper": lookup_pepper,
             }
 
         logger.info(
@@ -117,22 +129,24 @@ class LookupV2Servlet(SydentResource):
                 medium_address_tuples.append((medium, address))
 
             # Lookup the mxids
-            medium_address_mxid_tuples = self.globalAssociationStore.getMxids(
+            store = self.globalAssociationStore
+            medium_address_mxid_tuples = await store.getMxidsByHash(
                 medium_address_tuples
             )
 
             # Return a dictionary of lookup_string: mxid values
-            return {
-                "mappings": {
-                    "%s %s" % (x[1], x[0]): x[2] for x in medium_address_mxid_tuples
-                }
-            }
+            return StreamingJsonResponse(
+                "mappings",
+                {"%s %s" % (x[1], x[0]): x[2] for x in medium_address_mxid_tuples},
+            )
 
         elif algorithm == "sha256":
             # Lookup using SHA256 with URL-safe base64 encoding
-            mappings = self.globalAssociationStore.retrieveMxidsForHashes(addresses)
+            mappings = await self.globalAssociationStore.retrieveMxidsForHashes(
+                addresses, lookup_hash_column
+            )
 
-            return {"mappings": mappings}
+            return StreamingJsonResponse("mappings", mappings)
 
         request.setResponseCode(400)
         return {"errcode": "M_INVALID_PARAM", "error": "algorithm is not supported"}
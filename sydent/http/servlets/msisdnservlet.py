@@ -118,6 +118,8 @@ class MsisdnRequestCodeServlet(SydentResource):
         )
 
         brand = self.sydent.brand_from_request(request)
+
+        assert self.sydent.validators is not None
         try:
             sid = await self.sydent.validators.msisdn.requestToken(
                 phone_number_object, clientSecret, sendAttempt, brand
@@ -220,6 +222,7 @@ class MsisdnValidateCodeServlet(SydentResource):
                 "error": "Invalid client_secret provided",
             }
 
+        assert self.sydent.validators is not None
         try:
             return self.sydent.validators.msisdn.validateSessionWithToken(
                 sid, clientSecret, tokenString
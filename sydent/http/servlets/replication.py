@@ -7,23 +7,21 @@
 # Originally licensed under the Apache License, Version 2.0:
 # <http://www.apache.org/licenses/LICENSE-2.0>.
 
-import json
 import logging
-from typing import TYPE_CHECKING, List, cast
+from typing import TYPE_CHECKING, List, Tuple, cast
 
 import twisted.python.log
+from canonicaljson import encode_canonical_json
 from OpenSSL.crypto import X509
 from twisted.internet.interfaces import ISSLTransport
 from twisted.web.server import Request
 
-from sydent.db.hashing_metadata import HashingMetadataStore
-from sydent.db.peers import PeerStore
+from sydent.db.hashing_metadata import hash_threepid
 from sydent.db.threepid_associations import GlobalAssociationStore, SignedAssociations
 from sydent.http.servlets import MatrixRestError, SydentResource, jsonwrap
-from sydent.threepid import threePidAssocFromDict
+from sydent.threepid import ThreepidAssociation, threePidAssocFromDict
 from sydent.types import JsonDict
 from sydent.util import json_decoder
-from sydent.util.hash import sha256_and_url_safe_base64
 from sydent.util.stringutils import normalise_address
 
 if TYPE_CHECKING:
@@ -36,7 +34,7 @@ class ReplicationPushServlet(SydentResource):
     def __init__(self, sydent: "Sydent") -> None:
         super().__init__()
         self.sydent = sydent
-        self.hashing_store = HashingMetadataStore(sydent)
+        self.hashing_store = sydent.hashing_store
 
     @jsonwrap
     def render_POST(self, request: Request) -> JsonDict:
@@ -46,9 +44,7 @@ class ReplicationPushServlet(SydentResource):
         peerCert = cast(X509, request.transport.getPeerCertificate())
         peerCertCn = peerCert.get_subject().commonName
 
-        peerStore = PeerStore(self.sydent)
-
-        peer = peerStore.getPeerByName(peerCertCn)
+        peer = self.sydent.peer_registry.get_peer(peerCertCn)
 
         if not peer:
             logger.warning(
@@ -92,14 +88,33 @@ class ReplicationPushServlet(SydentResource):
             )
             raise MatrixRestError(400, "M_BAD_JSON", 'No "sgAssocs" key in JSON')
 
-        failedIds: List[int] = []
+        sg_assocs_raw: SignedAssociations = inJson.get("sgAssocs", {})
+
+        # Tell peers sending too much at once how much they can send, so that they
+        # adjust their batches rather than retrying the same one.
+        max_push_size = self.sydent.config.http.replication_max_push_size
+        if len(sg_assocs_raw) > max_push_size:
+            logger.warning(
+                "Peer %s pushed %d associations, more than the maximum of %d",
+                peer.servername,
+                len(sg_assocs_raw),
+                max_push_size,
+            )
+            request.setResponseCode(413)
+            return {
+                "errcode": "M_TOO_LARGE",
+                "error": "Too many associations in one push",
+                "max_push_size": max_push_size,
+            }
 
-        globalAssocsStore = GlobalAssociationStore(self.sydent)
+        failedIds: List[int] = []
 
         # Ensure items are pulled out of the dictionary in order of origin_id.
-        sg_assocs_raw: SignedAssociations = inJson.get("sgAssocs", {})
         sg_assocs = sorted(sg_assocs_raw.items(), key=lambda k: int(k[0]))
 
+        # Verify the whole batch before storing any of it, and give a complete list of
+        # the associations which don't verify if some don't.
+        assocs: List[Tuple[ThreepidAssociation, str, int]] = []
         for originId, sgAssoc in sg_assocs:
             try:
                 peer.verifySignedAssociation(sgAssoc)
@@ -109,47 +124,15 @@ class ReplicationPushServlet(SydentResource):
                     originId,
                 )
 
-                # Don't bother adding if one has already failed: we add all of them or none so
-                # we're only going to roll back the transaction anyway (but we continue to try
-                # & verify the rest so we can give a complete list of the ones that don't
-                # verify)
-                if len(failedIds) > 0:
-                    continue
-
                 assocObj = threePidAssocFromDict(sgAssoc)
 
                 # ensure we are casefolding email addresses before hashing/storing
                 assocObj.address = normalise_address(assocObj.address, assocObj.medium)
 
-                if assocObj.mxid is not None:
-                    # Calculate the lookup hash with our own pepper for this association
-                    pepper = self.hashing_store.get_lookup_pepper()
-                    assert pepper is not None
-                    str_to_hash = " ".join(
-                        [assocObj.address, assocObj.medium, pepper],
-                    )
-                    assocObj.lookup_hash = sha256_and_url_safe_base64(str_to_hash)
-
-                    # Add this association
-                    globalAssocsStore.addAssociation(
-                        assocObj,
-                        json.dumps(sgAssoc),
-                        peer.servername,
-                        originId,
-                        commit=False,
-                    )
-                else:
-                    logger.info(
-                        "Incoming deletion: removing associations for %s / %s",
-                        assocObj.medium,
-                        assocObj.address,
-                    )
-                    globalAssocsStore.removeAssociation(
-                        assocObj.medium, assocObj.address
-                    )
-                logger.info(
-                    "Stored association origin ID %s from %s", originId, peer.servername
-                )
+                # Store the signed association in the canonical form its signature
+                # covers.
+                rawSgAssoc = encode_canonical_json(sgAssoc).decode("utf8")
+                assocs.append((assocObj, rawSgAssoc, int(originId)))
             except Exception:
                 failedIds.append(originId)
                 logger.warning(
@@ -160,13 +143,29 @@ class ReplicationPushServlet(SydentResource):
                 twisted.python.log.err()
 
         if len(failedIds) > 0:
-            self.sydent.db.rollback()
             request.setResponseCode(400)
             return {
                 "errcode": "M_VERIFICATION_FAILED",
                 "error": "Verification failed for one or more associations",
                 "failed_ids": failedIds,
             }
-        else:
-            self.sydent.db.commit()
-            return {"success": True}
+
+        # Calculate the lookup hashes with our own pepper.
+        pepper = self.hashing_store.get_lookup_pepper()
+        assert pepper is not None
+        for assocObj, _, _ in assocs:
+            if assocObj.mxid is not None:
+                assocObj.lookup_hash = hash_threepid(
+                    assocObj.medium,
+                    normalise_address(assocObj.address, assocObj.medium),
+                    pepper,
+                )
+
+        # Store the whole batch in a single transaction, so that either all of it or
+        # none of it is stored.
+        with self.sydent.db.unit_of_work():
+            GlobalAssociationStore(self.sydent).addAssociations(assocs, peer.servername)
+
+        logger.info("Stored %d associations from %s", len(assocs), peer.servername)
+
+        return {"success": True}
@@ -0,0 +1,53 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+from typing import TYPE_CHECKING
+
+from twisted.web.server import Request
+
+from sydent.db.hashing_metadata import PepperRotationError
+from sydent.http.servlets import SydentResource, get_args, jsonwrap, send_cors
+from sydent.types import JsonDict
+from sydent.util.tokenutils import generateAlphanumericTokenOfLength
+
+if TYPE_CHECKING:
+    from sydent.sydent import Sydent
+
+
+class RotateLookupPepperServlet(SydentResource):
+    """A servlet which starts rotating the pepper clients hash 3PIDs with for
+    lookups. Clients are given the new pepper once every 3PID has been rehashed with
+    it, and the previous pepper can still be used until the next rotation.
+
+    It is assumed that authentication happens out of band
+    """
+
+    def __init__(self, sydent: "Sydent") -> None:
+        super().__init__()
+        self.sydent = sydent
+
+    @jsonwrap
+    def render_POST(self, request: Request) -> JsonDict:
+        send_cors(request)
+        args = get_args(request, ("pepper",), required=False)
+
+        pepper = args.get("pepper")
+        if pepper is None:
+            pepper = generateAlphanumericTokenOfLength(5)
+        if not isinstance(pepper, str) or not pepper or " " in pepper:
+            request.setResponseCode(400)
+            return {"errcode": "M_INVALID_PARAM", "error": "Invalid pepper"}
+
+        try:
+            self.sydent.hashing_store.start_pepper_rotation(pepper)
+        except PepperRotationError as e:
+            request.setResponseCode(400)
+            return {"errcode": "M_UNKNOWN", "error": str(e)}
+
+        return {"next_lookup_pepper": pepper}
+
+    def render_OPTIONS(self, request: Request) -> bytes:
+        send_cors(request)
+        return b""
@@ -25,8 +25,8 @@ from sydent.http.auth import authV2
 from sydent.http.servlets import (
     MatrixRestError,
     SydentResource,
+    asyncjsonwrap,
     get_args,
-    jsonwrap,
     send_cors,
 )
 from sydent.types import JsonDict
@@ -46,8 +46,8 @@ class StoreInviteServlet(SydentResource):
         self.random = random.SystemRandom()
         self.require_auth = require_auth
 
-    @jsonwrap
-    def render_POST(self, request: Request) -> JsonDict:
+    @asyncjsonwrap
+    async def render_POST(self, request: Request) -> JsonDict:
         send_cors(request)
 
         args = get_args(
@@ -91,7 +91,7 @@ class StoreInviteServlet(SydentResource):
         )
 
         globalAssocStore = GlobalAssociationStore(self.sydent)
-        mxid = globalAssocStore.getMxid(medium, normalised_address)
+        mxid = await globalAssocStore.getMxid(medium, normalised_address)
         if mxid:
             request.setResponseCode(400)
             return {
@@ -121,8 +121,9 @@ class StoreInviteServlet(SydentResource):
         ephemeralPrivateKeyBase64 = encode_base64(ephemeralPrivateKey.encode(), True)
         ephemeralPublicKeyBase64 = encode_base64(ephemeralPublicKey.encode(), True)
 
-        tokenStore.storeEphemeralPublicKey(ephemeralPublicKeyBase64)
-        tokenStore.storeToken(medium, normalised_address, roomId, sender, token)
+        with self.sydent.db.unit_of_work():
+            tokenStore.storeEphemeralPublicKey(ephemeralPublicKeyBase64)
+            tokenStore.storeToken(medium, normalised_address, roomId, sender, token)
 
         # Variables to substitute in the template.
         substitutions = {}
@@ -0,0 +1,88 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+import logging
+from typing import TYPE_CHECKING, Collection, Optional
+
+from twisted.internet.interfaces import IConnector
+from twisted.python.failure import Failure
+from twisted.web.proxy import ProxyClientFactory
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Request
+
+from sydent.http.servlets import dict_to_json_bytes
+
+if TYPE_CHECKING:
+    from sydent.sydent import Sydent
+
+logger = logging.getLogger(__name__)
+
+
+class WriterProxyResource(Resource):
+    """Forwards the requests for a part of the client API from a worker process to
+    the writer (see sydent.workers), along with the client's IP address.
+    """
+
+    isLeaf = True
+
+    def __init__(
+        self,
+        sydent: "Sydent",
+        resource: Optional[Resource] = None,
+        read_methods: Collection[bytes] = (),
+    ) -> None:
+        """
+        :param sydent: The worker's Sydent instance.
+        :param resource: The resource to serve the read requests with, if any.
+        :param read_methods: The HTTP methods of the requests to serve with
+            `resource` rather than forward.
+        """
+        super().__init__()
+        self.sydent = sydent
+        self._resource = resource
+        self._read_methods = read_methods
+
+    def render(self, request: Request) -> object:
+        if self._resource is not None and request.method in self._read_methods:
+            return self._resource.render(request)
+
+        worker = self.sydent.worker
+        assert worker is not None
+
+        ip = self.sydent.ip_from_request(request)
+        if ip is not None:
+            request.requestHeaders.setRawHeaders(b"X-Forwarded-For", [ip.encode()])
+        request.content.seek(0, 0)
+        # Type safety: twisted.web.proxy isn't annotated.
+        factory = _WriterClientFactory(  # type: ignore[no-untyped-call]
+            request.method,
+            request.uri,
+            request.clientproto,
+            request.getAllHeaders(),
+            request.content.read(),
+            request,
+        )
+        self.sydent.reactor.connectUNIX(
+            worker.writer_socket,
+            factory,
+            timeout=30,  # taken from PosixReactorBase.connectUNIX
+            checkPID=False,
+        )
+        return NOT_DONE_YET
+
+
+class _WriterClientFactory(ProxyClientFactory):
+    def clientConnectionFailed(self, connector: IConnector, reason: Failure) -> None:
+        logger.error(
+            "Failed to forward a request to the writer: %s", reason.getErrorMessage()
+        )
+        self.father.setResponseCode(503)
+        self.father.setHeader("Content-Type", "application/json")
+        self.father.write(
+            dict_to_json_bytes(
+                {"errcode": "M_UNKNOWN", "error": "Service temporarily unavailable"}
+            )
+        )
+        self.father.finish()
@@ -23,7 +23,6 @@ from twisted.web.iweb import IResponse
 from unpaddedbase64 import decode_base64
 
 from sydent.config.exceptions import ConfigError
-from sydent.db.hashing_metadata import HashingMetadataStore
 from sydent.db.threepid_associations import GlobalAssociationStore, SignedAssociations
 from sydent.threepid import threePidAssocFromDict
 from sydent.types import JsonDict
@@ -40,6 +39,9 @@ logger = logging.getLogger(__name__)
 
 SIGNING_KEY_ALGORITHM = "ed25519"
 
+# The longest a peer can ask us to wait before pushing to it again, in seconds.
+MAX_RETRY_AFTER = 60 * 60
+
 
 class Peer(Generic[PushUpdateReturn]):
     def __init__(self, servername: str, pubkeys: Dict[str, str]):
@@ -69,7 +71,7 @@ class LocalPeer(Peer[bool]):
     def __init__(self, sydent: "Sydent") -> None:
         super().__init__(sydent.config.general.server_name, {})
         self.sydent = sydent
-        self.hashing_store = HashingMetadataStore(sydent)
+        self.hashing_store = sydent.hashing_store
 
         globalAssocStore = GlobalAssociationStore(self.sydent)
         lastId = globalAssocStore.lastIdFromServer(self.servername)
@@ -260,11 +262,20 @@ class RemotePeer(Peer[IResponse]):
             updateDeferred.callback(result)
         else:
             d = readBody(result)
-            d.addCallback(self._failedPushBodyRead, updateDeferred=updateDeferred)
+            d.addCallback(
+                self._failedPushBodyRead,
+                updateDeferred=updateDeferred,
+                code=result.code,
+                retryAfter=_parse_retry_after(result),
+            )
             d.addErrback(self._pushFailed, updateDeferred=updateDeferred)
 
     def _failedPushBodyRead(
-        self, body: bytes, updateDeferred: "Deferred[IResponse]"
+        self,
+        body: bytes,
+        updateDeferred: "Deferred[IResponse]",
+        code: Optional[int] = None,
+        retryAfter: Optional[float] = None,
     ) -> None:
         """
         Processes a response body from a failed push request, then calls the error
@@ -272,9 +283,12 @@ class RemotePeer(Peer[IResponse]):
 
         :param body: The response body.
         :param updateDeferred: The deferred to call the error callback of.
+        :param code: The HTTP status code of the response.
+        :param retryAfter: How long the peer asked us to wait before pushing again,
+            in seconds, if it did.
         """
         errObj = json_decoder.decode(body.decode("utf8"))
-        e = RemotePeerError(errObj)
+        e = RemotePeerError(errObj, code, retryAfter)
         updateDeferred.errback(e)
 
     def _pushFailed(
@@ -309,9 +323,40 @@ class NoMatchingSignatureException(Exception):
         )
 
 
+def _parse_retry_after(response: IResponse) -> Optional[int]:
+    """
+    :param response: An HTTP response.
+
+    :return: The number of seconds the response's Retry-After header asks to wait,
+        capped at MAX_RETRY_AFTER, or None if it doesn't have one given as a number
+        of seconds.
+    """
+    values = response.headers.getRawHeaders(b"Retry-After")
+    if not values:
+        return None
+    # The header is either a date, which we ignore, or a non-negative integer.
+    value = values[0].strip()
+    if not value.isdigit():
+        return None
+    return min(int(value), MAX_RETRY_AFTER)
+
+
 class RemotePeerError(Exception):
-    def __init__(self, errorDict: JsonDict):
+    def __init__(
+        self,
+        errorDict: JsonDict,
+        code: Optional[int] = None,
+        retryAfter: Optional[float] = None,
+    ):
+        """
+        :param errorDict: The body of the peer's error response.
+        :param code: The HTTP status code of the response.
+        :param retryAfter: How long the peer asked us to wait before pushing again,
+            in seconds, if it did.
+        """
         self.errorDict = errorDict
+        self.code = code
+        self.retryAfter = retryAfter
 
     def __str__(self) -> str:
         return repr(self.errorDict)
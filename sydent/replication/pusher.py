@@ -9,37 +9,126 @@
 # <http://www.apache.org/licenses/LICENSE-2.0>.
 
 import logging
-from typing import TYPE_CHECKING, List, Tuple
+from collections import deque
+from typing import TYPE_CHECKING, Deque, Dict, List, Optional, Set, Tuple
 
-import twisted.internet.reactor
-import twisted.internet.task
+import attr
 from twisted.internet import defer
+from twisted.internet.interfaces import IDelayedCall
+from twisted.web.iweb import IResponse
 
 from sydent.db.peers import PeerStore
-from sydent.db.threepid_associations import LocalAssociationStore
-from sydent.replication.peer import LocalPeer, RemotePeer
+from sydent.db.threepid_associations import LocalAssociationStore, SignedAssociations
+from sydent.replication.peer import LocalPeer, RemotePeer, RemotePeerError
 from sydent.util import time_msec
+from sydent.util.stringutils import normalise_address_for_lookup
 
 if TYPE_CHECKING:
     from sydent.sydent import Sydent
 
 logger = logging.getLogger(__name__)
 
-# Maximum amount of signed associations to replicate to a peer at a time
+# The number of signed associations to replicate to a peer at a time, to start with.
+# The batch size then adapts to how quickly the peer processes them, between
+# MIN_PUSH_SIZE and MAX_PUSH_SIZE.
 ASSOCIATIONS_PUSH_LIMIT = 100
+MIN_PUSH_SIZE = 10
+MAX_PUSH_SIZE = 1000
+
+# How many associations to add to a peer's batch size after each push it
+# acknowledged within TARGET_PUSH_LATENCY seconds. The batch size is halved after
+# pushes which took longer, or failed.
+PUSH_SIZE_STEP = 50
+TARGET_PUSH_LATENCY = 2.0
+
+# How long to wait after an association is written before pushing it, in seconds, so
+# that the associations written in a burst are pushed together.
+PUSH_DELAY = 0.1
+
+# How long to wait before pushing to the peers again after a push failed, in seconds,
+# unless they tell us otherwise.
+RETRY_INTERVAL = 10.0
+
+
+@attr.s(slots=True, auto_attribs=True)
+class _PeerPushState:
+    """What we've learned about pushing to a peer."""
+
+    # The number of associations to send in each push.
+    batch_size: int = ASSOCIATIONS_PUSH_LIMIT
+    # The largest number of associations the peer accepts in a push.
+    max_batch_size: int = MAX_PUSH_SIZE
+    # If the last push to the peer failed, when to try again (in seconds since the
+    # epoch).
+    retry_at: Optional[float] = None
+
+    def on_success(self, latency: float) -> None:
+        """Adapt the batch size after a push succeeded.
+
+        :param latency: How long the push took, in seconds.
+        """
+        if latency <= TARGET_PUSH_LATENCY:
+            self.batch_size = min(self.batch_size + PUSH_SIZE_STEP, self.max_batch_size)
+        else:
+            self.batch_size = max(self.batch_size // 2, MIN_PUSH_SIZE)
+
+    def on_failure(self) -> None:
+        """Adapt the batch size after a push failed."""
+        self.batch_size = max(self.batch_size // 2, MIN_PUSH_SIZE)
+
+
+@attr.s(slots=True, auto_attribs=True)
+class _Batch:
+    """A batch of associations sent to a peer, waiting to be acknowledged."""
+
+    # The ID of the last association in the batch.
+    last_id: int
+    # The (medium, normalised address) of the 3PIDs of the associations.
+    threepids: Set[Tuple[str, str]]
+    # The time the batch was sent at, in seconds.
+    sent_at: float
+    response: "defer.Deferred[IResponse]"
 
 
 class Pusher:
+    """Pushes the local associations to the remote peers.
+
+    Pushes are triggered by writes to the local associations (see doLocalPush), and
+    send batches to each peer until it has caught up, keeping several batches in
+    flight at once. The size of the batches sent to each peer adapts to how quickly it
+    acknowledges them. Peers which can't be pushed to are retried every
+    RETRY_INTERVAL seconds, or when they ask to be.
+    """
+
     def __init__(self, sydent: "Sydent") -> None:
         self.sydent = sydent
         self.pushing = False
         self.peerStore = PeerStore(self.sydent)
         self.local_assoc_store = LocalAssociationStore(self.sydent)
+        # The names of the peers being pushed to.
+        self._peers_being_pushed_to: Set[str] = set()
+        self._peer_states: Dict[str, _PeerPushState] = {}
+        self._pending_push: Optional[IDelayedCall] = None
+        self._pending_retry: Optional[IDelayedCall] = None
 
     def setup(self) -> None:
-        cb = twisted.internet.task.LoopingCall(Pusher.scheduledPush, self)
-        cb.clock = self.sydent.reactor
-        cb.start(10.0)
+        # Push whatever was written before we started.
+        self.schedulePush()
+
+    def schedulePush(self, delay: float = PUSH_DELAY) -> None:
+        """Push the pending associations to every remote peer after a delay, unless a
+        push is already scheduled by then.
+
+        :param delay: How long to wait before pushing, in seconds.
+        """
+        if self._pending_push is not None and self._pending_push.active():
+            return
+
+        def push() -> None:
+            self._pending_push = None
+            self._push(retry=False)
+
+        self._pending_push = self.sydent.reactor.callLater(delay, push)
 
     def doLocalPush(self) -> None:
         """
@@ -57,69 +146,231 @@ class Pusher:
 
         localPeer.pushUpdates(signedAssocs)
 
+        # Push the associations to the remote peers too, once they've been committed.
+        self.sydent.db.call_after_commit(self.schedulePush)
+
     def scheduledPush(self) -> "defer.Deferred[List[Tuple[bool, None]]]":
-        """Push pending updates to all known remote peers. To be called regularly.
+        """Push pending updates to all known remote peers, including the ones the last
+        push to failed.
 
         :returns a deferred.DeferredList of defers, one per peer we're pushing to that will
         resolve when pushing to that peer has completed, successfully or otherwise
         """
-        peers = self.peerStore.getAllPeers()
+        return self._push(retry=True)
+
+    def _push(self, retry: bool) -> "defer.Deferred[List[Tuple[bool, None]]]":
+        """Push pending updates to the known remote peers.
+
+        :param retry: Whether to push to the peers the last push to failed too, once
+            they're due to be retried.
+
+        :returns a deferred.DeferredList of defers, one per peer we're pushing to that will
+        resolve when pushing to that peer has completed, successfully or otherwise
+        """
+        if retry and self._pending_retry is not None:
+            if self._pending_retry.active():
+                self._pending_retry.cancel()
+            self._pending_retry = None
+
+        peers = self.sydent.peer_registry.get_all_peers()
+        now = self.sydent.reactor.seconds()
 
         # Push to all peers in parallel
         dl = []
         for p in peers:
-            dl.append(defer.ensureDeferred(self._push_to_peer(p)))
+            retry_at = self._get_state(p.servername).retry_at
+            if retry_at is None or (retry and retry_at <= now):
+                dl.append(defer.ensureDeferred(self._push_to_peer(p)))
+            elif retry:
+                self._schedule_retry(retry_at)
         return defer.DeferredList(dl)
 
+    def _get_state(self, servername: str) -> _PeerPushState:
+        state = self._peer_states.get(servername)
+        if state is None:
+            state = self._peer_states[servername] = _PeerPushState()
+        return state
+
+    def _schedule_retry(self, retry_at: float) -> None:
+        """Push to the remote peers again at the given time, after a push failed,
+        unless a retry is already scheduled by then.
+
+        :param retry_at: The time to retry at, in seconds since the epoch.
+        """
+        if self._pending_retry is not None and self._pending_retry.active():
+            if self._pending_retry.getTime() <= retry_at:
+                return
+            self._pending_retry.cancel()
+
+        def retry() -> None:
+            self._pending_retry = None
+            self._push(retry=True)
+
+        delay = max(retry_at - self.sydent.reactor.seconds(), 0)
+        self._pending_retry = self.sydent.reactor.callLater(delay, retry)
+
     async def _push_to_peer(self, p: "RemotePeer") -> None:
         """
-        For a given peer, retrieves the list of associations that were created since
-        the last successful push to this peer (limited to ASSOCIATIONS_PUSH_LIMIT) and
-        sends them.
+        For a given peer, retrieves the associations that were created since the last
+        successful push to this peer and sends them in batches until there are none
+        left.
+
+        Up to replication.https.push_window batches are sent at once. Batches in flight
+        at the same time never contain associations for the same 3PID, so that the
+        peer can't apply an association before an older one for the same 3PID even if
+        it processes the batches out of order. Once a batch fails, no more are sent:
+        the pushes are retried later from the last batch which was acknowledged along
+        with all of the ones before it.
 
         :param p: The peer to send associations to.
         """
         logger.debug("Looking for updates to push to %s", p.servername)
 
-        # Check if a push operation is already active. If so, don't start another
-        if p.is_being_pushed_to:
+        # Check if a push operation is already active. If so, don't start another: it
+        # will pick up the associations written since it started.
+        if p.servername in self._peers_being_pushed_to:
             logger.debug(
                 "Waiting for %s to finish pushing...", p.replication_url_origin
             )
             return
 
-        p.is_being_pushed_to = True
+        self._peers_being_pushed_to.add(p.servername)
+
+        state = self._get_state(p.servername)
+        window = self.sydent.config.http.replication_push_window
+        in_flight: Deque[_Batch] = deque()
+        # The ID of the last association sent, acknowledged or not.
+        last_sent_id = p.lastSentVersion
+        failure: Optional[Exception] = None
+        # Whether every batch so far has been acknowledged, so that the next one can
+        # be recorded as sent once it is.
+        all_acknowledged = True
 
         try:
-            # Push associations
-            (
-                assocs,
-                latest_assoc_id,
-            ) = self.local_assoc_store.getSignedAssociationsAfterId(
-                p.lastSentVersion, ASSOCIATIONS_PUSH_LIMIT
-            )
+            while True:
+                while failure is None and len(in_flight) < window:
+                    try:
+                        batch = self._send_batch(p, state, last_sent_id, in_flight)
+                    except Exception as e:
+                        # Stop sending, but wait for the batches already in flight.
+                        failure = e
+                        break
+                    if batch is None:
+                        break
+                    in_flight.append(batch)
+                    last_sent_id = batch.last_id
 
-            # If there are no updates left to send, break the loop
-            if not assocs:
-                return
+                # If there are no updates left to send, break the loop
+                if not in_flight:
+                    break
 
-            logger.info(
-                "Pushing %d updates to %s", len(assocs), p.replication_url_origin
-            )
-            result = await p.pushUpdates(assocs)
+                batch = in_flight.popleft()
+                try:
+                    result = await batch.response
+                except Exception as e:
+                    state.on_failure()
+                    all_acknowledged = False
+                    if failure is None:
+                        failure = e
+                    continue
 
-            self.peerStore.setLastSentVersionAndPokeSucceeded(
-                p.servername, latest_assoc_id, time_msec()
-            )
+                # Only record the batch as sent once the ones before it have been
+                # acknowledged too.
+                if not all_acknowledged:
+                    continue
 
-            logger.info(
-                "Pushed updates to %s with result %d %s",
-                p.replication_url_origin,
-                result.code,
-                result.phrase,
-            )
-        except Exception:
-            logger.exception("Error pushing updates to %s", p.replication_url_origin)
+                state.on_success(self.sydent.reactor.seconds() - batch.sent_at)
+                self.peerStore.setLastSentVersionAndPokeSucceeded(
+                    p.servername, batch.last_id, time_msec()
+                )
+                p.lastSentVersion = batch.last_id
+
+                logger.info(
+                    "Pushed updates to %s with result %d %s",
+                    p.replication_url_origin,
+                    result.code,
+                    result.phrase,
+                )
+        except Exception as e:
+            failure = e
+            # Wait for the batches still in flight, so that their responses aren't
+            # left unhandled and no other push starts while they are.
+            for batch in in_flight:
+                try:
+                    await batch.response
+                except Exception:
+                    pass
         finally:
             # Whether pushing completed or an error occurred, signal that pushing has finished
-            p.is_being_pushed_to = False
+            self._peers_being_pushed_to.discard(p.servername)
+
+        if failure is None:
+            state.retry_at = None
+            return
+
+        logger.error(
+            "Error pushing updates to %s",
+            p.replication_url_origin,
+            exc_info=failure,
+        )
+        delay = RETRY_INTERVAL
+        if isinstance(failure, RemotePeerError):
+            max_push_size = failure.errorDict.get("max_push_size")
+            if failure.code == 413 and isinstance(max_push_size, int):
+                # The peer told us how much to send, so try again straight away.
+                state.max_batch_size = max(max_push_size, 1)
+                state.batch_size = min(state.batch_size, state.max_batch_size)
+                delay = 0
+            if failure.retryAfter is not None:
+                delay = failure.retryAfter
+        state.retry_at = self.sydent.reactor.seconds() + delay
+        self._schedule_retry(state.retry_at)
+
+    def _send_batch(
+        self,
+        p: "RemotePeer",
+        state: _PeerPushState,
+        after_id: Optional[int],
+        in_flight: Deque[_Batch],
+    ) -> Optional[_Batch]:
+        """Send the next batch of associations to a peer, if there is one which can be
+        sent now.
+
+        :param p: The peer to send the associations to.
+        :param state: What we've learned about pushing to the peer.
+        :param after_id: The ID of the last association sent to the peer.
+        :param in_flight: The batches waiting to be acknowledged by the peer.
+
+        :return: The batch sent, or None if there are no associations left to send, or
+            if the next one is for a 3PID in a batch in flight.
+        """
+        assocs, _ = self.local_assoc_store.getSignedAssociationsAfterId(
+            after_id, state.batch_size
+        )
+
+        busy_threepids: Set[Tuple[str, str]] = set()
+        for batch in in_flight:
+            busy_threepids.update(batch.threepids)
+
+        batch_assocs: SignedAssociations = {}
+        threepids: Set[Tuple[str, str]] = set()
+        for assoc_id in sorted(assocs):
+            assoc = assocs[assoc_id]
+            threepid = (assoc["medium"], normalise_address_for_lookup(assoc["address"]))
+            if threepid in busy_threepids:
+                break
+            batch_assocs[assoc_id] = assoc
+            threepids.add(threepid)
+
+        if not batch_assocs:
+            return None
+
+        logger.info(
+            "Pushing %d updates to %s", len(batch_assocs), p.replication_url_origin
+        )
+        return _Batch(
+            last_id=max(batch_assocs),
+            threepids=threepids,
+            sent_at=self.sydent.reactor.seconds(),
+            response=p.pushUpdates(batch_assocs),
+        )
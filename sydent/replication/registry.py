@@ -0,0 +1,145 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+"""A long-lived registry of the remote peers, shared by the pusher and the replication
+servlet.
+
+The peers are read from the peers and peer_pubkeys tables, which are edited by hand
+rather than by Sydent. Triggers on those tables count the changes made to them in
+peers_version, which the registry polls, rebuilding the peers whose configuration
+changed when the count changes. It can also be told to reload straight away (Sydent
+does on SIGHUP). The peers which didn't change are kept as they are, along with their
+decoded public keys and the ID of the last association pushed to them.
+"""
+
+import logging
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+from twisted.internet import task
+
+from sydent.db.peers import PeerStore
+from sydent.replication.peer import RemotePeer
+
+if TYPE_CHECKING:
+    from sydent.sydent import Sydent
+
+logger = logging.getLogger(__name__)
+
+
+class PeerRegistry:
+    # How often to check the database for changes to the peers, in seconds.
+    POLL_INTERVAL = 10.0
+
+    def __init__(self, sydent: "Sydent") -> None:
+        self.sydent = sydent
+        self.peerStore = PeerStore(sydent)
+
+        # The peers by server name, or None until they're first loaded.
+        self._peers: Optional[Dict[str, RemotePeer]] = None
+        # The version of the peers' configuration _peers was loaded from.
+        self._version: Optional[int] = None
+        # The port and public keys each peer in _peers was built with.
+        self._configs: Dict[str, Tuple[Optional[int], Dict[str, str]]] = {}
+        self._change_callbacks: List[Callable[[], None]] = []
+
+    def start(self) -> None:
+        """Load the peers, and start polling the database for changes to them."""
+        cb = task.LoopingCall(self._poll)
+        cb.clock = self.sydent.reactor
+        cb.start(self.POLL_INTERVAL)
+
+    def add_change_callback(self, callback: Callable[[], None]) -> None:
+        """Register a function to call whenever the peers change after they were first
+        loaded.
+
+        :param callback: The function to call.
+        """
+        self._change_callbacks.append(callback)
+
+    def get_peer(self, name: str) -> Optional[RemotePeer]:
+        """Get an active remote peer by its server name.
+
+        :param name: The server name of the peer.
+
+        :return: The peer, or None if there is no active peer with that name.
+        """
+        peer = self._get_peers().get(name)
+        if peer is None:
+            # The peer may have been added since the last poll, but only reload the
+            # peers if something has changed, so that unknown peers can't make us
+            # read them all over and over.
+            self._reload_if_changed()
+            peer = self._get_peers().get(name)
+        return peer
+
+    def get_all_peers(self) -> List[RemotePeer]:
+        """
+        :return: The active remote peers.
+        """
+        return list(self._get_peers().values())
+
+    def _get_peers(self) -> Dict[str, RemotePeer]:
+        if self._peers is None:
+            self.reload()
+            assert self._peers is not None
+        return self._peers
+
+    def _poll(self) -> None:
+        try:
+            self._reload_if_changed()
+        except Exception:
+            logger.exception("Failed to reload the replication peers")
+
+    def _reload_if_changed(self) -> None:
+        """Reload the peers if their configuration has changed since they were last
+        loaded.
+        """
+        if self.peerStore.getPeersVersion() != self._version:
+            self.reload()
+
+    def reload(self) -> None:
+        """Read the peers from the database, and rebuild the ones whose configuration
+        changed.
+        """
+        first_load = self._peers is None
+        old_peers = self._peers or {}
+
+        # Read the version first, so that changes made while the peers are read are
+        # picked up by the next poll.
+        version = self.peerStore.getPeersVersion()
+        new_configs = self.peerStore.getPeerConfigs()
+
+        peers: Dict[str, RemotePeer] = {}
+        configs: Dict[str, Tuple[Optional[int], Dict[str, str]]] = {}
+        changed = set(old_peers) != set(new_configs)
+        for name, (port, pubkeys, lastSentVersion) in new_configs.items():
+            old_peer = old_peers.get(name)
+            if old_peer is not None and self._configs[name] == (port, pubkeys):
+                peers[name] = old_peer
+                configs[name] = (port, pubkeys)
+                continue
+
+            changed = True
+            try:
+                peer = RemotePeer(self.sydent, name, port, pubkeys, lastSentVersion)
+            except Exception:
+                logger.exception("Failed to load replication peer %s", name)
+                continue
+
+            # Carry on pushing from where we got to with the peer's old configuration.
+            if old_peer is not None:
+                peer.lastSentVersion = old_peer.lastSentVersion
+
+            peers[name] = peer
+            configs[name] = (port, pubkeys)
+
+        self._peers = peers
+        self._configs = configs
+        self._version = version
+
+        if changed and not first_load:
+            logger.info("Replication peers changed, now %s", sorted(peers))
+            for callback in self._change_callbacks:
+                callback()
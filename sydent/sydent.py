@@ -9,33 +9,57 @@
 # Originally licensed under the Apache License, Version 2.0:
 # <http://www.apache.org/licenses/LICENSE-2.0>.
 
+import argparse
 import gc
 import logging
 import logging.handlers
 import os
-import sqlite3
-from typing import Optional
+import signal
+from types import FrameType
+from typing import Optional, Tuple
 
 import attr
 import prometheus_client
 import twisted.internet.reactor
 from matrix_common.versionstring import get_distribution_version_string
 from signedjson.types import SigningKey
-from twisted.internet import address, task
+from twisted.internet import address, defer, task
 from twisted.internet.interfaces import (
     IReactorCore,
+    IReactorFromThreads,
     IReactorPluggableNameResolver,
+    IReactorProcess,
+    IReactorSocket,
     IReactorSSL,
     IReactorTCP,
     IReactorTime,
+    IReactorUNIX,
 )
 from twisted.python import log
 from twisted.web.http import Request
 from zope.interface import Interface
 
 from sydent.config import SydentConfig
-from sydent.db.hashing_metadata import HashingMetadataStore
-from sydent.db.sqlitedb import SqliteDatabase
+from sydent.db.background_updates import BackgroundUpdater
+from sydent.db.engines import create_engine
+from sydent.db.hashing_metadata import REHASH_LOOKUP_HASHES, HashingMetadataStore
+from sydent.db.lookup_bloom_filter import LookupBloomFilter
+from sydent.db.lookup_cache import (
+    HashEntry,
+    LookupCache,
+    MxidEntry,
+    SignedAssociationEntry,
+)
+from sydent.db.lookup_hash_index import LookupHashIndex
+from sydent.db.lookup_snapshot import LookupSnapshot
+from sydent.db.pool import DatabasePool
+from sydent.db.threepid_associations import GlobalAssociationStore
+from sydent.db.transaction import TransactionalConnection
+from sydent.db.updates import (
+    BACKGROUND_UPDATE_HANDLERS,
+    POPULATE_CURRENT_MAPPINGS,
+    POPULATE_LOOKUP_HASHES,
+)
 from sydent.db.valsession import ThreePidValSessionStore
 from sydent.hs_federation.verifier import Verifier
 from sydent.http.httpcommon import SslComponents
@@ -46,12 +70,15 @@ from sydent.http.httpserver import (
     ReplicationHttpsServer,
 )
 from sydent.replication.pusher import Pusher
+from sydent.replication.registry import PeerRegistry
 from sydent.threepid.bind import ThreepidBinder
 from sydent.util.hash import sha256_and_url_safe_base64
 from sydent.util.ratelimiter import Ratelimiter
+from sydent.util.singleflight import SingleFlight
 from sydent.util.tokenutils import generateAlphanumericTokenOfLength
 from sydent.validators.emailvalidator import EmailValidator
 from sydent.validators.msisdnvalidator import MsisdnValidator
+from sydent.workers import WORKER_POLL_INTERVAL, ForwardedRequest, WorkerOptions
 
 logger = logging.getLogger(__name__)
 
@@ -62,6 +89,10 @@ class SydentReactor(
     IReactorSSL,
     IReactorTime,
     IReactorPluggableNameResolver,
+    IReactorUNIX,
+    IReactorSocket,
+    IReactorProcess,
+    IReactorFromThreads,
     Interface,
 ):
     pass
@@ -73,15 +104,61 @@ class Sydent:
         sydent_config: SydentConfig,
         reactor: SydentReactor = twisted.internet.reactor,  # type: ignore[assignment]
         use_tls_for_federation: bool = True,
+        worker: Optional[WorkerOptions] = None,
     ):
+        """
+        :param worker: If this process is a worker serving part of the client API
+            (see sydent.workers), what it's been told by the writer process.
+        """
         self.config = sydent_config
 
         self.reactor = reactor
         self.use_tls_for_federation = use_tls_for_federation
+        self.worker = worker
 
         logger.info("Starting Sydent server")
 
-        self.db: sqlite3.Connection = SqliteDatabase(self).db
+        self.db_engine = create_engine(self.config.database)
+        self.db: TransactionalConnection = self.db_engine.connect()
+        self.db_engine.prepare_database(self.db)
+        if self.config.database.group_commit:
+            self.db.enable_group_commit(self.reactor)
+        self.db_pool = DatabasePool(self, "db-pool", self.config.database.pool_size)
+        # Lookups get their own pool of read-only connections, so that they don't
+        # queue up behind slower background work.
+        self.lookup_db_pool = DatabasePool(
+            self,
+            "lookup-db-pool",
+            self.config.database.lookup_pool_size,
+            read_only=True,
+        )
+        self.background_updater = BackgroundUpdater(self, BACKGROUND_UPDATE_HANDLERS)
+        self.lookup_hash_index: Optional[LookupHashIndex] = None
+        self.lookup_bloom_filter: Optional[LookupBloomFilter] = None
+        self.lookup_cache: Optional[LookupCache] = None
+        # Workers don't see the changes made by the writer as they're committed, so
+        # can't keep the index, Bloom filter and lookup cache up to date.
+        if self.worker is None:
+            if self.config.database.lookup_hash_index:
+                self.lookup_hash_index = LookupHashIndex(self)
+            if self.config.database.lookup_bloom_filter:
+                self.lookup_bloom_filter = LookupBloomFilter(self)
+            if self.config.database.lookup_cache_size > 0:
+                self.lookup_cache = LookupCache(self.config.database.lookup_cache_size)
+        self.lookup_snapshot: Optional[LookupSnapshot] = None
+        if self.config.database.lookup_snapshot_path is not None:
+            self.lookup_snapshot = LookupSnapshot(self)
+        # Concurrent lookups of the same 3PIDs and hashes share their queries, see
+        # GlobalAssociationStore.
+        self.mxid_lookups: SingleFlight[Tuple[str, str], MxidEntry] = SingleFlight(
+            "mxid"
+        )
+        self.signed_association_lookups: SingleFlight[
+            Tuple[str, str], SignedAssociationEntry
+        ] = SingleFlight("signed_association")
+        self.lookup_hash_lookups: SingleFlight[
+            Tuple[str, str], HashEntry
+        ] = SingleFlight("lookup_hash")
 
         if self.config.general.sentry_enabled:
             import sentry_sdk
@@ -103,20 +180,46 @@ class Sydent:
         # See if a pepper already exists in the database
         # Note: This MUST be run before we start serving requests, otherwise lookups for
         # 3PID hashes may come in before we've completed generating them
-        hashing_metadata_store = HashingMetadataStore(self)
-        lookup_pepper = hashing_metadata_store.get_lookup_pepper()
-        if not lookup_pepper:
+        self.hashing_store = HashingMetadataStore(self)
+        if not self.hashing_store.get_lookup_pepper():
             # No pepper defined in the database, generate one
             lookup_pepper = generateAlphanumericTokenOfLength(5)
 
             # Store it in the database and rehash 3PIDs
-            hashing_metadata_store.store_lookup_pepper(
+            self.hashing_store.store_lookup_pepper(
                 sha256_and_url_safe_base64, lookup_pepper
             )
-
-        self.validators: Validators = Validators(
-            EmailValidator(self), MsisdnValidator(self)
+        # Start using the new pepper once a rotation has finished.
+        self.background_updater.add_completion_callback(
+            REHASH_LOOKUP_HASHES, self.hashing_store.reload
         )
+        # The lookup hash index and Bloom filter can only be loaded once the current
+        # mappings have been built, and must be reloaded once their hashes have been
+        # changed.
+        for update_name in (
+            POPULATE_CURRENT_MAPPINGS,
+            POPULATE_LOOKUP_HASHES,
+            REHASH_LOOKUP_HASHES,
+        ):
+            if self.lookup_hash_index is not None:
+                self.background_updater.add_completion_callback(
+                    update_name, self.lookup_hash_index.start_loading
+                )
+            if self.lookup_bloom_filter is not None:
+                self.background_updater.add_completion_callback(
+                    update_name, self.lookup_bloom_filter.start_loading
+                )
+            # Only the writer writes the lookup snapshot.
+            if self.lookup_snapshot is not None and self.worker is None:
+                self.background_updater.add_completion_callback(
+                    update_name, self.lookup_snapshot.start_writing
+                )
+
+        # Lookup-only servers don't validate 3PIDs, so don't need to be able to send
+        # emails or text messages.
+        self.validators: Optional[Validators] = None
+        if not self.config.general.lookup_only:
+            self.validators = Validators(EmailValidator(self), MsisdnValidator(self))
 
         self.keyring: Keyring = Keyring(self.config.crypto.signing_key)
         self.keyring.ed25519.alg = "ed25519"
@@ -127,13 +230,19 @@ class Sydent:
 
         self.sslComponents: SslComponents = SslComponents(self)
 
-        self.clientApiHttpServer = ClientApiHttpServer(self, lookup_pepper)
+        self.clientApiHttpServer = ClientApiHttpServer(self)
         self.replicationHttpsServer = ReplicationHttpsServer(self)
         self.replicationHttpsClient: ReplicationHttpsClient = ReplicationHttpsClient(
             self
         )
 
-        self.pusher: Pusher = Pusher(self)
+        self.peer_registry = PeerRegistry(self)
+        # Lookup-only servers only receive associations from their peers.
+        self.pusher: Optional[Pusher] = None
+        if not self.config.general.lookup_only:
+            self.pusher = Pusher(self)
+            # Push to the peers which were added straight away.
+            self.peer_registry.add_change_callback(self.pusher.schedulePush)
 
         self.email_sender_ratelimiter: Ratelimiter[str] = Ratelimiter(
             self.reactor,
@@ -142,16 +251,60 @@ class Sydent:
         )
 
     def run(self) -> None:
+        if self.worker is not None:
+            self._run_worker()
+            return
+
+        self.db_pool.start()
+        self.lookup_db_pool.start()
+        self.background_updater.start()
+        if self.background_updater.has_completed_update(POPULATE_CURRENT_MAPPINGS):
+            if self.lookup_hash_index is not None:
+                self.lookup_hash_index.start_loading()
+            if self.lookup_bloom_filter is not None:
+                self.lookup_bloom_filter.start_loading()
+        # Make sure changes waiting for a group commit make it to disk.
+        self.reactor.addSystemEventTrigger("before", "shutdown", self.db.flush)
         self.clientApiHttpServer.setup()
+        self.peer_registry.start()
         self.replicationHttpsServer.setup()
-        self.pusher.setup()
+        if self.pusher is not None:
+            self.pusher.setup()
         self.maybe_start_prometheus_server()
 
-        # A dedicated validation session store just to clean up old sessions every N minutes
-        self.cleanupValSession = ThreePidValSessionStore(self)
-        cb = task.LoopingCall(self.cleanupValSession.deleteOldSessions)
+        if not self.config.general.lookup_only:
+            # A dedicated validation session store just to clean up old sessions every N minutes
+            self.cleanupValSession = ThreePidValSessionStore(self)
+            cb = task.LoopingCall(self.cleanupValSession.deleteOldSessions)
+            cb.clock = self.reactor
+            cb.start(10 * 60.0)
+
+        # Remove superseded associations from the history every few hours.
+        globalAssocStore = GlobalAssociationStore(self)
+        cb = task.LoopingCall(
+            lambda: defer.ensureDeferred(
+                globalAssocStore.compactAssociationsInBackground()
+            )
+        )
         cb.clock = self.reactor
-        cb.start(10 * 60.0)
+        cb.start(6 * 60 * 60.0, now=False)
+
+        # Rebuild the lookup Bloom filter every few hours, to forget the 3PIDs which
+        # have been unbound.
+        if self.lookup_bloom_filter is not None:
+            cb = task.LoopingCall(self.lookup_bloom_filter.start_loading)
+            cb.clock = self.reactor
+            cb.start(6 * 60 * 60.0, now=False)
+
+        # Write a new lookup snapshot every few minutes, and keep up with the changes
+        # made since the snapshot in use was written.
+        if self.lookup_snapshot is not None:
+            cb = task.LoopingCall(self.lookup_snapshot.start_writing)
+            cb.clock = self.reactor
+            cb.start(self.config.database.lookup_snapshot_interval)
+            cb = task.LoopingCall(self.lookup_snapshot.start_refreshing)
+            cb.clock = self.reactor
+            cb.start(LookupSnapshot.POLL_INTERVAL, now=False)
 
         if self.config.http.internal_port is not None:
             internalport = self.config.http.internal_port
@@ -160,12 +313,47 @@ class Sydent:
             self.internalApiHttpServer = InternalApiHttpServer(self)
             self.internalApiHttpServer.setup(interface, internalport)
 
+        # Pick up changes to the replication peers on SIGHUP without waiting for the
+        # next poll.
+        def reload_peers(signum: int, frame: Optional[FrameType]) -> None:
+            # Signal handlers can run in the middle of the reactor's own code, so
+            # hand the reload over the same way as from another thread.
+            self.reactor.callFromThread(self.peer_registry.reload)
+
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, reload_peers)
+
         if self.config.general.pidfile:
             with open(self.config.general.pidfile, "w") as pidfile:
                 pidfile.write(str(os.getpid()) + "\n")
 
         self.reactor.run()
 
+    def _run_worker(self) -> None:
+        """Serve the lookups of the client API, and forward the rest of it to the
+        writer process.
+        """
+        self.db_pool.start()
+        self.lookup_db_pool.start()
+
+        # Pick up the lookup pepper and the background updates once the writer has
+        # changed them.
+        def refresh() -> None:
+            self.hashing_store.reload()
+            self.background_updater.refresh()
+
+        cb = task.LoopingCall(refresh)
+        cb.clock = self.reactor
+        cb.start(WORKER_POLL_INTERVAL, now=False)
+
+        if self.lookup_snapshot is not None:
+            cb = task.LoopingCall(self.lookup_snapshot.start_refreshing)
+            cb.clock = self.reactor
+            cb.start(LookupSnapshot.POLL_INTERVAL)
+
+        self.clientApiHttpServer.setup()
+        self.reactor.run()
+
     def maybe_start_prometheus_server(self) -> None:
         if self.config.general.prometheus_enabled:
             assert self.config.general.prometheus_addr is not None
@@ -182,6 +370,12 @@ class Sydent:
             # Type safety: hasHeaders returning True means that getRawHeaders
             # returns a nonempty list
             return request.requestHeaders.getRawHeaders("X-Forwarded-For")[0]  # type: ignore[index]
+        # Requests forwarded by a worker come through the writer's UNIX socket, along
+        # with the IP address of the client.
+        if isinstance(request, ForwardedRequest) and request.requestHeaders.hasHeader(
+            "X-Forwarded-For"
+        ):
+            return request.requestHeaders.getRawHeaders("X-Forwarded-For")[0]  # type: ignore[index]
         client = request.getClientAddress()
         if isinstance(client, (address.IPv4Address, address.IPv6Address)):
             return client.host
@@ -263,13 +457,17 @@ def run_gc() -> None:
             gc.collect(i)
 
 
-def setup_logging(config: SydentConfig) -> None:
+def setup_logging(config: SydentConfig, worker: Optional[WorkerOptions] = None) -> None:
     """
     Setup logging using the options specified in the config
 
     :param config: the configuration to use
+    :param worker: the options of this process if it's a worker, which logs to its
+        own file so that the processes don't rotate each other's logs
     """
     log_path = config.general.log_path
+    if log_path != "" and worker is not None:
+        log_path = "%s.worker%d" % (log_path, worker.index)
     log_level = config.general.log_level
 
     log_format = "%(asctime)s - %(name)s - %(lineno)d - %(levelname)s" " - %(message)s"
@@ -294,12 +492,38 @@ def setup_logging(config: SydentConfig) -> None:
     observer.start()
 
 
+def parse_worker_args() -> Optional[WorkerOptions]:
+    """Parse the command line arguments the writer starts worker processes with.
+
+    :return: The options of this process if it's a worker, None otherwise.
+    """
+    parser = argparse.ArgumentParser(
+        description="Sydent identity server", add_help=False
+    )
+    parser.add_argument("--worker-index", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-listen-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-listen-family", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-writer-socket", help=argparse.SUPPRESS)
+    # Sydent is configured through its config file rather than its command line, so
+    # leave any other arguments alone as it always has.
+    args, _ = parser.parse_known_args()
+    if args.worker_index is None:
+        return None
+    return WorkerOptions(
+        index=args.worker_index,
+        listen_fd=args.worker_listen_fd,
+        listen_family=args.worker_listen_family,
+        writer_socket=args.worker_writer_socket,
+    )
+
+
 def main() -> None:
+    worker = parse_worker_args()
     sydent_config = SydentConfig()
     sydent_config.parse_config_file(get_config_file_path())
-    setup_logging(sydent_config)
+    setup_logging(sydent_config, worker)
 
-    syd = Sydent(sydent_config)
+    syd = Sydent(sydent_config, worker=worker)
     syd.run()
 
 
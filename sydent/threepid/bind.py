@@ -15,7 +15,6 @@ from typing import TYPE_CHECKING, Any, Dict, Union
 import signedjson.sign
 from twisted.internet import defer
 
-from sydent.db.hashing_metadata import HashingMetadataStore
 from sydent.db.invite_tokens import JoinTokenStore
 from sydent.db.threepid_associations import LocalAssociationStore
 from sydent.http.httpclient import FederationHttpClient
@@ -37,7 +36,7 @@ class ThreepidBinder:
 
     def __init__(self, sydent: "Sydent") -> None:
         self.sydent = sydent
-        self.hashing_store = HashingMetadataStore(sydent)
+        self.hashing_store = sydent.hashing_store
 
     def addBinding(self, medium: str, address: str, mxid: str) -> Dict[str, Any]:
         """
@@ -81,31 +80,36 @@ class ThreepidBinder:
             expires,
         )
 
-        localAssocStore.addOrUpdateAssociation(assoc)
-
-        self.sydent.pusher.doLocalPush()
-
-        joinTokenStore = JoinTokenStore(self.sydent)
-        pendingJoinTokens = joinTokenStore.getTokens(medium, normalised_address)
-        invites = []
-        # Widen the value type to Any: we're going to set the signed key
-        # to point to a dict, but pendingJoinTokens yields Dict[str, str]
-        token: Dict[str, Any]
-        for token in pendingJoinTokens:
-            token["mxid"] = mxid
-            presigned = {
-                "mxid": mxid,
-                "token": token["token"],
-            }
-            token["signed"] = signedjson.sign.sign_json(
-                presigned,
-                self.sydent.config.general.server_name,
-                self.sydent.keyring.ed25519,
-            )
-            invites.append(token)
-        if invites:
-            assoc.extra_fields["invites"] = invites
-            joinTokenStore.markTokensAsSent(medium, normalised_address)
+        # Store the association, copy it to the global table and mark any pending
+        # invites as sent in a single transaction.
+        with self.sydent.db.unit_of_work():
+            localAssocStore.addOrUpdateAssociation(assoc)
+
+            # Lookup-only servers don't make binds.
+            assert self.sydent.pusher is not None
+            self.sydent.pusher.doLocalPush()
+
+            joinTokenStore = JoinTokenStore(self.sydent)
+            pendingJoinTokens = joinTokenStore.getTokens(medium, normalised_address)
+            invites = []
+            # Widen the value type to Any: we're going to set the signed key
+            # to point to a dict, but pendingJoinTokens yields Dict[str, str]
+            token: Dict[str, Any]
+            for token in pendingJoinTokens:
+                token["mxid"] = mxid
+                presigned = {
+                    "mxid": mxid,
+                    "token": token["token"],
+                }
+                token["signed"] = signedjson.sign.sign_json(
+                    presigned,
+                    self.sydent.config.general.server_name,
+                    self.sydent.keyring.ed25519,
+                )
+                invites.append(token)
+            if invites:
+                assoc.extra_fields["invites"] = invites
+                joinTokenStore.markTokensAsSent(medium, normalised_address)
 
         signer = Signer(self.sydent)
         sgassoc = signer.signedThreePidAssociation(assoc)
@@ -126,8 +130,11 @@ class ThreepidBinder:
         threepid["address"] = normalise_address(threepid["address"], threepid["medium"])
 
         localAssocStore = LocalAssociationStore(self.sydent)
-        localAssocStore.removeAssociation(threepid, mxid)
-        self.sydent.pusher.doLocalPush()
+        with self.sydent.db.unit_of_work():
+            localAssocStore.removeAssociation(threepid, mxid)
+            # Lookup-only servers don't remove binds.
+            assert self.sydent.pusher is not None
+            self.sydent.pusher.doLocalPush()
 
     async def _notify(self, assoc: Dict[str, Any], attempt: int) -> None:
         """
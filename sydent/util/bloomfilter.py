@@ -0,0 +1,66 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+import hashlib
+import math
+
+
+class BloomFilter:
+    """A set of strings which can tell for sure that a string isn't in it, but may
+    wrongly say that it is, with a probability which depends on how full it is.
+    Strings can't be removed from it.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float) -> None:
+        """
+        :param capacity: The number of strings the filter is sized for. More can be
+            added, but the false positive rate then goes up.
+        :param false_positive_rate: The false positive rate to size the filter for,
+            once it holds `capacity` strings.
+        """
+        capacity = max(capacity, 1)
+        # The optimal number of bits and of hash functions for that many strings.
+        num_bits = math.ceil(
+            -capacity * math.log(false_positive_rate) / (math.log(2) ** 2)
+        )
+        self.capacity = capacity
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(round(self.num_bits / capacity * math.log(2)), 1)
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, value: str) -> range:
+        # Derive the positions of the string's bits from two 64-bit hashes (see
+        # Kirsch and Mitzenmacher, "Less Hashing, Same Performance: Building a
+        # Better Bloom Filter"). The positions are those of a range with the second
+        # hash as its step, taken modulo the size of the filter.
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        start = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return range(start, start + step * self.num_hashes, step)
+
+    def add(self, value: str) -> None:
+        bits = self._bits
+        for position in self._positions(value):
+            position %= self.num_bits
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        bits = self._bits
+        for position in self._positions(value):
+            position %= self.num_bits
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self) -> int:
+        """The number of strings added to the filter, including duplicates."""
+        return self.count
+
+    @property
+    def size(self) -> int:
+        """The size of the filter's bit array, in bytes."""
+        return len(self._bits)
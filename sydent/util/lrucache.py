@@ -0,0 +1,108 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+from collections import OrderedDict
+from typing import Generic, Iterable, Tuple, TypeVar, Union
+
+from prometheus_client import Counter, Gauge
+from typing_extensions import Literal
+
+from sydent.util.ttlcache import Sentinel
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+lru_cache_lookups = Counter(
+    "sydent_lru_cache_lookups",
+    "Number of keys looked up in an LRU cache, by whether they were found (hit) or "
+    "not (miss)",
+    labelnames=("cache", "result"),
+)
+lru_cache_evictions = Counter(
+    "sydent_lru_cache_evictions",
+    "Number of entries evicted from an LRU cache to make room for newer ones",
+    labelnames=("cache",),
+)
+lru_cache_size = Gauge(
+    "sydent_lru_cache_size",
+    "Number of entries in an LRU cache",
+    labelnames=("cache",),
+)
+
+
+class LruCache(Generic[K, V]):
+    """A key/value cache holding up to a number of entries, which evicts the least
+    recently used entry to make room for new ones.
+
+    The cache has a version, which is bumped whenever entries are invalidated, so
+    that values fetched while they were can be dropped rather than cached: see
+    `set_many`.
+    """
+
+    def __init__(self, cache_name: str, max_size: int) -> None:
+        """
+        :param cache_name: The name of the cache, for the metrics.
+        :param max_size: The maximum number of entries to hold.
+        """
+        self._name = cache_name
+        self._max_size = max_size
+        self._data: "OrderedDict[K, V]" = OrderedDict()
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K) -> Union[V, Literal[Sentinel.token]]:
+        """Get a value from the cache, marking it as the most recently used.
+
+        :param key: The key to look up.
+
+        :return: The value, or Sentinel.token if it isn't in the cache.
+        """
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            lru_cache_lookups.labels(self._name, "miss").inc()
+            return Sentinel.token
+        lru_cache_lookups.labels(self._name, "hit").inc()
+        return self._data[key]
+
+    def set_many(self, items: Iterable[Tuple[K, V]], version: int) -> None:
+        """Add or update entries, unless the cache has been invalidated since the
+        given version was read.
+
+        :param items: The keys and values of the entries.
+        :param version: The version of the cache when the values started being
+            fetched.
+        """
+        if version != self.version:
+            return
+
+        for key, value in items:
+            self._data[key] = value
+            self._data.move_to_end(key)
+        evictions = len(self._data) - self._max_size
+        for _ in range(max(evictions, 0)):
+            self._data.popitem(last=False)
+        if evictions > 0:
+            lru_cache_evictions.labels(self._name).inc(evictions)
+        lru_cache_size.labels(self._name).set(len(self._data))
+
+    def invalidate(self, keys: Iterable[K]) -> None:
+        """Remove the given keys from the cache, and bump its version.
+
+        :param keys: The keys to remove.
+        """
+        self.version += 1
+        for key in keys:
+            if key in self._data:
+                del self._data[key]
+        lru_cache_size.labels(self._name).set(len(self._data))
+
+    def clear(self) -> None:
+        """Remove every entry from the cache, and bump its version."""
+        self.version += 1
+        self._data.clear()
+        lru_cache_size.labels(self._name).set(0)
@@ -0,0 +1,144 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Iterable,
+    List,
+    Set,
+    TypeVar,
+    Union,
+)
+
+from prometheus_client import Counter
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+single_flight_keys = Counter(
+    "sydent_single_flight_keys",
+    "Number of keys fetched by concurrent requests, by whether they were fetched "
+    "(fetched) or shared the fetch of another request (coalesced)",
+    labelnames=("name", "result"),
+)
+
+
+class SingleFlight(Generic[K, V]):
+    """Shares the results of fetches between concurrent requests for the same keys,
+    so that each key only has one fetch in flight at a time.
+
+    A request for several keys waits for the fetches already in flight for some of
+    them, and fetches the rest itself, in one go.
+    """
+
+    def __init__(self, name: str) -> None:
+        """
+        :param name: The name of the fetches, for the metrics.
+        """
+        self._name = name
+        self._in_flight: Dict[K, _Flight[K, V]] = {}
+
+    async def get_many(
+        self, keys: Iterable[K], fetch: Callable[[List[K]], Awaitable[Dict[K, V]]]
+    ) -> Dict[K, V]:
+        """Fetch the values of the given keys, sharing the fetches in flight.
+
+        :param keys: The keys to fetch.
+        :param fetch: The function to fetch the keys which don't have a fetch in
+            flight with. Keys missing from the dict it returns have no value.
+
+        :return: The values of the keys which have one.
+        """
+        # The keys to wait for, by the fetch in flight for them.
+        joined: Dict[_Flight[K, V], List[K]] = {}
+        missing: List[K] = []
+        seen: Set[K] = set()
+        for key in keys:
+            if key in seen:
+                continue
+            seen.add(key)
+            flight = self._in_flight.get(key)
+            if flight is None:
+                missing.append(key)
+            else:
+                joined.setdefault(flight, []).append(key)
+
+        # Start observing the fetches we share before ours can let them finish.
+        observed = [
+            (flight.observe(), flight_keys) for flight, flight_keys in joined.items()
+        ]
+        single_flight_keys.labels(self._name, "coalesced").inc(len(seen) - len(missing))
+
+        results: Dict[K, V] = {}
+        if missing:
+            single_flight_keys.labels(self._name, "fetched").inc(len(missing))
+            own = _Flight[K, V]()
+            for key in missing:
+                self._in_flight[key] = own
+            try:
+                fetched = await fetch(missing)
+            except Exception:
+                failure = Failure()
+                self._finish(missing, own)
+                own.resolve(failure)
+                # We won't wait for the others.
+                for d, _ in observed:
+                    d.addErrback(lambda f: None)
+                raise
+            self._finish(missing, own)
+            own.resolve(fetched)
+            results.update(fetched)
+
+        for d, flight_keys in observed:
+            shared = await d
+            for key in flight_keys:
+                if key in shared:
+                    results[key] = shared[key]
+
+        return results
+
+    def forget(self, keys: Iterable[K]) -> None:
+        """Stop sharing the fetches in flight for the given keys with later requests,
+        e.g. because their values have changed since the fetches started.
+
+        :param keys: The keys to forget.
+        """
+        for key in keys:
+            self._in_flight.pop(key, None)
+
+    def forget_all(self) -> None:
+        """Stop sharing every fetch in flight with later requests."""
+        self._in_flight.clear()
+
+    def _finish(self, keys: List[K], flight: "_Flight[K, V]") -> None:
+        for key in keys:
+            # Don't drop the fetch which replaced this one if it was forgotten.
+            if self._in_flight.get(key) is flight:
+                del self._in_flight[key]
+
+
+class _Flight(Generic[K, V]):
+    """A fetch in flight, which requests for the same keys can wait for."""
+
+    def __init__(self) -> None:
+        self._observers: List["defer.Deferred[Dict[K, V]]"] = []
+
+    def observe(self) -> "defer.Deferred[Dict[K, V]]":
+        d: "defer.Deferred[Dict[K, V]]" = defer.Deferred()
+        self._observers.append(d)
+        return d
+
+    def resolve(self, result: Union[Dict[K, V], Failure]) -> None:
+        observers, self._observers = self._observers, []
+        for d in observers:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
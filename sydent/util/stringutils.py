@@ -128,3 +128,16 @@ def normalise_address(address: str, medium: str) -> str:
         return address.casefold()
     else:
         return address
+
+
+def normalise_address_for_lookup(address: str) -> str:
+    """Normalise an address for matching it against the addresses of stored
+    associations. Lookups are case-insensitive for every medium, since that's true of
+    all the 3PIDs we currently support (we treat the local part of email addresses as
+    case-insensitive, which is technically incorrect).
+
+    :param address: The address to normalise.
+
+    :return: The normalised address.
+    """
+    return address.casefold()
@@ -51,11 +51,12 @@ class EmailValidator:
         """
         valSessionStore = ThreePidValSessionStore(self.sydent)
 
-        valSession, token_info = valSessionStore.getOrCreateTokenSession(
-            medium="email", address=emailAddress, clientSecret=clientSecret
-        )
+        with self.sydent.db.unit_of_work():
+            valSession, token_info = valSessionStore.getOrCreateTokenSession(
+                medium="email", address=emailAddress, clientSecret=clientSecret
+            )
 
-        valSessionStore.setMtime(valSession.id, time_msec())
+            valSessionStore.setMtime(valSession.id, time_msec())
 
         # self.sydent.config.email.template is deprecated
         if self.sydent.config.email.template is None:
@@ -62,11 +62,12 @@ class MsisdnValidator:
             phoneNumber, phonenumbers.PhoneNumberFormat.E164
         )[1:]
 
-        valSession, token_info = valSessionStore.getOrCreateTokenSession(
-            medium="msisdn", address=msisdn, clientSecret=clientSecret
-        )
+        with self.sydent.db.unit_of_work():
+            valSession, token_info = valSessionStore.getOrCreateTokenSession(
+                medium="msisdn", address=msisdn, clientSecret=clientSecret
+            )
 
-        valSessionStore.setMtime(valSession.id, time_msec())
+            valSessionStore.setMtime(valSession.id, time_msec())
 
         if token_info.send_attempt_number >= send_attempt:
             logger.info(
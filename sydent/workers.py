@@ -0,0 +1,214 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+"""Serving the client API from several processes.
+
+When clientapi.http.workers is set, the main Sydent process (the writer) binds the
+client API's listening socket itself but doesn't accept connections on it. Instead,
+it starts that many worker processes, which inherit the socket and share the
+connections between them. Workers serve the lookup, hash details, public key and
+terms endpoints themselves, and forward every other request to the writer over a
+UNIX socket only the writer's user can reach, so that everything which writes to the
+database (binds, validation sessions, replication, pushing to peers and background
+work) happens in the writer. The writer restarts workers which exit.
+
+Workers only learn about the changes made by the writer through the database, so
+they don't use the lookup hash index or Bloom filter, which are kept in step with
+the changes made by the process holding them, but can use the lookup snapshot.
+"""
+
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import attr
+from twisted.internet import abstract, defer
+from twisted.internet.interfaces import IListeningPort, IProcessTransport
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python.failure import Failure
+from twisted.web.server import Site
+
+from sydent.http.httpcommon import SizeLimitingRequest
+
+if TYPE_CHECKING:
+    from sydent.sydent import Sydent
+
+logger = logging.getLogger(__name__)
+
+# How often workers check the database for changes made by the writer which affect
+# them, in seconds.
+WORKER_POLL_INTERVAL = 1.0
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class WorkerOptions:
+    """What a worker process is told by the writer when it's started."""
+
+    # The index of the worker, from 0.
+    index: int
+    # The file descriptor of the client API's listening socket, and its address
+    # family.
+    listen_fd: int
+    listen_family: int
+    # The path of the UNIX socket to forward requests to the writer through.
+    writer_socket: str
+
+
+def bind_client_socket(interface: str, port: int) -> socket.socket:
+    """Bind the client API's listening socket, without accepting connections on it.
+
+    :param interface: The address to listen on.
+    :param port: The port to listen on.
+
+    :return: The listening socket.
+    """
+    # Pick the address family the same way listenTCP does.
+    family = socket.AF_INET6 if abstract.isIPv6Address(interface) else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(50)
+    # The workers' reactors expect the socket they adopt to be non-blocking, and
+    # inheriting it keeps the flag.
+    sock.setblocking(False)
+    return sock
+
+
+class ForwardedRequest(SizeLimitingRequest):
+    """A request forwarded by a worker to the writer, with the IP address of the
+    client in its X-Forwarded-For header.
+    """
+
+
+class WorkerSupervisor:
+    """Starts the worker processes, restarts them when they exit, and stops them when
+    Sydent shuts down.
+    """
+
+    # How long to wait before restarting a worker which has exited, in seconds.
+    RESTART_DELAY = 1.0
+
+    def __init__(self, sydent: "Sydent", listen_socket: socket.socket) -> None:
+        self.sydent = sydent
+        self._socket = listen_socket
+        self._processes: Dict[int, IProcessTransport] = {}
+        self._exited: Dict[int, "defer.Deferred[None]"] = {}
+        self._stopping = False
+        self._socket_dir: Optional[str] = None
+        self._writer_port: Optional[IListeningPort] = None
+        self.writer_socket: Optional[str] = None
+
+    def start(self, num_workers: int) -> None:
+        """Listen for requests forwarded by the workers, and start them.
+
+        :param num_workers: The number of workers to start.
+        """
+        # Only the user Sydent runs as can reach the socket.
+        self._socket_dir = tempfile.mkdtemp(prefix="sydent-")
+        self.writer_socket = os.path.join(self._socket_dir, "writer.sock")
+        factory = Site(self.sydent.clientApiHttpServer.root, ForwardedRequest)
+        factory.displayTracebacks = False
+        self._writer_port = self.sydent.reactor.listenUNIX(
+            self.writer_socket,
+            factory,
+            backlog=50,  # taken from PosixReactorBase.listenUNIX
+            mode=0o600,
+            wantPID=False,
+        )
+
+        self.sydent.reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+        for index in range(num_workers):
+            self._spawn(index)
+
+    def _spawn(self, index: int) -> None:
+        if self._stopping:
+            return
+        assert self.writer_socket is not None
+
+        fd = self._socket.fileno()
+        args: List[str] = [
+            sys.executable,
+            "-m",
+            "sydent.sydent",
+            "--worker-index",
+            str(index),
+            "--worker-listen-fd",
+            str(fd),
+            "--worker-listen-family",
+            str(int(self._socket.family)),
+            "--worker-writer-socket",
+            self.writer_socket,
+        ]
+        logger.info("Starting client API worker %d", index)
+        self._exited[index] = defer.Deferred()
+        self._processes[index] = self.sydent.reactor.spawnProcess(
+            _WorkerProcessProtocol(self, index),
+            sys.executable,
+            args,
+            env=os.environ.copy(),
+            # Type safety: the interface doesn't say so, but None keeps the working
+            # directory and user of this process, as the implementations do by
+            # default. Passing our own uid would make them try to switch user.
+            path=None,  # type: ignore[arg-type]
+            uid=None,  # type: ignore[arg-type]
+            gid=None,  # type: ignore[arg-type]
+            usePTY=False,
+            childFDs={0: 0, 1: 1, 2: 2, fd: fd},
+        )
+
+    def _worker_exited(self, index: int, reason: Failure) -> None:
+        self._processes.pop(index, None)
+        exited = self._exited.pop(index, None)
+        if exited is not None:
+            exited.callback(None)
+        if self._stopping:
+            return
+
+        logger.warning(
+            "Client API worker %d exited (%s), restarting it",
+            index,
+            reason.getErrorMessage(),
+        )
+        self.sydent.reactor.callLater(self.RESTART_DELAY, self._spawn, index)
+
+    def stop(self) -> "defer.Deferred[object]":
+        """Stop the workers.
+
+        :return: A Deferred which resolves once they have all exited.
+        """
+        self._stopping = True
+        for index, process in list(self._processes.items()):
+            try:
+                process.signalProcess("TERM")
+            except Exception:
+                logger.exception("Failed to stop client API worker %d", index)
+
+        exited = defer.DeferredList(list(self._exited.values()))
+        return exited.addBoth(self._stop_listening).addBoth(self._cleanup)
+
+    def _stop_listening(self, result: object) -> object:
+        self._socket.close()
+        if self._writer_port is None:
+            return result
+        # Stop listening on the writer's socket before its directory is removed.
+        return self._writer_port.stopListening()
+
+    def _cleanup(self, result: object) -> object:
+        if self._socket_dir is not None:
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
+        return result
+
+
+class _WorkerProcessProtocol(ProcessProtocol):
+    def __init__(self, supervisor: WorkerSupervisor, index: int) -> None:
+        self._supervisor = supervisor
+        self._index = index
+
+    def processEnded(self, reason: Failure) -> None:
+        self._supervisor._worker_exited(self._index, reason)
@@ -0,0 +1,114 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+from typing import List, Optional, Tuple
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from sydent.db.background_updates import BackgroundUpdater, schedule_background_update
+from sydent.db.transaction import Cursor
+from sydent.types import JsonDict
+from tests.utils import make_sydent
+
+
+class BackgroundUpdaterTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.sydent = make_sydent()
+        # The (update name, progress, batch size) each handler was called with.
+        self.calls: List[Tuple[str, JsonDict, int]] = []
+
+        cur = self.sydent.db.cursor()
+        schedule_background_update(cur, "second", 2)
+        schedule_background_update(cur, "first", 1)
+        self.sydent.db.commit()
+
+    def _make_handler(self, update_name: str, total: int):  # type: ignore[no-untyped-def]
+        """Make a handler which processes the given number of items in total."""
+
+        def handler(
+            cur: Cursor, progress: JsonDict, batch_size: int
+        ) -> Tuple[int, Optional[JsonDict]]:
+            self.calls.append((update_name, progress, batch_size))
+            done = progress.get("done", 0)
+            items = min(batch_size, total - done)
+            if done + items == total:
+                return items, None
+            return items, {"done": done + items}
+
+        return handler
+
+    def _make_updater(self) -> BackgroundUpdater:
+        updater = BackgroundUpdater(
+            self.sydent,
+            {
+                "first": self._make_handler("first", 250),
+                "second": self._make_handler("second", 10),
+            },
+        )
+        # Don't let the batch size depend on how fast the test runs.
+        updater.BATCH_DURATION_MS = 0
+        return updater
+
+    def test_run_in_order(self) -> None:
+        """Tests that updates are run in batches, in order, until they've finished."""
+        updater = self._make_updater()
+        self.assertFalse(updater.has_completed_update("first"))
+
+        self.successResultOf(defer.ensureDeferred(updater.run_updates(sleep=False)))
+
+        self.assertEqual(
+            self.calls,
+            [
+                ("first", {}, 100),
+                ("first", {"done": 100}, 100),
+                ("first", {"done": 200}, 100),
+                ("second", {}, 100),
+            ],
+        )
+        self.assertTrue(updater.has_completed_all_updates())
+
+        # The updates shouldn't be run again.
+        self.assertTrue(self._make_updater().has_completed_all_updates())
+
+    def test_resume(self) -> None:
+        """Tests that an interrupted update resumes from the progress it stored."""
+        updater = self._make_updater()
+        self.successResultOf(defer.ensureDeferred(updater.do_next_batch()))
+
+        updater = self._make_updater()
+        self.assertFalse(updater.has_completed_update("first"))
+        self.successResultOf(defer.ensureDeferred(updater.do_next_batch()))
+
+        self.assertEqual(
+            self.calls, [("first", {}, 100), ("first", {"done": 100}, 100)]
+        )
+
+    def test_unknown_update(self) -> None:
+        """Tests that Sydent refuses to start with an update it doesn't know."""
+        self.assertRaises(Exception, BackgroundUpdater, self.sydent, {})
+
+    def test_refresh(self) -> None:
+        """Tests that a process which doesn't run the updates picks up the ones
+        another process has finished.
+        """
+        updater = self._make_updater()
+        finished: List[str] = []
+        updater.add_completion_callback("first", lambda: finished.append("first"))
+        updater.add_completion_callback("second", lambda: finished.append("second"))
+
+        # Run the first update from another process.
+        other = self._make_updater()
+        while not other.has_completed_update("first"):
+            self.successResultOf(defer.ensureDeferred(other.do_next_batch()))
+
+        updater.refresh()
+        self.assertEqual(finished, ["first"])
+        self.assertTrue(updater.has_completed_update("first"))
+        self.assertFalse(updater.has_completed_update("second"))
+
+        # Nothing's changed.
+        updater.refresh()
+        self.assertEqual(finished, ["first"])
@@ -0,0 +1,180 @@
+import sqlite3
+import threading
+from unittest.mock import Mock
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+
+from sydent.config import SydentConfig
+from sydent.db.engines import Sqlite3Engine
+from sydent.db.pool import DatabasePool
+from sydent.db.threepid_associations import GlobalAssociationStore
+from sydent.db.valsession import ThreePidValSessionStore
+from sydent.threepid import ThreepidAssociation
+from tests.utils import USE_POSTGRES_FOR_TESTS, make_sydent
+
+
+class DatabasePoolTestCase(unittest.TestCase):
+    """Tests that the database pool runs interactions off the reactor thread."""
+
+    def setUp(self):
+        db_path = self.mktemp() + ".db"
+        config = SydentConfig()
+        config.parse_config_dict(
+            {"db": {"db.file": db_path, "db.journal_mode": "wal", "db.mmap_size": "0"}}
+        )
+
+        engine = Sqlite3Engine(config.database)
+        self.db = engine.connect()
+        self.db.execute("CREATE TABLE things (id INTEGER PRIMARY KEY, name TEXT)")
+        self.db.execute("INSERT INTO things (name) VALUES ('apple')")
+        self.db.commit()
+        self.addCleanup(self.db.close)
+
+        self.sydent = Mock()
+        self.sydent.config = config
+        self.sydent.db_engine = engine
+        self.sydent.db = self.db
+        self.sydent.reactor = reactor
+
+        self.pool = DatabasePool(self.sydent, "test", 2)
+        self.addCleanup(self.pool.stop)
+
+    @staticmethod
+    def _read_names(cur):
+        cur.execute("SELECT name FROM things ORDER BY id")
+        return [row[0] for row in cur.fetchall()], threading.get_ident()
+
+    def test_inline_before_start(self):
+        """Interactions run synchronously on the main connection until the pool is
+        started.
+        """
+        d = self.pool.runInteraction("read_names", self._read_names)
+        names, thread_id = self.successResultOf(d)
+
+        self.assertEqual(names, ["apple"])
+        self.assertEqual(thread_id, threading.get_ident())
+
+    @defer.inlineCallbacks
+    def test_runs_on_thread(self):
+        """Once started, interactions run on a separate thread with their own
+        connection, and see data committed by the main connection.
+        """
+        self.pool.start()
+
+        self.db.execute("INSERT INTO things (name) VALUES ('banana')")
+        self.db.commit()
+
+        names, thread_id = yield self.pool.runInteraction(
+            "read_names", self._read_names
+        )
+
+        self.assertEqual(names, ["apple", "banana"])
+        self.assertNotEqual(thread_id, threading.get_ident())
+
+    @defer.inlineCallbacks
+    def test_rollback_on_failure(self):
+        """An interaction that raises has its changes rolled back, and the failure
+        is propagated to the caller.
+        """
+        self.pool.start()
+
+        def insert_then_fail(cur):
+            cur.execute("INSERT INTO things (name) VALUES ('cherry')")
+            raise RuntimeError("oh no")
+
+        with self.assertRaises(RuntimeError):
+            yield self.pool.runInteraction("insert_then_fail", insert_then_fail)
+
+        names, _ = yield self.pool.runInteraction("read_names", self._read_names)
+        self.assertEqual(names, ["apple"])
+
+    @defer.inlineCallbacks
+    def test_read_only(self):
+        """Connections in a read-only pool can't write to the database, but can still
+        use temporary tables.
+        """
+        pool = DatabasePool(self.sydent, "test-ro", 1, read_only=True)
+        self.addCleanup(pool.stop)
+        pool.start()
+
+        def use_temp_table(cur):
+            cur.execute("CREATE TEMPORARY TABLE tmp_names (name TEXT)")
+            cur.execute("INSERT INTO tmp_names (name) VALUES ('apple')")
+            cur.execute("SELECT things.name FROM things JOIN tmp_names USING (name)")
+            rows = cur.fetchall()
+            cur.execute("DROP TABLE tmp_names")
+            return rows
+
+        rows = yield pool.runInteraction("use_temp_table", use_temp_table)
+        self.assertEqual(rows, [("apple",)])
+
+        def write(cur):
+            cur.execute("INSERT INTO things (name) VALUES ('banana')")
+
+        with self.assertRaises(sqlite3.OperationalError):
+            yield pool.runInteraction("write", write)
+
+    def test_memory_database_never_uses_threads(self):
+        """In-memory databases can't be shared between connections, so interactions
+        on them always run on the main connection.
+        """
+        self.sydent.config.database.database_path = ":memory:"
+        pool = DatabasePool(self.sydent, "test-memory", 2)
+        pool.start()
+
+        d = pool.runInteraction("read_names", self._read_names)
+        _, thread_id = self.successResultOf(d)
+        self.assertEqual(thread_id, threading.get_ident())
+
+
+class ThreadedSydentTestCase(unittest.TestCase):
+    """Tests Sydent's database pools with a database file and the default pool
+    sizes, which is the only configuration in which they run interactions on threads.
+    """
+
+    if USE_POSTGRES_FOR_TESTS:
+        skip = "The PostgreSQL tests run every interaction on the main connection"
+
+    def setUp(self):
+        self.sydent = make_sydent({"db": {"db.file": self.mktemp() + ".db"}})
+        self.addCleanup(self.sydent.db.close)
+        # The fake reactor never delivers the results of the pools' threads.
+        self.sydent.reactor = reactor
+        for pool in (self.sydent.db_pool, self.sydent.lookup_db_pool):
+            pool.start()
+            self.addCleanup(pool.stop)
+
+    @defer.inlineCallbacks
+    def test_lookup_on_thread(self):
+        """Lookups run on the lookup pool's threads, and see the associations
+        committed by the main connection.
+        """
+        store = GlobalAssociationStore(self.sydent)
+        assoc = ThreepidAssociation(
+            medium="email",
+            address="bob@example.com",
+            lookup_hash=None,
+            mxid="@bob:example.com",
+            ts=1000,
+            not_before=0,
+            not_after=99999999999999,
+        )
+        store.addAssociation(assoc, "{}", "example.com", 1)
+
+        mxid = yield defer.ensureDeferred(store.getMxid("email", "bob@example.com"))
+
+        self.assertEqual(mxid, "@bob:example.com")
+        self.assertEqual(len(self.sydent.lookup_db_pool._connections), 1)
+
+    def test_delete_old_sessions_on_main_connection(self):
+        """Cleaning up old validation sessions writes on the main connection, rather
+        than contending with it for the write lock from a pool thread.
+        """
+        store = ThreePidValSessionStore(self.sydent)
+        sid = store.addValSession("email", "bob@example.com", "secret", 0)
+
+        store.deleteOldSessions()
+
+        self.assertIsNone(store.getSessionById(sid))
+        self.assertEqual(self.sydent.db_pool._connections, [])
@@ -0,0 +1,158 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+import json
+from typing import List
+from unittest.mock import patch
+
+import signedjson.sign
+from twisted.trial import unittest
+
+from sydent.db.threepid_associations import GlobalAssociationStore
+from sydent.http.servlets import StreamingJsonResponse
+from sydent.threepid import ThreepidAssociation
+from sydent.threepid.signer import Signer
+from tests.utils import FakeChannel, make_request, make_sydent
+
+
+class LookupResponseCacheTestCase(unittest.TestCase):
+    """Tests for the cache of v1 lookup responses."""
+
+    def setUp(self) -> None:
+        self.sydent = make_sydent()
+        self.sydent.run()
+
+        # An association replicated from a peer, which we countersign.
+        sender = make_sydent(
+            {
+                "general": {"server.name": "fake.server"},
+                "crypto": {
+                    "ed25519.signingkey": "ed25519 0 b29eXMMAYCFvFEtq9mLI42aivMtcg4Hl0wK89a+Vb6c"
+                },
+            }
+        )
+        assoc = ThreepidAssociation(
+            medium="email",
+            address="bob@example.com",
+            lookup_hash=None,
+            mxid="@bob:example.com",
+            ts=10000,
+            not_before=0,
+            not_after=99999999999999,
+        )
+        GlobalAssociationStore(self.sydent).addAssociation(
+            assoc,
+            json.dumps(Signer(sender).signedThreePidAssociation(assoc)),
+            "fake.server",
+            1,
+        )
+
+    def _lookup(self):
+        _, channel = make_request(
+            self.sydent.reactor,
+            self.sydent.clientApiHttpServer.factory,
+            "GET",
+            "/_matrix/identity/api/v1/lookup?medium=email&address=bob@example.com",
+        )
+        self.assertEqual(channel.code, 200)
+        return channel.json_body
+
+    def test_sign_once(self) -> None:
+        """Tests that replicated associations are only countersigned the first time
+        they are looked up.
+        """
+        with patch(
+            "signedjson.sign.sign_json", side_effect=signedjson.sign.sign_json
+        ) as sign_json:
+            first = self._lookup()
+            second = self._lookup()
+
+        self.assertEqual(sign_json.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(first["mxid"], "@bob:example.com")
+        self.assertIn(self.sydent.config.general.server_name, first["signatures"])
+        self.assertIn("fake.server", first["signatures"])
+
+
+class StreamingLookupTestCase(unittest.TestCase):
+    """Tests for the bulk lookups whose responses are streamed."""
+
+    def setUp(self) -> None:
+        self.sydent = make_sydent()
+        self.sydent.run()
+
+        store = GlobalAssociationStore(self.sydent)
+        for i in range(100):
+            store.addAssociation(
+                ThreepidAssociation(
+                    medium="email",
+                    address="user%d@example.com" % (i,),
+                    lookup_hash=None,
+                    mxid="@user%d:example.com" % (i,),
+                    ts=10000,
+                    not_before=0,
+                    not_after=99999999999999,
+                ),
+                "{}",
+                "fake.server",
+                i,
+            )
+
+    def _bulk_lookup(self) -> FakeChannel:
+        _, channel = make_request(
+            self.sydent.reactor,
+            self.sydent.clientApiHttpServer.factory,
+            "POST",
+            "/_matrix/identity/api/v1/bulk_lookup",
+            {"threepids": [["email", "user%d@example.com" % (i,)] for i in range(101)]},
+        )
+        return channel
+
+    def _expected_threepids(self) -> List[List[str]]:
+        return sorted(
+            ["email", "user%d@example.com" % (i,), "@user%d:example.com" % (i,)]
+            for i in range(100)
+        )
+
+    @patch("sydent.http.servlets.StreamingJsonResponse.STREAMING_THRESHOLD", 50)
+    @patch("sydent.http.servlets._JsonProducer.CHUNK_SIZE", 100)
+    def test_bulk_lookup(self) -> None:
+        """Tests that large bulk lookup responses are written in several chunks,
+        which add up to the whole response.
+        """
+        channel = self._bulk_lookup()
+        self.assertNotIn("done", channel.result)
+        self.sydent.reactor.advance(0)
+        self.assertNotIn("done", channel.result)
+        for _ in range(200):
+            self.sydent.reactor.advance(0.1)
+
+        self.assertTrue(channel.result["done"])
+        self.assertEqual(channel.code, 200)
+        self.assertEqual(channel.json_body["threepids"], self._expected_threepids())
+
+    @patch("sydent.http.servlets._JsonProducer.CHUNK_SIZE", 100)
+    def test_small_bulk_lookup(self) -> None:
+        """Tests that small bulk lookup responses are written in one go."""
+        channel = self._bulk_lookup()
+        self.sydent.reactor.advance(0)
+
+        self.assertTrue(channel.result["done"])
+        self.assertEqual(channel.code, 200)
+        self.assertEqual(channel.json_body["threepids"], self._expected_threepids())
+
+    def test_iterencode(self) -> None:
+        """Tests that streamed responses are encoded the same way as others."""
+        for items in (
+            [["email", "élodie@example.com", "@elodie:example.com"], [1, None]],
+            {"hash1": "@a:example.com", 'quo"te': "@b:example.com"},
+            [],
+            {},
+        ):
+            response = StreamingJsonResponse("results", items)
+            self.assertEqual(
+                "".join(response.iterencode()).encode("UTF-8"),
+                response.to_json_bytes(),
+            )
@@ -0,0 +1,113 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+from twisted.trial import unittest
+
+from sydent.threepid import ThreepidAssociation
+from sydent.threepid.signer import Signer
+from tests.utils import make_request, make_sydent
+
+
+class LookupOnlyTestCase(unittest.TestCase):
+    """Tests for servers configured with general.lookup_only."""
+
+    def setUp(self) -> None:
+        self.sydent = make_sydent({"general": {"lookup_only": "true"}})
+        self.sydent.run()
+
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "INSERT INTO peers (name, port, lastSentVersion, active) VALUES (?, ?, ?, ?)",
+            ("fake.server", 1234, 0, 1),
+        )
+        cur.execute(
+            "INSERT INTO peer_pubkeys (peername, alg, key) VALUES (?, ?, ?)",
+            ("fake.server", "ed25519", "+vB8mTaooD/MA8YYZM8t9+vnGhP1937q2icrqPV9JTs"),
+        )
+        self.sydent.db.commit()
+
+    def test_no_validation(self) -> None:
+        """Tests that lookup-only servers don't set up what they won't use."""
+        self.assertIsNone(self.sydent.validators)
+        self.assertIsNone(self.sydent.pusher)
+
+    def test_serve_replicated_lookups(self) -> None:
+        """Tests that lookup-only servers serve lookups for the associations pushed
+        to them by their peers.
+        """
+        sender = make_sydent(
+            {
+                "general": {"server.name": "fake.server"},
+                "crypto": {
+                    "ed25519.signingkey": "ed25519 0 b29eXMMAYCFvFEtq9mLI42aivMtcg4Hl0wK89a+Vb6c"
+                },
+            }
+        )
+        assoc = ThreepidAssociation(
+            medium="email",
+            address="bob@example.com",
+            lookup_hash=None,
+            mxid="@bob:example.com",
+            ts=10000,
+            not_before=0,
+            not_after=99999999999999,
+        )
+        signed_assoc = Signer(sender).signedThreePidAssociation(assoc)
+
+        _, channel = make_request(
+            self.sydent.reactor,
+            self.sydent.replicationHttpsServer.factory,
+            "POST",
+            "/_matrix/identity/replicate/v1/push",
+            {"sgAssocs": {"1": signed_assoc}},
+        )
+        self.assertEqual(channel.code, 200)
+
+        _, channel = make_request(
+            self.sydent.reactor,
+            self.sydent.clientApiHttpServer.factory,
+            "GET",
+            "/_matrix/identity/api/v1/lookup?medium=email&address=bob@example.com",
+        )
+        self.assertEqual(channel.code, 200)
+        self.assertEqual(channel.json_body["mxid"], "@bob:example.com")
+
+    def test_refuse_writes(self) -> None:
+        """Tests that lookup-only servers refuse the endpoints which would write to
+        the database, but still serve the terms and public keys.
+        """
+        site = self.sydent.clientApiHttpServer.factory
+        for path in (
+            "validate/email/requestToken",
+            "3pid/bind",
+            "account/register",
+            "terms",
+        ):
+            _, channel = make_request(self.sydent.reactor, site, "POST", path, {})
+            self.assertEqual(channel.code, 403, path)
+            self.assertEqual(channel.json_body["errcode"], "M_FORBIDDEN", path)
+
+        _, channel = make_request(self.sydent.reactor, site, "GET", "terms")
+        self.assertEqual(channel.code, 200)
+        _, channel = make_request(self.sydent.reactor, site, "GET", "pubkey/ed25519:0")
+        self.assertEqual(channel.code, 200)
+
+    def test_refuse_internal_writes(self) -> None:
+        """Tests that lookup-only servers refuse the internal API's write endpoints."""
+        sydent = make_sydent(
+            {
+                "general": {"lookup_only": "true"},
+                "http": {"internalapi.http.port": "8091"},
+            }
+        )
+        sydent.run()
+
+        site = sydent.internalApiHttpServer.factory
+        for path in ("bind", "unbind", "rotate_lookup_pepper"):
+            _, channel = make_request(
+                sydent.reactor, site, "POST", "/_matrix/identity/internal/" + path, {}
+            )
+            self.assertEqual(channel.code, 403, path)
+            self.assertEqual(channel.json_body["errcode"], "M_FORBIDDEN", path)
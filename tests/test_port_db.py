@@ -0,0 +1,81 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+import sqlite3
+
+from twisted.trial import unittest
+
+from scripts.port_db import port_db
+from tests.utils import USE_POSTGRES_FOR_TESTS, make_sydent
+
+
+class PortDbTestCase(unittest.TestCase):
+    if not USE_POSTGRES_FOR_TESTS:
+        skip = "Requires PostgreSQL (set SYDENT_POSTGRES)"
+
+    def setUp(self) -> None:
+        # Create a SQLite database with the current schema, and fill it in.
+        self.sqlite_path = self.mktemp()
+        sqlite_sydent = make_sydent(
+            {"db": {"db.engine": "sqlite", "db.file": self.sqlite_path}}
+        )
+        cur = sqlite_sydent.db.cursor()
+        cur.execute(
+            "INSERT INTO local_threepid_associations "
+            "(medium, address, mxid, ts, notBefore, notAfter, lookup_hash) "
+            "VALUES ('email', 'bob@example.com', '@bob:example.com', 1, 1, 2, 'h')"
+        )
+        cur.execute(
+            "INSERT INTO threepid_validation_sessions "
+            "(id, medium, address, clientSecret, validated, mtime) "
+            "VALUES (42, 'email', 'bob@example.com', 'secret', 1, 1)"
+        )
+        cur.execute(
+            "INSERT INTO accepted_terms_urls (user_id, url) "
+            "VALUES ('@bob:example.com', 'https://example.com/terms')"
+        )
+        sqlite_sydent.db.commit()
+        sqlite_sydent.db.close()
+
+        self.source = sqlite3.connect(self.sqlite_path)
+        self.sydent = make_sydent()
+
+    def tearDown(self) -> None:
+        self.source.close()
+
+    def test_port(self) -> None:
+        """Tests that the contents of the SQLite database are copied to PostgreSQL,
+        and that Sydent can keep adding rows afterwards.
+        """
+        port_db(self.source, self.sydent.db)
+
+        cur = self.sydent.db.cursor()
+        cur.execute("SELECT address, mxid FROM local_threepid_associations")
+        self.assertEqual(cur.fetchall(), [("bob@example.com", "@bob:example.com")])
+        cur.execute("SELECT id, validated FROM threepid_validation_sessions")
+        self.assertEqual(cur.fetchall(), [(42, True)])
+        cur.execute("SELECT user_id, url FROM accepted_terms_urls")
+        self.assertEqual(
+            cur.fetchall(), [("@bob:example.com", "https://example.com/terms")]
+        )
+
+        # The sequence generating IDs must have been moved past the copied rows.
+        cur.execute(
+            "INSERT INTO local_threepid_associations "
+            "(medium, address, mxid, ts, notBefore, notAfter) "
+            "VALUES ('email', 'alice@example.com', '@alice:example.com', 1, 1, 2)"
+        )
+        self.sydent.db.commit()
+
+    def test_refuses_non_empty_target(self) -> None:
+        """Tests that the database isn't ported into a PostgreSQL database which
+        already has data in it.
+        """
+        self.sydent.db.execute(
+            "INSERT INTO accounts (user_id, created_ts) VALUES ('@a:example.com', 1)"
+        )
+        self.sydent.db.commit()
+
+        self.assertRaises(RuntimeError, port_db, self.source, self.sydent.db)
@@ -1,10 +1,19 @@
 import json
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
+import signedjson.key
+import signedjson.sign
+from canonicaljson import encode_canonical_json
+from signedjson.sign import SignatureVerifyException
 from twisted.internet import defer
 from twisted.trial import unittest
 from twisted.web.client import Response
+from twisted.web.http_headers import Headers
 
+from sydent.db.threepid_associations import LocalAssociationStore
+from sydent.replication.peer import MAX_RETRY_AFTER, RemotePeer, _parse_retry_after
+from sydent.replication.pusher import PUSH_DELAY, RETRY_INTERVAL
+from sydent.replication.registry import PeerRegistry
 from sydent.threepid import ThreepidAssociation
 from sydent.threepid.signer import Signer
 from tests.utils import make_request, make_sydent
@@ -103,6 +112,106 @@ class ReplicationTestCase(unittest.TestCase):
         for assoc_id, signed_assoc in signed_assocs.items():
             self.assertDictEqual(signed_assoc, res_assocs[assoc_id])
 
+    def _peer_signer(self):
+        """Make a signer signing associations as the fake peer."""
+        config = {
+            "general": {"server.name": "fake.server"},
+            "crypto": {
+                "ed25519.signingkey": "ed25519 0 b29eXMMAYCFvFEtq9mLI42aivMtcg4Hl0wK89a+Vb6c"
+            },
+        }
+        return Signer(make_sydent(config))
+
+    def _push_from_peer(self, body):
+        _, channel = make_request(
+            self.sydent.reactor,
+            self.sydent.replicationHttpsServer.factory,
+            "POST",
+            "/_matrix/identity/replicate/v1/push",
+            body,
+        )
+        return channel
+
+    def _stored_associations(self):
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT originId, mxid, sgAssoc FROM global_threepid_associations"
+        )
+        return {row[0]: (row[1], row[2]) for row in res.fetchall()}
+
+    def test_incoming_replication_in_order(self):
+        """Tests that the additions and deletions in a push are applied in order, and
+        that the signed associations are stored as canonical JSON.
+        """
+        self.sydent.run()
+        signer = self._peer_signer()
+
+        deletion = ThreepidAssociation(
+            medium="email",
+            address=self.assocs[0].address,
+            lookup_hash=None,
+            mxid=None,
+            ts=10**6,
+            not_before=None,
+            not_after=None,
+        )
+        sg_assocs = [
+            signer.signedThreePidAssociation(self.assocs[0]),
+            signer.signedThreePidAssociation(deletion),
+            signer.signedThreePidAssociation(self.assocs[1]),
+        ]
+        channel = self._push_from_peer(
+            {"sgAssocs": {str(i): a for i, a in enumerate(sg_assocs)}}
+        )
+        self.assertEqual(channel.code, 200)
+
+        self.assertEqual(
+            self._stored_associations(),
+            {2: (self.assocs[1].mxid, encode_canonical_json(sg_assocs[2]).decode())},
+        )
+        cur = self.sydent.db.cursor()
+        res = cur.execute(
+            "SELECT normalised_address, mxid FROM global_threepid_current_mappings"
+        )
+        self.assertEqual(
+            res.fetchall(), [(self.assocs[1].address, self.assocs[1].mxid)]
+        )
+
+    def test_incoming_replication_atomic(self):
+        """Tests that nothing in a push is stored if an association in it doesn't
+        verify, including deletions.
+        """
+        self.sydent.run()
+        signer = self._peer_signer()
+
+        sg_assoc = signer.signedThreePidAssociation(self.assocs[0])
+        channel = self._push_from_peer({"sgAssocs": {"0": sg_assoc}})
+        self.assertEqual(channel.code, 200)
+
+        deletion = ThreepidAssociation(
+            medium="email",
+            address=self.assocs[0].address,
+            lookup_hash=None,
+            mxid=None,
+            ts=10**6,
+            not_before=None,
+            not_after=None,
+        )
+        forged = signer.signedThreePidAssociation(self.assocs[1])
+        forged["mxid"] = "@mallory:example.com"
+        channel = self._push_from_peer(
+            {
+                "sgAssocs": {
+                    "1": signer.signedThreePidAssociation(deletion),
+                    "2": forged,
+                }
+            }
+        )
+        self.assertEqual(channel.code, 400)
+        self.assertEqual(channel.json_body["failed_ids"], ["2"])
+        self.assertEqual(list(self._stored_associations()), [0])
+        self.assertEqual(len(self.flushLoggedErrors(SignatureVerifyException)), 1)
+
     def test_outgoing_replication(self):
         """Make a fake peer and associations and make sure Sydent tries to push to it."""
         cur = self.sydent.db.cursor()
@@ -189,3 +298,379 @@ class ReplicationTestCase(unittest.TestCase):
             # will push will be 1, so we need to subtract 1 when figuring out which index
             # to lookup.
             self.assertDictEqual(assoc, signed_assocs[int(assoc_id) - 1])
+
+    def _mock_agent(self, sent_assocs, failures=0):
+        """Mock the replication client's agent, so that it records the associations
+        it is asked to push, after failing to connect the given number of times.
+        """
+
+        def request(method, uri, headers, body):
+            nonlocal failures
+            if failures > 0:
+                failures -= 1
+                return defer.fail(ConnectionRefusedError())
+            payload = json.loads(body._inputFile.read().decode("utf8"))
+            sent_assocs.update(payload["sgAssocs"])
+            return defer.succeed(Response((b"HTTP", 1, 1), 200, b"OK", None, None))
+
+        agent = Mock(spec=["request"])
+        agent.request.side_effect = request
+        self.sydent.replicationHttpsClient.agent = agent
+        return agent
+
+    def _error_response(self, code, body, headers=None):
+        """Build a response to a push with the given status code and JSON body."""
+        response = Response(
+            (b"HTTP", 1, 1), code, b"Error", Headers(headers or {}), None
+        )
+        response._bodyDataReceived(json.dumps(body).encode("utf8"))
+        response._bodyDataFinished()
+        return response
+
+    def _bind(self, assoc):
+        with self.sydent.db.unit_of_work():
+            LocalAssociationStore(self.sydent).addOrUpdateAssociation(assoc)
+            self.sydent.pusher.doLocalPush()
+
+    def test_push_on_write(self):
+        """Tests that new associations are pushed straight away, and that bursts of
+        them are pushed together.
+        """
+        sent_assocs = {}
+        agent = self._mock_agent(sent_assocs)
+        self.sydent.run()
+        self.sydent.reactor.advance(1)
+        self.assertEqual(agent.request.call_count, 0)
+
+        for assoc in self.assocs[:3]:
+            self._bind(assoc)
+        self.sydent.reactor.advance(1)
+
+        self.assertEqual(agent.request.call_count, 1)
+        self.assertEqual(len(sent_assocs), 3)
+
+    def test_retry(self):
+        """Tests that pushes which fail are retried, and that peers which failed
+        aren't pushed to on every write until then.
+        """
+        sent_assocs = {}
+        agent = self._mock_agent(sent_assocs, failures=2)
+        self.sydent.run()
+
+        self._bind(self.assocs[0])
+        self.sydent.reactor.advance(1)
+        self.assertEqual(agent.request.call_count, 1)
+        self._bind(self.assocs[1])
+        self.sydent.reactor.advance(1)
+        self.assertEqual(agent.request.call_count, 1)
+
+        # The first retry fails too, the second one succeeds.
+        self.sydent.reactor.advance(RETRY_INTERVAL)
+        self.assertEqual(agent.request.call_count, 2)
+        self.sydent.reactor.advance(RETRY_INTERVAL)
+        self.assertEqual(agent.request.call_count, 3)
+        self.assertEqual(len(sent_assocs), 2)
+
+    def test_push_window(self):
+        """Tests that several batches are pushed to a peer at once, unless they are
+        for the same 3PIDs, and that the peer is only recorded as having them once
+        they have all been acknowledged.
+        """
+        responses = []
+        pushed_ids = []
+
+        def request(method, uri, headers, body):
+            payload = json.loads(body._inputFile.read().decode("utf8"))
+            pushed_ids.append(sorted(int(i) for i in payload["sgAssocs"]))
+            d = defer.Deferred()
+            responses.append(d)
+            return d
+
+        agent = Mock(spec=["request"])
+        agent.request.side_effect = request
+        self.sydent.replicationHttpsClient.agent = agent
+        self.sydent.run()
+
+        # Push one association at a time.
+        self.sydent.pusher._get_state("fake.server").batch_size = 1
+        self._bind(self.assocs[0])
+        self._bind(self.assocs[1])
+        self.sydent.reactor.advance(1)
+        self.assertEqual(pushed_ids, [[1], [2]])
+
+        # Rebind the second 3PID while its first association is in flight. The new
+        # association must not be sent until the peer has acknowledged the old one.
+        self._bind(self.assocs[1])
+        self.sydent.reactor.advance(1)
+        responses[0].callback(Response((b"HTTP", 1, 1), 200, b"OK", None, None))
+        self.assertEqual(pushed_ids, [[1], [2]])
+        self.assertEqual(self._last_sent_version(), 1)
+
+        responses[1].callback(Response((b"HTTP", 1, 1), 200, b"OK", None, None))
+        self.assertEqual(pushed_ids, [[1], [2], [3]])
+        self.assertEqual(self._last_sent_version(), 2)
+
+        responses[2].callback(Response((b"HTTP", 1, 1), 200, b"OK", None, None))
+        self.assertEqual(self._last_sent_version(), 3)
+
+    def test_max_push_size(self):
+        """Tests that the batches pushed to a peer shrink to the size it asks for."""
+        sent_assocs = {}
+        batch_sizes = []
+
+        def request(method, uri, headers, body):
+            payload = json.loads(body._inputFile.read().decode("utf8"))
+            batch_sizes.append(len(payload["sgAssocs"]))
+            if len(payload["sgAssocs"]) > 20:
+                return defer.succeed(
+                    self._error_response(
+                        413,
+                        {
+                            "errcode": "M_TOO_LARGE",
+                            "error": "Too many associations in one push",
+                            "max_push_size": 20,
+                        },
+                    )
+                )
+            sent_assocs.update(payload["sgAssocs"])
+            return defer.succeed(Response((b"HTTP", 1, 1), 200, b"OK", None, None))
+
+        agent = Mock(spec=["request"])
+        agent.request.side_effect = request
+        self.sydent.replicationHttpsClient.agent = agent
+        self.sydent.run()
+
+        for assoc in self.assocs:
+            self._bind(assoc)
+        self.sydent.reactor.advance(1)
+
+        # The first pushes are rejected, and every push after them fits.
+        self.assertGreater(batch_sizes[0], 20)
+        self.assertTrue(all(size <= 20 for size in batch_sizes[2:]))
+        self.assertEqual(len(sent_assocs), len(self.assocs))
+
+    def test_retry_after(self):
+        """Tests that peers asking us to wait before pushing again are left alone
+        until then.
+        """
+        sent_assocs = {}
+        calls = 0
+
+        def request(method, uri, headers, body):
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                return defer.succeed(
+                    self._error_response(
+                        503,
+                        {"errcode": "M_UNKNOWN", "error": "Busy"},
+                        {b"Retry-After": [b"30"]},
+                    )
+                )
+            payload = json.loads(body._inputFile.read().decode("utf8"))
+            sent_assocs.update(payload["sgAssocs"])
+            return defer.succeed(Response((b"HTTP", 1, 1), 200, b"OK", None, None))
+
+        agent = Mock(spec=["request"])
+        agent.request.side_effect = request
+        self.sydent.replicationHttpsClient.agent = agent
+        self.sydent.run()
+
+        self._bind(self.assocs[0])
+        self.sydent.reactor.advance(1)
+        self.assertEqual(calls, 1)
+
+        self.sydent.reactor.advance(RETRY_INTERVAL)
+        self.assertEqual(calls, 1)
+
+        self.sydent.reactor.advance(30)
+        self.assertEqual(calls, 2)
+        self.assertEqual(len(sent_assocs), 1)
+
+    def test_parse_retry_after(self):
+        """Tests that only non-negative integer delays are taken from the Retry-After
+        header, and that they are capped.
+        """
+        for value, expected in [
+            (b"30", 30),
+            (b" 0 ", 0),
+            (b"99999999", MAX_RETRY_AFTER),
+            (b"-1", None),
+            (b"1.5", None),
+            (b"nan", None),
+            (b"inf", None),
+            (b"Wed, 21 Oct 2015 07:28:00 GMT", None),
+        ]:
+            response = self._error_response(503, {}, {b"Retry-After": [value]})
+            self.assertEqual(_parse_retry_after(response), expected, value)
+
+    def test_send_failure(self):
+        """Tests that when sending a batch fails, the batches already in flight are
+        still waited for, and recorded as sent once acknowledged.
+        """
+        responses = []
+
+        def request(method, uri, headers, body):
+            d = defer.Deferred()
+            responses.append(d)
+            return d
+
+        agent = Mock(spec=["request"])
+        agent.request.side_effect = request
+        self.sydent.replicationHttpsClient.agent = agent
+        self.sydent.run()
+
+        pusher = self.sydent.pusher
+        pusher._get_state("fake.server").batch_size = 1
+        get_assocs = pusher.local_assoc_store.getSignedAssociationsAfterId
+        calls = 0
+
+        def failing_get_assocs(after_id, limit):
+            nonlocal calls
+            calls += 1
+            if calls == 2:
+                raise Exception("oh no")
+            return get_assocs(after_id, limit)
+
+        self._bind(self.assocs[0])
+        self._bind(self.assocs[1])
+        with patch.object(
+            pusher.local_assoc_store,
+            "getSignedAssociationsAfterId",
+            side_effect=failing_get_assocs,
+        ):
+            self.sydent.reactor.advance(1)
+        self.assertEqual(len(responses), 1)
+        self.assertIn("fake.server", pusher._peers_being_pushed_to)
+
+        responses[0].callback(Response((b"HTTP", 1, 1), 200, b"OK", None, None))
+        self.assertNotIn("fake.server", pusher._peers_being_pushed_to)
+        self.assertEqual(self._last_sent_version(), 1)
+
+        # The rest is pushed when retrying.
+        self.sydent.reactor.advance(RETRY_INTERVAL)
+        self.assertEqual(len(responses), 2)
+
+    def test_peer_registry(self):
+        """Tests that the peers are kept between pushes, and that changes to the
+        peers tables are picked up.
+        """
+        sent_assocs = {}
+        agent = self._mock_agent(sent_assocs)
+        self.sydent.run()
+        registry = self.sydent.peer_registry
+
+        peer = registry.get_peer("fake.server")
+        self.assertIs(registry.get_all_peers()[0], peer)
+        self._bind(self.assocs[0])
+        self.sydent.reactor.advance(1)
+        self.assertIs(registry.get_peer("fake.server"), peer)
+        self.assertEqual(peer.lastSentVersion, 1)
+
+        # Add a peer, which gets pushed to once the registry notices it.
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "INSERT INTO peers (name, port, lastSentVersion, active) VALUES (?, ?, ?, ?)",
+            ("other.server", 1234, 0, 1),
+        )
+        cur.execute(
+            "INSERT INTO peer_pubkeys (peername, alg, key) VALUES (?, ?, ?)",
+            ("other.server", "ed25519", "+vB8mTaooD/MA8YYZM8t9+vnGhP1937q2icrqPV9JTs"),
+        )
+        self.sydent.db.commit()
+        self.assertEqual(len(registry.get_all_peers()), 1)
+
+        self.sydent.reactor.advance(PeerRegistry.POLL_INTERVAL)
+        self.assertEqual(
+            sorted(p.servername for p in registry.get_all_peers()),
+            ["fake.server", "other.server"],
+        )
+        self.assertIs(registry.get_peer("fake.server"), peer)
+        self.sydent.reactor.advance(PUSH_DELAY)
+        self.assertEqual(agent.request.call_count, 2)
+
+        # Deactivate it.
+        cur.execute("UPDATE peers SET active = 0 WHERE name = ?", ("other.server",))
+        self.sydent.db.commit()
+        registry.reload()
+        self.assertEqual(registry.get_all_peers(), [peer])
+
+    def test_peer_registry_unknown_peer(self):
+        """Tests that looking up peers which don't exist only reads the peers again
+        if they have changed.
+        """
+        self.sydent.run()
+        registry = self.sydent.peer_registry
+
+        with patch.object(
+            registry.peerStore,
+            "getPeerConfigs",
+            wraps=registry.peerStore.getPeerConfigs,
+        ) as get_peer_configs:
+            self.assertIsNone(registry.get_peer("unknown.server"))
+            self.assertIsNone(registry.get_peer("unknown.server"))
+            self.sydent.reactor.advance(PeerRegistry.POLL_INTERVAL)
+            self.assertEqual(get_peer_configs.call_count, 0)
+
+            cur = self.sydent.db.cursor()
+            cur.execute(
+                "UPDATE peers SET port = ? WHERE name = ?", (4321, "fake.server")
+            )
+            self.sydent.db.commit()
+            self.assertIsNone(registry.get_peer("unknown.server"))
+            self.assertEqual(get_peer_configs.call_count, 1)
+
+            # Sydent's own updates to the peers don't count as changes.
+            cur.execute(
+                "UPDATE peers SET lastSentVersion = ? WHERE name = ?",
+                (10, "fake.server"),
+            )
+            self.sydent.db.commit()
+            self.sydent.reactor.advance(PeerRegistry.POLL_INTERVAL)
+            self.assertEqual(get_peer_configs.call_count, 1)
+
+        peer = registry.get_peer("fake.server")
+        assert peer is not None
+        self.assertEqual(peer.replication_url_origin, "https://fake.server:4321/")
+
+    def test_sign_once(self):
+        """Tests that associations are signed when they're made, rather than every
+        time they're pushed.
+        """
+        sent_assocs = {}
+        agent = self._mock_agent(sent_assocs, failures=1)
+        self.sydent.run()
+
+        self._bind(self.assocs[0])
+        self._bind(self.assocs[1])
+        with self.sydent.db.unit_of_work():
+            LocalAssociationStore(self.sydent).removeAssociation(
+                {"medium": "email", "address": self.assocs[1].address},
+                self.assocs[1].mxid,
+            )
+            self.sydent.pusher.doLocalPush()
+
+        # Neither the push nor its retry sign anything.
+        with patch(
+            "signedjson.sign.sign_json", wraps=signedjson.sign.sign_json
+        ) as sign_json:
+            self.sydent.reactor.advance(1)
+            self.sydent.reactor.advance(RETRY_INTERVAL)
+        self.assertEqual(agent.request.call_count, 2)
+        sign_json.assert_not_called()
+
+        signer = Signer(self.sydent)
+        self.assertEqual(
+            sent_assocs["1"], signer.signedThreePidAssociation(self.assocs[0])
+        )
+        self.assertIsNone(sent_assocs["3"]["mxid"])
+        signedjson.sign.verify_signed_json(
+            sent_assocs["3"],
+            ":test:",
+            signedjson.key.get_verify_key(self.sydent.keyring.ed25519),
+        )
+
+    def _last_sent_version(self):
+        peer = self.sydent.pusher.peerStore.getPeerByName("fake.server")
+        assert isinstance(peer, RemotePeer)
+        return peer.lastSentVersion
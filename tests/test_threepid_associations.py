@@ -0,0 +1,933 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+import os
+from unittest.mock import patch
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from sydent.db.background_updates import BackgroundUpdater, schedule_background_update
+from sydent.db.hashing_metadata import PepperRotationError, hash_threepid
+from sydent.db.lookup_snapshot import LookupSnapshot
+from sydent.db.threepid_associations import GlobalAssociationStore
+from sydent.db.updates import (
+    BACKGROUND_UPDATE_HANDLERS,
+    DROP_LOWER_ADDRESS_INDEX,
+    POPULATE_CURRENT_MAPPINGS,
+    POPULATE_LOOKUP_HASHES,
+    POPULATE_NORMALISED_ADDRESSES,
+)
+from sydent.threepid import ThreepidAssociation
+from sydent.util import time_msec
+from sydent.util.hash import sha256_and_url_safe_base64
+from tests.utils import make_sydent
+
+
+class GlobalAssociationLookupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sydent = make_sydent()
+        self.store = GlobalAssociationStore(self.sydent)
+
+        now = time_msec()
+        for i, (address, mxid) in enumerate(
+            [
+                ("Bob@Example.com", "@bob:example.com"),
+                ("ÉLODIE@example.com", "@elodie:example.com"),
+            ]
+        ):
+            self.store.addAssociation(
+                ThreepidAssociation(
+                    "email", address, None, mxid, now, now - 1000, now + 100000
+                ),
+                "{}",
+                "origin.example.com",
+                i,
+            )
+
+    def test_get_mxid(self):
+        """Tests that single lookups match addresses case-insensitively."""
+        for address, mxid in [
+            ("bob@example.com", "@bob:example.com"),
+            ("BOB@EXAMPLE.COM", "@bob:example.com"),
+            ("élodie@example.com", "@elodie:example.com"),
+            ("alice@example.com", None),
+        ]:
+            res = self.successResultOf(
+                defer.ensureDeferred(self.store.getMxid("email", address))
+            )
+            self.assertEqual(res, mxid)
+
+    def test_get_mxids(self):
+        """Tests that bulk lookups match addresses case-insensitively, and return the
+        addresses as they were stored.
+        """
+        res = self.successResultOf(
+            defer.ensureDeferred(
+                self.store.getMxids(
+                    [
+                        ("email", "bob@example.com"),
+                        ("email", "élodie@EXAMPLE.com"),
+                        ("msisdn", "bob@example.com"),
+                    ]
+                )
+            )
+        )
+        self.assertEqual(
+            sorted(res),
+            [
+                ("email", "Bob@Example.com", "@bob:example.com"),
+                ("email", "ÉLODIE@example.com", "@elodie:example.com"),
+            ],
+        )
+
+    def test_get_mxids_large_batch(self):
+        """Tests that bulk lookups give the same results when the batch is large
+        enough to be passed as a single parameter, or split into several queries.
+        """
+        batch = [("email", "bob@example.com"), ("email", "élodie@example.com")]
+        batch += [("email", "user%d@example.com" % (i,)) for i in range(1200)]
+
+        for max_size in (0, 10000):
+            self.sydent.db_engine.IN_LIST_MAX_SIZE = max_size
+            res = self.successResultOf(defer.ensureDeferred(self.store.getMxids(batch)))
+            self.assertEqual(
+                sorted(res),
+                [
+                    ("email", "Bob@Example.com", "@bob:example.com"),
+                    ("email", "ÉLODIE@example.com", "@elodie:example.com"),
+                ],
+            )
+
+    def test_retrieve_mxids_for_hashes(self):
+        """Tests that hash lookups only return the hashes which are bound, whether
+        they're matched with an IN list or a single parameter.
+        """
+        now = time_msec()
+        self.store.addAssociation(
+            ThreepidAssociation(
+                "email", "c@example.com", "hash1", "@c:example.com", now, 0, now + 1000
+            ),
+            "{}",
+            "origin.example.com",
+            10,
+        )
+        for max_size in (0, 10000):
+            self.sydent.db_engine.IN_LIST_MAX_SIZE = max_size
+            res = self.successResultOf(
+                defer.ensureDeferred(
+                    self.store.retrieveMxidsForHashes(["hash1", "hash2"])
+                )
+            )
+            self.assertEqual(res, {"hash1": "@c:example.com"})
+
+    def test_rebind(self):
+        """Tests that lookups return the newest association for a 3PID, and fall back
+        to the previous one once the newest is removed.
+        """
+        now = time_msec()
+        self.store.addAssociation(
+            ThreepidAssociation(
+                "email",
+                "bob@example.com",
+                None,
+                "@bob2:example.com",
+                now + 1,
+                now - 1000,
+                now + 100000,
+            ),
+            "{}",
+            "origin.example.com",
+            10,
+        )
+
+        res = self.successResultOf(
+            defer.ensureDeferred(self.store.getMxid("email", "bob@example.com"))
+        )
+        self.assertEqual(res, "@bob2:example.com")
+
+        self.store.removeAssociation("email", "bob@example.com")
+
+        res = self.successResultOf(
+            defer.ensureDeferred(self.store.getMxid("email", "bob@example.com"))
+        )
+        self.assertEqual(res, "@bob:example.com")
+
+        self.store.removeAssociation("email", "Bob@Example.com")
+
+        res = self.successResultOf(
+            defer.ensureDeferred(self.store.getMxid("email", "bob@example.com"))
+        )
+        self.assertIsNone(res)
+
+    def test_new_pepper(self):
+        """Tests that hash lookups use the hashes computed with a new pepper."""
+        hashing_store = self.sydent.hashing_store
+        hashing_store.store_lookup_pepper(lambda combo: "hash of " + combo, "pepper")
+
+        res = self.successResultOf(
+            defer.ensureDeferred(
+                self.store.retrieveMxidsForHashes(
+                    ["hash of bob@example.com email pepper"]
+                )
+            )
+        )
+        self.assertEqual(
+            res, {"hash of bob@example.com email pepper": "@bob:example.com"}
+        )
+
+    def _schedule_updates(self, *update_names: str) -> None:
+        """Schedule the given background updates, and make Sydent pick them up."""
+        cur = self.sydent.db.cursor()
+        for ordering, update_name in enumerate(update_names):
+            schedule_background_update(cur, update_name, ordering)
+        self.sydent.db.commit()
+        self.sydent.background_updater = BackgroundUpdater(
+            self.sydent, BACKGROUND_UPDATE_HANDLERS
+        )
+
+    def _run_updates(self) -> None:
+        self.successResultOf(
+            defer.ensureDeferred(
+                self.sydent.background_updater.run_updates(sleep=False)
+            )
+        )
+
+    def test_populate_normalised_addresses(self):
+        """Tests that the background updates fill in the normalised address and
+        current mapping of existing associations.
+        """
+        self.sydent.db.execute(
+            "UPDATE global_threepid_associations SET normalised_address = NULL"
+        )
+        self.sydent.db.execute("DELETE FROM global_threepid_current_mappings")
+        self._schedule_updates(POPULATE_NORMALISED_ADDRESSES, POPULATE_CURRENT_MAPPINGS)
+        self._run_updates()
+
+        res = self.successResultOf(
+            defer.ensureDeferred(self.store.getMxid("email", "élodie@example.com"))
+        )
+        self.assertEqual(res, "@elodie:example.com")
+
+    def test_lookups_during_background_updates(self):
+        """Tests that lookups keep working while the current mappings are being
+        built.
+        """
+        self.sydent.db.execute(
+            "CREATE INDEX global_threepid_medium_lower_address "
+            "ON global_threepid_associations (medium, lower(address))"
+        )
+        self.sydent.db.execute("DELETE FROM global_threepid_current_mappings")
+        self._schedule_updates(POPULATE_CURRENT_MAPPINGS, DROP_LOWER_ADDRESS_INDEX)
+        self.sydent.background_updater.MINIMUM_BATCH_SIZE = 1
+
+        # Run the first batch, which only builds the current mapping of the first
+        # association.
+        self.successResultOf(
+            defer.ensureDeferred(self.sydent.background_updater.do_next_batch())
+        )
+        self.assertFalse(self.sydent.background_updater.has_completed_all_updates())
+
+        for _ in range(2):
+            res = self.successResultOf(
+                defer.ensureDeferred(
+                    self.store.getMxids(
+                        [("email", "BOB@example.com"), ("email", "alice@example.com")]
+                    )
+                )
+            )
+            self.assertEqual(res, [("email", "Bob@Example.com", "@bob:example.com")])
+            res = self.successResultOf(
+                defer.ensureDeferred(self.store.getMxid("email", "bob@example.com"))
+            )
+            self.assertEqual(res, "@bob:example.com")
+
+            self._run_updates()
+            self.assertTrue(self.sydent.background_updater.has_completed_all_updates())
+
+    def test_populate_lookup_hashes(self):
+        """Tests that plaintext lookups fall back to matching addresses until the
+        lookup hashes of existing associations have been filled in, and are served
+        through the hashes afterwards.
+        """
+        self._schedule_updates(POPULATE_LOOKUP_HASHES)
+        expected = [
+            ("email", "bob@example.com", "@bob:example.com"),
+            ("email", "élodie@example.com", "@elodie:example.com"),
+        ]
+
+        res = self.successResultOf(
+            defer.ensureDeferred(
+                self.store.getMxidsByHash(
+                    [("email", "BOB@example.com"), ("email", "élodie@example.com")]
+                )
+            )
+        )
+        self.assertEqual(res, expected)
+
+        self._run_updates()
+
+        pepper = self.sydent.hashing_store.get_lookup_pepper()
+        lookup_hash = hash_threepid("email", "bob@example.com", pepper)
+        res = self.successResultOf(
+            defer.ensureDeferred(self.store.retrieveMxidsForHashes([lookup_hash]))
+        )
+        self.assertEqual(res, {lookup_hash: "@bob:example.com"})
+
+        res = self.successResultOf(
+            defer.ensureDeferred(
+                self.store.getMxidsByHash(
+                    [("email", "BOB@example.com"), ("email", "élodie@example.com")]
+                )
+            )
+        )
+        self.assertEqual(res, expected)
+
+    def test_compact_associations(self):
+        """Tests that compaction removes superseded associations, apart from the
+        latest one from each server, without changing lookup results.
+        """
+        now = time_msec()
+        for address, mxid, ts, origin_server, origin_id in [
+            ("bob@example.com", "@bob2:example.com", now + 1, "origin.example.com", 10),
+            (
+                "élodie@example.com",
+                "@old:example.com",
+                now - 10,
+                "other.example.com",
+                3,
+            ),
+            ("élodie@example.com", "@old:example.com", now - 5, "other.example.com", 5),
+        ]:
+            self.store.addAssociation(
+                ThreepidAssociation(
+                    "email", address, None, mxid, ts, now - 1000, now + 100000
+                ),
+                "{}",
+                origin_server,
+                origin_id,
+            )
+
+        self.store.COMPACTION_CHUNK_SIZE = 2
+        d = defer.ensureDeferred(self.store.compactAssociations())
+        # Let the chunks after the first one run.
+        self.sydent.reactor.pump([self.store.COMPACTION_SLEEP_DURATION_MS / 1000] * 3)
+        self.successResultOf(d)
+
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "SELECT originServer, originId FROM global_threepid_associations "
+            "ORDER BY originServer, originId"
+        )
+        self.assertEqual(
+            cur.fetchall(),
+            [
+                ("origin.example.com", 1),
+                ("origin.example.com", 10),
+                ("other.example.com", 5),
+            ],
+        )
+        self.assertEqual(self.store.lastIdFromServer("other.example.com"), 5)
+
+        res = self.successResultOf(
+            defer.ensureDeferred(
+                self.store.getMxids(
+                    [("email", "bob@example.com"), ("email", "élodie@example.com")]
+                )
+            )
+        )
+        self.assertEqual(
+            res,
+            [
+                ("email", "bob@example.com", "@bob2:example.com"),
+                ("email", "ÉLODIE@example.com", "@elodie:example.com"),
+            ],
+        )
+
+    def test_compact_associations_in_background(self):
+        """Tests that a failed compaction is logged rather than failing the looping
+        call running it, which would stop it from running again.
+        """
+        with patch.object(
+            self.store, "compactAssociations", side_effect=Exception("oh no")
+        ):
+            self.successResultOf(
+                defer.ensureDeferred(self.store.compactAssociationsInBackground())
+            )
+
+
+class PepperRotationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sydent = make_sydent()
+        self.store = GlobalAssociationStore(self.sydent)
+        self.hashing_store = self.sydent.hashing_store
+        self.hashing_store.store_lookup_pepper(sha256_and_url_safe_base64, "old")
+
+        for i in range(3):
+            self._add_association(i)
+
+        # Run the rehashing one association at a time.
+        self.sydent.background_updater.MINIMUM_BATCH_SIZE = 1
+        self.sydent.background_updater.BATCH_DURATION_MS = 0
+
+    def _add_association(self, i: int) -> None:
+        now = time_msec()
+        address = "user%d@example.com" % (i,)
+        self.store.addAssociation(
+            ThreepidAssociation(
+                "email",
+                address,
+                self._hash(i, self.hashing_store.get_lookup_pepper()),
+                "@user%d:example.com" % (i,),
+                now,
+                now - 1000,
+                now + 100000,
+            ),
+            "{}",
+            "origin.example.com",
+            i,
+        )
+
+    def _hash(self, i: int, pepper: str) -> str:
+        return sha256_and_url_safe_base64("user%d@example.com email %s" % (i, pepper))
+
+    def _lookup(self, pepper: str, count: int = 4):
+        """Look up the hashes of the first `count` users computed with the given
+        pepper, the way the v2 lookup servlet does.
+        """
+        column = self.hashing_store.get_lookup_hash_column(pepper)
+        if column is None:
+            return None
+        return self.successResultOf(
+            defer.ensureDeferred(
+                self.store.retrieveMxidsForHashes(
+                    [self._hash(i, pepper) for i in range(count)], column
+                )
+            )
+        )
+
+    def test_rotate(self):
+        """Tests that lookups keep working with the old pepper while 3PIDs are
+        rehashed, and with both peppers once the new one is in use.
+        """
+        updater = self.sydent.background_updater
+        self.hashing_store.start_pepper_rotation("new")
+        self.assertRaises(
+            PepperRotationError, self.hashing_store.start_pepper_rotation, "newer"
+        )
+
+        # Rehash some of the associations, and add one in the middle of it.
+        self.successResultOf(defer.ensureDeferred(updater.do_next_batch()))
+        self._add_association(3)
+        self.assertEqual(self.hashing_store.get_lookup_pepper(), "old")
+        self.assertEqual(len(self._lookup("old")), 4)
+        self.assertIsNone(self._lookup("new"))
+
+        self.successResultOf(defer.ensureDeferred(updater.run_updates(sleep=False)))
+
+        expected = {
+            self._hash(i, "new"): "@user%d:example.com" % (i,) for i in range(4)
+        }
+        self.assertEqual(self.hashing_store.get_lookup_pepper(), "new")
+        self.assertEqual(self._lookup("new"), expected)
+        self.assertEqual(len(self._lookup("old")), 4)
+
+        # The old pepper stops working once the next rotation starts.
+        self.hashing_store.start_pepper_rotation("newer")
+        self.assertIsNone(self._lookup("old"))
+        self.successResultOf(defer.ensureDeferred(updater.run_updates(sleep=False)))
+        self.assertEqual(len(self._lookup("newer")), 4)
+        self.assertEqual(self._lookup("new"), expected)
+
+    def test_rotate_reuse_pepper(self):
+        """Tests that a pepper can't be rotated back to."""
+        self.assertRaises(
+            PepperRotationError, self.hashing_store.start_pepper_rotation, "old"
+        )
+
+
+class LookupHashIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sydent = make_sydent({"db": {"db.lookup_hash_index": "true"}})
+        self.store = GlobalAssociationStore(self.sydent)
+        self.index = self.sydent.lookup_hash_index
+        self.successResultOf(defer.ensureDeferred(self.index.load()))
+
+        self.pepper = self.sydent.hashing_store.get_lookup_pepper()
+        for i in range(2):
+            self._add_association(i, "@user%d:example.com" % (i,))
+
+    def _hash(self, i: int) -> str:
+        return sha256_and_url_safe_base64(
+            "user%d@example.com email %s" % (i, self.pepper)
+        )
+
+    def _add_association(self, i: int, mxid: str, ts: int = 0) -> None:
+        now = time_msec()
+        self.store.addAssociation(
+            ThreepidAssociation(
+                "email",
+                "user%d@example.com" % (i,),
+                self._hash(i),
+                mxid,
+                now + ts,
+                now - 1000,
+                now + 100000,
+            ),
+            "{}",
+            "origin.example.com",
+            i + ts,
+        )
+
+    def _lookup(self, count: int = 3):
+        return self.successResultOf(
+            defer.ensureDeferred(
+                self.store.retrieveMxidsForHashes(
+                    [self._hash(i) for i in range(count)] + ["not a hash"]
+                )
+            )
+        )
+
+    def test_lookup_from_index(self):
+        """Tests that hash lookups are served from the index, which follows the
+        changes to the associations.
+        """
+        self.assertTrue(self.index.loaded)
+        # Lookups shouldn't be going to the database.
+        self.sydent.lookup_db_pool.runInteraction = None  # type: ignore[assignment]
+        self.assertEqual(
+            self._lookup(),
+            {self._hash(0): "@user0:example.com", self._hash(1): "@user1:example.com"},
+        )
+
+        self._add_association(0, "@new:example.com", ts=10)
+        self.store.removeAssociation("email", "user1@example.com")
+        self.assertEqual(self._lookup(), {self._hash(0): "@new:example.com"})
+
+    def test_plaintext_lookup_from_index(self):
+        """Tests that plaintext lookups are hashed and served from the index."""
+        self.sydent.lookup_db_pool.runInteraction = None  # type: ignore[assignment]
+        res = self.successResultOf(
+            defer.ensureDeferred(
+                self.store.getMxidsByHash(
+                    [
+                        ("email", "USER1@example.com"),
+                        ("email", "user0@example.com"),
+                        ("msisdn", "user0@example.com"),
+                        ("email", "user2@example.com"),
+                    ]
+                )
+            )
+        )
+        self.assertEqual(
+            res,
+            [
+                ("email", "user0@example.com", "@user0:example.com"),
+                ("email", "user1@example.com", "@user1:example.com"),
+            ],
+        )
+
+    def test_rolled_back_changes(self):
+        """Tests that changes which are rolled back don't make it into the index."""
+        with self.sydent.db.unit_of_work():
+            self._add_association(2, "@user2:example.com")
+            self.store.removeAssociation("email", "user0@example.com")
+            self.sydent.db.rollback()
+
+        self.assertEqual(
+            self._lookup(),
+            {self._hash(0): "@user0:example.com", self._hash(1): "@user1:example.com"},
+        )
+
+    def test_reload(self):
+        """Tests that changes committed while the index is being loaded aren't
+        lost.
+        """
+        load = defer.ensureDeferred(self.index.load())
+        self.assertTrue(self.index.loaded)
+        # The test database pool runs interactions synchronously, so simulate a change
+        # committed while the index is being loaded by loading it again and applying
+        # a change while it has loaded nothing yet.
+        d: defer.Deferred = defer.Deferred()
+        self.sydent.db_pool.runInteraction = lambda *args: d  # type: ignore[assignment]
+        reload = defer.ensureDeferred(self.index.load())
+        self.assertFalse(self.index.loaded)
+        self._add_association(2, "@user2:example.com")
+
+        d.callback(self.index._loadTxn(self.sydent.db.cursor()))
+        self.successResultOf(load)
+        self.successResultOf(reload)
+        self.assertTrue(self.index.loaded)
+        self.assertEqual(len(self._lookup()), 3)
+
+
+class LookupBloomFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sydent = make_sydent({"db": {"db.lookup_bloom_filter": "true"}})
+        self.store = GlobalAssociationStore(self.sydent)
+        self.bloom_filter = self.sydent.lookup_bloom_filter
+
+        now = time_msec()
+        self.store.addAssociation(
+            ThreepidAssociation(
+                "email",
+                "Bob@Example.com",
+                "hash1",
+                "@bob:example.com",
+                now,
+                0,
+                now + 1000,
+            ),
+            "{}",
+            "origin.example.com",
+            1,
+        )
+        self.successResultOf(defer.ensureDeferred(self.bloom_filter.load()))
+
+        # Count the queries which reach the database.
+        self.queries = 0
+        run_interaction = self.sydent.lookup_db_pool.runInteraction
+
+        def counting_run_interaction(*args, **kwargs):
+            self.queries += 1
+            return run_interaction(*args, **kwargs)
+
+        self.sydent.lookup_db_pool.runInteraction = counting_run_interaction
+
+    def test_misses(self):
+        """Tests that lookups for 3PIDs which aren't bound don't query the database,
+        and that lookups for bound ones still find them.
+        """
+        for address, mxid in [
+            ("alice@example.com", None),
+            ("BOB@example.com", "@bob:example.com"),
+        ]:
+            res = self.successResultOf(
+                defer.ensureDeferred(self.store.getMxid("email", address))
+            )
+            self.assertEqual(res, mxid)
+        self.assertEqual(self.queries, 1)
+
+        res = self.successResultOf(
+            defer.ensureDeferred(
+                self.store.getMxids(
+                    [("email", "alice@example.com"), ("msisdn", "bob@example.com")]
+                )
+            )
+        )
+        self.assertEqual(res, [])
+        res = self.successResultOf(
+            defer.ensureDeferred(self.store.retrieveMxidsForHashes(["hash2"]))
+        )
+        self.assertEqual(res, {})
+        res = self.successResultOf(
+            defer.ensureDeferred(
+                self.store.signedAssociationStringForThreepid(
+                    "email", "alice@example.com"
+                )
+            )
+        )
+        self.assertIsNone(res)
+        self.assertEqual(self.queries, 1)
+
+        res = self.successResultOf(
+            defer.ensureDeferred(self.store.retrieveMxidsForHashes(["hash1", "hash2"]))
+        )
+        self.assertEqual(res, {"hash1": "@bob:example.com"})
+        self.assertEqual(self.queries, 2)
+
+    def test_new_binding(self):
+        """Tests that 3PIDs bound after the filter was built are added to it."""
+        now = time_msec()
+        self.store.addAssociation(
+            ThreepidAssociation(
+                "email",
+                "alice@example.com",
+                "hash2",
+                "@alice:example.com",
+                now,
+                0,
+                now + 1000,
+            ),
+            "{}",
+            "origin.example.com",
+            2,
+        )
+        res = self.successResultOf(
+            defer.ensureDeferred(self.store.getMxid("email", "Alice@example.com"))
+        )
+        self.assertEqual(res, "@alice:example.com")
+        res = self.successResultOf(
+            defer.ensureDeferred(self.store.retrieveMxidsForHashes(["hash2"]))
+        )
+        self.assertEqual(res, {"hash2": "@alice:example.com"})
+
+
+class LookupSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        self.sydent = make_sydent(
+            {
+                "db": {
+                    "db.lookup_snapshot.path": os.path.join(directory, "snapshot"),
+                }
+            }
+        )
+        self.store = GlobalAssociationStore(self.sydent)
+        self.snapshot = self.sydent.lookup_snapshot
+
+        self.pepper = self.sydent.hashing_store.get_lookup_pepper()
+        # Enough associations for some of the snapshot's buckets to hold several.
+        self.count = 300
+        for i in range(self.count):
+            self._add_association(i, "@user%d:example.com" % (i,))
+        self.successResultOf(defer.ensureDeferred(self.snapshot.write()))
+
+    def _hash(self, i: int) -> str:
+        return sha256_and_url_safe_base64(
+            "user%d@example.com email %s" % (i, self.pepper)
+        )
+
+    def _add_association(self, i: int, mxid: str, ts: int = 0) -> None:
+        now = time_msec()
+        self.store.addAssociation(
+            ThreepidAssociation(
+                "email",
+                "user%d@example.com" % (i,),
+                self._hash(i),
+                mxid,
+                now + ts,
+                now - 1000,
+                now + 100000,
+            ),
+            "{}",
+            "origin.example.com",
+            i + ts,
+        )
+
+    def _lookup(self, count: int):
+        return self.successResultOf(
+            defer.ensureDeferred(
+                self.store.retrieveMxidsForHashes([self._hash(i) for i in range(count)])
+            )
+        )
+
+    def test_lookup_from_snapshot(self):
+        """Tests that hash lookups are served from the snapshot, which follows the
+        changes to the associations.
+        """
+        self.assertTrue(self.snapshot.loaded)
+        # Lookups shouldn't be going to the database.
+        run_interaction = self.sydent.lookup_db_pool.runInteraction
+        self.sydent.lookup_db_pool.runInteraction = None  # type: ignore[assignment]
+        self.assertEqual(
+            self._lookup(self.count + 1),
+            {self._hash(i): "@user%d:example.com" % (i,) for i in range(self.count)},
+        )
+
+        self._add_association(0, "@new:example.com", ts=1000)
+        self.store.removeAssociation("email", "user1@example.com")
+        self._add_association(self.count, "@newest:example.com")
+        res = self._lookup(self.count + 1)
+        self.assertEqual(res[self._hash(0)], "@new:example.com")
+        self.assertNotIn(self._hash(1), res)
+        self.assertEqual(res[self._hash(self.count)], "@newest:example.com")
+
+        # Hashes which aren't SHA-256 digests are looked up in the database.
+        self.sydent.lookup_db_pool.runInteraction = run_interaction
+        res = self.successResultOf(
+            defer.ensureDeferred(self.store.retrieveMxidsForHashes(["not a hash"]))
+        )
+        self.assertEqual(res, {})
+
+    def test_changes_from_another_process(self):
+        """Tests that another process using the snapshot reads the changes made
+        since it was written from the database.
+        """
+        other = LookupSnapshot(self.sydent)
+        self.successResultOf(defer.ensureDeferred(other.refresh()))
+        self._add_association(0, "@new:example.com", ts=1000)
+        self.store.removeAssociation("email", "user1@example.com")
+        self._add_association(self.count, "@newest:example.com")
+
+        self.successResultOf(defer.ensureDeferred(other.refresh()))
+        answer = other.get_mxids(
+            [self._hash(i) for i in (0, 1, 2, self.count)], "lookup_hash", time_msec()
+        )
+        assert answer is not None
+        self.assertEqual(
+            answer,
+            (
+                {
+                    self._hash(0): "@new:example.com",
+                    self._hash(2): "@user2:example.com",
+                    self._hash(self.count): "@newest:example.com",
+                },
+                [],
+            ),
+        )
+
+        # Once the snapshot has been rewritten, the other process picks it up.
+        self.successResultOf(defer.ensureDeferred(self.snapshot.write()))
+        self.successResultOf(defer.ensureDeferred(other.refresh()))
+        assert other._overlay is not None
+        self.assertEqual(other._overlay.mappings, {})
+        answer = other.get_mxids(
+            [self._hash(1), self._hash(0)], "lookup_hash", time_msec()
+        )
+        self.assertEqual(answer, ({self._hash(0): "@new:example.com"}, []))
+
+    def test_prune_changes(self):
+        """Tests that the changes made before the previous snapshot was written are
+        pruned when writing a new one.
+        """
+        self._add_association(0, "@new:example.com", ts=1000)
+        self.successResultOf(defer.ensureDeferred(self.snapshot.write()))
+        self._add_association(1, "@new:example.com", ts=1000)
+        self.successResultOf(defer.ensureDeferred(self.snapshot.write()))
+
+        cur = self.sydent.db.cursor()
+        cur.execute(
+            "SELECT normalised_address FROM global_threepid_mapping_changes "
+            "ORDER BY stream_id"
+        )
+        self.assertEqual(
+            [row[0] for row in cur.fetchall()],
+            ["user1@example.com", "user1@example.com"],
+        )
+
+    def test_rotated_pepper(self):
+        """Tests that lookups with a pepper the snapshot wasn't written with go to
+        the database.
+        """
+        self.assertIsNone(
+            self.snapshot.get_mxids([self._hash(0)], "alt_lookup_hash", time_msec())
+        )
+
+
+class LookupCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sydent = make_sydent({"db": {"db.lookup_cache.size": "10"}})
+        self.store = GlobalAssociationStore(self.sydent)
+        self._add_association("@bob:example.com", 1)
+
+        # Count the queries which reach the database.
+        self.queries = 0
+        run_interaction = self.sydent.lookup_db_pool.runInteraction
+
+        def counting_run_interaction(*args, **kwargs):
+            self.queries += 1
+            return run_interaction(*args, **kwargs)
+
+        self.sydent.lookup_db_pool.runInteraction = counting_run_interaction
+
+    def _add_association(self, mxid: str, ts: int) -> None:
+        now = time_msec()
+        self.store.addAssociation(
+            ThreepidAssociation(
+                "email",
+                "Bob@Example.com",
+                "hash1",
+                mxid,
+                now + ts,
+                now - 1000,
+                now + 100000,
+            ),
+            '{"mxid": "%s"}' % (mxid,),
+            "origin.example.com",
+            ts,
+        )
+
+    def _lookup(self):
+        return (
+            self.successResultOf(
+                defer.ensureDeferred(
+                    self.store.getMxids(
+                        [("email", "bob@example.com"), ("email", "alice@example.com")]
+                    )
+                )
+            ),
+            self.successResultOf(
+                defer.ensureDeferred(
+                    self.store.signedAssociationStringForThreepid(
+                        "email", "BOB@example.com"
+                    )
+                )
+            ),
+            self.successResultOf(
+                defer.ensureDeferred(
+                    self.store.retrieveMxidsForHashes(["hash1", "hash2"])
+                )
+            ),
+        )
+
+    def test_cached_lookups(self):
+        """Tests that repeated lookups, including of 3PIDs which aren't bound, are
+        served from the cache.
+        """
+        expected = (
+            [("email", "Bob@Example.com", "@bob:example.com")],
+            '{"mxid": "@bob:example.com"}',
+            {"hash1": "@bob:example.com"},
+        )
+        self.assertEqual(self._lookup(), expected)
+        self.assertEqual(self.queries, 3)
+        self.assertEqual(self._lookup(), expected)
+        self.assertEqual(self.queries, 3)
+
+    def test_invalidation(self):
+        """Tests that the cache follows the changes to the associations."""
+        self._lookup()
+
+        self._add_association("@new:example.com", 2)
+        self.assertEqual(
+            self._lookup(),
+            (
+                [("email", "Bob@Example.com", "@new:example.com")],
+                '{"mxid": "@new:example.com"}',
+                {"hash1": "@new:example.com"},
+            ),
+        )
+
+        self.store.removeAssociation("email", "Bob@Example.com")
+        self.assertEqual(self._lookup(), ([], None, {}))
+
+    def test_rolled_back_changes(self):
+        """Tests that changes which are rolled back don't invalidate the cache."""
+        self._lookup()
+        with self.sydent.db.unit_of_work():
+            self.store.removeAssociation("email", "Bob@Example.com")
+            self.sydent.db.rollback()
+
+        queries = self.queries
+        self.assertEqual(len(self._lookup()[0]), 1)
+        self.assertEqual(self.queries, queries)
+
+    def test_stale_fetch(self):
+        """Tests that results fetched while the association changed aren't cached."""
+        d: defer.Deferred = defer.Deferred()
+        run_interaction = self.sydent.lookup_db_pool.runInteraction
+        self.sydent.lookup_db_pool.runInteraction = (  # type: ignore[assignment]
+            lambda *args: d
+        )
+        lookup = defer.ensureDeferred(
+            self.store.getMxids([("email", "bob@example.com")])
+        )
+
+        # The lookup read the database before the association was removed, but
+        # finishes after.
+        rows = self.store._getMxidsTxn(
+            self.sydent.db.cursor(), [("email", "bob@example.com")]
+        )
+        self.store.removeAssociation("email", "Bob@Example.com")
+        d.callback(rows)
+        self.assertEqual(len(self.successResultOf(lookup)), 1)
+
+        self.sydent.lookup_db_pool.runInteraction = run_interaction
+        res = self.successResultOf(
+            defer.ensureDeferred(self.store.getMxids([("email", "bob@example.com")]))
+        )
+        self.assertEqual(res, [])
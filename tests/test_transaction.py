@@ -0,0 +1,143 @@
+import sqlite3
+
+from twisted.internet.testing import MemoryReactorClock
+from twisted.trial import unittest
+
+from sydent.config import SydentConfig
+from sydent.db.engines import Sqlite3Engine
+
+
+class TransactionalConnectionTestCase(unittest.TestCase):
+    """Tests for units of work and group commit."""
+
+    def setUp(self):
+        db_path = self.mktemp() + ".db"
+        config = SydentConfig()
+        config.parse_config_dict({"db": {"db.file": db_path}})
+
+        self.db = Sqlite3Engine(config.database).connect()
+        self.db.execute("CREATE TABLE things (name TEXT)")
+        self.db.commit()
+        self.addCleanup(self.db.close)
+
+        # A second connection, to check what has actually been committed.
+        self.other_db = sqlite3.connect(db_path)
+        self.addCleanup(self.other_db.close)
+
+    def _committed_names(self):
+        cur = self.other_db.execute("SELECT name FROM things ORDER BY name")
+        return [row[0] for row in cur.fetchall()]
+
+    def _insert(self, name):
+        self.db.execute("INSERT INTO things (name) VALUES (?)", (name,))
+        self.db.commit()
+
+    def test_unit_of_work_commits_once(self):
+        """Commits inside a unit of work are deferred until the unit exits."""
+        with self.db.unit_of_work():
+            self._insert("apple")
+            self._insert("banana")
+            self.assertEqual(self._committed_names(), [])
+
+        self.assertEqual(self._committed_names(), ["apple", "banana"])
+
+    def test_unit_of_work_rolls_back_on_failure(self):
+        """A unit of work which raises has all of its changes rolled back."""
+        with self.assertRaises(RuntimeError):
+            with self.db.unit_of_work():
+                self._insert("apple")
+                with self.db.unit_of_work():
+                    self._insert("banana")
+                raise RuntimeError("oh no")
+
+        self.assertFalse(self.db.in_transaction)
+        self.assertEqual(self._committed_names(), [])
+
+    def test_call_after_commit(self):
+        """Callbacks run once their unit of work has committed, and are dropped if it
+        is rolled back.
+        """
+        calls = []
+        with self.db.unit_of_work():
+            self._insert("apple")
+            self.db.call_after_commit(lambda: calls.append("apple"))
+            self.assertEqual(calls, [])
+        self.assertEqual(calls, ["apple"])
+
+        with self.db.unit_of_work():
+            self._insert("banana")
+            self.db.call_after_commit(lambda: calls.append("banana"))
+            self.db.rollback()
+
+        with self.assertRaises(RuntimeError):
+            with self.db.unit_of_work():
+                self.db.call_after_commit(lambda: calls.append("cherry"))
+                raise RuntimeError("oh no")
+
+        self.db.call_after_commit(lambda: calls.append("date"))
+        self.assertEqual(calls, ["apple", "date"])
+
+    def test_call_after_commit_outside_unit_of_work(self):
+        """Callbacks registered outside of a unit of work wait for the changes made
+        so far to be committed, and are dropped if they are rolled back.
+        """
+        calls = []
+        self.db.execute("INSERT INTO things (name) VALUES ('apple')")
+        self.db.call_after_commit(lambda: calls.append("apple"))
+        self.assertEqual(calls, [])
+        self.db.commit()
+        self.assertEqual(calls, ["apple"])
+
+        self.db.execute("INSERT INTO things (name) VALUES ('banana')")
+        self.db.call_after_commit(lambda: calls.append("banana"))
+        self.db.rollback()
+        self.db.commit()
+        self.assertEqual(calls, ["apple"])
+
+    def test_group_commit(self):
+        """In group commit mode, commits only happen at the end of the reactor tick,
+        and rolling back a unit of work doesn't affect other pending changes.
+        """
+        clock = MemoryReactorClock()
+        self.db.enable_group_commit(clock)
+
+        self._insert("apple")
+        with self.db.unit_of_work():
+            self._insert("banana")
+        with self.db.unit_of_work():
+            self._insert("cherry")
+            self.db.rollback()
+
+        self.assertEqual(self._committed_names(), [])
+
+        clock.advance(0)
+        self.assertEqual(self._committed_names(), ["apple", "banana"])
+        self.assertFalse(self.db.in_transaction)
+
+    def test_flush(self):
+        """Flushing commits pending changes straight away."""
+        clock = MemoryReactorClock()
+        self.db.enable_group_commit(clock)
+
+        self._insert("apple")
+        self.db.flush()
+
+        self.assertEqual(self._committed_names(), ["apple"])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_call_after_commit_with_group_commit(self):
+        """In group commit mode, callbacks run once the group commit has happened."""
+        clock = MemoryReactorClock()
+        self.db.enable_group_commit(clock)
+
+        calls = []
+        with self.db.unit_of_work():
+            self._insert("apple")
+            self.db.call_after_commit(lambda: calls.append("apple"))
+        self._insert("banana")
+        self.db.call_after_commit(lambda: calls.append("banana"))
+        self.assertEqual(calls, [])
+
+        clock.advance(0)
+        self.assertEqual(self._committed_names(), ["apple", "banana"])
+        self.assertEqual(calls, ["apple", "banana"])
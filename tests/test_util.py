@@ -1,6 +1,11 @@
+from twisted.internet import defer
 from twisted.trial import unittest
 
+from sydent.util.bloomfilter import BloomFilter
+from sydent.util.lrucache import LruCache
+from sydent.util.singleflight import SingleFlight
 from sydent.util.stringutils import is_valid_matrix_server_name
+from sydent.util.ttlcache import Sentinel
 
 
 class UtilTests(unittest.TestCase):
@@ -36,3 +41,76 @@ class UtilTests(unittest.TestCase):
         self.assertFalse(is_valid_matrix_server_name("example.com: 4242"))
         self.assertFalse(is_valid_matrix_server_name("example.com/example.com"))
         self.assertFalse(is_valid_matrix_server_name("example.com#example.com"))
+
+    def test_bloom_filter(self):
+        """Tests that a Bloom filter contains everything added to it, and has about
+        the false positive rate it was sized for.
+        """
+        bloom_filter = BloomFilter(10000, 0.01)
+        for i in range(10000):
+            bloom_filter.add("in %d" % (i,))
+
+        self.assertEqual(len(bloom_filter), 10000)
+        for i in range(10000):
+            self.assertIn("in %d" % (i,), bloom_filter)
+
+        false_positives = sum("out %d" % (i,) in bloom_filter for i in range(10000))
+        self.assertLess(false_positives, 200)
+
+    def test_lru_cache(self):
+        """Tests that the LRU cache evicts the least recently used entries, and
+        doesn't cache values fetched before it was invalidated.
+        """
+        cache = LruCache("test", 2)
+        cache.set_many([("a", 1), ("b", 2)], cache.version)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set_many([("c", 3)], cache.version)
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get("b"), Sentinel.token)
+        self.assertEqual(cache.get("c"), 3)
+
+        version = cache.version
+        cache.invalidate(["a"])
+        self.assertIs(cache.get("a"), Sentinel.token)
+        cache.set_many([("a", 1)], version)
+        self.assertIs(cache.get("a"), Sentinel.token)
+
+    def test_single_flight(self):
+        """Tests that concurrent requests for the same keys share the fetches in
+        flight, and only fetch the keys nobody else is fetching.
+        """
+        single_flight = SingleFlight("test")
+        fetches = []
+
+        def fetch(keys):
+            d = defer.Deferred()
+            fetches.append((keys, d))
+            return d
+
+        first = defer.ensureDeferred(single_flight.get_many(["a", "b"], fetch))
+        second = defer.ensureDeferred(single_flight.get_many(["b", "c", "c"], fetch))
+        self.assertEqual([keys for keys, _ in fetches], [["a", "b"], ["c"]])
+
+        # Keys which have no value are shared too.
+        fetches[0][1].callback({"a": 1})
+        self.assertEqual(self.successResultOf(first), {"a": 1})
+        self.assertNoResult(second)
+        fetches[1][1].callback({"c": 3})
+        self.assertEqual(self.successResultOf(second), {"c": 3})
+
+        # Once a fetch has finished, it isn't shared any more.
+        third = defer.ensureDeferred(single_flight.get_many(["a"], fetch))
+        self.assertEqual(len(fetches), 3)
+
+        # Nor once it's been forgotten.
+        single_flight.forget(["a"])
+        fourth = defer.ensureDeferred(single_flight.get_many(["a"], fetch))
+        self.assertEqual(len(fetches), 4)
+
+        # Failures are shared with the requests waiting for the fetch.
+        fifth = defer.ensureDeferred(single_flight.get_many(["a"], fetch))
+        fetches[3][1].errback(ValueError())
+        self.failureResultOf(fourth, ValueError)
+        self.failureResultOf(fifth, ValueError)
+        fetches[2][1].callback({"a": 1})
+        self.assertEqual(self.successResultOf(third), {"a": 1})
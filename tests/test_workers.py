@@ -0,0 +1,137 @@
+# Copyright 2025 New Vector Ltd.
+#
+# SPDX-License-Identifier: AGPL-3.0-only OR LicenseRef-Element-Commercial
+# Please see LICENSE files in the repository root for full details.
+
+import socket
+from unittest.mock import patch
+
+from twisted.internet.address import UNIXAddress
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web.server import Request
+
+from sydent.config.exceptions import ConfigError
+from sydent.sydent import parse_worker_args
+from sydent.workers import ForwardedRequest, WorkerOptions
+from tests.utils import FakeChannel, make_request, make_sydent
+
+WRITER_SOCKET = "/run/sydent/writer.sock"
+
+
+class WorkersTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.sydent = make_sydent(
+            worker=WorkerOptions(
+                index=0,
+                listen_fd=3,
+                listen_family=socket.AF_INET,
+                writer_socket=WRITER_SOCKET,
+            )
+        )
+        self.site = self.sydent.clientApiHttpServer.factory
+
+    def test_serve_lookups(self) -> None:
+        """Tests that workers serve the read-only endpoints themselves."""
+        _, channel = make_request(self.sydent.reactor, self.site, "GET", "terms")
+        self.assertEqual(channel.code, 200)
+
+        _, channel = make_request(
+            self.sydent.reactor, self.site, "GET", "pubkey/ed25519:0"
+        )
+        self.assertEqual(channel.code, 200)
+
+        self.assertEqual(self.sydent.reactor.unixClients, [])
+
+    def test_forward_writes(self) -> None:
+        """Tests that workers forward the endpoints which write to the database to the
+        writer, along with the client's IP address.
+        """
+        _, channel = make_request(
+            self.sydent.reactor,
+            self.site,
+            "POST",
+            "account/register",
+            {"access_token": "foo", "matrix_server_name": "example.com"},
+        )
+        self.assertNotIn("code", channel.result)
+
+        self.assertEqual(len(self.sydent.reactor.unixClients), 1)
+        path, factory = self.sydent.reactor.unixClients[0][:2]
+        self.assertEqual(path, WRITER_SOCKET)
+        self.assertEqual(factory.command, b"POST")
+        self.assertEqual(factory.rest, b"/_matrix/identity/v2/account/register")
+        self.assertEqual(factory.headers[b"x-forwarded-for"], b"127.0.0.1")
+
+        # If the writer can't be reached, the client should be told to try again.
+        factory.clientConnectionFailed(None, Failure(ConnectionRefusedError()))
+        self.assertEqual(channel.code, 503)
+        self.assertEqual(channel.json_body["errcode"], "M_UNKNOWN")
+
+    def test_forward_terms_acceptance(self) -> None:
+        """Tests that workers serve the terms, but forward accepting them."""
+        make_request(
+            self.sydent.reactor, self.site, "POST", "terms", {"user_accepts": []}
+        )
+        self.assertEqual(len(self.sydent.reactor.unixClients), 1)
+
+
+class WriterTestCase(unittest.TestCase):
+    def test_ip_from_forwarded_request(self) -> None:
+        """Tests that the writer trusts the client IP address given by workers, and
+        only them.
+        """
+        sydent = make_sydent()
+        site = sydent.clientApiHttpServer.factory
+        request = Request(FakeChannel(site, sydent.reactor))
+        request.requestHeaders.addRawHeader(b"X-Forwarded-For", b"10.0.0.1")
+        self.assertEqual(sydent.ip_from_request(request), "127.0.0.1")
+
+        # Other clients connecting over UNIX sockets aren't trusted either.
+        request.getClientAddress = lambda: UNIXAddress(b"/run/sydent/other.sock")  # type: ignore[method-assign]
+        self.assertIsNone(sydent.ip_from_request(request))
+
+        request = ForwardedRequest(FakeChannel(site, sydent.reactor))
+        request.requestHeaders.addRawHeader(b"X-Forwarded-For", b"10.0.0.1")
+        self.assertEqual(sydent.ip_from_request(request), "10.0.0.1")
+
+    def test_parse_worker_args(self) -> None:
+        """Tests that the worker options are read from the command line, and that
+        other arguments are ignored.
+        """
+        with patch("sys.argv", ["sydent", "--unknown", "-h"]):
+            self.assertIsNone(parse_worker_args())
+
+        argv = [
+            "sydent",
+            "--worker-index",
+            "1",
+            "--worker-listen-fd",
+            "3",
+            "--worker-listen-family",
+            str(int(socket.AF_INET)),
+            "--worker-writer-socket",
+            WRITER_SOCKET,
+        ]
+        with patch("sys.argv", argv):
+            self.assertEqual(
+                parse_worker_args(),
+                WorkerOptions(
+                    index=1,
+                    listen_fd=3,
+                    listen_family=int(socket.AF_INET),
+                    writer_socket=WRITER_SOCKET,
+                ),
+            )
+
+    def test_in_memory_database(self) -> None:
+        """Tests that Sydent refuses to start workers which couldn't share the
+        database.
+        """
+        with self.assertRaises(ConfigError):
+            make_sydent(
+                {
+                    "db": {"db.engine": "sqlite", "db.file": ":memory:"},
+                    "http": {"clientapi.http.workers": "2"},
+                }
+            )
@@ -10,13 +10,14 @@ import twisted.logger
 from OpenSSL import crypto
 from twisted.internet import address
 from twisted.internet._resolver import SimpleResolverComplexifier
-from twisted.internet.defer import fail, succeed
+from twisted.internet.defer import ensureDeferred, fail, succeed
 from twisted.internet.error import DNSLookupError
 from twisted.internet.interfaces import (
     IHostnameResolver,
     IReactorPluggableNameResolver,
     IResolverSimple,
 )
+from twisted.python.failure import Failure
 from twisted.test.proto_helpers import MemoryReactorClock
 from twisted.web.http import unquote
 from twisted.web.http_headers import Headers
@@ -25,6 +26,7 @@ from zope.interface import implementer
 
 from sydent.config import SydentConfig
 from sydent.sydent import Sydent
+from sydent.workers import WorkerOptions
 
 # Expires on Jan 11 2030 at 17:53:40 GMT
 FAKE_SERVER_CERT_PEM = """
@@ -53,20 +55,76 @@ tWVEpHfT+G7AjA8=
 """
 
 
-def make_sydent(test_config: Optional[dict] = None) -> Sydent:
+# Set SYDENT_POSTGRES to run the tests against PostgreSQL rather than SQLite. The
+# connection parameters are read from SYDENT_POSTGRES_HOST, SYDENT_POSTGRES_PORT,
+# SYDENT_POSTGRES_USER and SYDENT_POSTGRES_PASSWORD, and the user must be allowed to
+# create databases.
+USE_POSTGRES_FOR_TESTS = bool(os.environ.get("SYDENT_POSTGRES"))
+
+_postgres_test_database_count = 0
+
+
+def _create_postgres_test_database() -> str:
+    """Create a new, empty PostgreSQL database for a test, replacing any left over
+    by a previous run.
+
+    :return: The name of the database.
+    """
+    import psycopg2
+
+    global _postgres_test_database_count
+    _postgres_test_database_count += 1
+    name = "sydent_test_%d" % (_postgres_test_database_count,)
+
+    args = {
+        option: os.environ["SYDENT_POSTGRES_" + option.upper()]
+        for option in ("host", "port", "user", "password")
+        if os.environ.get("SYDENT_POSTGRES_" + option.upper())
+    }
+    conn = psycopg2.connect(database="postgres", **args)
+    # CREATE DATABASE can't be run inside a transaction.
+    conn.autocommit = True
+    cur = conn.cursor()
+    # FORCE disconnects any connections left open by a previous run.
+    cur.execute("DROP DATABASE IF EXISTS %s WITH (FORCE)" % (name,))
+    cur.execute("CREATE DATABASE %s ENCODING 'UTF8' TEMPLATE template0" % (name,))
+    conn.close()
+
+    return name
+
+
+def make_sydent(
+    test_config: Optional[dict] = None, worker: Optional[WorkerOptions] = None
+) -> Sydent:
     """Create a new sydent
 
     Args:
         test_config: Configuration variables for overriding the default sydent
             config
+        worker: The options of the worker process to create, if it should be one
     """
     if test_config is None:
         test_config = {}
 
-    # Use an in-memory SQLite database. Note that the database isn't cleaned up between
-    # tests, so by default the same database will be used for each test if changed to be
-    # a file on disk.
-    test_config.setdefault("db", {}).setdefault("db.file", ":memory:")
+    if USE_POSTGRES_FOR_TESTS:
+        # Use a new, empty PostgreSQL database.
+        db_config = test_config.setdefault("db", {})
+        db_config.setdefault("db.engine", "postgres")
+        db_config.setdefault("db.postgres.database", _create_postgres_test_database())
+        # The tests run on a fake reactor, which can't receive results from the
+        # database pools' threads, so run every interaction on the main connection.
+        db_config.setdefault("db.pool.size", "0")
+        db_config.setdefault("db.lookup_pool.size", "0")
+        for option in ("host", "port", "user", "password"):
+            db_config.setdefault(
+                "db.postgres." + option,
+                os.environ.get("SYDENT_POSTGRES_" + option.upper(), ""),
+            )
+    else:
+        # Use an in-memory SQLite database. Note that the database isn't cleaned up
+        # between tests, so by default the same database will be used for each test if
+        # changed to be a file on disk.
+        test_config.setdefault("db", {}).setdefault("db.file", ":memory:")
 
     # Specify a server name to avoid warnings.
     general_config = test_config.setdefault("general", {})
@@ -87,12 +145,22 @@ def make_sydent(test_config: Optional[dict] = None) -> Sydent:
     sydent_config = SydentConfig()
     sydent_config.parse_config_dict(test_config)
 
-    return Sydent(
+    sydent = Sydent(
         reactor=reactor,
         sydent_config=sydent_config,
         use_tls_for_federation=False,
+        worker=worker,
     )
 
+    # Finish the background updates scheduled when creating the database, which would
+    # otherwise only run once the (fake) reactor runs.
+    d = ensureDeferred(sydent.background_updater.run_updates(sleep=False))
+    assert d.called, "Background updates didn't run synchronously"
+    if isinstance(d.result, Failure):
+        d.result.raiseException()
+
+    return sydent
+
 
 @attr.s
 class FakeChannel: